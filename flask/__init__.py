@@ -3,7 +3,6 @@ from flask import Flask, session, send_from_directory, g
 from flask_login import LoginManager
 from datetime import timedelta
 from werkzeug.security import check_password_hash
-import logging
 from .auth import authenticate_user
 
 # 设置登录管理器
@@ -21,12 +20,9 @@ def create_app():
         DATABASE=os.path.join(app.root_path, 'chat_system.sqlite'),  # 数据库路径
     )
     
-    # 配置日志记录
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format='[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
+    # 配置日志记录：经有界队列异步输出，不再把所有日志器都设为DEBUG（utils/logs.py）
+    from .utils.logs import log_pipeline
+    log_pipeline.init_app(app)
     
     # 注册登录管理器
     login_manager.init_app(app)
@@ -5,6 +5,7 @@ And register each blueprint module
 """
 import sys
 import os
+import logging
 
 # Add current directory to system path
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
@@ -26,12 +27,31 @@ from flask_talisman import Talisman
 from config import config
 
 # Import utils module functions
-from utils.db import get_db_connection, init_app as init_db
+from utils.db import get_db_connection, init_app as init_db, add_write_observer
+from utils.rate_limit import admission_controller
+from utils.user_cache import user_cache
+from utils.bootstrap import bootstrap_cache
+from utils.password_pool import password_pool
+from utils.key_directory import key_directory_cache
+from utils.channel_keys import key_presence_cache
+from utils.key_reconcile import key_reconciler
+from utils.rotation_jobs import rotation_dispatcher
+from utils.rotation_scheduler import rotation_scheduler
+from utils.upload_sessions import upload_janitor
+from utils.previews import preview_pipeline, ready_preview_cache
+from utils.blob_store import alias_cache
+from utils.upload_gc import upload_collector
+from utils import assets, blob_store
+from utils.compression import response_compressor
+from utils.metrics import metrics
+from utils.logs import log_pipeline, get_logger
 from utils.errors import register_error_handlers
 
 # Import blueprints
 from blueprints.resources import resources_bp
 from blueprints.uploads import uploads_bp
+from blueprints.assets import assets_bp
+from blueprints.metrics import metrics_bp
 from blueprints.auth import auth_bp, load_user
 from blueprints.main import main_bp
 from blueprints.chat import chat_bp
@@ -50,7 +70,11 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1, x_port=1, x_prefix=1,
 # Load configuration based on environment variable
 env = os.environ.get('FLASK_ENV', 'default')
 app.config.from_object(config[env])
-print(f"Loading configuration: {env}")
+
+# Structured logs through a bounded queue, levels per subsystem from LOG_LEVELS (utils/logs.py)
+log_pipeline.init_app(app)
+log = get_logger('app')
+log.info('config_loaded', env=env)
 
 # Ensure uploads directory exists
 uploads_path = os.path.join(app.static_folder, app.config['UPLOAD_FOLDER'].split('/')[-1])
@@ -65,6 +89,10 @@ csrf = CSRFProtect(app)
 # Initialize database connection
 init_db(app)
 
+# Feed DB write latency into the socket admission controller
+admission_controller.init_app(app)
+add_write_observer(admission_controller.record_write)
+
 # Register error handlers
 register_error_handlers(app)
 
@@ -84,16 +112,82 @@ else:
              session_cookie_secure=False,  # 开发环境允许HTTP使用session
              content_security_policy=None)  # Disable CSP to avoid conflicts with existing JavaScript
 
+# Socket.IO message queue for multi-worker fan-out
+socketio_queue_options = {}
+message_queue = app.config.get('SOCKETIO_MESSAGE_QUEUE')
+if message_queue:
+    if message_queue.startswith('broker://'):
+        # 内置代理，无需Redis
+        from utils.socketio_broker import BrokerClientManager
+        socketio_queue_options['client_manager'] = BrokerClientManager(
+            message_queue, channel=app.config['SOCKETIO_CHANNEL'],
+            secret=app.config.get('SOCKETIO_BROKER_SECRET'))
+    else:
+        socketio_queue_options['message_queue'] = message_queue
+        socketio_queue_options['channel'] = app.config['SOCKETIO_CHANNEL']
+    log.info('socketio_message_queue', backend=message_queue.split('://')[0])
+
 # Initialize Socket.IO
 socketio = SocketIO(
-    app, 
+    app,
     cors_allowed_origins="*",  # Allow all origins
     manage_session=False,      # Don't manage sessions
-    logger=True,               # Enable logging
-    engineio_logger=True,      # Enable Engine.IO logging
+    # Levels come from LOG_LEVELS; passing loggers keeps them from adding their own stderr handlers
+    logger=logging.getLogger('socketio.server'),
+    engineio_logger=logging.getLogger('engineio.server'),
     async_mode='gevent',       # 使用gevent模式替代eventlet
-    monkey_patching=True       # 启用monkey patching以避免线程问题
+    monkey_patching=True,      # 启用monkey patching以避免线程问题
+    **socketio_queue_options
 )
+# REST handlers emit through current_app.socketio
+app.socketio = socketio
+
+# Channel-key presence cache and background key reconciliation (utils/channel_keys.py, utils/key_reconcile.py)
+key_presence_cache.configure(ttl=app.config['CHANNEL_KEY_STATE_TTL'])
+key_reconciler.init_app(app, socketio)
+
+# Server-orchestrated key rotation jobs; resumes unfinished jobs after a restart (utils/rotation_jobs.py)
+rotation_dispatcher.init_app(app, socketio)
+rotation_dispatcher.start()
+
+# Periodic rotation for channels with channel_encryption.key_rotation_frequency set (utils/rotation_scheduler.py)
+rotation_scheduler.init_app(app, socketio)
+rotation_scheduler.start()
+
+# Expire abandoned chunked uploads and their temp files (utils/upload_sessions.py)
+upload_janitor.init_app(app, socketio)
+upload_janitor.start()
+
+# Thumbnails/previews for uploaded images in a process pool, off the request path (utils/previews.py)
+preview_pipeline.init_app(app, socketio)
+preview_pipeline.start()
+
+# Incremental GC of unreferenced uploads: quarantine, then delete; also `flask gc-uploads [--dry-run]` (utils/upload_gc.py)
+upload_collector.init_app(app, socketio)
+upload_collector.start()
+
+# Fingerprinted CSS/JS bundles: asset_url() in templates, `flask assets build` (utils/assets.py)
+assets.init_app(app)
+
+# Prometheus metrics at /metrics: HTTP/socket latency, emit fan-out, DB time, cache stats (utils/metrics.py)
+metrics.init_app(app, socketio)
+for subsystem, stats in (('user_cache', user_cache.stats), ('bootstrap_cache', bootstrap_cache.stats),
+                         ('key_directory_cache', key_directory_cache.stats),
+                         ('key_presence_cache', key_presence_cache.stats), ('alias_cache', alias_cache.stats),
+                         ('ready_preview_cache', ready_preview_cache.stats), ('blob_store', blob_store.stats),
+                         ('password_pool', password_pool.stats), ('admission', admission_controller.stats),
+                         ('key_reconciler', key_reconciler.stats), ('rotation_dispatcher', rotation_dispatcher.stats),
+                         ('rotation_scheduler', rotation_scheduler.stats), ('upload_janitor', upload_janitor.stats),
+                         ('preview_pipeline', preview_pipeline.stats), ('upload_collector', upload_collector.stats),
+                         ('response_compressor', response_compressor.stats), ('logging', log_pipeline.stats)):
+    metrics.add_stats(subsystem, stats)
+
+# gzip/brotli for large JSON API responses, compressed in chunks with cooperative yields (utils/compression.py)
+response_compressor.init_app(app, socketio)
+
+# Filename -> blob lookups for serving uploads (utils/blob_store.py)
+alias_cache.configure(ttl=app.config['UPLOAD_ALIAS_CACHE_TTL'])
+ready_preview_cache.configure(ttl=app.config['UPLOAD_ALIAS_CACHE_TTL'])
 
 # Initialize LoginManager
 login_manager = LoginManager()
@@ -129,21 +223,31 @@ def add_security_headers(response):
     return response
 
 # Register user loader function
+# Users are served from a TTL + LRU cache (utils/user_cache.py)
+user_cache.configure(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+
+# Per-user initial state for /chat (utils/bootstrap.py)
+bootstrap_cache.configure(maxsize=app.config['BOOTSTRAP_CACHE_SIZE'], ttl=app.config['BOOTSTRAP_CACHE_TTL'])
+
+# Public-key directory cache (utils/key_directory.py)
+key_directory_cache.configure(ttl=app.config['KEY_DIRECTORY_CACHE_TTL'])
+
+# bcrypt runs in a bounded native thread pool (utils/password_pool.py)
+password_pool.configure(size=app.config['PASSWORD_POOL_SIZE'],
+                        max_queue=app.config['PASSWORD_POOL_MAX_QUEUE'],
+                        rounds=app.config['BCRYPT_ROUNDS'])
+
 @login_manager.user_loader
 def user_loader(user_id):
-    print(f"Loading user: id={user_id}")
-    user = load_user(user_id)
-    if user:
-        print(f"User loaded: {user}")
-    else:
-        print(f"User load failed: id={user_id}")
-    return user
+    return load_user(user_id)
 
 # Register blueprints
 app.register_blueprint(main_bp)  # Main blueprint remains at root, no prefix needed
 app.register_blueprint(auth_bp, url_prefix='/auth')  # Authentication routes
 app.register_blueprint(resources_bp)
 app.register_blueprint(uploads_bp)
+app.register_blueprint(assets_bp)  # /assets/<bundle>
+app.register_blueprint(metrics_bp)  # /metrics (loopback or METRICS_TOKEN)
 app.register_blueprint(chat_bp)
 app.register_blueprint(crypto_bp)  # 注册加密蓝图
 
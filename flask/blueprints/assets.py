@@ -0,0 +1,56 @@
+from flask import Blueprint, request, current_app, send_file, abort, make_response
+import os
+from werkzeug.utils import safe_join
+from utils import assets
+
+# Create blueprint
+assets_bp = Blueprint('assets', __name__)
+
+# Precompressed siblings written by `flask assets build`, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+def _send_built(filename):
+    """Send a fingerprinted bundle, picking a precompressed sibling the client accepts"""
+    path = safe_join(current_app.static_folder, assets.DIST_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    mimetype = assets.MIMETYPES.get(assets.bundle_type(filename), 'application/octet-stream')
+
+    encoding = None
+    for name, suffix in ENCODINGS:
+        if request.accept_encodings.quality(name) > 0 and os.path.isfile(path + suffix):
+            encoding, path = name, path + suffix
+            break
+
+    # The name changes whenever the content does, so the file can be cached forever
+    max_age = current_app.config.get('ASSETS_CACHE_MAX_AGE', 365 * 24 * 3600)
+    response = send_file(path, mimetype=mimetype, conditional=True, max_age=max_age,
+                         etag=f"{filename}-{encoding or 'identity'}")
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+def _send_unbuilt(name):
+    """Concatenate a bundle on the fly when `flask assets build` has not been run (development)"""
+    try:
+        body = assets.bundle_source(current_app.static_folder, name, current_app.static_url_path)
+    except ValueError as e:
+        current_app.logger.error(f"Failed to bundle {name}: {str(e)}")
+        abort(500)
+    response = make_response(body)
+    response.mimetype = assets.MIMETYPES[assets.bundle_type(name)]
+    response.headers['Cache-Control'] = 'no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+@assets_bp.route('/assets/<path:filename>')
+def asset(filename):
+    """Serve a CSS/JS bundle referenced by asset_url() in templates"""
+    if assets.built_file(filename):
+        return _send_built(filename)
+    if filename in assets.BUNDLES:
+        return _send_unbuilt(filename)
+    abort(404)
@@ -4,14 +4,18 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 import os
 import re
-import bcrypt
 
 from utils.db import get_db_connection
 from utils.crypto import validate_public_key
 from models.user import User
+from utils.user_cache import user_cache, invalidate_user
+from utils import key_directory
+from utils.password_pool import password_pool, PasswordPoolBusy
+from utils.logs import get_logger
 
 # Create blueprint
 auth_bp = Blueprint('auth', __name__)
+log = get_logger('auth')
 
 # Route: Login
 @auth_bp.route('/login', methods=['GET', 'POST'])
@@ -19,7 +23,6 @@ def login():
     """Handle user login requests"""
     # Check current login status
     if current_user.is_authenticated:
-        print(f"User already logged in: {current_user}")
         return redirect(url_for('chat.index'))
     
     error = None
@@ -29,8 +32,6 @@ def login():
         password = request.form.get('password')
         remember = 'remember' in request.form
         
-        print(f"Login attempt: username={username}, remember={remember}")
-        
         # Validate form data
         if not username or not password:
             error = 'Username and password are required'
@@ -44,12 +45,15 @@ def login():
         
         if user:
             user_id = user['user_id']
-            print(f"User found: id={user_id}, username={user['username']}")
+            # Verify password using bcrypt (runs in the password thread pool)
+            try:
+                password_ok = password_pool.check_password(password, user['password_hash'])
+            except PasswordPoolBusy:
+                conn.close()
+                flash('Server is busy, please try again in a moment')
+                return render_template('login.html'), 503
             
-            # Verify password using bcrypt
-            if bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8')):
-                print(f"Password verification passed")
-                
+            if password_ok:
                 # Create user object
                 user_obj = User(
                     id=user_id,
@@ -71,12 +75,12 @@ def login():
                 session.clear()
                 
                 # Login user
-                print(f"Calling login_user function: user_id={user_id}, remember={remember}")
                 login_success = login_user(user_obj, remember=remember)
                 
                 # Add user session data
                 session['user_id'] = user_id
                 session['username'] = user['username']
+                log.info('login', user_id=user_id, remember=remember)
                 
                 # Check redirect target
                 next_page = request.args.get('next')
@@ -86,10 +90,10 @@ def login():
                     return redirect(url_for('chat.index'))
             else:
                 error = 'Incorrect password'
-                print(f"Password verification failed: {error}")
+                log.info('login_failed', user_id=user_id, reason='password')
         else:
             error = 'User does not exist'
-            print(f"Login failed: {error}")
+            log.info('login_failed', reason='unknown_user')
         
         conn.close()
         flash(error)
@@ -180,9 +184,13 @@ def register():
             return render_template('register.html')
         
         # Create new user - using bcrypt with salt for password hashing
-        # 生成随机盐值并对密码进行哈希
-        salt = bcrypt.gensalt(rounds=12)  # 推荐使用12轮加密，提供足够的安全性
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+        # 在密码哈希线程池中生成哈希，轮数由 BCRYPT_ROUNDS 配置（默认12轮）
+        try:
+            password_hash = password_pool.hash_password(password)
+        except PasswordPoolBusy:
+            conn.close()
+            flash('Server is busy, please try again in a moment')
+            return render_template('register.html'), 503
         
         conn.execute('INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
                     (username, email, password_hash))
@@ -209,9 +217,8 @@ def register():
                     (user_id, mock_public_key)
                 )
                 conn.commit()
-                print(f"已为新用户 {username} (ID={user_id}) 创建加密密钥")
         except Exception as e:
-            print(f"为新用户创建密钥时出错: {str(e)}")
+            log.warning('register_key_failed', user_id=user_id, error=str(e))
         
         # Add user to public chat room
         default_room = conn.execute('SELECT room_id FROM rooms WHERE room_name = ?', ('Public Chat Room',)).fetchone()
@@ -246,12 +253,8 @@ def register():
 def logout():
     """Simplified user logout handling"""
     # Get current user info for logging
-    username = current_user.username if current_user.is_authenticated else 'Unknown'
     user_id = current_user.id if current_user.is_authenticated else None
     
-    # Print log
-    print(f"User logout: id={user_id}, username={username}")
-    
     # Update user status in database
     if user_id:
         try:
@@ -259,9 +262,8 @@ def logout():
             conn.execute('UPDATE users SET is_active = 0 WHERE user_id = ?', (user_id,))
             conn.commit()
             conn.close()
-            print(f"Updated user status: offline")
         except Exception as e:
-            print(f"Failed to update user status: {str(e)}")
+            log.error('logout_status_failed', user_id=user_id, error=str(e))
     
     # Use Flask-Login's logout_user function
     logout_user()
@@ -270,7 +272,7 @@ def logout():
     session.clear()
     
     # Log the event
-    print(f"User {username} has logged out")
+    log.info('logout', user_id=user_id)
     
     # Redirect to homepage
     flash('You have been successfully logged out')
@@ -333,14 +335,19 @@ def load_user(user_id):
         # Ensure user_id is an integer
         user_id = int(user_id)
         
+        # Serve from the user cache when possible
+        user = user_cache.get(user_id)
+        if user is not None:
+            return user
+        
         # Load user data from database
         conn = get_db_connection()
         user_data = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
         conn.close()
         
         if user_data:
-            # Create and return user object
-            return User(
+            # Create a read-only user object and cache it
+            user = User(
                 id=user_data['user_id'],
                 username=user_data['username'],
                 email=user_data['email'],
@@ -349,9 +356,11 @@ def load_user(user_id):
                 avatar_url=user_data['avatar_url'],
                 public_key=user_data['public_key'] if 'public_key' in user_data else None,
                 key_updated_at=user_data['key_updated_at'] if 'key_updated_at' in user_data else None
-            )
+            ).freeze()
+            user_cache.set(user_id, user)
+            return user
     except Exception as e:
-        print(f"Error loading user: {e}")
+        log.error('load_user_failed', user_id=user_id, error=str(e))
     
     return None
 
@@ -388,6 +397,8 @@ def upload_pubkey():
         )
         conn.commit()
         conn.close()
+        invalidate_user(current_user.id)
+        key_directory.invalidate(current_user.id)
         
         return jsonify({
             'success': True,
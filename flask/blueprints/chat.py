@@ -5,16 +5,24 @@
 from flask import Blueprint, render_template, redirect, url_for, request, jsonify, current_app
 from flask_login import login_required, current_user
 from utils.db import get_db_connection
+from utils.user_cache import bump_user_version
+from utils.channel_keys import get_active_key_version, store_key_shares, activate_key_version, invalidate_channel
+from utils import kdm, rotation_jobs, ciphertext, previews, file_catalog, bootstrap, dm_index
+from utils.rotation_jobs import rotation_dispatcher
+from utils.rotation_scheduler import get_schedule as get_rotation_schedule
+from utils.logs import get_logger
 import json
 from datetime import datetime
 
+log = get_logger('keys')
+
 # 从socket_events.py导入加密处理函数
 try:
     from socket_events import process_channel_key
 except ImportError:
     # 如果无法导入，提供一个简单的填充函数
     def process_channel_key(conn, channel_id, user_id, username):
-        print(f"无法从socket_events导入process_channel_key，跳过密钥处理")
+        log.warning('process_channel_key_unavailable', channel_id=channel_id, user_id=user_id)
         return False
 
 # 创建蓝图
@@ -24,83 +32,25 @@ chat_bp = Blueprint('chat', __name__)
 @chat_bp.route('/chat')
 @login_required
 def index():
-    conn = get_db_connection()
-    
-    # 获取用户所在的聊天室
-    rooms_data = conn.execute('''\
-        SELECT r.room_id, r.room_name, r.description, r.is_private
-        FROM rooms r
-        JOIN user_rooms ur ON r.room_id = ur.room_id
-        WHERE ur.user_id = ?
-    ''', (current_user.id,)).fetchall()
-    
-    # 将SQLite的Row对象转换为字典列表
-    rooms_list = []
-    for room in rooms_data:
-        rooms_list.append({
-            'room_id': room['room_id'],
-            'room_name': room['room_name'],
-            'description': room['description'],
-            'is_private': bool(room['is_private'])
-        })
-    
-    # 获取每个聊天室下的频道
-    channels_data = {}
-    active_channel = None
-    
-    for room in rooms_list:
-        room_id = room['room_id']
-        channels = conn.execute('''\
-            SELECT channel_id, channel_name, description
-            FROM channels
-            WHERE room_id = ?
-        ''', (room_id,)).fetchall()
-        
-        # 将SQLite的Row对象转换为字典列表
-        channels_list = []
-        for channel in channels:
-            channel_dict = {
-                'channel_id': channel['channel_id'],
-                'channel_name': channel['channel_name'],
-                'description': channel['description']
-            }
-            channels_list.append(channel_dict)
-            
-            # 设置第一个频道为活跃频道
-            if active_channel is None and len(channels_list) > 0:
-                active_channel = channel_dict
-        
-        channels_data[room_id] = channels_list
-    
-    # 获取直接消息联系人
-    direct_messages = conn.execute('''\
-        SELECT u.user_id, u.username, u.avatar_url, 
-               u.is_active AS is_online
-        FROM users u
-        WHERE u.user_id != ?
-        ORDER BY is_online DESC, u.username
-    ''', (current_user.id,)).fetchall()
-    
-    # 将SQLite的Row对象转换为字典列表
-    direct_messages_list = []
-    for dm in direct_messages:
-        direct_messages_list.append({
-            'user_id': dm['user_id'],
-            'username': dm['username'],
-            'avatar_url': dm['avatar_url'],
-            'is_online': bool(dm['is_online'])
-        })
-    
-    # 关闭数据库连接
-    conn.close()
-    
-    # 渲染聊天页面，传递数据
+    # 初始状态由固定数量的集合查询构建并按用户缓存（utils/bootstrap.py）
+    state = bootstrap.get_state(int(current_user.id),
+                                conversation_limit=current_app.config.get('BOOTSTRAP_CONVERSATION_LIMIT', 30),
+                                contact_limit=current_app.config.get('BOOTSTRAP_CONTACT_LIMIT', 50))
+
+    # 模板按聊天室分组渲染频道
+    channels_data = {room['room_id']: [] for room in state['rooms']}
+    for channel in state['channels']:
+        channels_data[channel['room_id']].append(channel)
+    active_channel = state['channels'][0] if state['channels'] else None
+
+    # 渲染聊天页面，前端用到的部分嵌入页面（window.CHAT_BOOTSTRAP）
     return render_template('chat.html', 
                           current_user=current_user, 
-                          rooms=rooms_list, 
+                          rooms=state['rooms'], 
                           channels=channels_data,
                           active_channel=active_channel,
-                          direct_messages=direct_messages_list)
+                          direct_messages=state['conversations'] + state['contacts'],
+                          bootstrap=bootstrap.client_state(state))
 
 # 添加一个简单聊天路由
 @chat_bp.route('/simple_chat')
@@ -174,6 +124,7 @@ def get_channel_messages(channel_id):
         # 构建查询
         query = '''
             SELECT m.message_id, m.channel_id, m.user_id, m.content, 
+                  m.ciphertext, m.cipher_nonce, m.cipher_key_version, m.cipher_envelope,
                   m.message_type, m.created_at, m.updated_at, 
                   m.is_deleted, m.parent_id,
                   u.username, u.avatar_url, u.is_active
@@ -195,6 +146,9 @@ def get_channel_messages(channel_id):
         
         messages = conn.execute(query, params).fetchall()
         
+        # 消息中引用的上传文件的缩略图信息，一次查询取出
+        attachments = previews.attachment_map(conn, [msg['content'] for msg in messages])
+        
         # 转换为列表并反转，以获得按时间正序排列的消息
         messages_list = []
         for msg in messages:
@@ -207,12 +161,13 @@ def get_channel_messages(channel_id):
                     'avatar_url': msg['avatar_url'],
                     'is_online': bool(msg['is_active'])
                 },
-                'content': msg['content'],
+                'content': ciphertext.message_content(msg),
                 'message_type': msg['message_type'],
                 'created_at': msg['created_at'],
                 'updated_at': msg['updated_at'],
                 'is_deleted': bool(msg['is_deleted']),
-                'parent_id': msg['parent_id']
+                'parent_id': msg['parent_id'],
+                'attachments': previews.message_attachments(msg['content'], attachments)
             })
         
         # 反转列表以获得正序排列
@@ -272,10 +227,11 @@ def pin_message_api():
                 sender_id, created_at
             ) VALUES (?, ?, ?, ?, ?, ?)
         ''', (
-            message_id, channel_id, current_user.id, message['content'],
+            message_id, channel_id, current_user.id, ciphertext.message_content(message),
             message['user_id'], message['created_at']
         ))
         conn.commit()
+        bootstrap.bootstrap_cache.invalidate_all()  # 固定消息数
         
         return jsonify({
             'success': True, 
@@ -320,6 +276,7 @@ def unpin_message_api():
         conn.execute('DELETE FROM pinned_messages WHERE message_id = ? AND channel_id = ?', 
                  (message_id, channel_id))
         conn.commit()
+        bootstrap.bootstrap_cache.invalidate_all()  # 固定消息数
         
         return jsonify({
             'success': True, 
@@ -445,24 +402,23 @@ def send_message():
             conn.close()
             return jsonify({'success': False, 'message': '您在此频道已被静音，无法发送消息'}), 403
         
-        # 创建消息 (修改SQL以保存加密状态)
+        # 创建消息 (修改SQL以保存加密状态，二进制存储时加密信封拆分为BLOB列)
+        stored = ciphertext.message_storage(
+            content, is_encrypted, current_app.config.get('CIPHERTEXT_BINARY_STORAGE', False))
         cursor = conn.execute('''
-            INSERT INTO messages (channel_id, user_id, content, message_type, parent_id, is_encrypted)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (channel_id, current_user.id, content, message_type, parent_id, 1 if is_encrypted else 0))
+            INSERT INTO messages (channel_id, user_id, content, message_type, parent_id, is_encrypted,
+                                  ciphertext, cipher_nonce, cipher_key_version, cipher_envelope)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (channel_id, current_user.id, stored[0], message_type, parent_id, 1 if is_encrypted else 0,
+              *stored[1:]))
         
         message_id = cursor.lastrowid
+        # 关联消息中引用的、发送者上传到该频道的文件
+        file_catalog.link_message(conn, message_id, channel_id, current_user.id, content, data.get('file_ids'))
         conn.commit()
         
-        # 检查频道是否启用了加密，无论消息是否加密
-        channel_encrypted = conn.execute('''
-            SELECT is_encrypted FROM channels WHERE channel_id = ?
-        ''', (channel_id,)).fetchone()
-        
-        # 如果频道启用了加密，处理sender_key
-        if channel_encrypted and channel_encrypted['is_encrypted'] == 1:
-            print(f"频道 {channel_id} 启用了加密，处理sender_key")
-            process_channel_key(conn, channel_id, current_user.id, current_user.username)
+        # 无论消息是否加密，确认加密频道中发送者有密钥记录（未加密频道直接返回）
+        process_channel_key(conn, channel_id, current_user.id, current_user.username)
         
         # 记录消息发送日志
         conn.execute('''
@@ -664,6 +620,7 @@ def update_channel_description():
         
         conn.commit()
         conn.close()
+        bootstrap.bootstrap_cache.invalidate_all()
         
         return jsonify({
             'success': True, 
@@ -1153,13 +1110,13 @@ def get_saved_items():
         query += " LIMIT ? OFFSET ?"
         params.extend([limit, offset])
         
-        current_app.logger.info(f"执行查询: {query} 参数: {params}")
+        current_app.logger.debug("执行查询: %s 参数: %s", query, params)
         saved_items = conn.execute(query, params).fetchall()
         
         # 在记录转换前检查一下第一条记录的实际列
         if saved_items and len(saved_items) > 0:
             first_item = saved_items[0]
-            current_app.logger.info(f"第一条记录的列: {dict(first_item).keys()}")
+            current_app.logger.debug("第一条记录的列: %s", list(first_item.keys()))
         
         # 转换为字典列表
         items_list = []
@@ -1307,6 +1264,7 @@ def create_group():
                     ''', (user_id, channel_id))
         
         conn.commit()
+        bootstrap.bootstrap_cache.invalidate(*member_ids)
         
         # 获取创建的聊天室信息
         room = conn.execute('SELECT * FROM rooms WHERE room_id = ?', (room_id,)).fetchone()
@@ -1430,6 +1388,53 @@ def get_users():
     
     return jsonify({'users': users_list})
 
+# 私信会话列表（分页）
+@chat_bp.route('/api/direct_messages/conversations', methods=['GET'])
+@login_required
+def list_dm_conversations():
+    """按最后一条私信倒序分页列出当前用户的私信会话（?before_id=N&limit=30）"""
+    conn = get_db_connection()
+    try:
+        rows, next_before_id = dm_index.list_conversations(
+            conn, current_user.id, before_id=request.args.get('before_id', type=int),
+            limit=request.args.get('limit', dm_index.DEFAULT_PAGE_SIZE, type=int))
+        return jsonify({
+            'success': True,
+            'conversations': [dm_index.conversation_info(row) for row in rows],
+            'next_before_id': next_before_id
+        })
+    except Exception as e:
+        current_app.logger.error(f"获取私信会话列表错误: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'message': '获取私信会话列表失败'}), 500
+    finally:
+        conn.close()
+
+# 搜索用户（发起新会话、@提及）
+@chat_bp.route('/api/search_users', methods=['GET'])
+@login_required
+def search_users():
+    """按用户名前缀搜索用户（?query=ab&limit=20）"""
+    query = request.args.get('query') or request.args.get('q') or ''
+    conn = get_db_connection()
+    try:
+        rows = dm_index.search_users(conn, current_user.id, query,
+                                     limit=request.args.get('limit', dm_index.DEFAULT_SEARCH_LIMIT, type=int))
+        return jsonify({
+            'success': True,
+            'users': [{
+                'user_id': row['user_id'],
+                'username': row['username'],
+                'avatar_url': row['avatar_url'],
+                'is_online': bool(row['is_active']),
+                'has_conversation': bool(row['has_conversation'])
+            } for row in rows]
+        })
+    except Exception as e:
+        current_app.logger.error(f"搜索用户错误: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'message': '搜索用户失败'}), 500
+    finally:
+        conn.close()
+
 # 获取历史私聊消息
 @chat_bp.route('/api/direct_messages/<int:user_id>')
 @login_required
@@ -1465,11 +1470,9 @@ def get_direct_messages(user_id):
                 'sender_id': msg['sender_id'],
                 'recipient_id': msg['recipient_id'],
                 'content': msg['content'],
-                'encrypted_content': msg['encrypted_content'] if is_encrypted else None,
-                'iv': msg['iv'] if is_encrypted else None,
-                # 添加为自己加密的数据
-                'encrypted_for_self': msg['encrypted_for_self'] if (is_encrypted and is_outgoing) else None,
-                'iv_for_self': msg['iv_for_self'] if (is_encrypted and is_outgoing) else None,
+                # 密文统一以base64返回（数据库中可能是BLOB）；为自己加密的数据只返回给发送者
+                **(ciphertext.dm_fields(msg, False, include_self=is_outgoing) if is_encrypted
+                   else dict.fromkeys(ciphertext.DM_CIPHER_FIELDS)),
                 'is_encrypted': is_encrypted,
                 'message_type': msg['message_type'],
                 'created_at': msg['created_at'],
@@ -1488,7 +1491,9 @@ def get_direct_messages(user_id):
             SET read_at = CURRENT_TIMESTAMP
             WHERE recipient_id = ? AND sender_id = ? AND read_at IS NULL
         ''', (current_user.id, user_id))
+        dm_index.refresh_unread(conn, current_user.id, [user_id])
         conn.commit()
+        bootstrap.bootstrap_cache.invalidate(current_user.id)
         
         # 获取用户信息
         user = conn.execute('SELECT user_id, username, avatar_url, is_active FROM users WHERE user_id = ?', 
@@ -1571,13 +1576,7 @@ def send_direct_message():
         if encrypted_content and 'channel_id' in data:
             channel_id = data.get('channel_id')
             if channel_id:
-                print(f"加密私信涉及频道 {channel_id}，检查是否需要保存sender_key")
-                channel_encrypted = conn.execute('''
-                    SELECT is_encrypted FROM channels WHERE channel_id = ?
-                ''', (channel_id,)).fetchone()
-                
-                if channel_encrypted and channel_encrypted['is_encrypted'] == 1:
-                    process_channel_key(conn, channel_id, current_user.id, current_user.username)
+                process_channel_key(conn, channel_id, current_user.id, current_user.username)
         
         # 构建消息
         is_encrypted = encrypted_content is not None and iv is not None
@@ -1586,6 +1585,7 @@ def send_direct_message():
         actual_content = None if is_encrypted else content
         
         # 创建消息 - 添加encrypted_for_self和iv_for_self字段到插入语句
+        binary_storage = current_app.config.get('CIPHERTEXT_BINARY_STORAGE', False)
         cursor = conn.execute('''
             INSERT INTO direct_messages (
                 sender_id, recipient_id, content, 
@@ -1596,13 +1596,17 @@ def send_direct_message():
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
             current_user.id, recipient_id, actual_content, 
-            encrypted_content, iv, 
-            encrypted_for_self, iv_for_self, 
+            ciphertext.storage_value(encrypted_content, binary_storage),
+            ciphertext.storage_value(iv, binary_storage),
+            ciphertext.storage_value(encrypted_for_self, binary_storage),
+            ciphertext.storage_value(iv_for_self, binary_storage),
             message_type
         ))
         
         message_id = cursor.lastrowid
+        dm_index.record_message(conn, message_id, current_user.id, recipient['user_id'])
         conn.commit()
+        bootstrap.bootstrap_cache.invalidate(current_user.id, recipient_id)
         
         # 获取创建的消息
         message = conn.execute('SELECT * FROM direct_messages WHERE dm_id = ?', (message_id,)).fetchone()
@@ -1613,10 +1617,7 @@ def send_direct_message():
             'sender_id': message['sender_id'],
             'recipient_id': message['recipient_id'],
             'content': message['content'],
-            'encrypted_content': message['encrypted_content'],
-            'iv': message['iv'],
-            'encrypted_for_self': message['encrypted_for_self'],
-            'iv_for_self': message['iv_for_self'],
+            **ciphertext.dm_fields(message, False),
             'is_encrypted': is_encrypted,
             'message_type': message['message_type'],
             'created_at': message['created_at'],
@@ -1665,7 +1666,9 @@ def mark_message_read(message_id):
             UPDATE direct_messages SET read_at = CURRENT_TIMESTAMP
             WHERE dm_id = ? AND recipient_id = ?
         ''', (message_id, current_user.id))
+        dm_index.refresh_unread(conn, current_user.id, [message['sender_id']])
         conn.commit()
+        bootstrap.bootstrap_cache.invalidate(current_user.id)
         
         conn.close()
         
@@ -1731,11 +1734,9 @@ def get_latest_direct_messages():
                 'sender_id': msg['sender_id'],
                 'recipient_id': msg['recipient_id'],
                 'content': msg['content'],
-                'encrypted_content': msg['encrypted_content'] if is_encrypted else None,
-                'iv': msg['iv'] if is_encrypted else None,
-                # 添加为自己加密的数据
-                'encrypted_for_self': msg['encrypted_for_self'] if (is_encrypted and is_outgoing) else None,
-                'iv_for_self': msg['iv_for_self'] if (is_encrypted and is_outgoing) else None,
+                # 密文统一以base64返回（数据库中可能是BLOB）；为自己加密的数据只返回给发送者
+                **(ciphertext.dm_fields(msg, False, include_self=is_outgoing) if is_encrypted
+                   else dict.fromkeys(ciphertext.DM_CIPHER_FIELDS)),
                 'is_encrypted': is_encrypted,
                 'message_type': msg['message_type'],
                 'created_at': msg['created_at'],
@@ -1752,7 +1753,9 @@ def get_latest_direct_messages():
                     SET read_at = CURRENT_TIMESTAMP
                     WHERE dm_id = ? AND read_at IS NULL
                 ''', (msg['id'],))
+            dm_index.refresh_unread(conn, current_user.id, [msg['sender_id'] for msg in unread_messages])
             conn.commit()
+            bootstrap.bootstrap_cache.invalidate(current_user.id)
         
         conn.close()
         
@@ -1831,6 +1834,8 @@ def add_channel_member():
             INSERT INTO user_channels (channel_id, user_id, joined_at)
             VALUES (?, ?, CURRENT_TIMESTAMP)
         ''', (channel_id, user_id))
+        # 成员关系变化，已连接的Socket会话在下一个事件时重新验证
+        bump_user_version(user_id)
         
         # 记录添加成员的操作日志
         conn.execute('''
@@ -1870,8 +1875,12 @@ def add_channel_member():
                 f"用户 {target_user['username']} 已加入频道，需要请求加密密钥。",
                 'system'
             ))
+            
+            # 正在进行的密钥轮换也需要投递给新成员
+            rotation_jobs.add_member(conn, channel_id, user_id)
         
         conn.commit()
+        bootstrap.bootstrap_cache.invalidate(user_id)
         
         # 通过WebSocket通知其他成员有新用户加入
         if 'socketio' in globals() or hasattr(current_app, 'socketio'):
@@ -1982,6 +1991,7 @@ def remove_channel_member():
         # 从频道中移除用户
         conn.execute('DELETE FROM user_channels WHERE channel_id = ? AND user_id = ?', 
                     (channel_id, user_id))
+        bump_user_version(user_id)
         
         # 记录移除操作
         conn.execute('''
@@ -2001,34 +2011,12 @@ def remove_channel_member():
         # 检查频道是否启用了加密
         is_encrypted = ('is_encrypted' in channel.keys() and channel['is_encrypted'] == 1)
         
-        # 如果频道启用了加密，需要处理密钥轮换
+        # 如果频道启用了加密，创建密钥轮换任务，由后台调度器分批交给在线管理员完成
+        rotation_job_id = None
         if is_encrypted:
-            # 获取当前密钥版本
-            master_key = conn.execute("""
-                SELECT key_version FROM channel_master_keys 
-                WHERE channel_id = ? AND is_active = 1
-                ORDER BY key_version DESC LIMIT 1
-            """, (channel_id,)).fetchone()
-            
-            current_key_version = 1  # 默认值
-            if master_key and master_key[0]:
-                current_key_version = master_key[0]
-            
-            # 新密钥版本
-            new_key_version = current_key_version + 1
-            
-            # 记录密钥轮换
-            conn.execute("""
-                INSERT INTO key_rotation_logs 
-                (channel_id, old_key_version, new_key_version, rotated_by, reason) 
-                VALUES (?, ?, ?, ?, ?)
-            """, (
-                channel_id,
-                current_key_version,
-                new_key_version,
-                current_user.id,
-                f"用户 {target_user['username']} 被移出频道"
-            ))
+            rotation_job_id, new_key_version = rotation_jobs.create_job(
+                conn, channel_id, current_user.id, f"用户 {target_user['username']} 被移出频道"
+            )
             
             # 创建系统消息通知其他用户密钥已轮换
             conn.execute('''
@@ -2039,32 +2027,11 @@ def remove_channel_member():
                 f"由于用户 {target_user['username']} 已被移除，频道密钥需要轮换。",
                 'system'
             ))
-            
-            # 获取所有剩余的频道成员
-            remaining_members = conn.execute('''
-                SELECT uc.user_id, u.username
-                FROM user_channels uc
-                JOIN users u ON uc.user_id = u.user_id
-                WHERE uc.channel_id = ?
-            ''', (channel_id,)).fetchall()
-            
-            # 提交数据库更改
-            conn.commit()
-            
-            # 通知密钥需要轮换
-            if 'socketio' in globals() or hasattr(current_app, 'socketio'):
-                socketio = current_app.socketio if hasattr(current_app, 'socketio') else globals().get('socketio')
-                if socketio:
-                    # 向频道管理员发送密钥轮换通知，包含所有需要接收新密钥的成员信息
-                    socketio.emit('key_rotation_needed', {
-                        'channel_id': channel_id,
-                        'new_version': new_key_version,
-                        'reason': f"用户 {target_user['username']} 被移出频道",
-                        'is_key_rotation': True,
-                        'members': [{'id': m['user_id'], 'username': m['username']} for m in remaining_members],
-                        'removed_user': {'id': user_id, 'username': target_user['username']},
-                        'timestamp': datetime.now().isoformat()
-                    }, room=f'user_{current_user.id}')
+        
+        conn.commit()
+        bootstrap.bootstrap_cache.invalidate(user_id)
+        if rotation_job_id:
+            rotation_dispatcher.kick()
         
         # 通知其他成员有用户被移除
         if 'socketio' in globals() or hasattr(current_app, 'socketio'):
@@ -2085,7 +2052,8 @@ def remove_channel_member():
             'success': True,
             'message': f"已成功将用户 {target_user['username']} 移出频道",
             'removed_member': removed_member_info,
-            'requires_key_rotation': is_encrypted
+            'requires_key_rotation': is_encrypted,
+            'rotation_job_id': rotation_job_id
         })
         
     except Exception as e:
@@ -2266,8 +2234,6 @@ def share_channel_key():
         is_key_rotation = data.get('is_key_rotation', False)
         key_version = data.get('key_version')  # 可能为密钥版本
         
-        print(f"共享密钥请求: 用户={user_id}, 频道={channel_id}, 是否密钥轮换={is_key_rotation}, 密钥版本={key_version}")
-        
         conn = get_db_connection()
         
         # 检查目标用户是否存在
@@ -2322,8 +2288,6 @@ def share_channel_key():
             # 使用请求中提供的版本号
             current_key_version = key_version
         
-        print(f"当前密钥版本: {current_key_version}")
-        
         # 记录共享操作，创建密钥共享记录
         try:
             cursor = conn.execute('''
@@ -2334,9 +2298,8 @@ def share_channel_key():
             
             share_id = cursor.lastrowid
             conn.commit()
-            print(f"创建密钥共享记录成功: ID={share_id}")
         except Exception as e:
-            print(f"创建密钥共享记录失败: {str(e)}")
+            log.warning('key_share_insert_failed', channel_id=channel_id, recipient_id=user_id, error=str(e))
             # 检查是否是nonce字段缺失导致的错误
             if "no such column: nonce" in str(e):
                 try:
@@ -2349,17 +2312,17 @@ def share_channel_key():
                     
                     share_id = cursor.lastrowid
                     conn.commit()
-                    print(f"不使用nonce字段，创建密钥共享记录成功: ID={share_id}")
                     
                     # 检查表结构并尝试添加nonce字段
                     try:
                         conn.execute("ALTER TABLE channel_key_shares ADD COLUMN nonce TEXT DEFAULT 'auto_generated'")
                         conn.commit()
-                        print("已添加nonce字段到channel_key_shares表")
+                        log.info('key_shares_nonce_column_added')
                     except Exception as alter_err:
-                        print(f"尝试添加nonce字段失败: {str(alter_err)}")
+                        log.warning('key_shares_nonce_column_failed', error=str(alter_err))
                 except Exception as insert_err:
-                    print(f"尝试不使用nonce字段插入也失败: {str(insert_err)}")
+                    log.error('key_share_insert_failed', channel_id=channel_id, recipient_id=user_id,
+                              error=str(insert_err))
             # 继续执行，主要确保用户有密钥记录
         
         # 强制写入user_channel_keys表，确保用户有密钥记录
@@ -2371,8 +2334,6 @@ def share_channel_key():
             """, (channel_id, user_id, current_key_version)).fetchone()
             
             if existing_key:
-                print(f"用户 {user_id} 已有频道 {channel_id} 版本 {current_key_version} 的密钥记录")
-                
                 # 如果是密钥轮换或明确要求更新，则更新现有记录
                 if is_key_rotation or data.get('force_update', False):
                     conn.execute("""
@@ -2381,21 +2342,17 @@ def share_channel_key():
                         WHERE channel_id = ? AND user_id = ? AND key_version = ?
                     """, (encrypted_key, channel_id, user_id, current_key_version))
                     conn.commit()
-                    print(f"已更新用户 {user_id} 的密钥记录")
             else:
                 # 没有现有记录，创建新记录
-                print(f"用户 {user_id} 没有密钥记录，创建新记录")
                 conn.execute("""
                     INSERT INTO user_channel_keys 
                     (channel_id, user_id, key_version, encrypted_key, nonce, is_active, created_at, updated_at) 
                     VALUES (?, ?, ?, ?, 'auto_generated', 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
                 """, (channel_id, user_id, current_key_version, encrypted_key))
                 conn.commit()
-                print(f"已为用户 {user_id} 创建新的密钥记录")
-        except Exception as e:
-            print(f"处理用户密钥记录失败: {str(e)}")
-            import traceback
-            traceback.print_exc()
+        except Exception:
+            log.error('user_channel_key_write_failed', channel_id=channel_id, user_id=user_id,
+                      key_version=current_key_version, exc_info=True)
             # 尝试一种更简单的方式插入/更新
             try:
                 # 先删除可能存在的记录
@@ -2411,9 +2368,9 @@ def share_channel_key():
                     VALUES (?, ?, ?, ?, 'auto_generated', 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
                 """, (channel_id, user_id, current_key_version, encrypted_key))
                 conn.commit()
-                print(f"使用替代方法成功为用户 {user_id} 创建密钥记录")
             except Exception as alt_e:
-                print(f"替代方法也失败了: {str(alt_e)}")
+                log.error('user_channel_key_replace_failed', channel_id=channel_id, user_id=user_id,
+                          error=str(alt_e))
         
         # 如果是密钥轮换，更新主密钥版本记录
         if is_key_rotation:
@@ -2440,27 +2397,38 @@ def share_channel_key():
                     """, (channel_id, current_key_version, current_user.id))
                     
                     conn.commit()
-                    print(f"更新频道 {channel_id} 的主密钥版本为 {current_key_version}")
+                    log.info('master_key_rotated', channel_id=channel_id, key_version=current_key_version)
             except Exception as e:
-                print(f"更新主密钥版本失败: {str(e)}")
+                log.error('master_key_rotate_failed', channel_id=channel_id, key_version=current_key_version,
+                          error=str(e))
         
-        # 通过WebSocket将加密的密钥发送给目标用户
-        if 'socketio' in globals() or hasattr(current_app, 'socketio'):
-            try:
-                socketio = current_app.socketio if hasattr(current_app, 'socketio') else globals().get('socketio')
-                if socketio:
-                    socketio.emit('channel_key_share', {
-                        'channel_id': channel_id,
-                        'sender_id': current_user.id,
-                        'sender_username': current_user.username,
-                        'encrypted_key': encrypted_key,
-                        'key_version': current_key_version,
-                        'is_key_rotation': is_key_rotation,
-                        'timestamp': datetime.now().isoformat()
-                    }, room=f'user_{user_id}')
-                    print(f"已通过WebSocket发送密钥通知给用户 {user_id}")
-            except Exception as e:
-                print(f"发送WebSocket通知失败: {str(e)}")
+        # 密钥记录或主密钥版本已变化，使发送路径上的密钥缓存失效
+        invalidate_channel(channel_id, None if is_key_rotation else [user_id])
+        
+        # 更新进行中的轮换任务的投递状态
+        try:
+            rotation_job_ids = rotation_jobs.record_deliveries(
+                conn, channel_id, current_key_version, [int(user_id), current_user.id])
+            conn.commit()
+            if rotation_job_ids:
+                rotation_dispatcher.kick()
+        except Exception as e:
+            current_app.logger.error(f"更新密钥轮换投递状态失败: {str(e)}", exc_info=True)
+        
+        # 写入接收者的KDM发件箱并通过WebSocket推送，离线时重连从游标补发
+        try:
+            outbox = kdm.enqueue(conn, channel_id, current_user.id, [{
+                'user_id': int(user_id),
+                'encrypted_key': encrypted_key,
+                'nonce': 'auto_generated',
+                'key_version': current_key_version
+            }], is_key_rotation)
+            conn.commit()
+            if hasattr(current_app, 'socketio'):
+                kdm.push(current_app.socketio, outbox, sender_username=current_user.username,
+                         timestamp=datetime.now().isoformat())
+        except Exception as e:
+            current_app.logger.error(f"写入KDM发件箱失败: {str(e)}", exc_info=True)
         
         # 更新任何待处理的密钥请求
         try:
@@ -2470,12 +2438,13 @@ def share_channel_key():
                 WHERE channel_id = ? AND requester_id = ? AND status = 'pending'
             ''', (channel_id, user_id))
             conn.commit()
-            print(f"已更新用户 {user_id} 的密钥请求状态")
         except Exception as e:
-            print(f"更新密钥请求状态失败: {str(e)}")
+            log.error('key_request_complete_failed', channel_id=channel_id, user_id=user_id, error=str(e))
         
         conn.close()
         
+        log.info('channel_key_shared', channel_id=channel_id, sender_id=current_user.id, recipient_id=user_id,
+                 key_version=current_key_version, rotation=bool(is_key_rotation))
         return jsonify({
             'success': True,
             'message': '频道密钥分享成功',
@@ -2484,7 +2453,194 @@ def share_channel_key():
             'is_key_rotation': is_key_rotation
         })
     except Exception as e:
-        print(f"分享频道密钥错误: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'success': False, 'message': f'分享频道密钥失败: {str(e)}'}), 500
\ No newline at end of file
+        log.error('channel_key_share_failed', exc_info=True)
+        return jsonify({'success': False, 'message': f'分享频道密钥失败: {str(e)}'}), 500
+
+# 批量分享频道密钥（密钥轮换时一次请求分发给所有成员）
+@chat_bp.route('/api/channels/share_keys', methods=['POST'])
+@login_required
+def share_channel_keys_batch():
+    """
+    批量分享频道加密密钥
+    
+    请求体:
+    {
+        "channel_id": 1,
+        "is_key_rotation": true,
+        "key_version": 3,            // 非轮换时可选，默认当前版本；轮换时必填（或由 rotation_job_id 的目标版本确定）
+        "force_update": false,       // 可选，非轮换时是否覆盖已有密钥
+        "rotation_job_id": 7,        // 可选，处理 key_rotation_needed 批次时提供
+        "shares": [{"user_id": 2, "encrypted_key": "...", "nonce": "...", "key_version": 3}, ...]
+    }
+    
+    成员关系用一次查询验证，所有记录在一个事务中写入，返回每个接收者的结果。
+    重复的user_id只处理第一条；轮换时条目的key_version必须等于目标版本；
+    不覆盖时已有相同版本密钥的接收者标记为 skipped
+    """
+    max_shares = 500
+    channel_id = None
+    try:
+        data = request.json or {}
+        channel_id = data.get('channel_id')
+        shares = data.get('shares')
+        is_key_rotation = bool(data.get('is_key_rotation', False))
+        
+        if not channel_id or not isinstance(shares, list) or not shares:
+            return jsonify({'success': False, 'message': '缺少必要参数: channel_id, shares'}), 400
+        if len(shares) > max_shares:
+            return jsonify({'success': False, 'message': f'一次最多分享{max_shares}个密钥'}), 400
+        
+        conn = get_db_connection()
+        try:
+            channel = conn.execute('SELECT 1 FROM channels WHERE channel_id = ?', (channel_id,)).fetchone()
+            if not channel:
+                return jsonify({'success': False, 'message': '频道不存在'}), 404
+            
+            # 先整理请求中的接收者，格式错误的条目直接记录失败
+            results = {}
+            invalid = []
+            candidates = []
+            seen = set()
+            for entry in shares:
+                try:
+                    recipient_id = int(entry.get('user_id'))
+                except (TypeError, ValueError, AttributeError):
+                    invalid.append({'user_id': entry.get('user_id') if isinstance(entry, dict) else None,
+                                    'success': False, 'message': '无效的user_id'})
+                    continue
+                if recipient_id in seen:
+                    # 同一接收者重复出现会写入两次密钥和发件箱记录
+                    invalid.append({'user_id': recipient_id, 'success': False, 'message': '重复的user_id'})
+                    continue
+                seen.add(recipient_id)
+                if not entry.get('encrypted_key'):
+                    results[recipient_id] = {'user_id': recipient_id, 'success': False, 'message': '缺少encrypted_key'}
+                    continue
+                candidates.append((recipient_id, entry))
+            
+            # 一次查询验证发送者和所有接收者的成员关系
+            member_ids = {current_user.id} | {rid for rid, _ in candidates}
+            placeholders = ','.join('?' * len(member_ids))
+            members = {row['user_id'] for row in conn.execute(f'''
+                SELECT user_id FROM user_channels
+                WHERE channel_id = ? AND user_id IN ({placeholders})
+            ''', (channel_id, *member_ids)).fetchall()}
+            
+            if current_user.id not in members:
+                return jsonify({'success': False, 'message': '您不是该频道成员'}), 403
+            
+            # 轮换任务被重新分配后，旧持有者生成的密钥不能再写入
+            rotation_job_id = data.get('rotation_job_id')
+            if rotation_job_id and not rotation_jobs.can_deliver(conn, rotation_job_id, current_user.id):
+                return jsonify({'success': False, 'message': '密钥轮换任务已完成或已重新分配'}), 409
+            
+            # 轮换的目标版本必须固定：分批请求各自按活跃版本+1计算会让每批都升一次版本，
+            # 成员被分到不同版本。未提供时取轮换任务的目标版本，都没有时拒绝
+            default_version = data.get('key_version')
+            if not default_version and is_key_rotation and rotation_job_id:
+                job = conn.execute('SELECT target_version FROM key_rotation_jobs WHERE job_id = ?',
+                                   (rotation_job_id,)).fetchone()
+                default_version = job['target_version'] if job else None
+            if not default_version:
+                if is_key_rotation:
+                    return jsonify({'success': False, 'message': '密钥轮换必须提供key_version'}), 400
+                default_version = get_active_key_version(conn, channel_id)
+            
+            overwrite = is_key_rotation or bool(data.get('force_update', False))
+            existing = set()
+            if not overwrite and candidates:
+                # 不覆盖时已有相同版本密钥的接收者不写入，也不报告为成功
+                existing = {(row['user_id'], str(row['key_version'])) for row in conn.execute(f'''
+                    SELECT user_id, key_version FROM user_channel_keys
+                    WHERE channel_id = ? AND user_id IN ({','.join('?' * len(candidates))})
+                ''', (channel_id, *(rid for rid, _ in candidates))).fetchall()}
+            
+            valid = []
+            for recipient_id, entry in candidates:
+                if recipient_id not in members:
+                    results[recipient_id] = {'user_id': recipient_id, 'success': False, 'message': '接收者不是该频道成员'}
+                    continue
+                if is_key_rotation and entry.get('key_version') and str(entry['key_version']) != str(default_version):
+                    results[recipient_id] = {'user_id': recipient_id, 'success': False,
+                                             'message': '密钥版本与轮换目标版本不一致'}
+                    continue
+                if (recipient_id, str(entry.get('key_version') or default_version)) in existing:
+                    results[recipient_id] = {'user_id': recipient_id, 'success': False, 'skipped': True,
+                                             'key_version': entry.get('key_version') or default_version,
+                                             'message': '已存在该版本的密钥'}
+                    continue
+                share = {
+                    'user_id': recipient_id,
+                    'encrypted_key': entry['encrypted_key'],
+                    'nonce': entry.get('nonce') or 'auto_generated',
+                    'key_version': entry.get('key_version') or default_version
+                }
+                valid.append(share)
+                results[recipient_id] = {'user_id': recipient_id, 'success': True, 'key_version': share['key_version']}
+            
+            # 所有写入在同一个事务中完成
+            if valid:
+                with conn:
+                    store_key_shares(conn, channel_id, current_user.id, valid, overwrite=overwrite)
+                    if is_key_rotation:
+                        activate_key_version(conn, channel_id, default_version, current_user.id)
+                    outbox = kdm.enqueue(conn, channel_id, current_user.id, valid, is_key_rotation)
+                    delivered = {}
+                    for share in valid:
+                        delivered.setdefault(share['key_version'], {current_user.id}).add(share['user_id'])
+                    rotation_job_ids = []
+                    for version, user_ids in delivered.items():
+                        rotation_job_ids += rotation_jobs.record_deliveries(conn, channel_id, version, user_ids)
+        finally:
+            conn.close()
+        
+        if valid and rotation_job_ids:
+            rotation_dispatcher.kick()
+        
+        # 推送给在线的接收者，离线用户重连时从游标补发
+        if valid and hasattr(current_app, 'socketio'):
+            from socket_events import user_sessions
+            online = None if current_app.config.get('SOCKETIO_MESSAGE_QUEUE') else set(user_sessions)
+            kdm.push(current_app.socketio, outbox, sender_username=current_user.username,
+                     timestamp=datetime.now().isoformat(), online=online)
+        
+        result_list = list(results.values()) + invalid
+        succeeded = sum(1 for r in result_list if r['success'])
+        return jsonify({
+            'success': succeeded > 0,
+            'message': f'成功分享 {succeeded}/{len(result_list)} 个密钥',
+            'key_version': default_version,
+            'is_key_rotation': is_key_rotation,
+            'results': result_list
+        })
+    except Exception as e:
+        log.exception('batch_share_failed', channel_id=channel_id)
+        return jsonify({'success': False, 'message': f'批量分享频道密钥失败: {str(e)}'}), 500
+
+# 查询频道最近一次密钥轮换任务的进度
+@chat_bp.route('/api/channels/<int:channel_id>/key_rotation', methods=['GET'])
+@login_required
+def get_key_rotation_status(channel_id):
+    """获取频道最近一次密钥轮换任务的进度和定期轮换周期（频道成员可见）"""
+    conn = get_db_connection()
+    try:
+        member = conn.execute('''
+            SELECT 1 FROM user_channels WHERE channel_id = ? AND user_id = ?
+        ''', (channel_id, current_user.id)).fetchone()
+        if not member:
+            return jsonify({'success': False, 'message': '您不是该频道成员'}), 403
+        
+        job = conn.execute('''
+            SELECT * FROM key_rotation_jobs WHERE channel_id = ?
+            ORDER BY job_id DESC LIMIT 1
+        ''', (channel_id,)).fetchone()
+        return jsonify({
+            'success': True,
+            'job': rotation_jobs.job_progress(job) if job else None,
+            'schedule': get_rotation_schedule(conn, channel_id)
+        })
+    except Exception as e:
+        current_app.logger.error(f"获取密钥轮换进度失败: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'message': f'获取密钥轮换进度失败: {str(e)}'}), 500
+    finally:
+        conn.close()
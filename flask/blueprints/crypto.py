@@ -8,6 +8,11 @@ from utils.db import get_db_connection
 import json
 import os
 from utils.crypto import validate_public_key, create_error_response
+from utils.user_cache import invalidate_user
+from utils import key_directory, kdm
+from utils.channel_keys import invalidate_channel
+from utils.bootstrap import bootstrap_cache
+from utils.rotation_scheduler import rotation_scheduler, set_channel_schedule, get_schedule
 
 # 创建蓝图
 crypto_bp = Blueprint('crypto', __name__)
@@ -213,9 +218,12 @@ def enable_channel_encryption(channel_id):
             'UPDATE channels SET is_encrypted = ? WHERE channel_id = ?',
             (1 if encrypted else 0, channel_id)
         )
+        set_channel_schedule(conn, channel_id, encrypted, jitter_seconds=rotation_scheduler.jitter_seconds)
         
         conn.commit()
         conn.close()
+        invalidate_channel(channel_id)
+        bootstrap_cache.invalidate_all()
         
         # 返回成功响应
         return jsonify({
@@ -242,6 +250,16 @@ def update_channel_encryption(channel_id):
         
         enable_encryption = bool(data.get('enable_encryption'))
         
+        # 可选：自动轮换周期(天)，0表示不自动轮换
+        rotation_frequency = data.get('key_rotation_frequency')
+        if rotation_frequency is not None:
+            try:
+                rotation_frequency = int(rotation_frequency)
+            except (TypeError, ValueError):
+                return create_error_response('key_rotation_frequency必须是整数(天)', 400)
+            if rotation_frequency < 0:
+                return create_error_response('key_rotation_frequency不能为负数', 400)
+        
         # 连接数据库
         conn = get_crypto_db_connection()
         
@@ -272,15 +290,21 @@ def update_channel_encryption(channel_id):
             'UPDATE channels SET is_encrypted = ? WHERE channel_id = ?',
             (1 if enable_encryption else 0, channel_id)
         )
+        set_channel_schedule(conn, channel_id, enable_encryption, rotation_frequency,
+                             jitter_seconds=rotation_scheduler.jitter_seconds)
         
         conn.commit()
+        schedule = get_schedule(conn, channel_id)
         conn.close()
+        invalidate_channel(channel_id)
+        bootstrap_cache.invalidate_all()
         
         # 返回成功响应
         return jsonify({
             'success': True,
             'message': f'频道加密已{"启用" if enable_encryption else "禁用"}',
-            'is_encrypted': enable_encryption
+            'is_encrypted': enable_encryption,
+            'rotation_schedule': schedule
         })
     
     except Exception as e:
@@ -366,6 +390,8 @@ def store_public_key():
         
         conn.commit()
         conn.close()
+        invalidate_user(current_user.id)
+        key_directory.invalidate(current_user.id)
         
         return jsonify({
             'success': True,
@@ -376,6 +402,74 @@ def store_public_key():
         current_app.logger.error(f"存储公钥失败: {str(e)}", exc_info=True)
         return create_error_response(f'存储公钥时发生错误: {str(e)}', 500)
 
+@crypto_bp.route('/api/crypto/key_directory', methods=['GET'])
+@login_required
+def get_key_directory():
+    """
+    批量获取公钥目录
+    
+    查询参数（二选一）:
+    - user_ids: 逗号分隔的用户ID列表
+    - channel_id: 返回整个频道成员的公钥（需要是频道成员）
+    
+    响应带强ETag，客户端可用 If-None-Match 发起条件请求，未变化时返回304
+    """
+    try:
+        channel_id = request.args.get('channel_id', type=int)
+        raw_ids = request.args.get('user_ids', '')
+        
+        conn = get_db_connection()
+        try:
+            if channel_id is not None:
+                member_check = conn.execute(
+                    'SELECT 1 FROM user_channels WHERE channel_id = ? AND user_id = ?',
+                    (channel_id, current_user.id)
+                ).fetchone()
+                if not member_check:
+                    return create_error_response('您不是此频道的成员', 403)
+                
+                user_ids = [row['user_id'] for row in conn.execute(
+                    'SELECT user_id FROM user_channels WHERE channel_id = ? LIMIT ?',
+                    (channel_id, key_directory.MAX_DIRECTORY_USERS)
+                ).fetchall()]
+            else:
+                try:
+                    user_ids = [int(part) for part in raw_ids.split(',') if part.strip()]
+                except ValueError:
+                    return create_error_response('user_ids格式无效', 400)
+                if not user_ids:
+                    return create_error_response('缺少user_ids或channel_id参数', 400)
+                if len(user_ids) > key_directory.MAX_DIRECTORY_USERS:
+                    return create_error_response(
+                        f'一次最多查询{key_directory.MAX_DIRECTORY_USERS}个用户', 400)
+            
+            entries = key_directory.fetch_public_keys(conn, user_ids)
+        finally:
+            conn.close()
+        
+        keys = [entries[uid] for uid in sorted(entries) if entries[uid]['public_key']]
+        missing = [uid for uid in user_ids if uid not in entries or not entries[uid]['public_key']]
+        etag = key_directory.directory_etag(keys, missing)
+        
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = jsonify({
+                'success': True,
+                'channel_id': channel_id,
+                'keys': keys,
+                'missing': missing,
+                'etag': etag
+            })
+        response.set_etag(etag)
+        # 允许缓存但每次使用前都要重新验证
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    
+    except Exception as e:
+        current_app.logger.error(f"获取公钥目录失败: {str(e)}", exc_info=True)
+        return create_error_response(f'获取公钥目录时发生错误: {str(e)}', 500)
+
 @crypto_bp.route('/api/users/<string:user_id>/public_key', methods=['GET'])
 @login_required
 def get_user_public_key(user_id):
@@ -472,6 +566,8 @@ def share_channel_key():
                 (channel_id,)
             )
             conn.commit()
+            invalidate_channel(channel_id)
+            bootstrap_cache.invalidate_all()
         
         # 检查当前用户是否是频道成员
         sender_check = conn.execute(
@@ -555,141 +651,36 @@ def share_channel_key():
 @crypto_bp.route('/api/kdm/pending', methods=['GET'])
 @login_required
 def get_pending_kdm():
-    """获取挂起的KDM密钥"""
+    """
+    获取游标之后的KDM密钥
+    
+    参数:
+    - after: 可选，客户端游标；不提供时使用服务端保存的游标
+    - channel_id: 可选，只返回该频道的密钥
+    - limit: 可选，最大条数（不超过 KDM_REPLAY_LIMIT）
+    """
     try:
-        # 获取请求参数
-        after_version = request.args.get('after', 0)
-        channel_id = request.args.get('channel_id')
-        
-        try:
-            after_version = int(after_version)
-        except (ValueError, TypeError):
-            after_version = 0
+        max_limit = current_app.config.get('KDM_REPLAY_LIMIT', kdm.DEFAULT_REPLAY_LIMIT)
+        after = request.args.get('after', type=int)
+        channel_id = request.args.get('channel_id', type=int)
+        limit = min(request.args.get('limit', max_limit, type=int), max_limit)
         
         conn = get_crypto_db_connection()
-        
-        # 检查是否存在兼容表
-        compat_exists = conn.execute(
-            "SELECT name FROM sqlite_master WHERE type='table' AND name='channel_keys_compat'"
-        ).fetchone()
-        
-        # 检查是否存在视图
-        view_exists = conn.execute(
-            "SELECT name FROM sqlite_master WHERE type='view' AND name='channel_keys_view'"
-        ).fetchone()
-        
-        # 根据存在的表结构构建查询
-        if compat_exists:
-            # 使用兼容表
-            table_name = 'channel_keys_compat'
-            id_column = 'id'
-            sender_column = 'sender_id'
-            recipient_column = 'user_id'
-            key_column = 'encrypted_key'
-            timestamp_column = 'sent_at'
-        elif view_exists:
-            # 使用视图
-            table_name = 'channel_keys_view'
-            id_column = 'id'
-            sender_column = 'sender_id'
-            recipient_column = 'user_id'
-            key_column = 'encrypted_key'
-            timestamp_column = 'sent_at'
-        else:
-            # 使用原表
-            table_name = 'channel_keys'
-            id_column = 'key_id'
-            sender_column = 'created_by'
-            recipient_column = 'user_id'  # 注意：原始表可能没有这个字段，所以下面会直接使用current_user.id
-            key_column = 'key_data'
-            timestamp_column = 'created_at'
-        
-        # 构建查询条件
-        query_conditions = []
-        query_params = []
-        
-        # 使用兼容表时，可以过滤用户ID
-        if compat_exists or view_exists:
-            query_conditions.append(f'k.{recipient_column} = ?')
-            query_params.append(current_user.id)
-        
-        # 添加版本条件
-        if after_version > 0:
-            query_conditions.append('k.version > ?')
-            query_params.append(after_version)
-        
-        # 添加频道条件（如果提供）
-        if channel_id:
-            try:
-                channel_id = int(channel_id)
-                query_conditions.append('k.channel_id = ?')
-                query_params.append(channel_id)
-            except (ValueError, TypeError):
-                pass
-        
-        # 构建完整查询
-        if compat_exists or view_exists:
-            # 使用兼容表或视图的查询
-            query = f'''
-                SELECT k.{id_column} as id, k.channel_id, k.{sender_column} as sender_id, 
-                       k.{recipient_column} as recipient_id, k.{key_column} as encrypted_key, 
-                       k.version, k.{timestamp_column} as sent_at,
-                       u.username as sender_username, c.channel_name as channel_name
-                FROM {table_name} k
-                JOIN users u ON k.{sender_column} = u.user_id
-                JOIN channels c ON k.channel_id = c.channel_id
-                {' WHERE ' + ' AND '.join(query_conditions) if query_conditions else ''}
-                ORDER BY k.version
-                LIMIT 100
-            '''
-        else:
-            # 使用原表的查询 - 注意这里直接使用current_user.id作为recipient_id
-            query = f'''
-                SELECT k.{id_column} as id, k.channel_id, k.{sender_column} as sender_id, 
-                       ? as recipient_id, k.{key_column} as encrypted_key, 
-                       k.version, k.{timestamp_column} as sent_at,
-                       u.username as sender_username, c.channel_name as channel_name
-                FROM {table_name} k
-                JOIN users u ON k.{sender_column} = u.user_id
-                JOIN channels c ON k.channel_id = c.channel_id
-                {' WHERE ' + ' AND '.join(query_conditions) if query_conditions else ''}
-                ORDER BY k.version
-                LIMIT 100
-            '''
-            # 在参数开头添加current_user.id作为recipient_id
-            query_params.insert(0, current_user.id)
-        
-        # 执行查询
-        results = conn.execute(query, query_params).fetchall()
-        
-        # 准备响应数据
-        pending_keys = []
-        latest_version = after_version
-        
-        for row in results:
-            key_data = {
-                'id': row['id'],
-                'channel_id': row['channel_id'],
-                'sender_id': row['sender_id'],
-                'sender_username': row['sender_username'],
-                'channel_name': row['channel_name'],
-                'encrypted_keys_for_me': row['encrypted_key'],
-                'version': row['version'],
-                'timestamp': row['sent_at']
-            }
-            
-            pending_keys.append(key_data)
-            
-            # 更新最新版本号
-            if row['version'] > latest_version:
-                latest_version = row['version']
-        
-        conn.close()
+        try:
+            pending_keys, cursor, has_more = kdm.replay(
+                conn, current_user.id, after=after, channel_id=channel_id, limit=max(limit, 1)
+            )
+            if cursor is None:
+                cursor = kdm.get_cursor(conn, current_user.id)
+        finally:
+            conn.close()
         
         return jsonify({
             'success': True,
             'pending_keys': pending_keys,
-            'latest_version': latest_version,
+            'latest_version': cursor,  # 兼容旧客户端，值为游标
+            'cursor': cursor,
+            'has_more': has_more,
             'count': len(pending_keys)
         })
     
@@ -704,7 +695,7 @@ def get_pending_kdm():
 @crypto_bp.route('/api/kdm/ack', methods=['POST'])
 @login_required
 def acknowledge_kdm():
-    """确认KDM密钥接收并更新最新版本号"""
+    """确认已处理到指定游标的KDM密钥，游标只会前进"""
     try:
         data = request.json
         if not data:
@@ -713,81 +704,28 @@ def acknowledge_kdm():
                 'message': '缺少必要参数'
             }), 400
         
-        # 获取必要参数
-        channel_id = data.get('channel_id')
-        version = data.get('version')
-        
-        if not channel_id or not version:
-            return jsonify({
-                'success': False,
-                'message': '缺少channel_id或version参数'
-            }), 400
-        
+        # 旧客户端使用version字段传递
+        cursor = data.get('cursor', data.get('version'))
         try:
-            version = int(version)
+            cursor = int(cursor)
         except (ValueError, TypeError):
             return jsonify({
                 'success': False,
-                'message': 'version必须是整数'
+                'message': 'cursor必须是整数'
             }), 400
         
-        # 连接数据库
         conn = get_crypto_db_connection()
-        
-        # 检查是否存在兼容表
-        compat_exists = conn.execute(
-            "SELECT name FROM sqlite_master WHERE type='table' AND name='channel_keys_compat'"
-        ).fetchone()
-        
-        # 检查是否存在视图
-        view_exists = conn.execute(
-            "SELECT name FROM sqlite_master WHERE type='view' AND name='channel_keys_view'"
-        ).fetchone()
-        
-        # 根据存在的表结构确定使用的表名
-        if compat_exists:
-            # 使用兼容表
-            table_name = 'channel_keys_compat'
-        elif view_exists:
-            # 使用视图
-            table_name = 'channel_keys_view'
-        else:
-            # 使用原表
-            table_name = 'channel_keys'
-        
-        # 检查用户设置表中是否有对应的记录
-        user_setting = conn.execute(
-            'SELECT 1 FROM user_settings WHERE user_id = ?',
-            (current_user.id,)
-        ).fetchone()
-        
-        if user_setting:
-            # 更新现有记录
-            conn.execute(
-                'UPDATE user_settings SET last_kdm_version = ? WHERE user_id = ?',
-                (version, current_user.id)
-            )
-        else:
-            # 创建新记录
-            conn.execute(
-                'INSERT INTO user_settings (user_id, last_kdm_version) VALUES (?, ?)',
-                (current_user.id, version)
-            )
-        
-        # 获取当前频道的所有已确认密钥
-        conn.execute(
-            f'''UPDATE {table_name} 
-               SET acknowledged = 1, acknowledged_at = CURRENT_TIMESTAMP
-               WHERE user_id = ? AND channel_id = ? AND version <= ?''',
-            (current_user.id, channel_id, version)
-        )
-        
-        conn.commit()
-        conn.close()
+        try:
+            kdm.ack_cursor(conn, current_user.id, cursor)
+            conn.commit()
+            stored = kdm.get_cursor(conn, current_user.id)
+        finally:
+            conn.close()
         
         return jsonify({
             'success': True,
-            'message': f'已确认接收到版本 {version} 之前的所有KDM密钥'
+            'cursor': stored,
+            'message': f'已确认接收到游标 {stored} 之前的所有KDM密钥'
         })
     
     except Exception as e:
@@ -1085,6 +1023,9 @@ def fix_public_key_format(user_id):
             fixed = True
         
         conn.close()
+        if fixed:
+            invalidate_user(user_id)
+            key_directory.invalidate(user_id)
         
         return jsonify({
             'success': True,
@@ -0,0 +1,31 @@
+from flask import Blueprint, request, current_app, abort, Response
+import hmac
+from utils.metrics import metrics, CONTENT_TYPE
+
+# Create blueprint
+metrics_bp = Blueprint('metrics', __name__)
+
+def _direct_peer():
+    """Socket peer address, or None when the request was forwarded by a proxy"""
+    if request.headers.get('X-Forwarded-For') or request.headers.get('Forwarded'):
+        return None
+    # ProxyFix rewrites REMOTE_ADDR from X-Forwarded-For; the original is the real peer
+    original = request.environ.get('werkzeug.proxy_fix.orig', {})
+    return original.get('REMOTE_ADDR', request.remote_addr)
+
+def _authorized():
+    """Direct connections from METRICS_ALLOWED_IPS may scrape; anyone else needs the METRICS_TOKEN bearer token"""
+    if _direct_peer() in current_app.config.get('METRICS_ALLOWED_IPS', ('127.0.0.1', '::1')):
+        return True
+    token = current_app.config.get('METRICS_TOKEN')
+    supplied = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(supplied.encode('utf-8'), f'Bearer {token}'.encode('utf-8'))
+
+@metrics_bp.route('/metrics')
+def scrape():
+    """Prometheus text exposition of process metrics (internal)"""
+    if not metrics.enabled or not _authorized():
+        abort(404)
+    response = Response(metrics.render(), content_type=CONTENT_TYPE)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
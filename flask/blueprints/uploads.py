@@ -1,8 +1,14 @@
-from flask import Blueprint, request, jsonify, current_app, send_from_directory, url_for, g
+from flask import Blueprint, request, jsonify, current_app, send_file, url_for, redirect, g
 from flask_login import login_required, current_user
 import os
 import uuid
-from werkzeug.utils import secure_filename
+import mimetypes
+from urllib.parse import quote
+from werkzeug.utils import secure_filename, safe_join
+from utils.db import get_db_connection
+from utils import blob_store, file_catalog, previews, upload_sessions
+from utils.previews import preview_pipeline
+from utils.upload_sessions import UploadError
 
 # Create blueprint
 uploads_bp = Blueprint('uploads', __name__)
@@ -14,6 +20,74 @@ def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def _storage_name(original_filename):
+    """Build the unique user-visible filename used in the URL; returns (filename, timestamp)"""
+    secure_name = secure_filename(original_filename)
+    timestamp = uuid.uuid4().hex
+    filename = f"{secure_name.rsplit('.', 1)[0]}_{timestamp}.{secure_name.rsplit('.', 1)[1]}" if '.' in secure_name else f"{secure_name}_{timestamp}"
+    return filename, timestamp
+
+def _upload_folder():
+    """Ensure the upload directory exists and return it"""
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    os.makedirs(upload_folder, exist_ok=True)
+    return upload_folder
+
+def _file_info(original_filename, filename, blob, timestamp):
+    """File info returned by both the single-request and the chunked upload APIs"""
+    # Extract original filename without extension as default description
+    description = original_filename.rsplit('.', 1)[0] if '.' in original_filename else original_filename
+    return {
+        'name': original_filename,
+        'path': blob['path'],
+        'url': url_for('uploads.uploaded_file', filename=filename),
+        'description': description,
+        'size': blob['size'],
+        'sha256': blob['sha256'],
+        'deduplicated': blob['deduplicated'],
+        'timestamp': timestamp,
+        **(previews.preview_urls(filename) if previews.preview_kind(filename) == 'image' else {})
+    }
+
+def _queue_preview(conn, blob, filename):
+    """Queue thumbnail/preview generation for a stored upload (off the request path)"""
+    try:
+        if previews.enqueue(conn, blob['sha256'], filename):
+            conn.commit()
+            preview_pipeline.kick()
+    except Exception as e:
+        # The upload itself succeeded; clients fall back to the original file
+        current_app.logger.error(f"Error queueing upload preview: {str(e)}", exc_info=True)
+
+def _upload_channel(conn, channel_id):
+    """Channel the upload is attached to (None for uploads outside a channel); checks access"""
+    if channel_id in (None, ''):
+        return None
+    try:
+        channel_id = int(channel_id)
+    except (TypeError, ValueError):
+        raise UploadError('Invalid channel')
+    if not file_catalog.can_access_channel(conn, current_user.id, channel_id):
+        raise UploadError('You do not have access to this channel', 403)
+    return channel_id
+
+def _record_file(conn, channel_id, blob, filename, original_filename, info):
+    """Record a channel upload in the files table and add its file_id to the response"""
+    if channel_id is None:
+        return
+    try:
+        info['file_id'] = file_catalog.record_upload(
+            conn, current_user.id, channel_id, filename, original_filename,
+            blob['storage_path'], blob['size'])
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        current_app.logger.error(f"Error recording uploaded file: {str(e)}", exc_info=True)
+
+def _upload_error(error):
+    """JSON response for an upload protocol error"""
+    return jsonify({'success': False, 'message': error.message, **error.extra}), error.status
+
 # API: Upload file
 @uploads_bp.route('/api/upload', methods=['POST'])
 @login_required
@@ -35,42 +109,250 @@ def upload_file():
             'message': 'No file selected'
         }), 400
     
-    # Securely handle filename
+    # Securely handle filename and ensure it is unique
     original_filename = file.filename
-    secure_name = secure_filename(original_filename)
+    filename, timestamp = _storage_name(original_filename)
     
-    # Ensure filename is unique
-    timestamp = uuid.uuid4().hex
-    filename = f"{secure_name.rsplit('.', 1)[0]}_{timestamp}.{secure_name.rsplit('.', 1)[1]}" if '.' in secure_name else f"{secure_name}_{timestamp}"
-    
-    # Ensure upload directory exists
-    upload_folder = current_app.config['UPLOAD_FOLDER']
-    os.makedirs(upload_folder, exist_ok=True)
-    
-    # Save file
-    file_path = os.path.join(upload_folder, filename)
-    file.save(file_path)
-    
-    # Generate file URL using new uploads route
-    file_url = url_for('uploads.uploaded_file', filename=filename)
-    
-    # Extract original filename without extension as default description
-    description = original_filename.rsplit('.', 1)[0] if '.' in original_filename else original_filename
+    conn = get_db_connection()
+    try:
+        channel_id = _upload_channel(conn, request.form.get('channel_id'))
+        
+        # Hash while spooling to a temp file, then store by content (identical files are kept once)
+        tmp_path, sha256, size = blob_store.spool_stream(file.stream, upload_sessions.tmp_folder())
+        try:
+            blob = blob_store.save(conn, _upload_folder(), tmp_path, sha256, size,
+                                   filename, original_filename, current_user.id)
+        except Exception:
+            blob_store.discard(tmp_path)
+            raise
+        _queue_preview(conn, blob, filename)
+        info = _file_info(original_filename, filename, blob, timestamp)
+        _record_file(conn, channel_id, blob, filename, original_filename, info)
+    except UploadError as e:
+        return _upload_error(e)
+    except Exception as e:
+        current_app.logger.error(f"Error storing uploaded file: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'message': 'Failed to store file'}), 500
+    finally:
+        conn.close()
     
     # Return success response with file info
     return jsonify({
         'success': True,
         'message': 'File uploaded successfully',
-        'file': {
-            'name': original_filename,
-            'path': file_path,
-            'url': file_url,
-            'description': description,
-            'size': os.path.getsize(file_path),
-            'timestamp': timestamp
-        }
+        'file': info
+    })
+
+# API: Resumable chunked upload
+# 1. POST /api/uploads                      {filename, size, checksum?, chunk_size?} -> upload_id, chunk_size
+# 2. PUT  /api/uploads/<id>?offset=N        raw chunk body, optional X-Chunk-SHA256 header
+# 3. GET  /api/uploads/<id>                 current offset, used to resume after a failure
+# 4. POST /api/uploads/<id>/finalize        {channel_id?}, same response as /api/upload
+@uploads_bp.route('/api/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    """Start a resumable chunked upload"""
+    data = request.get_json(silent=True) or {}
+    filename = (data.get('filename') or '').strip()
+    if not filename:
+        return jsonify({'success': False, 'message': 'No file selected'}), 400
+    
+    conn = get_db_connection()
+    try:
+        session = upload_sessions.create_session(
+            conn, current_user.id, filename, data.get('size'),
+            checksum=data.get('checksum'), chunk_size=data.get('chunk_size'))
+        return jsonify({'success': True, 'upload': upload_sessions.session_info(session)}), 201
+    except UploadError as e:
+        return _upload_error(e)
+    except Exception as e:
+        current_app.logger.error(f"Error creating upload session: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'message': 'Failed to create upload'}), 500
+    finally:
+        conn.close()
+
+@uploads_bp.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def get_upload(upload_id):
+    """Get the received offset of a chunked upload"""
+    conn = get_db_connection()
+    try:
+        session = upload_sessions.get_session(conn, upload_id, current_user.id)
+        return jsonify({'success': True, 'upload': upload_sessions.session_info(session)})
+    except UploadError as e:
+        return _upload_error(e)
+    finally:
+        conn.close()
+
+@uploads_bp.route('/api/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def put_upload_chunk(upload_id):
+    """Append one chunk, streamed from the request body straight to disk"""
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify({'success': False, 'message': 'Missing offset'}), 400
+    
+    conn = get_db_connection()
+    try:
+        session = upload_sessions.write_chunk(
+            conn, upload_id, current_user.id, offset, request.content_length,
+            request.stream, request.headers.get('X-Chunk-SHA256'))
+        return jsonify({'success': True, 'upload': upload_sessions.session_info(session)})
+    except UploadError as e:
+        return _upload_error(e)
+    except Exception as e:
+        current_app.logger.error(f"Error writing upload chunk: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'message': 'Failed to write chunk'}), 500
+    finally:
+        conn.close()
+
+@uploads_bp.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(upload_id):
+    """Verify a completed chunked upload and move it into the blob store"""
+    data = request.get_json(silent=True) or {}
+    conn = get_db_connection()
+    try:
+        channel_id = _upload_channel(conn, data.get('channel_id'))
+        session = upload_sessions.get_session(conn, upload_id, current_user.id)
+        original_filename = session['filename']
+        filename, timestamp = _storage_name(original_filename)
+        blob = upload_sessions.finalize(conn, upload_id, current_user.id, filename)
+        _queue_preview(conn, blob, filename)
+        info = _file_info(original_filename, filename, blob, timestamp)
+        _record_file(conn, channel_id, blob, filename, original_filename, info)
+        return jsonify({
+            'success': True,
+            'message': 'File uploaded successfully',
+            'file': info
+        })
+    except UploadError as e:
+        return _upload_error(e)
+    except Exception as e:
+        current_app.logger.error(f"Error finalizing upload: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'message': 'Failed to finalize upload'}), 500
+    finally:
+        conn.close()
+
+@uploads_bp.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def abort_upload(upload_id):
+    """Cancel a chunked upload and discard the received data"""
+    conn = get_db_connection()
+    try:
+        upload_sessions.abort(conn, upload_id, current_user.id)
+        return jsonify({'success': True, 'message': 'Upload cancelled'})
+    except UploadError as e:
+        return _upload_error(e)
+    finally:
+        conn.close()
+
+def _file_list_response(conn, **filters):
+    """Paginated file listing (?type=image&before_id=N&limit=50)"""
+    file_type = request.args.get('type')
+    if file_type and file_type not in file_catalog.FILE_TYPES and file_type != 'other':
+        return jsonify({'success': False, 'message': 'Invalid file type'}), 400
+    rows, next_before_id = file_catalog.list_files(
+        conn, file_type=file_type, before_id=request.args.get('before_id', type=int),
+        limit=request.args.get('limit', file_catalog.DEFAULT_PAGE_SIZE, type=int), **filters)
+    return jsonify({
+        'success': True,
+        'files': [file_catalog.file_info(row) for row in rows],
+        'next_before_id': next_before_id
     })
 
+# API: Attachments sent in a channel
+@uploads_bp.route('/api/channels/<int:channel_id>/files', methods=['GET'])
+@login_required
+def list_channel_files(channel_id):
+    """List files attached to messages in a channel, newest first"""
+    conn = get_db_connection()
+    try:
+        if not file_catalog.can_access_channel(conn, current_user.id, channel_id):
+            return jsonify({'success': False, 'message': 'You do not have access to this channel'}), 403
+        return _file_list_response(conn, channel_id=channel_id)
+    except Exception as e:
+        current_app.logger.error(f"Error listing channel files: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'message': 'Failed to list files'}), 500
+    finally:
+        conn.close()
+
+# API: Files uploaded by the current user
+@uploads_bp.route('/api/files', methods=['GET'])
+@login_required
+def list_my_files():
+    """List files uploaded by the current user, newest first"""
+    conn = get_db_connection()
+    try:
+        return _file_list_response(conn, user_id=current_user.id)
+    except Exception as e:
+        current_app.logger.error(f"Error listing user files: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'message': 'Failed to list files'}), 500
+    finally:
+        conn.close()
+
+def _send_upload(relative_path, download_name, etag=None, immutable=False):
+    """
+    Send a file from the upload folder with conditional/range support
+    
+    Parameters:
+    -----------
+    relative_path: str
+        Path below UPLOAD_FOLDER ('/' separated)
+    download_name: str
+        User-visible filename, used for the content type and Content-Disposition
+    etag: str
+        Strong ETag (the content hash for blob-backed files); None derives one from mtime and size
+    immutable: bool
+        The URL always returns the same bytes, so it may be cached for a long time
+    """
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    path = safe_join(upload_folder, *relative_path.split('/'))
+    if path is None or not os.path.isfile(path):
+        return "File not found", 404
+    
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    max_age = current_app.config['UPLOAD_CACHE_MAX_AGE'] if immutable else current_app.config['UPLOAD_LEGACY_CACHE_MAX_AGE']
+    
+    accel_prefix = current_app.config.get('UPLOAD_ACCEL_REDIRECT_PREFIX')
+    if accel_prefix:
+        # nginx serves the bytes (including ranges) from an internal location mapped to UPLOAD_FOLDER;
+        # validators are still checked here so a 304 never reaches the proxy
+        stat = os.stat(path)
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{quote(relative_path)}"
+        response.headers['Content-Disposition'] = f"inline; filename*=UTF-8''{quote(download_name)}"
+        response.set_etag(etag or f"{int(stat.st_mtime)}-{stat.st_size}")
+        response.last_modified = int(stat.st_mtime)
+        response.cache_control.max_age = max_age
+        response.cache_control.public = True
+        response = response.make_conditional(request)
+    else:
+        # Werkzeug handles If-None-Match/If-Modified-Since (304) and Range (206);
+        # with USE_X_SENDFILE the body is replaced by an X-Sendfile header
+        response = send_file(path, mimetype=mimetype, download_name=download_name,
+                             etag=etag or True, max_age=max_age, conditional=True)
+        response.cache_control.public = True
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+@uploads_bp.route('/thumbnails/<variant>/<path:filename>')
+def uploaded_preview(variant, filename):
+    """Serve a generated thumbnail/preview, or redirect to the original until it is ready"""
+    if variant not in previews.VARIANTS:
+        return "File not found", 404
+    preview = previews.cached_ready_preview(filename)
+    path = preview[f'{variant}_path'] if preview else None
+    if not path:
+        response = redirect(url_for('uploads.uploaded_file', filename=filename))
+        # The same URL serves the thumbnail once it exists
+        response.cache_control.no_cache = True
+        return response
+    ext = path.rsplit('.', 1)[1]
+    return _send_upload(path, f"{filename.rsplit('.', 1)[0]}_{variant}.{ext}",
+                        etag=f"{preview['sha256']}-{variant}-{ext}", immutable=True)
+
 @uploads_bp.route('/uploads/<path:filename>')
 def uploaded_file(filename):
     """
@@ -84,21 +366,17 @@ def uploaded_file(filename):
     Returns:
     --------
     file: bytes
-        The requested file
+        The requested file (206 for ranges, 304 when the client copy is current)
     """
     try:
-        # Get absolute path for the file
-        upload_folder = current_app.config['UPLOAD_FOLDER']
-        file_path = os.path.join(upload_folder, filename)
-        
-        # Check if file exists and is within the uploads directory
-        abs_path = os.path.abspath(file_path)
-        uploads_abs_path = os.path.abspath(upload_folder)
-        
-        if not abs_path.startswith(uploads_abs_path) or not os.path.isfile(abs_path):
-            return "File not found", 404
+        # Content-addressed uploads: the filename is an alias for a shared blob whose
+        # bytes never change, so the content hash is a strong ETag
+        blob = blob_store.cached_resolve(get_db_connection, filename)
+        if blob:
+            return _send_upload(blob['storage_path'], filename, etag=blob['sha256'], immutable=True)
         
-        return send_from_directory(upload_folder, filename)
+        # Files saved before the blob store existed
+        return _send_upload(filename, filename)
     except Exception as e:
         current_app.logger.error(f"Error accessing uploaded file: {str(e)}", exc_info=True)
-        return "File does not exist or is not accessible", 404 
\ No newline at end of file
+        return "File does not exist or is not accessible", 404
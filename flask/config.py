@@ -10,12 +10,64 @@ class Config:
     """Base configuration, applicable to all environments"""
     # Application settings
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev_key_for_testing'
-    DATABASE = 'chat_system.sqlite'
+    DATABASE = os.environ.get('DATABASE') or 'chat_system.sqlite'
     UPLOAD_FOLDER = os.path.join('static', 'uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
+    UPLOAD_TMP_FOLDER = 'upload_tmp'  # 分片上传的临时文件目录（不在static下，未完成的文件不可访问）
+    UPLOAD_MAX_FILE_SIZE = 1024 * 1024 * 1024  # 分片上传的单文件上限(1GB)，每个请求仍受MAX_CONTENT_LENGTH限制
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 分片大小上限(8MB)
+    UPLOAD_SESSION_TTL = 24 * 3600  # 上传会话在最后一个分片之后保留的时间(秒)
+    UPLOAD_MAX_ACTIVE_SESSIONS = 10  # 每个用户同时进行的分片上传数
+    UPLOAD_CLEANUP_INTERVAL = 600  # 清理过期上传会话的间隔(秒)
+    UPLOAD_QUARANTINE_FOLDER = 'upload_quarantine'  # 未被引用的上传内容在删除前的隔离目录（不在static下，不可访问）
+    UPLOAD_GC_INTERVAL = 3600  # 回收未被引用的上传文件的间隔(秒)
+    UPLOAD_GC_BATCH_SIZE = 200  # 每轮回收中每个阶段最多处理的条目数
+    UPLOAD_GC_GRACE_PERIOD = 7 * 24 * 3600  # 上传后未发送或不再被引用多久之后移入隔离目录(秒)
+    UPLOAD_GC_QUARANTINE_PERIOD = 7 * 24 * 3600  # 在隔离目录中保留多久之后删除(秒)
+    UPLOAD_GC_PAUSE = 0.5  # 回收各阶段之间的暂停(秒)，避免持续占用数据库和磁盘
+    UPLOAD_GC_DRY_RUN = os.environ.get('UPLOAD_GC_DRY_RUN') == '1'  # 只记录将要回收的文件，不做修改
+    THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 2))  # 生成缩略图的进程数
+    THUMBNAIL_BATCH_SIZE = 8  # 每轮交给进程池的文件数
+    THUMBNAIL_INTERVAL = 30  # 检查未完成预览的间隔(秒)，有新上传时会立即处理
+    THUMBNAIL_SIZE = 320  # 缩略图最长边(像素)
+    THUMBNAIL_PREVIEW_SIZE = 1280  # 预览图最长边(像素)
+    THUMBNAIL_MAX_PIXELS = 50_000_000  # 超过此像素数的图片不解码
+    THUMBNAIL_MAX_SOURCE_SIZE = 100 * 1024 * 1024  # 超过此大小的文件不生成预览
+    UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600  # 按内容存储的文件和缩略图的缓存时间(秒)，内容不会改变，标记为immutable
+    UPLOAD_LEGACY_CACHE_MAX_AGE = 3600  # 内容存储之前保存的文件的缓存时间(秒)
+    UPLOAD_ALIAS_CACHE_TTL = 300  # 文件名到内容的进程内缓存时间(秒)
+    # 由前置代理发送文件内容，Python只返回响应头：
+    # nginx 设置为internal location的前缀（例如 /_uploads/，alias到UPLOAD_FOLDER）；Apache/lighttpd 使用 USE_X_SENDFILE
+    UPLOAD_ACCEL_REDIRECT_PREFIX = os.environ.get('UPLOAD_ACCEL_REDIRECT_PREFIX') or None
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE') == '1'
+    ASSETS_USE_BUNDLES = os.environ.get('ASSETS_USE_BUNDLES', '1') == '1'  # 使用 flask assets build 生成的文件；为0时即时合并源文件（开发）
+    ASSETS_CACHE_MAX_AGE = 365 * 24 * 3600  # 带哈希的打包文件的缓存时间(秒)，标记为immutable
+    ASSETS_GZIP_LEVEL = 9  # 构建时 .gz 文件的压缩级别
+    ASSETS_BROTLI_QUALITY = 11  # 构建时 .br 文件的压缩质量
+    COMPRESS_ENABLED = os.environ.get('COMPRESS_ENABLED', '1') == '1'  # 按Accept-Encoding压缩API响应（前置代理已压缩时可关闭）
+    COMPRESS_MIMETYPES = ('application/json',)  # 压缩的响应类型
+    COMPRESS_MIN_SIZE = 1024  # 小于此字节数的响应不压缩
+    COMPRESS_GZIP_LEVEL = 6  # gzip压缩级别(1-9)
+    COMPRESS_BROTLI_QUALITY = 4  # brotli压缩质量(0-11)，在线压缩使用较低质量
+    COMPRESS_CHUNK_SIZE = 64 * 1024  # 每次压缩的字节数，块之间让出协程
     
     # 端到端加密设置
     DEFAULT_CHANNEL_ENCRYPTION = True  # 默认启用频道端到端加密
+    KEY_DIRECTORY_CACHE_TTL = 300  # 公钥目录缓存有效期(秒)，公钥更新时会立即失效
+    KDM_REPLAY_LIMIT = 200  # 重连时从游标补发密钥的单次最大条数
+    CHANNEL_KEY_STATE_TTL = 60  # 发送路径上缓存频道加密状态和密钥版本的时间(秒)，本进程内的轮换会立即失效
+    KEY_RECONCILE_INTERVAL = 5  # 缺失密钥后台对账的间隔(秒)
+    KEY_RECONCILE_BATCH_SIZE = 50  # 每轮对账最多处理的用户数
+    KEY_ROTATION_DISPATCH_INTERVAL = 5  # 密钥轮换调度间隔(秒)，有新投递时会立即调度
+    KEY_ROTATION_BATCH_SIZE = 50  # 每次交给管理员加密分发的成员数
+    KEY_ROTATION_LEASE_SECONDS = 60  # 批次超过此时间未完成则重新分配
+    KEY_ROTATION_MAX_ATTEMPTS = 5  # 单个成员最多分配次数，超过后标记为投递失败
+    KEY_ROTATION_SCHEDULE_INTERVAL = 60  # 检查到期定期轮换的间隔(秒)
+    KEY_ROTATION_SCHEDULE_BATCH = 10  # 每轮最多创建的定期轮换任务数
+    KEY_ROTATION_MAX_ACTIVE_JOBS = 20  # 进行中的轮换任务达到此数量时暂停创建定期轮换
+    KEY_ROTATION_SCHEDULE_JITTER = 3600  # 下一次轮换时间的最大随机抖动(秒)，错开同时到期的频道
+    CIPHERTEXT_BINARY_STORAGE = os.environ.get('CIPHERTEXT_BINARY_STORAGE', '0') == '1'  # 新密文以BLOB存储，旧数据用migrations/convert_ciphertext_to_blob.py转换
+    CIPHERTEXT_BINARY_TRANSPORT = os.environ.get('CIPHERTEXT_BINARY_TRANSPORT', '0') == '1'  # 允许客户端协商以二进制附件接收密文
     
     # Session settings - Using Flask's default cookie storage, not file system
     # SESSION_TYPE = 'filesystem'
@@ -42,6 +94,67 @@ class Config:
     
     # Flask-Login settings
     LOGIN_DISABLED = False
+    USER_CACHE_SIZE = 2048  # user_loader缓存的最大用户数(LRU)
+    USER_CACHE_TTL = 60  # 缓存有效期(秒)，多worker部署时其他进程的最大不一致时间
+
+    # 聊天页面初始状态（utils/bootstrap.py）
+    BOOTSTRAP_CACHE_SIZE = 1024  # 缓存的最大用户数(LRU)
+    BOOTSTRAP_CACHE_TTL = 30  # 缓存有效期(秒)，失效只在当前进程内生效，其他worker最多在此时间内读到旧状态
+    BOOTSTRAP_CONVERSATION_LIMIT = 30  # 初始状态中最多包含的私信会话数
+    BOOTSTRAP_CONTACT_LIMIT = 50  # 会话之外最多补充的联系人数（不再加载所有用户）
+
+    # 密码哈希线程池 - bcrypt在原生线程中执行，不阻塞gevent事件循环
+    BCRYPT_ROUNDS = 12  # 推荐使用12轮加密，提供足够的安全性
+    PASSWORD_POOL_SIZE = int(os.environ.get('PASSWORD_POOL_SIZE', 4))  # 同时执行的bcrypt数量，建议不超过CPU核数
+    PASSWORD_POOL_MAX_QUEUE = 64  # 排队上限，超出后登录/注册返回503
+
+    # 运行指标（utils/metrics.py），Prometheus 抓取 /metrics
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'  # 关闭后 /metrics 返回404，不再记录HTTP请求和emit
+    METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')  # 无需令牌即可抓取的来源地址（仅限未经代理转发的直接连接）
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # 其他地址需要 Authorization: Bearer <token>，未设置时只允许上面的地址
+
+    # 日志（utils/logs.py）：结构化记录经有界队列异步写入stderr
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')  # 根日志器级别
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')  # text 或 json（每行一条JSON）
+    LOG_QUEUE_SIZE = 10000  # 日志队列上限，写入跟不上时丢弃并计入 chat_logging_dropped
+    LOG_LEVELS = {  # 按子系统设置级别：chat.socket / chat.auth / chat.keys 等
+        'chat': 'INFO',
+        'socketio.server': 'WARNING',  # INFO 时每次emit、进出房间都会记录
+        'engineio.server': 'WARNING',  # INFO 时逐个记录收发的数据包
+        'gevent.access': 'INFO',  # run_app.py 的访问日志
+        'werkzeug': 'INFO',
+    }
+    LOG_SAMPLE_RATES = {}  # 高频事件名 -> N，每N条只保留1条（WARNING及以上不采样）
+
+    # Socket.IO 多进程部署设置
+    # 为空时只在当前进程内emit；多worker部署时设置为 redis://host:6379/0
+    # 或 broker://127.0.0.1:5679（使用 utils/socketio_broker.py 内置代理）
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None
+    SOCKETIO_CHANNEL = os.environ.get('SOCKETIO_CHANNEL', 'chat-system')  # 多套部署共用一个Redis时区分频道
+    SOCKETIO_BROKER_SECRET = os.environ.get('SOCKETIO_BROKER_SECRET') or None  # broker:// 每帧的HMAC密钥，代理不在回环地址时必须设置
+
+    # 临时事件（输入中/查看中/焦点）设置，只在内存中路由，不写数据库
+    EPHEMERAL_COALESCE_SECONDS = 2.0  # 同一用户同一目标同一状态的最小转发间隔
+    EPHEMERAL_PEER_CACHE_SECONDS = 60  # 私信信号的接收者权限检查（私信会话或共同频道）缓存时间
+
+    # Socket事件限流 - 事件名: {'sid': (每秒令牌数, 桶容量), 'user': (每秒令牌数, 桶容量)}
+    # 超出限制的事件会收到 code='rate_limited' 的 error 帧
+    # leave_channel / leave_room 不限流：被拒绝的离开会让socket继续收到已离开房间的消息
+    SOCKET_RATE_LIMITS = {
+        'send_message': {'sid': (5, 10), 'user': (10, 20)},
+        'direct_message': {'sid': (5, 10), 'user': (10, 20)},
+        'join_channel': {'sid': (2, 10), 'user': (5, 20)},
+        'join_room': {'sid': (2, 10), 'user': (5, 20)},
+        'request_user_list': {'sid': (0.5, 3), 'user': (1, 5)},
+        'ephemeral': {'sid': (10, 10), 'user': (20, 20)},
+        'kdm_sync': {'sid': (0.5, 5), 'user': (1, 10)},
+        'kdm_ack': {'sid': (2, 10), 'user': (5, 20)},
+    }
+
+    # 准入控制 - 数据库写事务耗时(移动平均)超过阈值时丢弃低优先级事件、延迟普通优先级事件
+    DB_WRITE_LATENCY_THRESHOLD_MS = 200
+    DB_WRITE_LATENCY_CRITICAL_MS = 1000  # 超过此值时普通优先级事件也被丢弃
+    ADMISSION_DELAY_MS = 250  # 延迟处理的等待时间
 
 
 class DevelopmentConfig(Config):
@@ -53,6 +166,9 @@ class DevelopmentConfig(Config):
     SESSION_COOKIE_SECURE = False  # 开发环境允许HTTP发送Cookie
     REMEMBER_COOKIE_SECURE = False  # 开发环境允许HTTP发送记住我Cookie
     
+    # 开发环境记录调试日志和Socket.IO/Engine.IO数据包
+    LOG_LEVELS = {**Config.LOG_LEVELS, 'chat': 'DEBUG', 'socketio.server': 'INFO', 'engineio.server': 'INFO'}
+    
 
 class TestingConfig(Config):
     """Testing environment configuration"""
@@ -85,6 +201,16 @@ class ProductionConfig(Config):
     
     # Enable longer session timeout
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
+    
+    # 生产环境日志：JSON格式，关闭Engine.IO数据包日志和访问日志，高频事件采样
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+    LOG_LEVELS = {**Config.LOG_LEVELS, 'gevent.access': 'WARNING', 'werkzeug': 'WARNING'}
+    LOG_SAMPLE_RATES = {
+        'message_sent': 100,
+        'direct_message_sent': 100,
+        'socket_connected': 10,
+        'socket_disconnected': 10,
+    }
 
 
 # Configuration dictionary for selecting configuration based on environment variable
@@ -235,6 +235,18 @@ def init_db():
     # 添加KDM密钥同步相关字段和表
     add_channel_key_version_support(conn)
     
+    # 添加KDM发件箱游标
+    add_kdm_outbox_support(conn)
+    
+    # 添加定期密钥轮换时间字段
+    add_rotation_schedule_support(conn)
+    
+    # 添加频道消息二进制密文字段
+    add_binary_ciphertext_support(conn)
+    
+    # 由已有私信建立私信会话索引
+    add_dm_conversation_support(conn)
+    
     conn.close()
     print('Database initialization completed')
 
@@ -1220,6 +1232,70 @@ def add_channel_key_version_support(conn):
         print(f"添加KDM密钥同步支持失败: {str(e)}")
         raise
 
+def add_kdm_outbox_support(conn):
+    """为KDM发件箱添加每个用户的游标字段（kdm_outbox表由schema.sql创建）"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            last_kdm_version INTEGER DEFAULT 0,
+            kdm_cursor INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE,
+            UNIQUE (user_id)
+        )
+    ''')
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(user_settings)").fetchall()]
+    if 'kdm_cursor' not in columns:
+        print("添加kdm_cursor字段到user_settings表...")
+        conn.execute("ALTER TABLE user_settings ADD COLUMN kdm_cursor INTEGER DEFAULT 0")
+        conn.commit()
+    else:
+        print("kdm_cursor字段已存在")
+
+def add_rotation_schedule_support(conn):
+    """为channel_encryption添加next_rotation_at字段和索引，并为已配置轮换周期的频道计算下一次轮换时间"""
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(channel_encryption)").fetchall()]
+    if 'next_rotation_at' not in columns:
+        print("添加next_rotation_at字段到channel_encryption表...")
+        conn.execute("ALTER TABLE channel_encryption ADD COLUMN next_rotation_at TIMESTAMP")
+    else:
+        print("next_rotation_at字段已存在")
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_channel_encryption_next_rotation
+        ON channel_encryption(next_rotation_at) WHERE next_rotation_at IS NOT NULL
+    ''')
+    conn.execute('''
+        UPDATE channel_encryption
+        SET next_rotation_at = datetime(COALESCE(last_key_rotation, CURRENT_TIMESTAMP),
+                                        '+' || key_rotation_frequency || ' days')
+        WHERE enabled = 1 AND key_rotation_frequency > 0 AND next_rotation_at IS NULL
+    ''')
+    conn.commit()
+
+def add_binary_ciphertext_support(conn):
+    """
+    为messages添加二进制密文字段
+    私聊的密文字段不需要改表：SQLite按值保存BLOB，已有的TEXT列可以直接存放二进制密文
+    """
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(messages)").fetchall()]
+    for name, column_type in (('ciphertext', 'BLOB'), ('cipher_nonce', 'BLOB'), ('cipher_key_version', 'INTEGER'),
+                              ('cipher_envelope', 'TEXT')):
+        if name not in columns:
+            print(f"添加{name}字段到messages表...")
+            conn.execute(f"ALTER TABLE messages ADD COLUMN {name} {column_type}")
+    conn.commit()
+
+def add_dm_conversation_support(conn):
+    """dm_conversations表由schema.sql创建；会话为空而已有私信时（示例数据、旧数据库）由私信重建"""
+    from utils.dm_index import rebuild
+    has_conversations = conn.execute('SELECT 1 FROM dm_conversations LIMIT 1').fetchone()
+    has_messages = conn.execute('SELECT 1 FROM direct_messages LIMIT 1').fetchone()
+    if has_messages and not has_conversations:
+        print(f"已重建 {rebuild(conn)} 个私信会话")
+    conn.commit()
+
 if __name__ == '__main__':
     # Check if database file exists, if it does then delete it
     if os.path.exists('chat_system.sqlite'):
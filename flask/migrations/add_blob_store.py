@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+创建按内容寻址的上传存储表，并把上传目录中已有的文件移入内容存储
+原文件名作为别名保留，/uploads/<原文件名> 仍然可以访问；内容相同的文件只保留一份
+中断后重新运行会跳过已导入的文件
+
+用法:
+    python flask/migrations/add_blob_store.py [--upload-folder flask/static/uploads] [--dry-run]
+"""
+
+import argparse
+import sqlite3
+import os
+import sys
+
+# 添加父目录到路径，以便可以导入模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import blob_store
+
+def get_db_connection():
+    """获取数据库连接"""
+    conn = sqlite3.connect('flask/chat_system.sqlite', timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def create_tables(conn):
+    """创建 upload_blobs 和 upload_aliases 表"""
+    print("创建upload_blobs和upload_aliases表...")
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS upload_blobs (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        storage_path TEXT NOT NULL,             -- 相对UPLOAD_FOLDER的路径 blobs/ab/cd/<sha256>
+        ref_count INTEGER NOT NULL DEFAULT 0,   -- 指向此内容的文件名数
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_referenced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        quarantined_at TIMESTAMP                -- 移入隔离目录的时间
+    );
+
+    CREATE TABLE IF NOT EXISTS upload_aliases (
+        filename TEXT PRIMARY KEY,
+        sha256 TEXT NOT NULL,
+        original_filename TEXT NOT NULL,
+        user_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (sha256) REFERENCES upload_blobs(sha256),
+        FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE SET NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_upload_aliases_sha256 ON upload_aliases(sha256);
+    CREATE INDEX IF NOT EXISTS idx_upload_blobs_unreferenced ON upload_blobs(last_referenced_at) WHERE ref_count = 0;
+    CREATE INDEX IF NOT EXISTS idx_upload_blobs_quarantined ON upload_blobs(quarantined_at) WHERE quarantined_at IS NOT NULL;
+    """)
+    conn.commit()
+
+def import_existing(conn, upload_folder, dry_run=False):
+    """逐个导入上传目录顶层的文件，每个文件单独提交"""
+    if not os.path.isdir(upload_folder):
+        print(f"上传目录 {upload_folder} 不存在，跳过导入")
+        return
+    imported = 0
+    deduplicated = 0
+    saved_bytes = 0
+    with os.scandir(upload_folder) as entries:
+        names = sorted(entry.name for entry in entries if entry.is_file() and not entry.name.startswith('.'))
+    for name in names:
+        path = os.path.join(upload_folder, name)
+        if dry_run:
+            print(f"将导入: {name}")
+            continue
+        try:
+            blob = blob_store.import_file(conn, upload_folder, path, name)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"导入 {name} 失败: {str(e)}")
+            continue
+        if blob is None:
+            continue
+        imported += 1
+        if blob['deduplicated']:
+            deduplicated += 1
+            saved_bytes += blob['size']
+    if not dry_run:
+        print(f"导入 {imported} 个文件，其中 {deduplicated} 个与已有内容相同，节省 {saved_bytes} 字节")
+
+def run_migration(upload_folder, dry_run=False):
+    """运行迁移，创建内容存储表并导入已有文件"""
+    conn = get_db_connection()
+    try:
+        create_tables(conn)
+        import_existing(conn, upload_folder, dry_run)
+        print("迁移完成")
+    except Exception as e:
+        conn.rollback()
+        print(f"迁移失败: {str(e)}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='把上传文件迁移到按内容寻址的存储')
+    parser.add_argument('--upload-folder', default=os.path.join('flask', 'static', 'uploads'), help='上传目录')
+    parser.add_argument('--dry-run', action='store_true', help='只列出将要导入的文件')
+    args = parser.parse_args()
+    run_migration(args.upload_folder, args.dry_run)
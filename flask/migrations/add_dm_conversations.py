@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+添加私信会话索引 dm_conversations 及相关索引，并由已有私信重建会话
+
+用法:
+    python flask/migrations/add_dm_conversations.py
+"""
+
+import sqlite3
+import os
+import sys
+
+# 添加父目录到路径，以便可以导入模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.dm_index import rebuild
+
+def get_db_connection():
+    """获取数据库连接"""
+    conn = sqlite3.connect('flask/chat_system.sqlite')
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def run_migration():
+    """运行迁移，创建dm_conversations表和索引并重建会话"""
+    conn = get_db_connection()
+    try:
+        print("创建dm_conversations表和索引...")
+        conn.executescript("""
+        CREATE TABLE IF NOT EXISTS dm_conversations (
+            user_id INTEGER NOT NULL,
+            peer_id INTEGER NOT NULL,
+            last_dm_id INTEGER NOT NULL,
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, peer_id),
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+            FOREIGN KEY (peer_id) REFERENCES users(user_id) ON DELETE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS idx_dm_conversations_recent ON dm_conversations(user_id, last_dm_id);
+        CREATE INDEX IF NOT EXISTS idx_direct_messages_unread ON direct_messages(recipient_id, sender_id) WHERE read_at IS NULL;
+        CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(lower(username));
+        """)
+        # 重建期间持有写锁，避免与新私信交错
+        conn.execute("BEGIN IMMEDIATE")
+        count = rebuild(conn)
+        conn.commit()
+        print(f"已重建 {count} 个会话")
+        print("迁移完成")
+    except Exception as e:
+        conn.rollback()
+        print(f"迁移失败: {str(e)}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    run_migration()
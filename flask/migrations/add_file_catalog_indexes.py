@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import os
+import sys
+
+# 添加父目录到路径，以便可以导入模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def get_db_connection():
+    """获取数据库连接"""
+    conn = sqlite3.connect('flask/chat_system.sqlite')
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def run_migration():
+    """运行迁移，为files表添加频道附件和用户文件的分页索引"""
+    conn = get_db_connection()
+    try:
+        print("创建files表索引...")
+        conn.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_files_channel ON files(channel_id, file_id) WHERE is_deleted = 0 AND message_id IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS idx_files_channel_type ON files(channel_id, file_type, file_id) WHERE is_deleted = 0 AND message_id IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS idx_files_user ON files(user_id, file_id) WHERE is_deleted = 0;
+        CREATE INDEX IF NOT EXISTS idx_files_user_type ON files(user_id, file_type, file_id) WHERE is_deleted = 0;
+        CREATE INDEX IF NOT EXISTS idx_files_filename ON files(filename);
+        """)
+        conn.commit()
+        print("迁移完成")
+    except Exception as e:
+        conn.rollback()
+        print(f"迁移失败: {str(e)}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import os
+import sys
+
+# 添加父目录到路径，以便可以导入模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def get_db_connection():
+    """获取数据库连接"""
+    conn = sqlite3.connect('flask/chat_system.sqlite')
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def run_migration():
+    """运行迁移，创建kdm_outbox表并添加user_settings.kdm_cursor字段"""
+    conn = get_db_connection()
+    try:
+        print("创建kdm_outbox表...")
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS kdm_outbox (
+            outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            key_version INTEGER NOT NULL,
+            encrypted_key TEXT NOT NULL,
+            nonce TEXT,
+            is_key_rotation INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (recipient_id) REFERENCES users(user_id) ON DELETE CASCADE,
+            FOREIGN KEY (channel_id) REFERENCES channels(channel_id) ON DELETE CASCADE
+        )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_kdm_outbox_recipient ON kdm_outbox(recipient_id, outbox_id)")
+
+        from init_db import add_kdm_outbox_support
+        add_kdm_outbox_support(conn)
+
+        conn.commit()
+        print("迁移完成")
+    except Exception as e:
+        conn.rollback()
+        print(f"迁移失败: {str(e)}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import os
+import sys
+
+# 添加父目录到路径，以便可以导入模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def get_db_connection():
+    """获取数据库连接"""
+    conn = sqlite3.connect('flask/chat_system.sqlite')
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def run_migration():
+    """运行迁移，创建密钥轮换任务表和投递状态表"""
+    conn = get_db_connection()
+    try:
+        print("创建key_rotation_jobs和key_rotation_deliveries表...")
+        conn.executescript("""
+        CREATE TABLE IF NOT EXISTS key_rotation_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id INTEGER NOT NULL,
+            old_key_version INTEGER,
+            target_version INTEGER NOT NULL,
+            status TEXT DEFAULT 'pending',
+            reason TEXT,
+            created_by INTEGER,
+            key_holder_id INTEGER,
+            total_members INTEGER DEFAULT 0,
+            delivered_count INTEGER DEFAULT 0,
+            failed_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP,
+            FOREIGN KEY (channel_id) REFERENCES channels(channel_id) ON DELETE CASCADE,
+            FOREIGN KEY (created_by) REFERENCES users(user_id) ON DELETE SET NULL,
+            FOREIGN KEY (key_holder_id) REFERENCES users(user_id) ON DELETE SET NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS key_rotation_deliveries (
+            job_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT DEFAULT 'pending',
+            assigned_to INTEGER,
+            lease_token TEXT,
+            assigned_at TIMESTAMP,
+            attempts INTEGER DEFAULT 0,
+            delivered_at TIMESTAMP,
+            PRIMARY KEY (job_id, user_id),
+            FOREIGN KEY (job_id) REFERENCES key_rotation_jobs(job_id) ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_rotation_jobs_status ON key_rotation_jobs(status, channel_id);
+        CREATE INDEX IF NOT EXISTS idx_rotation_deliveries_status ON key_rotation_deliveries(job_id, status);
+        CREATE INDEX IF NOT EXISTS idx_rotation_deliveries_lease ON key_rotation_deliveries(status, assigned_at);
+        """)
+        conn.commit()
+        print("迁移完成")
+    except Exception as e:
+        print(f"迁移失败: {str(e)}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import os
+import sys
+
+# 添加父目录到路径，以便可以导入模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def get_db_connection():
+    """获取数据库连接"""
+    conn = sqlite3.connect('flask/chat_system.sqlite')
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def run_migration():
+    """运行迁移，为channel_encryption添加next_rotation_at字段和索引"""
+    conn = get_db_connection()
+    try:
+        from init_db import add_rotation_schedule_support
+        add_rotation_schedule_support(conn)
+
+        conn.commit()
+        print("迁移完成")
+    except Exception as e:
+        conn.rollback()
+        print(f"迁移失败: {str(e)}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    run_migration()
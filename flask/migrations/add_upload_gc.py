@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+为上传文件回收添加 upload_blobs.quarantined_at 字段和隔离记录的部分索引
+需要先运行 add_blob_store.py
+
+用法:
+    python flask/migrations/add_upload_gc.py
+"""
+
+import sqlite3
+import os
+import sys
+
+# 添加父目录到路径，以便可以导入模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def get_db_connection():
+    """获取数据库连接"""
+    conn = sqlite3.connect('flask/chat_system.sqlite')
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def run_migration():
+    """运行迁移，添加quarantined_at字段和索引"""
+    conn = get_db_connection()
+    try:
+        columns = [column['name'] for column in conn.execute("PRAGMA table_info(upload_blobs)").fetchall()]
+        if not columns:
+            print("upload_blobs表不存在，请先运行 add_blob_store.py")
+            return
+        if 'quarantined_at' not in columns:
+            print("添加quarantined_at字段...")
+            conn.execute("ALTER TABLE upload_blobs ADD COLUMN quarantined_at TIMESTAMP")
+        else:
+            print("quarantined_at字段已存在")
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_upload_blobs_quarantined
+            ON upload_blobs(quarantined_at) WHERE quarantined_at IS NOT NULL
+        """)
+        conn.commit()
+        print("迁移完成")
+    except Exception as e:
+        conn.rollback()
+        print(f"迁移失败: {str(e)}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+创建upload_previews表，并为已有的图片和PDF登记待生成的预览
+服务启动后由后台任务逐批生成
+
+用法:
+    python flask/migrations/add_upload_previews.py
+"""
+
+import sqlite3
+import os
+import sys
+
+# 添加父目录到路径，以便可以导入模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def get_db_connection():
+    """获取数据库连接"""
+    conn = sqlite3.connect('flask/chat_system.sqlite')
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def preview_kind(filename):
+    """按扩展名判断预览类型（与 utils.previews.preview_kind 一致）"""
+    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    if ext in ('png', 'jpg', 'jpeg', 'gif', 'webp'):
+        return 'image'
+    if ext == 'pdf':
+        return 'pdf'
+    return None
+
+def run_migration():
+    """运行迁移，创建upload_previews表并登记已有文件"""
+    conn = get_db_connection()
+    try:
+        print("创建upload_previews表...")
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS upload_previews (
+            sha256 TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,                 -- image, pdf
+            status TEXT DEFAULT 'pending',      -- pending, ready, unsupported, failed
+            width INTEGER,
+            height INTEGER,
+            page_count INTEGER,
+            thumbnail_path TEXT,                -- 相对UPLOAD_FOLDER的路径
+            preview_path TEXT,
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sha256) REFERENCES upload_blobs(sha256) ON DELETE CASCADE
+        )
+        """)
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_upload_previews_pending
+        ON upload_previews(created_at) WHERE status = 'pending'
+        """)
+
+        queued = 0
+        for row in conn.execute("SELECT filename, sha256 FROM upload_aliases").fetchall():
+            kind = preview_kind(row['filename'])
+            if kind:
+                cursor = conn.execute("""
+                    INSERT INTO upload_previews (sha256, kind) VALUES (?, ?)
+                    ON CONFLICT(sha256) DO NOTHING
+                """, (row['sha256'], kind))
+                queued += cursor.rowcount
+        conn.commit()
+        print(f"登记了 {queued} 个待生成的预览")
+        print("迁移完成")
+    except Exception as e:
+        conn.rollback()
+        print(f"迁移失败: {str(e)}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import os
+import sys
+
+# 添加父目录到路径，以便可以导入模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def get_db_connection():
+    """获取数据库连接"""
+    conn = sqlite3.connect('flask/chat_system.sqlite')
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def run_migration():
+    """运行迁移，创建upload_sessions表"""
+    conn = get_db_connection()
+    try:
+        print("创建upload_sessions表...")
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            upload_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,             -- 原始文件名
+            total_size INTEGER NOT NULL,
+            received_size INTEGER NOT NULL DEFAULT 0,  -- 已接收并写入临时文件的字节数
+            chunk_size INTEGER NOT NULL,
+            checksum TEXT,                      -- 可选，整个文件的SHA-256
+            status TEXT DEFAULT 'uploading',    -- uploading, completed
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,      -- 每收到一个分片顺延
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_upload_sessions_user ON upload_sessions(user_id, status)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_upload_sessions_expires ON upload_sessions(expires_at)")
+
+        conn.commit()
+        print("迁移完成")
+    except Exception as e:
+        conn.rollback()
+        print(f"迁移失败: {str(e)}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    run_migration()
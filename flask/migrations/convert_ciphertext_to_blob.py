@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+把已有的base64密文转换为二进制存储
+按主键分批处理，每批单独提交，可以在服务运行时执行；中断后重新运行会跳过已转换的数据
+
+用法:
+    python flask/migrations/convert_ciphertext_to_blob.py [--batch-size 500] [--pause 0.05]
+"""
+
+import argparse
+import sqlite3
+import os
+import sys
+import time
+
+# 添加父目录到路径，以便可以导入模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.ciphertext import convert_dm_batch, convert_message_batch
+
+def get_db_connection():
+    """获取数据库连接"""
+    conn = sqlite3.connect('flask/chat_system.sqlite', timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def convert_table(conn, label, convert_batch, batch_size, pause):
+    """逐批转换一张表，返回转换的行数"""
+    last_id = 0
+    scanned_batches = 0
+    total = 0
+    while True:
+        next_id, converted = convert_batch(conn, last_id, batch_size)
+        if next_id is None:
+            break
+        conn.commit()
+        last_id = next_id
+        total += converted
+        scanned_batches += 1
+        if scanned_batches % 20 == 0:
+            print(f"{label}: 已处理到ID {last_id}，转换 {total} 条")
+        # 让出写锁，避免阻塞在线写入
+        if pause:
+            time.sleep(pause)
+    print(f"{label}: 完成，共转换 {total} 条")
+    return total
+
+def run_migration(batch_size=500, pause=0.05):
+    """运行迁移，添加二进制密文字段并转换已有数据"""
+    conn = get_db_connection()
+    try:
+        from init_db import add_binary_ciphertext_support
+        add_binary_ciphertext_support(conn)
+
+        convert_table(conn, "私聊消息", convert_dm_batch, batch_size, pause)
+        convert_table(conn, "频道消息", convert_message_batch, batch_size, pause)
+        print("迁移完成")
+    except Exception as e:
+        conn.rollback()
+        print(f"迁移失败: {str(e)}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='把base64密文转换为二进制存储')
+    parser.add_argument('--batch-size', type=int, default=500, help='每批处理的行数')
+    parser.add_argument('--pause', type=float, default=0.05, help='两批之间的暂停时间(秒)')
+    args = parser.parse_args()
+    run_migration(args.batch_size, args.pause)
@@ -21,6 +21,16 @@ class User(UserMixin):
         self.public_key = public_key
         self.key_updated_at = key_updated_at
         
+    def freeze(self):
+        """Make the object read-only so one instance can be shared by the user cache"""
+        object.__setattr__(self, '_frozen', True)
+        return self
+        
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError(f"User object is read-only, cannot set '{name}'")
+        super().__setattr__(name, value)
+        
     def get_id(self):
         """Must return a unique user identifier (string)"""
         return str(self._id)
@@ -4,6 +4,7 @@ Entry point for running Flask application
 from app import app, socketio
 import os
 import ssl
+import logging
 from gevent import pywsgi
 from geventwebsocket.handler import WebSocketHandler
 
@@ -34,6 +35,9 @@ if __name__ == "__main__":
         ('0.0.0.0', port),
         app,
         handler_class=WebSocketHandler,
+        # Access and error lines go through the log queue; LOG_LEVELS['gevent.access'] controls them
+        log=logging.getLogger('gevent.access'),
+        error_log=logging.getLogger('gevent.error'),
         **ssl_args
     )
     
@@ -72,6 +72,10 @@ CREATE TABLE IF NOT EXISTS messages (
     parent_id INTEGER,
     is_deleted INTEGER NOT NULL DEFAULT 0,
     is_encrypted INTEGER NOT NULL DEFAULT 0, -- 用于标记消息是否加密
+    ciphertext BLOB,          -- 二进制存储的加密消息（content为空，读取时重建JSON信封）
+    cipher_nonce BLOB,
+    cipher_key_version INTEGER,
+    cipher_envelope TEXT,     -- 信封的其余字段和键顺序（content/nonce为null），重建时原样恢复
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (channel_id) REFERENCES channels(channel_id),
@@ -115,10 +119,10 @@ CREATE TABLE IF NOT EXISTS direct_messages (
     sender_id INTEGER NOT NULL,
     recipient_id INTEGER NOT NULL,
     content TEXT,  -- 未加密内容（仅用于回退）
-    encrypted_content TEXT,  -- 加密后的内容（给接收者的）
-    iv TEXT,  -- 接收者的随机向量/nonce
-    encrypted_for_self TEXT, -- 加密后的内容（给发送者自己的副本）
-    iv_for_self TEXT, -- 发送者自己的随机向量/nonce
+    encrypted_content BLOB,  -- 加密后的内容（给接收者的），旧数据为base64文本
+    iv BLOB,  -- 接收者的随机向量/nonce
+    encrypted_for_self BLOB, -- 加密后的内容（给发送者自己的副本）
+    iv_for_self BLOB, -- 发送者自己的随机向量/nonce
     message_type TEXT DEFAULT 'text',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     read_at TIMESTAMP,
@@ -127,6 +131,18 @@ CREATE TABLE IF NOT EXISTS direct_messages (
     FOREIGN KEY (recipient_id) REFERENCES users(user_id)
 );
 
+-- 私信会话索引：每个用户与每个私信对象一行，插入私信时维护（utils/dm_index.py）
+CREATE TABLE IF NOT EXISTS dm_conversations (
+    user_id INTEGER NOT NULL,
+    peer_id INTEGER NOT NULL,
+    last_dm_id INTEGER NOT NULL,       -- 最后一条私信，会话列表按此排序和分页
+    last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    unread_count INTEGER NOT NULL DEFAULT 0,  -- peer_id 发给 user_id 的未读私信数
+    PRIMARY KEY (user_id, peer_id),
+    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+    FOREIGN KEY (peer_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
 -- Channel logs (audit trail)
 CREATE TABLE IF NOT EXISTS channel_logs (
     log_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -159,7 +175,8 @@ CREATE TABLE IF NOT EXISTS channel_encryption (
     enabled INTEGER NOT NULL DEFAULT 0,
     encrypted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     last_key_rotation TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    key_rotation_frequency INTEGER DEFAULT 0, -- 0表示不自动轮换密钥
+    key_rotation_frequency INTEGER DEFAULT 0, -- 自动轮换周期(天)，0表示不自动轮换密钥
+    next_rotation_at TIMESTAMP,               -- 下一次定期轮换时间，未启用时为NULL（索引见init_db.add_rotation_schedule_support）
     FOREIGN KEY (channel_id) REFERENCES channels(channel_id) ON DELETE CASCADE
 );
 
@@ -189,6 +206,9 @@ CREATE INDEX IF NOT EXISTS idx_pinned_messages_pinned_at ON pinned_messages(pinn
 CREATE INDEX IF NOT EXISTS idx_direct_messages_sender ON direct_messages(sender_id);
 CREATE INDEX IF NOT EXISTS idx_direct_messages_recipient ON direct_messages(recipient_id);
 CREATE INDEX IF NOT EXISTS idx_direct_messages_created_at ON direct_messages(created_at);
+CREATE INDEX IF NOT EXISTS idx_direct_messages_unread ON direct_messages(recipient_id, sender_id) WHERE read_at IS NULL;
+CREATE INDEX IF NOT EXISTS idx_dm_conversations_recent ON dm_conversations(user_id, last_dm_id);
+CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(lower(username));
 
 -- Create saved messages/files table
 CREATE TABLE IF NOT EXISTS saved_items (
@@ -312,4 +332,130 @@ CREATE INDEX IF NOT EXISTS idx_key_requests_requester ON key_distribution_reques
 CREATE INDEX IF NOT EXISTS idx_key_requests_status ON key_distribution_requests(status);
 
 CREATE INDEX IF NOT EXISTS idx_key_rotation_channel ON key_rotation_logs(channel_id);
-CREATE INDEX IF NOT EXISTS idx_key_rotation_version ON key_rotation_logs(new_key_version);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_key_rotation_version ON key_rotation_logs(new_key_version);
+-- KDM密钥发件箱：每个接收者按 outbox_id 递增的游标读取新密钥
+CREATE TABLE IF NOT EXISTS kdm_outbox (
+    outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,  -- 单调递增的游标
+    recipient_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    sender_id INTEGER NOT NULL,
+    key_version INTEGER NOT NULL,
+    encrypted_key TEXT NOT NULL,    -- 用接收者公钥加密的频道密钥
+    nonce TEXT,
+    is_key_rotation INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (recipient_id) REFERENCES users(user_id) ON DELETE CASCADE,
+    FOREIGN KEY (channel_id) REFERENCES channels(channel_id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_kdm_outbox_recipient ON kdm_outbox(recipient_id, outbox_id);
+
+-- 密钥轮换任务：记录目标版本和每个成员的投递状态，重启后继续
+CREATE TABLE IF NOT EXISTS key_rotation_jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel_id INTEGER NOT NULL,
+    old_key_version INTEGER,
+    target_version INTEGER NOT NULL,
+    status TEXT DEFAULT 'pending',  -- pending, running, completed, failed, superseded
+    reason TEXT,
+    created_by INTEGER,
+    key_holder_id INTEGER,          -- 生成新密钥的管理员
+    total_members INTEGER DEFAULT 0,
+    delivered_count INTEGER DEFAULT 0,
+    failed_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    completed_at TIMESTAMP,
+    FOREIGN KEY (channel_id) REFERENCES channels(channel_id) ON DELETE CASCADE,
+    FOREIGN KEY (created_by) REFERENCES users(user_id) ON DELETE SET NULL,
+    FOREIGN KEY (key_holder_id) REFERENCES users(user_id) ON DELETE SET NULL
+);
+
+CREATE TABLE IF NOT EXISTS key_rotation_deliveries (
+    job_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    status TEXT DEFAULT 'pending',  -- pending, assigned, delivered, failed
+    assigned_to INTEGER,            -- 负责加密分发的管理员
+    lease_token TEXT,
+    assigned_at TIMESTAMP,
+    attempts INTEGER DEFAULT 0,
+    delivered_at TIMESTAMP,
+    PRIMARY KEY (job_id, user_id),
+    FOREIGN KEY (job_id) REFERENCES key_rotation_jobs(job_id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_rotation_jobs_status ON key_rotation_jobs(status, channel_id);
+CREATE INDEX IF NOT EXISTS idx_rotation_deliveries_status ON key_rotation_deliveries(job_id, status);
+CREATE INDEX IF NOT EXISTS idx_rotation_deliveries_lease ON key_rotation_deliveries(status, assigned_at);
+
+-- 分片续传上传会话
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    upload_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    filename TEXT NOT NULL,             -- 原始文件名
+    total_size INTEGER NOT NULL,
+    received_size INTEGER NOT NULL DEFAULT 0,  -- 已接收并写入临时文件的字节数
+    chunk_size INTEGER NOT NULL,
+    checksum TEXT,                      -- 可选，整个文件的SHA-256
+    status TEXT DEFAULT 'uploading',    -- uploading, completed
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,      -- 每收到一个分片顺延
+    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_user ON upload_sessions(user_id, status);
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_expires ON upload_sessions(expires_at);
+
+-- 按内容寻址的上传文件，相同内容只保存一份
+CREATE TABLE IF NOT EXISTS upload_blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    storage_path TEXT NOT NULL,             -- 相对UPLOAD_FOLDER的路径 blobs/ab/cd/<sha256>
+    ref_count INTEGER NOT NULL DEFAULT 0,   -- 指向此内容的文件名数
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_referenced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    quarantined_at TIMESTAMP                -- 未被引用的内容移入隔离目录的时间，重新上传相同内容时清空
+);
+
+-- 用户可见的文件名（URL中的 <name>_<uuid>.<ext>）到内容的映射
+CREATE TABLE IF NOT EXISTS upload_aliases (
+    filename TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    original_filename TEXT NOT NULL,
+    user_id INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (sha256) REFERENCES upload_blobs(sha256),
+    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE SET NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_upload_aliases_sha256 ON upload_aliases(sha256);
+CREATE INDEX IF NOT EXISTS idx_upload_blobs_unreferenced ON upload_blobs(last_referenced_at) WHERE ref_count = 0;
+CREATE INDEX IF NOT EXISTS idx_upload_blobs_quarantined ON upload_blobs(quarantined_at) WHERE quarantined_at IS NOT NULL;
+
+-- 上传文件的缩略图和预览信息（按内容生成，相同内容共用）
+CREATE TABLE IF NOT EXISTS upload_previews (
+    sha256 TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,                 -- image, pdf
+    status TEXT DEFAULT 'pending',      -- pending, ready, unsupported, failed
+    width INTEGER,
+    height INTEGER,
+    page_count INTEGER,
+    thumbnail_path TEXT,                -- 相对UPLOAD_FOLDER的路径
+    preview_path TEXT,
+    attempts INTEGER DEFAULT 0,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (sha256) REFERENCES upload_blobs(sha256) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_upload_previews_pending ON upload_previews(created_at) WHERE status = 'pending';
+
+-- 文件目录索引：频道附件（已发送到消息中的文件）和用户文件，按 file_id 游标分页
+CREATE INDEX IF NOT EXISTS idx_files_channel ON files(channel_id, file_id) WHERE is_deleted = 0 AND message_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_files_channel_type ON files(channel_id, file_type, file_id) WHERE is_deleted = 0 AND message_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_files_user ON files(user_id, file_id) WHERE is_deleted = 0;
+CREATE INDEX IF NOT EXISTS idx_files_user_type ON files(user_id, file_type, file_id) WHERE is_deleted = 0;
+CREATE INDEX IF NOT EXISTS idx_files_filename ON files(filename);
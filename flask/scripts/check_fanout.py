@@ -0,0 +1,210 @@
+"""
+Multi-worker Socket.IO fan-out check
+
+Starts the in-repo Socket.IO broker and several app workers on separate
+ports (all sharing a scratch copy of the database), connects one logged-in
+client to each worker, sends a channel message through one of them and
+checks that every client receives the broadcast.
+
+Usage:
+    cd flask
+    python scripts/check_fanout.py --workers 3
+
+Pass --queue redis://localhost:6379/0 to check against a Redis backend
+instead of the built-in broker. Exits non-zero if any client misses the
+message.
+"""
+import argparse
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_AGENT = 'fanout-check/1.0'
+TEST_USERS = [
+    ('admin', 'admin123'),
+    ('alice', 'password123'),
+    ('bob', 'password456'),
+    ('charlie', 'password789'),
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def run_worker(port):
+    """Worker entry point: serve the app with gevent on the given port"""
+    from gevent import monkey
+    monkey.patch_all()
+    sys.path.insert(0, APP_DIR)
+    from gevent import pywsgi
+    from geventwebsocket.handler import WebSocketHandler
+    from app import app
+
+    server = pywsgi.WSGIServer(('127.0.0.1', port), app,
+                               handler_class=WebSocketHandler, log=None)
+    server.serve_forever()
+
+
+def find_shared_channel(db_path, usernames):
+    """Pick a public channel whose room contains all test users"""
+    conn = sqlite3.connect(db_path)
+    placeholders = ','.join('?' * len(usernames))
+    row = conn.execute(f'''
+        SELECT c.channel_id
+        FROM channels c
+        JOIN user_rooms ur ON ur.room_id = c.room_id
+        JOIN users u ON u.user_id = ur.user_id
+        WHERE c.is_private = 0 AND u.username IN ({placeholders})
+        GROUP BY c.channel_id
+        HAVING COUNT(DISTINCT u.user_id) = ?
+        ORDER BY c.channel_id
+        LIMIT 1
+    ''', (*usernames, len(usernames))).fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def connect_client(port, username, password, channel_id, received):
+    import requests
+    import socketio
+
+    base_url = f'http://127.0.0.1:{port}'
+    http = requests.Session()
+    http.headers['User-Agent'] = USER_AGENT
+    resp = http.post(f'{base_url}/auth/login',
+                     data={'username': username, 'password': password},
+                     allow_redirects=False)
+    if resp.status_code not in (200, 302) or 'session' not in http.cookies:
+        raise RuntimeError(f'login failed for {username} on port {port}: {resp.status_code}')
+
+    client = socketio.Client(reconnection=False)
+    joined = threading.Event()
+
+    @client.on('channel_status')
+    def on_channel_status(data):
+        if data.get('status') == 'joined' and data.get('username') == username:
+            joined.set()
+
+    @client.on('new_message')
+    def on_new_message(data):
+        received.setdefault(username, []).append(data.get('content'))
+
+    cookie = '; '.join(f'{k}={v}' for k, v in http.cookies.items())
+    client.connect(base_url, headers={'Cookie': cookie, 'User-Agent': USER_AGENT},
+                   transports=['websocket'])
+    client.emit('join_channel', {'channel_id': channel_id})
+    if not joined.wait(10):
+        raise RuntimeError(f'{username} could not join channel {channel_id}')
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--queue', help='message queue URL (default: built-in broker)')
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--worker-port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_port:
+        run_worker(args.worker_port)
+        return 0
+
+    workers = max(2, min(args.workers, len(TEST_USERS)))
+    users = TEST_USERS[:workers]
+    processes = []
+    tmp_dir = tempfile.mkdtemp(prefix='fanout-check-')
+    clients = []
+    try:
+        db_path = os.path.join(tmp_dir, 'chat_system.sqlite')
+        shutil.copy(os.path.join(APP_DIR, 'chat_system.sqlite'), db_path)
+        channel_id = find_shared_channel(db_path, [u for u, _ in users])
+        if channel_id is None:
+            print('No public channel shared by the test users; run init_db.py first')
+            return 2
+
+        queue_url = args.queue
+        if not queue_url:
+            broker_port = free_port()
+            processes.append(subprocess.Popen(
+                [sys.executable, '-m', 'utils.socketio_broker', '--port', str(broker_port)],
+                cwd=APP_DIR))
+            if not wait_for_port(broker_port):
+                print('Broker did not start')
+                return 2
+            queue_url = f'broker://127.0.0.1:{broker_port}'
+
+        env = dict(os.environ, DATABASE=db_path, SOCKETIO_MESSAGE_QUEUE=queue_url,
+                   FLASK_ENV='development', SECRET_KEY='fanout-check-secret')
+        ports = []
+        for _ in range(workers):
+            port = free_port()
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--worker-port', str(port)],
+                cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL))
+            ports.append(port)
+        for port in ports:
+            if not wait_for_port(port):
+                print(f'Worker on port {port} did not start')
+                return 2
+
+        received = {}
+        for port, (username, password) in zip(ports, users):
+            clients.append(connect_client(port, username, password, channel_id, received))
+
+        marker = f'fanout-check {uuid.uuid4()}'
+        clients[0].emit('send_message', {'channel_id': channel_id, 'content': marker})
+
+        deadline = time.time() + args.timeout
+        while time.time() < deadline:
+            if all(marker in received.get(u, []) for u, _ in users):
+                break
+            time.sleep(0.1)
+
+        ok = True
+        for port, (username, _) in zip(ports, users):
+            got = marker in received.get(username, [])
+            ok = ok and got
+            print(f"worker :{port} {username:<8} {'received' if got else 'MISSING'}")
+        print('fan-out OK' if ok else 'fan-out FAILED')
+        return 0 if ok else 1
+    finally:
+        for client in clients:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+        for proc in processes:
+            proc.terminate()
+        for proc in processes:
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
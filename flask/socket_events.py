@@ -3,16 +3,175 @@ Socket.IO event handling module
 Handles all real-time communication events
 """
 from flask import request, current_app, session
-from flask_socketio import emit, join_room, leave_room, disconnect
+from flask_socketio import emit, join_room, leave_room, disconnect, rooms
 from flask_login import current_user
 from datetime import datetime
 import json
 from utils.db import get_db_connection
+from utils.ephemeral import EPHEMERAL_TYPES, EphemeralCoalescer, PeerCache, shares_conversation
+from utils.rate_limit import (admission_controller, SocketRateLimiter,
+                              PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW, SHED, DELAY)
+from utils.user_cache import get_user_version
+from utils.bootstrap import bootstrap_cache
+from utils import kdm, ciphertext, previews, file_catalog, dm_index
+from utils.channel_keys import key_presence_cache, load_channel_key_state
+from utils.key_reconcile import key_reconciler
+from utils.metrics import metrics, observe_socket_event
+from utils.logs import get_logger
+from collections import namedtuple
+from functools import wraps
+import time
+
+log = get_logger('socket')
 
 # For tracking currently online users
 online_users = {}
 # For tracking each user's session IDs
 user_sessions = {}
+# 每个sid绑定的会话记录，连接时解析一次用户身份，事件处理函数直接读取
+# binary: 连接时协商的密文传输格式，True表示密文以二进制附件发送
+SocketSession = namedtuple('SocketSession', ['user_id', 'username', 'avatar_url', 'version', 'binary'])
+socket_sessions = {}
+
+def _bind_socket_session(sid, user, binary=None):
+    """根据用户对象创建并绑定sid的会话记录，binary为None时沿用原记录的传输格式"""
+    if binary is None:
+        previous = socket_sessions.get(sid)
+        binary = previous.binary if previous is not None else False
+    record = SocketSession(
+        user_id=user.id,
+        username=user.username,
+        avatar_url=getattr(user, 'avatar_url', None),
+        version=get_user_version(user.id),
+        binary=binary
+    )
+    socket_sessions[sid] = record
+    return record
+
+def _binary_transport_enabled():
+    """是否允许客户端协商二进制密文传输"""
+    return current_app.config.get('CIPHERTEXT_BINARY_TRANSPORT', False)
+
+def _join_format_room(room, record):
+    """二进制传输开启时，按客户端的密文格式加入对应的子房间"""
+    if _binary_transport_enabled():
+        join_room(ciphertext.format_room(room, record.binary))
+
+def _leave_format_rooms(room):
+    leave_room(ciphertext.format_room(room, True))
+    leave_room(ciphertext.format_room(room, False))
+
+def get_socket_session(sid=None):
+    """
+    获取当前sid的会话记录
+    只有当用户版本号变化（资料或角色变更）时才重新加载用户，其余情况不访问数据库
+    
+    返回:
+    - SocketSession，未认证或用户已不存在时返回None
+    """
+    sid = sid or request.sid
+    record = socket_sessions.get(sid)
+    if record is None:
+        return None
+    if record.version != get_user_version(record.user_id):
+        from blueprints.auth import load_user
+        user = load_user(record.user_id)
+        if user is None:
+            socket_sessions.pop(sid, None)
+            return None
+        record = _bind_socket_session(sid, user)
+    return record
+
+# 事件限流器、临时事件合并器和接收者权限缓存，首次使用时按配置创建
+_rate_limiter = None
+_ephemeral_coalescer = None
+_ephemeral_peers = None
+
+def _get_rate_limiter():
+    """获取按sid/用户的事件限流器"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = SocketRateLimiter(current_app.config.get('SOCKET_RATE_LIMITS', {}))
+    return _rate_limiter
+
+def _get_ephemeral_coalescer():
+    """获取临时事件合并器"""
+    global _ephemeral_coalescer
+    if _ephemeral_coalescer is None:
+        _ephemeral_coalescer = EphemeralCoalescer(
+            interval=current_app.config.get('EPHEMERAL_COALESCE_SECONDS', 2.0)
+        )
+    return _ephemeral_coalescer
+
+def _get_ephemeral_peers():
+    """获取临时事件接收者权限缓存"""
+    global _ephemeral_peers
+    if _ephemeral_peers is None:
+        _ephemeral_peers = PeerCache(ttl=current_app.config.get('EPHEMERAL_PEER_CACHE_SECONDS', 60.0))
+    return _ephemeral_peers
+
+def _can_signal(user_id, recipient_id):
+    """发送者和接收者是否有私信会话或共同频道（结果短时缓存）"""
+    peers = _get_ephemeral_peers()
+    allowed = peers.get(user_id, recipient_id)
+    if allowed is None:
+        conn = get_db_connection()
+        try:
+            allowed = shares_conversation(conn, user_id, recipient_id)
+        finally:
+            conn.close()
+        peers.set(user_id, recipient_id, allowed)
+    return allowed
+
+def socket_guard(event, priority=PRIORITY_NORMAL, silent=False):
+    """
+    Socket事件限流与准入控制装饰器，同时记录事件数和处理耗时（utils/metrics.py）
+
+    参数:
+    - event: 事件名，对应 SOCKET_RATE_LIMITS 中的配置
+    - priority: 事件优先级，数据库写入压力大时低优先级事件先被丢弃
+    - silent: 被拒绝时不发送错误帧（用于高频的临时事件）
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            record = socket_sessions.get(request.sid)
+            retry_after = _get_rate_limiter().check(event, request.sid, record.user_id if record else None)
+            if retry_after:
+                observe_socket_event(event, 'rate_limited')
+                if not silent:
+                    emit('error', {
+                        'code': 'rate_limited',
+                        'event': event,
+                        'message': 'Too many requests, please slow down',
+                        'retry_after': round(retry_after, 2)
+                    }, room=request.sid)
+                return None
+            
+            decision = admission_controller.decide(priority)
+            if decision == SHED:
+                observe_socket_event(event, 'shed')
+                if not silent:
+                    emit('error', {
+                        'code': 'server_busy',
+                        'event': event,
+                        'message': 'Server is busy, please try again shortly',
+                        'retry_after': admission_controller.delay_ms / 1000.0
+                    }, room=request.sid)
+                return None
+            if decision == DELAY:
+                time.sleep(admission_controller.delay_ms / 1000.0)
+            # 耗时不包含准入控制的延迟
+            started = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = f(*args, **kwargs)
+                outcome = 'ok'
+                return result
+            finally:
+                observe_socket_event(event, outcome, time.perf_counter() - started)
+        return wrapper
+    return decorator
 
 # 获取用户的Socket ID
 def get_user_socket_id(user_id):
@@ -27,196 +186,81 @@ def get_user_socket_id(user_id):
 
 def process_channel_key(conn, channel_id, user_id, username):
     """
-    处理频道密钥，确保用户在加密频道中有对应的密钥记录
+    确认用户在加密频道中有密钥记录
     无论消息是否加密，都应该调用此函数来确保密钥共享正常
     
+    稳态下命中进程内缓存，不执行任何密钥查询；
+    缺少密钥时交给后台对账任务补齐或向管理员发起密钥请求，不在发送路径上修复
+    
     参数:
-    - conn: 数据库连接
+    - conn: 数据库连接（只在缓存未命中时使用）
     - channel_id: 频道ID
     - user_id: 用户ID
-    - username: 用户名，用于日志记录
+    - username: 用户名，用于密钥请求通知
     
     返回:
-    - True: 如果用户已有密钥或成功处理了密钥
-    - False: 如果处理失败
+    - True: 频道未加密或用户已有密钥
+    - False: 用户缺少密钥（已安排后台对账）或处理失败
     """
     try:
-        # 检查频道是否启用了加密
-        channel = conn.execute("SELECT is_encrypted FROM channels WHERE channel_id = ?", 
-                             (channel_id,)).fetchone()
-        
-        if not channel or not channel['is_encrypted']:
-            # 频道不存在或未启用加密
+        channel_id = int(channel_id)
+        state = key_presence_cache.get_channel(channel_id)
+        if state is None:
+            state = load_channel_key_state(conn, channel_id)
+            key_presence_cache.set_channel(channel_id, state)
+        
+        is_encrypted, key_version = state
+        if not is_encrypted:
+            return True
+        if key_presence_cache.has_key(channel_id, user_id, key_version):
             return True
         
-        print(f"处理频道 {channel_id} 的密钥，用户 {user_id}")
-        
-        # 检查用户是否已有密钥记录
-        user_has_key = conn.execute("""
+        has_key = conn.execute("""
             SELECT 1 FROM user_channel_keys 
             WHERE channel_id = ? AND user_id = ? AND is_active = 1
+            LIMIT 1
         """, (channel_id, user_id)).fetchone()
-        
-        # 如果用户已有密钥，无需处理
-        if user_has_key:
-            print(f"用户 {user_id} 已有频道 {channel_id} 的密钥记录")
+        if has_key:
+            key_presence_cache.add_key(channel_id, user_id, key_version)
             return True
         
-        # 获取密钥版本
-        key_version = 1  # 默认值
-        master_key = conn.execute("""
-            SELECT key_version FROM channel_master_keys 
-            WHERE channel_id = ? AND is_active = 1
-            ORDER BY key_version DESC LIMIT 1
-        """, (channel_id,)).fetchone()
-        
-        if master_key:
-            if isinstance(master_key, dict) and 'key_version' in master_key:
-                key_version = master_key['key_version']
-            else:
-                key_version = master_key[0]
-                
-        # 查找密钥共享记录
-        key_shares = conn.execute("""
-            SELECT * FROM channel_key_shares 
-            WHERE channel_id = ? AND recipient_id = ?
-            ORDER BY created_at DESC
-        """, (channel_id, user_id)).fetchall()
-        
-        if key_shares:
-            print(f"找到 {len(key_shares)} 条密钥共享记录")
-            
-            # 使用最新的密钥共享记录
-            latest_share = key_shares[0]
-            encrypted_key = latest_share['encrypted_key']
-            
-            # 获取nonce值
-            current_nonce = None
-            try:
-                if 'nonce' in latest_share:
-                    current_nonce = latest_share['nonce']
-                elif hasattr(latest_share, 'nonce'):
-                    current_nonce = latest_share.nonce
-                elif isinstance(latest_share, (list, tuple)) and len(latest_share) > 3:
-                    # 尝试从列表/元组中获取
-                    current_nonce = latest_share[3]
-            except Exception as e:
-                print(f"获取nonce值时出错: {str(e)}")
-            
-            if not current_nonce:
-                current_nonce = 'auto_generated'
-            
-            # 尝试插入密钥记录
-            try:
-                conn.execute("""
-                    INSERT INTO user_channel_keys
-                    (channel_id, user_id, key_version, encrypted_key, nonce, is_active, created_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?, 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                """, (channel_id, user_id, key_version, encrypted_key, current_nonce))
-                conn.commit()
-                print(f"成功插入新的密钥记录: 用户={user_id}, 频道={channel_id}, 版本={key_version}")
-                return True
-            except Exception as e:
-                # 如果插入失败，可能是因为唯一约束冲突，尝试更新
-                print(f"插入密钥记录失败: {str(e)}")
-                try:
-                    conn.execute("""
-                        UPDATE user_channel_keys
-                        SET encrypted_key = ?, nonce = ?, is_active = 1, updated_at = CURRENT_TIMESTAMP
-                        WHERE channel_id = ? AND user_id = ? AND key_version = ?
-                    """, (encrypted_key, current_nonce, channel_id, user_id, key_version))
-                    conn.commit()
-                    print(f"成功更新现有密钥记录")
-                    return True
-                except Exception as update_err:
-                    print(f"更新密钥记录失败: {str(update_err)}")
-                    
-                    # 最后尝试：删除重建
-                    try:
-                        conn.execute("""
-                            DELETE FROM user_channel_keys
-                            WHERE channel_id = ? AND user_id = ? AND key_version = ?
-                        """, (channel_id, user_id, key_version))
-                        conn.commit()
-                        
-                        conn.execute("""
-                            INSERT INTO user_channel_keys
-                            (channel_id, user_id, key_version, encrypted_key, nonce, is_active, created_at, updated_at)
-                            VALUES (?, ?, ?, ?, ?, 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                        """, (channel_id, user_id, key_version, encrypted_key, current_nonce))
-                        conn.commit()
-                        print(f"通过删除重建方式成功创建密钥记录")
-                        return True
-                    except Exception as rebuild_err:
-                        print(f"删除重建失败: {str(rebuild_err)}")
-        else:
-            print(f"未找到用户 {user_id} 在频道 {channel_id} 的密钥共享记录")
-            
-            # 可以尝试自动触发密钥请求
-            try:
-                # 查找管理员
-                admin = conn.execute("""
-                    SELECT ur.user_id 
-                    FROM user_rooms ur
-                    JOIN channels c ON c.room_id = ur.room_id
-                    WHERE c.channel_id = ? AND ur.role IN ('admin', 'owner')
-                    ORDER BY CASE WHEN ur.role = 'owner' THEN 0 ELSE 1 END
-                    LIMIT 1
-                """, (channel_id,)).fetchone()
-                
-                if admin:
-                    admin_id = admin['user_id'] if 'user_id' in admin else admin[0]
-                    # 创建密钥请求
-                    conn.execute("""
-                        INSERT INTO key_distribution_requests
-                        (channel_id, requester_id, admin_id, status, created_at)
-                        VALUES (?, ?, ?, 'pending', CURRENT_TIMESTAMP)
-                    """, (channel_id, user_id, admin_id))
-                    conn.commit()
-                    print(f"已自动创建密钥请求: 用户={user_id}, 管理员={admin_id}")
-                    
-                    # 发送通知
-                    if 'socketio' in globals() or hasattr(current_app, 'socketio'):
-                        socketio = current_app.socketio if hasattr(current_app, 'socketio') else globals().get('socketio')
-                        if socketio:
-                            socketio.emit('channel_key_request', {
-                                'channel_id': channel_id,
-                                'requester_id': user_id,
-                                'requester_username': username,
-                                'timestamp': datetime.now().isoformat()
-                            }, room=f'user_{admin_id}')
-            except Exception as req_err:
-                print(f"创建密钥请求失败: {str(req_err)}")
-                
+        key_reconciler.schedule(channel_id, user_id, username)
         return False
     except Exception as e:
-        print(f"处理频道密钥时出错: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        current_app.logger.error(f"处理频道 {channel_id} 用户 {user_id} 的密钥时出错: {str(e)}", exc_info=True)
         return False
 
 def register_socket_events(socketio):
     """Register all Socket.IO event handlers"""
     
+    # 连接数和在线用户数在抓取指标时读取
+    metrics.gauge('chat_socket_connections', 'Authenticated Socket.IO connections in this process',
+                  lambda: len(socket_sessions))
+    metrics.gauge('chat_online_users', 'Users with at least one socket in this process',
+                  lambda: len(online_users))
+    
     @socketio.on('connect')
     def handle_connect():
-        print(f"Socket.IO connection: SID={request.sid}")
-        
         # Check if user is authenticated
         if current_user.is_authenticated:
             user_id = current_user.id
-            print(f"Authenticated user connected: id={user_id}, username={current_user.username}, SID={request.sid}")
+            log.info('socket_connected', user_id=user_id, sid=request.sid)
             
             # Record user online
             if user_id not in online_users:
                 online_users[user_id] = {}
                 
+            # 只在连接时解析一次用户身份，之后的事件读取会话记录
+            binary = (_binary_transport_enabled() and
+                      request.args.get('binary_ciphertext') in ('1', 'true'))
+            record = _bind_socket_session(request.sid, current_user, binary)
+            
             # Add or update this user's session
             online_users[user_id][request.sid] = {
                 'user_id': user_id,
-                'username': current_user.username,
+                'username': record.username,
                 'socket_id': request.sid,
-                'avatar': current_user.avatar_url if hasattr(current_user, 'avatar_url') else None,
+                'avatar': record.avatar_url,
                 'last_active': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             }
             
@@ -226,6 +270,10 @@ def register_socket_events(socketio):
             if request.sid not in user_sessions[user_id]:
                 user_sessions[user_id].append(request.sid)
             
+            # 加入个人房间，REST接口和其他worker通过 user_{id} 房间推送给该用户
+            join_room(f'user_{user_id}')
+            _join_format_room(f'user_{user_id}', record)
+            
             # Update user status in database
             conn = get_db_connection()
             conn.execute('UPDATE users SET is_active = 1 WHERE user_id = ?', (user_id,))
@@ -235,30 +283,36 @@ def register_socket_events(socketio):
             # Broadcast user online message
             emit('user_online', {
                 'user_id': user_id,
-                'username': current_user.username,
+                'username': record.username,
                 'online_count': len(online_users)
             }, broadcast=True)
         else:
-            print(f"Unauthenticated user connection attempt: SID={request.sid}")
+            log.info('socket_rejected', sid=request.sid, reason='unauthenticated')
             # Disconnect unauthenticated user
             disconnect()
 
     @socketio.on('disconnect')
     def handle_disconnect():
-        print(f"Socket.IO disconnection: SID={request.sid}")
+        record = socket_sessions.pop(request.sid, None)
+        if _rate_limiter is not None:
+            _rate_limiter.forget_sid(request.sid)
         
         # Check if user is authenticated
-        if current_user.is_authenticated:
-            user_id = current_user.id
+        if record is not None:
+            user_id = record.user_id
             
             # Remove this session from online users list
             if user_id in online_users and request.sid in online_users[user_id]:
-                print(f"Authenticated user disconnected: id={user_id}, username={current_user.username}, SID={request.sid}")
+                log.info('socket_disconnected', user_id=user_id, sid=request.sid)
                 del online_users[user_id][request.sid]
                 
                 # If user has no other active sessions, clean up user data
                 if not online_users[user_id]:
                     del online_users[user_id]
+                    if _ephemeral_coalescer is not None:
+                        _ephemeral_coalescer.forget_user(user_id)
+                    if _ephemeral_peers is not None:
+                        _ephemeral_peers.forget_user(user_id)
                     
                 # Update user session mapping
                 if user_id in user_sessions and request.sid in user_sessions[user_id]:
@@ -276,14 +330,16 @@ def register_socket_events(socketio):
                     # Only broadcast offline message when all user sessions are disconnected
                     emit('user_offline', {
                         'user_id': user_id,
-                        'username': current_user.username,
+                        'username': record.username,
                         'online_count': len(online_users)
                     }, broadcast=True)
 
     @socketio.on('join_room')
+    @socket_guard('join_room', PRIORITY_NORMAL)
     def handle_join_room(data):
         """Join room Socket.IO event"""
-        if not current_user.is_authenticated:
+        user = get_socket_session()
+        if user is None:
             return
             
         room_id = data.get('room_id')
@@ -294,7 +350,7 @@ def register_socket_events(socketio):
         conn = get_db_connection()
         room_member = conn.execute(
             'SELECT 1 FROM user_rooms WHERE user_id = ? AND room_id = ?',
-            (current_user.id, room_id)
+            (user.user_id, room_id)
         ).fetchone()
         conn.close()
         
@@ -305,16 +361,19 @@ def register_socket_events(socketio):
         join_room(room_key)
         emit('room_status', {
             'room_id': room_id,
-            'user_id': current_user.id,
-            'username': current_user.username,
+            'user_id': user.user_id,
+            'username': user.username,
             'status': 'joined',
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }, room=room_key)
 
     @socketio.on('leave_room')
+    # 离开会撤销房间订阅，丢弃后客户端会继续收到已离开房间的消息：不限流（见 SOCKET_RATE_LIMITS），高负载时也只延迟不丢弃
+    @socket_guard('leave_room', PRIORITY_HIGH)
     def handle_leave_room(data):
         """Leave room Socket.IO event"""
-        if not current_user.is_authenticated:
+        user = get_socket_session()
+        if user is None:
             return
             
         room_id = data.get('room_id')
@@ -325,16 +384,18 @@ def register_socket_events(socketio):
         leave_room(room_key)
         emit('room_status', {
             'room_id': room_id,
-            'user_id': current_user.id,
-            'username': current_user.username,
+            'user_id': user.user_id,
+            'username': user.username,
             'status': 'left',
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }, room=room_key)
 
     @socketio.on('join_channel')
+    @socket_guard('join_channel', PRIORITY_NORMAL)
     def handle_join_channel(data):
         """Join channel Socket.IO event"""
-        if not current_user.is_authenticated:
+        user = get_socket_session()
+        if user is None:
             return
             
         channel_id = data.get('channel_id')
@@ -357,7 +418,7 @@ def register_socket_events(socketio):
         # Check if user is a member of the room or an admin
         room_member = conn.execute(
             'SELECT role FROM user_rooms WHERE user_id = ? AND room_id = ?',
-            (current_user.id, channel['room_id'])
+            (user.user_id, channel['room_id'])
         ).fetchone()
         
         is_admin = room_member and room_member['role'] in ['admin', 'owner']
@@ -371,7 +432,7 @@ def register_socket_events(socketio):
         if channel['is_private'] == 1 and not is_admin:
             channel_member = conn.execute(
                 'SELECT 1 FROM user_channels WHERE user_id = ? AND channel_id = ?',
-                (current_user.id, channel_id)
+                (user.user_id, channel_id)
             ).fetchone()
             
             if not channel_member:
@@ -384,11 +445,11 @@ def register_socket_events(socketio):
             VALUES (?, ?, ?, ?)
         ''', (
             channel_id,
-            current_user.id,
+            user.user_id,
             'user_joined_channel',
             json.dumps({
-                'user_id': current_user.id,
-                'username': current_user.username
+                'user_id': user.user_id,
+                'username': user.username
             })
         ))
         conn.commit()
@@ -397,18 +458,22 @@ def register_socket_events(socketio):
         
         channel_key = f'channel_{channel_id}'
         join_room(channel_key)
+        _join_format_room(channel_key, user)
         emit('channel_status', {
             'channel_id': channel_id,
-            'user_id': current_user.id,
-            'username': current_user.username,
+            'user_id': user.user_id,
+            'username': user.username,
             'status': 'joined',
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }, room=channel_key)
 
     @socketio.on('leave_channel')
+    # 离开会撤销房间订阅，丢弃后客户端会继续收到已离开房间的消息：不限流（见 SOCKET_RATE_LIMITS），高负载时也只延迟不丢弃
+    @socket_guard('leave_channel', PRIORITY_HIGH)
     def handle_leave_channel(data):
         """Leave channel Socket.IO event"""
-        if not current_user.is_authenticated:
+        user = get_socket_session()
+        if user is None:
             return
             
         channel_id = data.get('channel_id')
@@ -422,11 +487,11 @@ def register_socket_events(socketio):
             VALUES (?, ?, ?, ?)
         ''', (
             channel_id,
-            current_user.id,
+            user.user_id,
             'user_left_channel',
             json.dumps({
-                'user_id': current_user.id,
-                'username': current_user.username
+                'user_id': user.user_id,
+                'username': user.username
             })
         ))
         conn.commit()
@@ -434,18 +499,21 @@ def register_socket_events(socketio):
         
         channel_key = f'channel_{channel_id}'
         leave_room(channel_key)
+        _leave_format_rooms(channel_key)
         emit('channel_status', {
             'channel_id': channel_id,
-            'user_id': current_user.id,
-            'username': current_user.username,
+            'user_id': user.user_id,
+            'username': user.username,
             'status': 'left',
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }, room=channel_key)
 
     @socketio.on('send_message')
+    @socket_guard('send_message', PRIORITY_HIGH)
     def handle_message(data):
         """Handle message sending"""
-        if not current_user.is_authenticated:
+        user = get_socket_session()
+        if user is None:
             return
             
         channel_id = data.get('channel_id')
@@ -476,7 +544,7 @@ def register_socket_events(socketio):
         # Check if user has permission to access the room
         room_access = conn.execute('''
             SELECT role FROM user_rooms WHERE user_id = ? AND room_id = ?
-        ''', (current_user.id, channel['room_id'])).fetchone()
+        ''', (user.user_id, channel['room_id'])).fetchone()
         
         if not room_access:
             conn.close()
@@ -490,7 +558,7 @@ def register_socket_events(socketio):
         if channel['is_private'] and not is_admin:
             channel_access = conn.execute('''
                 SELECT 1 FROM user_channels WHERE user_id = ? AND channel_id = ?
-            ''', (current_user.id, channel_id)).fetchone()
+            ''', (user.user_id, channel_id)).fetchone()
             
             if not channel_access:
                 conn.close()
@@ -503,28 +571,33 @@ def register_socket_events(socketio):
         user_muted = conn.execute('''
             SELECT is_muted FROM user_channels 
             WHERE user_id = ? AND channel_id = ? AND is_muted = 1
-        ''', (current_user.id, channel_id)).fetchone()
+        ''', (user.user_id, channel_id)).fetchone()
         
         if user_muted:
             conn.close()
             return
         
-        # 插入消息到数据库
+        # 插入消息到数据库（二进制存储时加密信封拆分为BLOB列）
+        stored = ciphertext.message_storage(
+            content, is_encrypted, current_app.config.get('CIPHERTEXT_BINARY_STORAGE', False))
         cursor = conn.execute('''
-            INSERT INTO messages (channel_id, user_id, content, message_type, parent_id, is_encrypted)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (channel_id, current_user.id, content, message_type, parent_id, 1 if is_encrypted else 0))
+            INSERT INTO messages (channel_id, user_id, content, message_type, parent_id, is_encrypted,
+                                  ciphertext, cipher_nonce, cipher_key_version, cipher_envelope)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (channel_id, user.user_id, stored[0], message_type, parent_id, 1 if is_encrypted else 0,
+              *stored[1:]))
         
         message_id = cursor.lastrowid
+        # 关联消息中引用的、发送者上传到该频道的文件
+        file_catalog.link_message(conn, message_id, channel_id, user.user_id, content, data.get('file_ids'))
         conn.commit()
         
-        print(f"用户 {current_user.id} 在频道 {channel_id} 发送了消息 ID={message_id}, 加密状态={is_encrypted}")
+        log.info('message_sent', user_id=user.user_id, channel_id=channel_id, message_id=message_id,
+                 encrypted=bool(is_encrypted))
         
         # 如果频道启用了加密，处理sender_key
         if is_channel_encrypted:
-            print(f"频道 {channel_id} 启用了加密，检查是否需要保存sender_key")
-            # 使用新的辅助函数处理密钥
-            process_channel_key(conn, channel_id, current_user.id, current_user.username)
+            process_channel_key(conn, channel_id, user.user_id, user.username)
         
         # Log message sending action
         conn.execute('''
@@ -532,7 +605,7 @@ def register_socket_events(socketio):
             VALUES (?, ?, ?, ?)
         ''', (
             channel_id,
-            current_user.id,
+            user.user_id,
             'send_message',
             json.dumps({
                 'message_id': message_id,
@@ -550,30 +623,45 @@ def register_socket_events(socketio):
             WHERE m.message_id = ?
         ''', (message_id,)).fetchone()
         
+        # 消息中引用的上传文件的缩略图信息
+        attachments = previews.message_attachments(content, previews.attachment_map(conn, [content]))
+        
         conn.close()
         
         # Broadcast message to all users in the channel
         channel_key = f'channel_{channel_id}'
-        emit('new_message', {
-            'id': message['message_id'],
-            'channel_id': channel_id,
-            'user': {
-                'id': current_user.id,
-                'username': current_user.username,
-                'avatar_url': current_user.avatar_url
-            },
-            'content': content,
-            'message_type': message_type,
-            'created_at': message['created_at'],
-            'parent_id': parent_id,
-            'encrypted': is_encrypted  # 新增：传递加密状态
-        }, room=channel_key)
+        def build_message(binary):
+            payload = {
+                'id': message['message_id'],
+                'channel_id': channel_id,
+                'user': {
+                    'id': user.user_id,
+                    'username': user.username,
+                    'avatar_url': user.avatar_url
+                },
+                'content': content,
+                'message_type': message_type,
+                'created_at': message['created_at'],
+                'parent_id': parent_id,
+                'encrypted': is_encrypted,  # 新增：传递加密状态
+                'attachments': attachments
+            }
+            if binary:
+                payload.update(ciphertext.message_fields(message, True))
+            return payload
+        
+        if _binary_transport_enabled():
+            ciphertext.emit_by_format(emit, 'new_message', channel_key, build_message)
+        else:
+            emit('new_message', build_message(False), room=channel_key)
 
     @socketio.on('direct_message')
+    @socket_guard('direct_message', PRIORITY_HIGH)
     def handle_direct_message(data):
         """处理私聊消息发送"""
-        if not current_user.is_authenticated:
-            print(f"未授权用户尝试发送私聊消息: {request.sid}")
+        user = get_socket_session()
+        if user is None:
+            log.warning('direct_message_rejected', sid=request.sid, reason='unauthenticated')
             return
             
         recipient_id = data.get('recipient_id')
@@ -582,15 +670,9 @@ def register_socket_events(socketio):
         iv = data.get('iv')  # 用于加密的初始化向量
         message_type = data.get('message_type', 'text')
         
-        print(f"收到私聊消息请求: {{recipient_id: {recipient_id}, " +
-              f"has_content: {content is not None}, " +
-              f"has_encrypted_content: {encrypted_content is not None}, " +
-              f"has_iv: {iv is not None}, " +
-              f"message_type: {message_type}}}")
-        
         # 需要有未加密内容或加密内容中的一个
         if not recipient_id or (not content and not encrypted_content):
-            print("缺少必要的消息内容，无法处理私聊消息")
+            log.info('direct_message_rejected', user_id=user.user_id, reason='missing_content')
             return
         
         # 验证收件人是否存在
@@ -599,26 +681,23 @@ def register_socket_events(socketio):
         
         if not recipient:
             conn.close()
-            print(f"收件人不存在: {recipient_id}")
+            log.info('direct_message_rejected', user_id=user.user_id, recipient_id=recipient_id,
+                     reason='unknown_recipient')
             emit('error', {'message': '收件人不存在'}, room=request.sid)
             return
         
         # 判断消息是否加密
         is_encrypted = encrypted_content is not None and iv is not None
-        print(f"消息加密状态: {is_encrypted}")
-        
-        if is_encrypted:
-            print(f"加密内容长度: {len(encrypted_content) if encrypted_content else 0}, " +
-                  f"IV长度: {len(iv) if iv else 0}")
         
         # 安全性考虑：优先使用加密内容，否则使用明文
         # 在实际应用中，如果双方都有密钥，应该强制使用加密
+        binary_storage = current_app.config.get('CIPHERTEXT_BINARY_STORAGE', False)
         insert_params = [
-            current_user.id, 
+            user.user_id, 
             recipient_id, 
             content if not is_encrypted else None,  # 如果有加密内容则不保存明文
-            encrypted_content,
-            iv,
+            ciphertext.storage_value(encrypted_content, binary_storage),
+            ciphertext.storage_value(iv, binary_storage),
             message_type
         ]
         
@@ -630,57 +709,48 @@ def register_socket_events(socketio):
             ''', insert_params)
             
             message_id = cursor.lastrowid
-            print(f"成功创建私聊消息, ID: {message_id}")
+            dm_index.record_message(conn, message_id, user.user_id, recipient['user_id'])
             
             # 获取完整消息信息
             message = conn.execute('SELECT * FROM direct_messages WHERE dm_id = ?', (message_id,)).fetchone()
             conn.commit()
+            bootstrap_cache.invalidate(user.user_id, recipient_id)
             
-            # 向接收者发送消息
-            recipient_sid = get_user_socket_id(recipient_id)
-            if recipient_sid:
-                print(f"接收者在线，发送消息到Socket ID: {recipient_sid}")
-                # 发送消息给接收者
-                message_data = {
+            def build_message(binary):
+                return {
                     'id': message_id,
                     'sender': {
-                        'id': current_user.id,
-                        'username': current_user.username,
-                        'avatar_url': current_user.avatar_url
+                        'id': user.user_id,
+                        'username': user.username,
+                        'avatar_url': user.avatar_url
                     },
                     'recipient_id': recipient_id,
                     'content': content if not is_encrypted else None,
-                    'encrypted_content': encrypted_content,
-                    'iv': iv,
+                    'encrypted_content': ciphertext.wire_value(message['encrypted_content'], binary),
+                    'iv': ciphertext.wire_value(message['iv'], binary),
                     'message_type': message_type,
                     'created_at': message['created_at'],
                     'is_encrypted': is_encrypted
                 }
-                print(f"发送给接收者的消息数据: {message_data}")
-                emit('direct_message', message_data, room=recipient_sid)
-            else:
-                print(f"接收者不在线，消息将在用户下次登录时显示")
+            
+            # 向接收者发送消息
+            # 通过个人房间投递，接收者连接在其他worker上时由消息队列转发
+            if recipient['user_id'] in user_sessions or current_app.config.get('SOCKETIO_MESSAGE_QUEUE'):
+                # 发送消息给接收者
+                recipient_room = f'user_{recipient_id}'
+                if _binary_transport_enabled():
+                    ciphertext.emit_by_format(emit, 'direct_message', recipient_room, build_message)
+                else:
+                    emit('direct_message', build_message(False), room=recipient_room)
+            
+            log.info('direct_message_sent', dm_id=message_id, sender_id=user.user_id,
+                     recipient_id=recipient['user_id'], encrypted=is_encrypted,
+                     recipient_online=recipient['user_id'] in user_sessions)
             
             # 向发送者确认消息已发送
-            confirmation_data = {
-                'id': message_id,
-                'sender': {
-                    'id': current_user.id,
-                    'username': current_user.username,
-                    'avatar_url': current_user.avatar_url
-                },
-                'recipient_id': recipient_id,
-                'content': content if not is_encrypted else None,
-                'encrypted_content': encrypted_content,
-                'iv': iv,
-                'message_type': message_type,
-                'created_at': message['created_at'],
-                'is_encrypted': is_encrypted
-            }
-            print(f"发送确认消息给发送者: {request.sid}")
-            emit('direct_message', confirmation_data, room=request.sid)
+            emit('direct_message', build_message(user.binary), room=request.sid)
         except Exception as e:
-            print(f"处理私聊消息时发生错误: {str(e)}")
+            log.error('direct_message_failed', sender_id=user.user_id, recipient_id=recipient_id, exc_info=True)
             emit('error', {'message': f'发送消息失败: {str(e)}'}, room=request.sid)
         finally:
             conn.close()
@@ -689,13 +759,123 @@ def register_socket_events(socketio):
         if is_encrypted and 'channel_id' in data:
             channel_id = data.get('channel_id')
             if channel_id:
-                print(f"加密私信涉及频道 {channel_id}，检查是否需要保存sender_key")
-                process_channel_key(conn, channel_id, current_user.id, current_user.username)
+                # 上面的连接已关闭，缓存命中时不会使用这个连接
+                conn = get_db_connection()
+                try:
+                    process_channel_key(conn, channel_id, user.user_id, user.username)
+                finally:
+                    conn.close()
+
+    @socketio.on('ephemeral')
+    @socket_guard('ephemeral', PRIORITY_LOW, silent=True)
+    def handle_ephemeral(data):
+        """
+        临时交互信号（输入中/正在查看/窗口焦点）
+        只在内存中路由，按sid/用户限流并在服务端合并；
+        发给单个用户时要求双方有私信会话或共同频道（检查结果短时缓存）
+        """
+        user = get_socket_session()
+        if user is None or not isinstance(data, dict):
+            return
+        user_id = user.user_id
+        
+        kind = data.get('type')
+        if kind not in EPHEMERAL_TYPES:
+            return
+        
+        active = bool(data.get('active', True))
+        channel_id = data.get('channel_id')
+        recipient_id = data.get('recipient_id')
+        try:
+            if channel_id is not None:
+                channel_id = int(channel_id)
+                room = f'channel_{channel_id}'
+                # 只能向已通过 join_channel 权限检查的频道发送
+                if room not in rooms():
+                    return
+                target = ('channel', channel_id)
+            elif recipient_id is not None:
+                recipient_id = int(recipient_id)
+                if recipient_id == user_id or not _can_signal(user_id, recipient_id):
+                    return
+                room = f'user_{recipient_id}'
+                target = ('user', recipient_id)
+            else:
+                return
+        except (TypeError, ValueError):
+            return
+        
+        if not _get_ephemeral_coalescer().should_emit(user_id, kind, target, active):
+            return
+        
+        emit('ephemeral', {
+            'type': kind,
+            'active': active,
+            'user_id': user_id,
+            'username': user.username,
+            'channel_id': channel_id,
+            'recipient_id': recipient_id
+        }, room=room, include_self=False)
+
+    @socketio.on('kdm_sync')
+    @socket_guard('kdm_sync', PRIORITY_NORMAL)
+    def handle_kdm_sync(data=None):
+        """
+        从游标补发密钥（客户端连接或重连后发送）
+
+        参数:
+        - after: 可选，客户端本地游标；不提供时使用服务端保存的游标
+        """
+        user = get_socket_session()
+        if user is None:
+            return
+
+        after = (data or {}).get('after')
+        try:
+            after = int(after) if after is not None else None
+        except (TypeError, ValueError):
+            after = None
+
+        conn = get_db_connection()
+        try:
+            entries, cursor, has_more = kdm.replay(
+                conn, user.user_id, after=after,
+                limit=current_app.config.get('KDM_REPLAY_LIMIT', kdm.DEFAULT_REPLAY_LIMIT)
+            )
+        finally:
+            conn.close()
+
+        emit('kdm_replay', {
+            'keys': entries,
+            'cursor': cursor,
+            'has_more': has_more
+        }, room=request.sid)
+
+    @socketio.on('kdm_ack')
+    @socket_guard('kdm_ack', PRIORITY_LOW, silent=True)
+    def handle_kdm_ack(data):
+        """客户端确认已处理到指定游标"""
+        user = get_socket_session()
+        if user is None or not isinstance(data, dict):
+            return
+        try:
+            cursor = int(data.get('cursor'))
+        except (TypeError, ValueError):
+            return
+
+        conn = get_db_connection()
+        try:
+            kdm.ack_cursor(conn, user.user_id, cursor)
+            conn.commit()
+        finally:
+            conn.close()
 
     @socketio.on('request_user_list')
+    @socket_guard('request_user_list', PRIORITY_LOW)
     def handle_user_list_request():
         """Handle user list request"""
-        if not current_user.is_authenticated:
+        user = get_socket_session()
+        if user is None:
             return
             
         conn = get_db_connection()
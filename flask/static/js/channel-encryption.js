@@ -10,6 +10,8 @@ const ChannelEncryption = {
     
     // 存储频道密钥
     channelKeys: {},
+    // 公钥目录缓存 userId -> publicKey
+    publicKeyCache: {},
     
     // 存储频道成员公钥信息
     channelMembers: {},
@@ -540,6 +542,9 @@ const ChannelEncryption = {
                 skipped: 0
             };
             
+            // 一次请求取回所有成员公钥
+            await this.prefetchPublicKeys(channelId);
+            
             // 将密钥分发给每个成员
             const promises = members.map(async (member) => {
                 // 跳过自己
@@ -751,9 +756,31 @@ const ChannelEncryption = {
         return members;
     },
     
+    // 批量预取频道成员公钥（服务器返回ETag，浏览器缓存会自动发起条件请求）
+    async prefetchPublicKeys(channelId) {
+        try {
+            const response = await fetch(`/api/crypto/key_directory?channel_id=${channelId}`, {
+                credentials: 'same-origin'
+            });
+            if (!response.ok) return false;
+            const data = await response.json();
+            (data.keys || []).forEach(entry => {
+                this.publicKeyCache[entry.user_id] = entry.public_key;
+            });
+            return true;
+        } catch (e) {
+            console.warn(`预取频道 ${channelId} 公钥目录失败:`, e);
+            return false;
+        }
+    },
+    
     // 获取用户公钥
     async getUserPublicKey(userId) {
         try {
+            if (this.publicKeyCache[userId]) {
+                return this.publicKeyCache[userId];
+            }
+            
             // 首先尝试从cryptoManager获取
             if (this.cryptoManagerAvailable && cryptoManager.getUserPublicKey) {
                 const key = await cryptoManager.getUserPublicKey(userId);
@@ -2700,6 +2727,8 @@ async function forceDistributeChannelKey() {
         let successCount = 0;
         const distributedToUsers = [];
         
+        await ChannelEncryption.prefetchPublicKeys(activeChannelId);
+        
         // 逐个尝试，即使部分失败也继续
         for (const member of members) {
             // 跳过自己
@@ -2935,6 +2964,23 @@ function setupPeriodicKeyDistributionCheck() {
     }, CHECK_INTERVAL);
 }
 
+// 页面初始状态（window.CHAT_BOOTSTRAP）中的频道加密状态，每个频道只使用一次，之后的检查仍请求接口
+const bootstrapEncryptionUsed = new Set();
+
+function takeBootstrapEncryption(channelId) {
+    const state = window.CHAT_BOOTSTRAP;
+    const key = String(channelId);
+    if (!state || !Array.isArray(state.channels) || bootstrapEncryptionUsed.has(key)) {
+        return null;
+    }
+    const channel = state.channels.find(item => String(item.channel_id) === key);
+    if (!channel) {
+        return null;
+    }
+    bootstrapEncryptionUsed.add(key);
+    return Boolean(channel.encrypted);
+}
+
 // 检查频道并分发密钥的函数
 async function checkAndDistributeChannelKey(channelId) {
     if (!channelId) {
@@ -2948,21 +2994,27 @@ async function checkAndDistributeChannelKey(channelId) {
         // 初始化加密状态变量
         let isEncrypted = false;
         
-        try {
-            // 从数据库或API获取频道加密状态
-            const response = await fetch(`/api/channels/${channelId}/encryption_status`);
-            if (response.ok) {
-                const data = await response.json();
-                isEncrypted = data.is_encrypted;
-            } else {
-                console.warn(`获取频道加密状态API返回错误: ${response.status}，将使用本地缓存状态`);
-                // 如果API不可用，使用本地缓存的状态
+        const bootstrapped = takeBootstrapEncryption(channelId);
+        if (bootstrapped !== null) {
+            // 首次检查使用页面嵌入的初始状态，不再请求接口
+            isEncrypted = bootstrapped;
+        } else {
+            try {
+                // 从数据库或API获取频道加密状态
+                const response = await fetch(`/api/channels/${channelId}/encryption_status`);
+                if (response.ok) {
+                    const data = await response.json();
+                    isEncrypted = data.is_encrypted;
+                } else {
+                    console.warn(`获取频道加密状态API返回错误: ${response.status}，将使用本地缓存状态`);
+                    // 如果API不可用，使用本地缓存的状态
+                    isEncrypted = ChannelEncryption.isChannelEncrypted(channelId);
+                }
+            } catch (fetchError) {
+                console.warn(`获取频道加密状态API不可用: ${fetchError.message}，将使用本地缓存状态`);
+                // 如果API请求失败，使用本地缓存的状态
                 isEncrypted = ChannelEncryption.isChannelEncrypted(channelId);
             }
-        } catch (fetchError) {
-            console.warn(`获取频道加密状态API不可用: ${fetchError.message}，将使用本地缓存状态`);
-            // 如果API请求失败，使用本地缓存的状态
-            isEncrypted = ChannelEncryption.isChannelEncrypted(channelId);
         }
         
         if (isEncrypted) {
@@ -3267,37 +3319,53 @@ document.addEventListener('DOMContentLoaded', () => {
 
 /**
  * KDM密钥同步相关功能
+ *
+ * 服务端为每个用户维护一个按游标递增的密钥发件箱：
+ * 新密钥写入时通过 kdm_update 推送，连接/重连时发送 kdm_sync 从游标补发（kdm_replay），
+ * 处理后确认游标。HTTP拉取 (/api/kdm/pending) 只在WebSocket不可用时使用。
  */
 
-// 存储上次看到的KDM版本号
-let lastKdmVersionSeen = 0;
+// 已处理的最后一个KDM游标
+let kdmCursor = 0;
+// 延迟合并的游标确认
+let kdmAckTimer = null;
+// kdm_sync 补发分页进行中时，实时推送的游标先暂存，补发结束后再合并
+let kdmReplaying = false;
+let kdmPendingLiveCursor = 0;
+
+// 本地游标按用户保存：outbox_id 全局递增，共用浏览器的其他用户的游标会跳过本用户的密钥
+function kdmCursorStorageKey() {
+    return window.currentUserId ? `kdm_cursor:${window.currentUserId}` : null;
+}
 
 // 初始化KDM同步
 async function initKdmSync() {
     console.log('初始化KDM同步...');
     
     try {
-        // 从localStorage获取上次同步的版本号
-        const storedVersion = localStorage.getItem('last_kdm_version_seen');
-        if (storedVersion) {
-            lastKdmVersionSeen = parseInt(storedVersion, 10);
-            console.log(`从本地存储加载KDM版本号: ${lastKdmVersionSeen}`);
+        // 从localStorage获取当前用户上次处理的游标；旧版本不区分用户的游标直接丢弃
+        localStorage.removeItem('kdm_cursor');
+        const storageKey = kdmCursorStorageKey();
+        const storedCursor = storageKey ? localStorage.getItem(storageKey) : null;
+        if (storedCursor) {
+            kdmCursor = parseInt(storedCursor, 10) || 0;
+            console.log(`从本地存储加载KDM游标: ${kdmCursor}`);
         }
         
         // 注册页面可见性变化事件，用于前台同步
         document.addEventListener('visibilitychange', handleVisibilityChange);
         
-        // 设置周期性同步（每30分钟）
+        // WebSocket断开期间的兜底同步（每30分钟）
         setInterval(periodicKdmSync, 30 * 60 * 1000);
         
-        // 在WebSocket重连时同步
+        // 在WebSocket连接和重连时同步
         setupWebSocketReconnectSync();
         
         console.log('KDM同步初始化完成');
         
-        // 首次进入频道时同步
-        if (window.activeChannelId) {
-            pullKdm();
+        // 页面加载时socket可能已经连接
+        if (typeof socket !== 'undefined' && socket.connected) {
+            syncKdm();
         }
         
         return true;
@@ -3311,39 +3379,114 @@ async function initKdmSync() {
 function handleVisibilityChange() {
     if (document.visibilityState === 'visible') {
         console.log('页面转为前台，触发KDM同步');
-        pullKdm();
+        syncKdm();
     }
 }
 
-// 周期性KDM同步
+// 周期性KDM同步，只在WebSocket不可用时拉取
 async function periodicKdmSync() {
+    if (typeof socket !== 'undefined' && socket.connected) {
+        return;
+    }
     console.log('执行周期性KDM同步');
     pullKdm();
 }
 
-// 设置WebSocket重连时的KDM同步
+// 从游标同步KDM：优先通过WebSocket补发，否则HTTP拉取
+function syncKdm() {
+    if (typeof socket !== 'undefined' && socket.connected) {
+        // 本地没有游标时由服务端使用保存的游标
+        kdmReplaying = true;
+        socket.emit('kdm_sync', kdmCursor ? { after: kdmCursor } : {});
+    } else {
+        pullKdm();
+    }
+}
+
+// 前进本地游标并延迟确认，多条密钥合并为一次确认
+function advanceKdmCursor(cursor) {
+    cursor = parseInt(cursor, 10);
+    if (!cursor || cursor <= kdmCursor) {
+        return;
+    }
+    kdmCursor = cursor;
+    const storageKey = kdmCursorStorageKey();
+    if (storageKey) {
+        localStorage.setItem(storageKey, kdmCursor.toString());
+    }
+    
+    if (kdmAckTimer) {
+        return;
+    }
+    kdmAckTimer = setTimeout(() => {
+        kdmAckTimer = null;
+        if (typeof socket !== 'undefined' && socket.connected) {
+            socket.emit('kdm_ack', { cursor: kdmCursor });
+        } else {
+            acknowledgeKdm(kdmCursor);
+        }
+    }, 1000);
+}
+
+// 设置WebSocket连接/重连时的KDM同步
 function setupWebSocketReconnectSync() {
     if (typeof socket !== 'undefined') {
-        // 监听重连成功事件
-        socket.on('reconnect', () => {
-            console.log('WebSocket重连成功，同步KDM');
-            
-            // 发送当前版本号给服务器
-            socket.emit('kdm_sync', { after: lastKdmVersionSeen });
-            
-            // 主动拉取，以防WebSocket推送有遗漏
-            pullKdm();
+        // socket.io 4.x 中重连成功也会触发connect事件
+        socket.on('connect', () => {
+            console.log('WebSocket已连接，从游标同步KDM');
+            syncKdm();
+        });
+        
+        // 断开时未完成的补发作废，重连后从已确认的游标重新补发
+        socket.on('disconnect', () => {
+            kdmReplaying = false;
+            kdmPendingLiveCursor = 0;
         });
         
-        // 添加KDM同步处理
-        socket.on('kdm_update', (data) => {
-            console.log('收到KDM更新推送:', data);
+        // kdm_sync 被限流或丢弃时结束本次补发，暂存的游标留到下一次补发
+        socket.on('error', (data) => {
+            if (data && data.event === 'kdm_sync') {
+                kdmReplaying = false;
+            }
+        });
+        
+        // 新密钥写入时的实时推送
+        socket.on('kdm_update', async (data) => {
+            console.log(`收到KDM推送, 频道: ${data.channel_id}, 游标: ${data.cursor}`);
             
             if (data.encrypted_keys_for_me) {
-                processReceivedKdm(data);
+                await processReceivedKdm(data);
+            }
+            if (kdmReplaying) {
+                // 补发还没到达这里，现在前进游标会跳过补发剩下的密钥
+                kdmPendingLiveCursor = Math.max(kdmPendingLiveCursor, parseInt(data.cursor, 10) || 0);
+            } else {
+                advanceKdmCursor(data.cursor);
+            }
+        });
+        
+        // kdm_sync 的补发结果
+        socket.on('kdm_replay', async (data) => {
+            const keys = data.keys || [];
+            console.log(`补发 ${keys.length} 个KDM密钥, 游标: ${data.cursor}`);
+            
+            for (const kdm of keys) {
+                await processReceivedKdm(kdm);
+            }
+            
+            if (data.has_more) {
+                // 用本页的游标翻页，补发结束前不前进本地游标
+                socket.emit('kdm_sync', { after: data.cursor });
+                return;
             }
+            kdmReplaying = false;
+            advanceKdmCursor(Math.max(parseInt(data.cursor, 10) || 0, kdmPendingLiveCursor));
+            kdmPendingLiveCursor = 0;
         });
         
+        // 服务端调度的密钥轮换批次（只发给在线的频道管理员）
+        socket.on('key_rotation_needed', handleKeyRotationBatch);
+        
         // 监听频道成员变动事件
         socket.on('member-update', (data) => {
             console.log('收到频道成员变动事件:', data);
@@ -3362,6 +3505,72 @@ function setupWebSocketReconnectSync() {
     }
 }
 
+// 处理服务端分配的一批密钥轮换任务
+// 第一批(generate_key)由本客户端生成新版本密钥，之后的批次用同一版本的密钥为成员加密并批量分发
+async function handleKeyRotationBatch(data) {
+    const channelId = data.channel_id.toString();
+    console.log(`密钥轮换任务 ${data.job_id}: 频道 ${channelId} 版本 ${data.new_version}, 本批 ${data.members.length} 名成员`);
+    
+    try {
+        if (data.generate_key) {
+            if (!await ChannelEncryption.generateChannelKey(channelId)) {
+                return;
+            }
+            ChannelEncryption.channelKeys[channelId].version = data.new_version;
+            ChannelEncryption.saveChannelKeys();
+        }
+        
+        const channelKey = ChannelEncryption.channelKeys[channelId];
+        if (!channelKey || (channelKey.version || 1) != data.new_version) {
+            // 没有目标版本的密钥，等待租约过期后由其他管理员处理
+            console.warn(`本地没有频道 ${channelId} 版本 ${data.new_version} 的密钥，跳过本批`);
+            return;
+        }
+        
+        await ChannelEncryption.prefetchPublicKeys(channelId);
+        
+        const shares = [];
+        for (const member of data.members) {
+            const publicKey = await ChannelEncryption.getUserPublicKey(member.id);
+            if (!publicKey) {
+                console.warn(`无法获取用户 ${member.id} 的公钥`);
+                continue;
+            }
+            const encryptedKey = await ChannelEncryption.encryptChannelKeyForUser(channelKey, publicKey);
+            if (!encryptedKey) {
+                continue;
+            }
+            shares.push({
+                user_id: member.id,
+                encrypted_key: typeof encryptedKey === 'string' ? encryptedKey : JSON.stringify(encryptedKey),
+                key_version: data.new_version
+            });
+        }
+        if (shares.length === 0) {
+            return;
+        }
+        
+        const response = await fetch('/api/channels/share_keys', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': ChannelEncryption.getCSRFToken()
+            },
+            body: JSON.stringify({
+                channel_id: data.channel_id,
+                is_key_rotation: true,
+                key_version: data.new_version,
+                rotation_job_id: data.job_id,
+                shares: shares
+            })
+        });
+        const result = await response.json();
+        console.log(`密钥轮换任务 ${data.job_id} 本批结果: ${result.message}`);
+    } catch (e) {
+        console.error(`处理密钥轮换任务 ${data.job_id} 失败:`, e);
+    }
+}
+
 // 密钥刷新标志
 let needKeyRefresh = false;
 
@@ -3373,65 +3582,57 @@ function handleChannelSwitch(newChannelId) {
     pullKdm(newChannelId);
 }
 
-// 拉取KDM密钥
+// 通过HTTP拉取KDM密钥
+// 指定channelId时只拉取该频道的密钥，不移动全局游标
 async function pullKdm(channelId = null) {
     try {
-        console.log(`开始拉取KDM，上次版本: ${lastKdmVersionSeen}, 频道: ${channelId || '所有'}`);
-        
-        // 构建请求URL
-        let url = `/api/kdm/pending?after=${lastKdmVersionSeen}`;
-        if (channelId) {
-            url += `&channel_id=${channelId}`;
-        }
+        console.log(`开始拉取KDM，游标: ${kdmCursor}, 频道: ${channelId || '所有'}`);
         
-        // 发送请求
-        const response = await fetch(url);
-        if (!response.ok) {
-            throw new Error(`服务器返回错误: ${response.status}`);
-        }
-        
-        const data = await response.json();
-        console.log(`拉取到 ${data.count} 个挂起的KDM密钥, 最新版本: ${data.latest_version}`);
-        
-        if (data.count > 0) {
-            // 处理每个KDM密钥
+        let total = 0;
+        let hasMore = true;
+        let after = kdmCursor;
+        while (hasMore) {
+            let url = `/api/kdm/pending?after=${after}`;
+            if (channelId) {
+                url += `&channel_id=${channelId}`;
+            }
+            
+            const response = await fetch(url);
+            if (!response.ok) {
+                throw new Error(`服务器返回错误: ${response.status}`);
+            }
+            
+            const data = await response.json();
             for (const kdm of data.pending_keys) {
                 await processReceivedKdm(kdm);
             }
+            total += data.count;
             
-            // 更新最新版本号
-            if (data.latest_version > lastKdmVersionSeen) {
-                lastKdmVersionSeen = data.latest_version;
-                // 保存到本地存储
-                localStorage.setItem('last_kdm_version_seen', lastKdmVersionSeen.toString());
-                
-                // 向服务器确认接收
-                await acknowledgeKdm(channelId, lastKdmVersionSeen);
+            if (!channelId) {
+                advanceKdmCursor(data.cursor);
             }
+            hasMore = data.has_more && data.cursor > after;
+            after = data.cursor;
         }
         
-        return data.count;
+        console.log(`拉取到 ${total} 个KDM密钥, 游标: ${after}`);
+        return total;
     } catch (e) {
         console.error('拉取KDM失败:', e);
         return 0;
     }
 }
 
-// 确认接收KDM密钥
-async function acknowledgeKdm(channelId, version) {
+// 确认已处理到指定游标的KDM密钥
+async function acknowledgeKdm(cursor) {
     try {
-        console.log(`确认接收KDM版本: ${version}, 频道: ${channelId || '所有'}`);
-        
         const response = await fetch('/api/kdm/ack', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
                 'X-CSRFToken': ChannelEncryption.getCSRFToken()
             },
-            body: JSON.stringify({
-                channel_id: channelId || window.activeChannelId,
-                version: version
-            })
+            body: JSON.stringify({ cursor: cursor })
         });
         
         if (!response.ok) {
@@ -3439,8 +3640,6 @@ async function acknowledgeKdm(channelId, version) {
         }
         
         const data = await response.json();
-        console.log('KDM确认结果:', data);
-        
         return data.success;
     } catch (e) {
         console.error('确认KDM失败:', e);
@@ -3463,9 +3662,17 @@ async function processReceivedKdm(kdm) {
         if (success) {
             console.log(`成功处理频道 ${kdm.channel_id} 的KDM密钥`);
             
+            // 记录密钥版本，发送消息时会带上 sender_key_version
+            const storedKey = ChannelEncryption.channelKeys[kdm.channel_id];
+            if (storedKey && kdm.version) {
+                storedKey.version = kdm.version;
+                ChannelEncryption.saveChannelKeys();
+            }
+            
             // 如果当前在这个频道，更新UI
             if (window.activeChannelId == kdm.channel_id) {
                 ChannelEncryption.updateEncryptionIndicator(true);
+                ChannelEncryption.removeWaitingKeyMessage();
             }
             
             return true;
@@ -3521,7 +3728,7 @@ Object.assign(ChannelEncryption, {
     initKdmSync,
     pullKdm,
     handleDecryptionFailure,
-    getLastKdmVersion: () => lastKdmVersionSeen
+    getLastKdmVersion: () => kdmCursor
 });
 
 // 在文档加载完成后初始化KDM同步
@@ -922,7 +922,7 @@ function createMessageElement(message) {
     switch (message.message_type) {
         case 'text':
             // Normal text message
-            contentHtml = `<p class="text-sm text-gray-800 dark:text-gray-200 break-words message-content">${formatMessageContent(messageContent)}</p>`;
+            contentHtml = `<p class="text-sm text-gray-800 dark:text-gray-200 break-words message-content">${formatMessageContent(messageContent, message.attachments)}</p>`;
             break;
             
         case 'image':
@@ -943,7 +943,7 @@ function createMessageElement(message) {
             // Picture message
             contentHtml += `
                 <div class="mt-2">
-                    <img src="${imageUrl}" class="max-w-sm rounded border border-gray-200 dark:border-gray-700" alt="Shared image" loading="lazy" />
+                    <a href="${imageUrl}" target="_blank"><img src="${thumbnailFor(imageUrl, message.attachments)}" class="max-w-sm rounded border border-gray-200 dark:border-gray-700" alt="Shared image" loading="lazy" /></a>
                 </div>
             `;
             break;
@@ -1182,8 +1182,16 @@ function createMessageElement(message) {
     return messageDiv;
 }
 
+// Thumbnail url for an uploaded image referenced by a message (server-generated, see message.attachments)
+function thumbnailFor(url, attachments) {
+    if (!url || !Array.isArray(attachments)) return url;
+    const filename = url.trim().split('/').pop();
+    const attachment = attachments.find(item => item.filename === filename && item.thumbnail_url);
+    return attachment ? attachment.thumbnail_url : url;
+}
+
 // Format message content, process links, etc.
-function formatMessageContent(content) {
+function formatMessageContent(content, attachments) {
     if (!content) return '';
     
     // 确保content是字符串类型
@@ -1207,7 +1215,7 @@ function formatMessageContent(content) {
         formattedContent.includes('.gif')
     )) {
         // If the whole content looks like a picture url, it is converted to picture tag
-        return `<img src="${formattedContent}" alt="Uploaded Image" class="mt-2 max-w-xs rounded shadow-sm" style="max-height:300px;">`;
+        return `<a href="${formattedContent}" target="_blank"><img src="${thumbnailFor(formattedContent, attachments)}" alt="Uploaded Image" class="mt-2 max-w-xs rounded shadow-sm" style="max-height:300px;" loading="lazy"></a>`;
     }
     
     // Detect the picture of the static path and replace it with a new path
@@ -1289,6 +1297,7 @@ function setupMessageForm() {
         
         // Send a message
         sendMessage(content);
+        emitTyping(false);
         
         // Reset the input box
         messageInput.value = '';
@@ -1296,10 +1305,51 @@ function setupMessageForm() {
         messageInput.focus();
     };
 
+    // Typing signals are ephemeral: the server only relays them, at most one per 2 seconds
+    messageInput.addEventListener('input', function() {
+        emitTyping(messageInput.value.trim().length > 0);
+    });
+}
+
+// Typing indicator state
+let lastTypingEmit = 0;
+let typingActive = false;
+const typingUsers = {};
+
+function emitTyping(active) {
+    if (typeof socket === 'undefined' || !activeChannelId) return;
+    const now = Date.now();
+    if (active && typingActive && now - lastTypingEmit < 2000) return;
+    if (!active && !typingActive) return;
+    typingActive = active;
+    lastTypingEmit = now;
+    socket.emit('ephemeral', { type: 'typing', channel_id: activeChannelId, active: active });
+}
+
+function renderTypingIndicator() {
+    const messageForm = document.getElementById('messageForm');
+    if (!messageForm) return;
+    let indicator = document.getElementById('typingIndicator');
+    if (!indicator) {
+        indicator = document.createElement('div');
+        indicator.id = 'typingIndicator';
+        indicator.className = 'typing-indicator small text-muted px-2';
+        messageForm.parentNode.insertBefore(indicator, messageForm);
+    }
+    const names = Object.values(typingUsers)
+        .filter(entry => entry.channelId === activeChannelId)
+        .map(entry => entry.username);
+    if (names.length === 0) {
+        indicator.textContent = '';
+    } else if (names.length === 1) {
+        indicator.textContent = `${names[0]} is typing...`;
+    } else {
+        indicator.textContent = `${names.slice(0, 3).join(', ')} are typing...`;
+    }
 }
 
 // Send message to the server
-async function sendMessage(channelId, messageContent, messageType = 'text') {
+async function sendMessage(channelId, messageContent, messageType = 'text', fileIds = null) {
   if (!messageContent.trim()) return;
 
   // 检查频道是否启用了加密
@@ -1316,12 +1366,17 @@ async function sendMessage(channelId, messageContent, messageType = 'text') {
     }
     
     // 发送消息到服务器
-    socket.emit('send_message', {
+    const payload = {
       channel_id: channelId,
       content: encryptedContent,
       type: messageType,
       encrypted: isEncrypted
-    });
+    };
+    // Uploaded files referenced by this message (linked server-side, also for encrypted channels)
+    if (fileIds && fileIds.length) {
+      payload.file_ids = fileIds;
+    }
+    socket.emit('send_message', payload);
     
     // 清空消息输入框
     if (messageInputElement) {
@@ -1335,6 +1390,27 @@ async function sendMessage(channelId, messageContent, messageType = 'text') {
 
 // Initialize socket.io events
 function initSocketEvents() {
+    // Listen to ephemeral typing signals (never persisted)
+    socket.on('ephemeral', function(data) {
+        if (!data || data.type !== 'typing' || !data.channel_id || data.user_id === window.currentUserId) return;
+        const key = `${data.channel_id}:${data.user_id}`;
+        if (typingUsers[key]) clearTimeout(typingUsers[key].timer);
+        if (data.active) {
+            typingUsers[key] = {
+                channelId: data.channel_id,
+                username: data.username || 'Someone',
+                // Expire if no refresh arrives within the coalescing window
+                timer: setTimeout(function() {
+                    delete typingUsers[key];
+                    renderTypingIndicator();
+                }, 5000)
+            };
+        } else {
+            delete typingUsers[key];
+        }
+        renderTypingIndicator();
+    });
+
     // Listen to message events
     socket.on('message', function(message) {
         console.log('Received message:', message);
@@ -2139,17 +2215,21 @@ function uploadFile(file, textContent) {
     `;
     document.body.appendChild(indicator);
     
-    // Send a request
-    fetch('/api/upload', {
-        method: 'POST',
-        body: formData
-    })
-    .then(response => {
-        if (!response.ok) {
-            throw new Error(`Upload failed: ${response.status}`);
-        }
-        return response.json();
-    })
+    // Send a request - large files use the resumable chunked API (chunked-upload.js)
+    const uploadRequest = (window.ChunkedUpload && file.size > window.ChunkedUpload.THRESHOLD)
+        ? window.ChunkedUpload.upload(file, {channelId: activeChannelId})
+        : fetch('/api/upload', {
+            method: 'POST',
+            body: formData
+        })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`Upload failed: ${response.status}`);
+            }
+            return response.json();
+        });
+    
+    uploadRequest
     .then(data => {
         console.log('Upload response:', data);
         
@@ -2172,23 +2252,8 @@ function uploadFile(file, textContent) {
             else if (file.type.includes('audio/')) messageType = 'audio';
             else if (file.type.includes('video/')) messageType = 'video';
             
-            // Get file name and description from server return data
-            const fileName = data.file.name || file.name;
-            const fileDescription = data.file.description || data.file.original_name || fileName.split('.')[0];
-            
-            // Send a message
-            socket.emit('message', {
-                channel_id: activeChannelId,
-                content: messageContent,
-                message_type: messageType,
-                file_info: {
-                    name: fileName,
-                    size: file.size,
-                    type: file.type,
-                    url: fileUrl,  // Use normalized url
-                    description: fileDescription
-                }
-            });
+            // Send a message (the file_id links the upload to the message in the channel's file list)
+            sendMessage(activeChannelId, messageContent, messageType, data.file.file_id ? [data.file.file_id] : null);
             
             // Clear input and preview
             const messageInput = document.getElementById('messageInput');
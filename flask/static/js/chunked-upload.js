@@ -0,0 +1,134 @@
+/**
+ * Resumable chunked upload client
+ *
+ * Large files are sent to /api/uploads in chunks. The upload id is kept in localStorage
+ * (keyed by name, size and lastModified), so a failed or interrupted upload resumes
+ * from the server's offset instead of starting over, even after a page reload.
+ * The finalize response has the same shape as /api/upload.
+ */
+(function() {
+    const STORAGE_PREFIX = 'chunked_upload:';
+    const MAX_RETRIES = 5;
+
+    function csrfToken() {
+        const meta = document.querySelector('meta[name="csrf-token"]');
+        return meta ? meta.getAttribute('content') : '';
+    }
+
+    function storageKey(file) {
+        return STORAGE_PREFIX + [file.name, file.size, file.lastModified].join(':');
+    }
+
+    async function request(method, url, body, headers) {
+        const response = await fetch(url, {
+            method: method,
+            credentials: 'same-origin',
+            headers: Object.assign({'X-CSRFToken': csrfToken()}, headers || {}),
+            body: body
+        });
+        let data = {};
+        try {
+            data = await response.json();
+        } catch (e) {
+            // Non-JSON error page
+        }
+        return {status: response.status, data: data};
+    }
+
+    async function sha256Hex(buffer) {
+        if (!window.crypto || !window.crypto.subtle) {
+            return null;
+        }
+        const digest = await window.crypto.subtle.digest('SHA-256', buffer);
+        return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+    }
+
+    function sleep(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+
+    async function resumeOrCreate(file) {
+        const key = storageKey(file);
+        const savedId = localStorage.getItem(key);
+        if (savedId) {
+            const result = await request('GET', `/api/uploads/${savedId}`);
+            if (result.status === 200 && result.data.upload && result.data.upload.status === 'uploading') {
+                return result.data.upload;
+            }
+            localStorage.removeItem(key);
+        }
+
+        const result = await request('POST', '/api/uploads', JSON.stringify({
+            filename: file.name,
+            size: file.size
+        }), {'Content-Type': 'application/json'});
+        if (result.status !== 201 || !result.data.success) {
+            throw new Error(result.data.message || `Upload failed: ${result.status}`);
+        }
+        localStorage.setItem(key, result.data.upload.upload_id);
+        return result.data.upload;
+    }
+
+    /**
+     * Upload a file in resumable chunks
+     * @param {File} file File to upload
+     * @param {Object} options {onProgress(sent, total), channelId}
+     * @returns {Promise<Object>} Same JSON as /api/upload ({success, message, file})
+     */
+    async function upload(file, options) {
+        const onProgress = (options && options.onProgress) || function() {};
+        const upload = await resumeOrCreate(file);
+        const uploadId = upload.upload_id;
+        let offset = upload.offset;
+        let retries = 0;
+        onProgress(offset, file.size);
+
+        while (offset < file.size) {
+            const chunk = await file.slice(offset, offset + upload.chunk_size).arrayBuffer();
+            const checksum = await sha256Hex(chunk);
+            const headers = {'Content-Type': 'application/octet-stream'};
+            if (checksum) {
+                headers['X-Chunk-SHA256'] = checksum;
+            }
+
+            let result;
+            try {
+                result = await request('PUT', `/api/uploads/${uploadId}?offset=${offset}`, chunk, headers);
+            } catch (error) {
+                result = {status: 0, data: {}};
+            }
+
+            if (result.status === 200 && result.data.success) {
+                offset = result.data.upload.offset;
+                retries = 0;
+                onProgress(offset, file.size);
+                continue;
+            }
+            // The server reports where to continue from (e.g. a previous attempt did arrive)
+            if (typeof result.data.offset === 'number' && result.status === 409) {
+                offset = result.data.offset;
+                continue;
+            }
+            if (result.status === 404 || ++retries > MAX_RETRIES) {
+                localStorage.removeItem(storageKey(file));
+                throw new Error(result.data.message || `Upload failed: ${result.status}`);
+            }
+            await sleep(Math.min(1000 * Math.pow(2, retries - 1), 10000));
+        }
+
+        const result = await request('POST', `/api/uploads/${uploadId}/finalize`, JSON.stringify({
+            channel_id: (options && options.channelId) || null
+        }), {'Content-Type': 'application/json'});
+        localStorage.removeItem(storageKey(file));
+        if (result.status !== 200 || !result.data.success) {
+            throw new Error(result.data.message || `Upload failed: ${result.status}`);
+        }
+        return result.data;
+    }
+
+    window.ChunkedUpload = {
+        // Files above this size use the chunked API instead of a single /api/upload request
+        THRESHOLD: 8 * 1024 * 1024,
+        upload: upload
+    };
+})();
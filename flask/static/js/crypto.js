@@ -44,6 +44,72 @@ const b64Utils = {
     }
 };
 
+/**
+ * 二进制密文传输
+ * 以binary_ciphertext=1连接的Socket收到的密文是ArrayBuffer，
+ * 在事件处理函数执行前转换回原来的base64字段和JSON信封，现有的解密代码不需要修改
+ */
+const ciphertextWire = {
+    DM_FIELDS: ['encrypted_content', 'iv', 'encrypted_for_self', 'iv_for_self'],
+
+    isBinary: function(value) {
+        return value instanceof ArrayBuffer || ArrayBuffer.isView(value);
+    },
+
+    toBase64: function(value) {
+        const bytes = value instanceof ArrayBuffer ? new Uint8Array(value)
+            : new Uint8Array(value.buffer, value.byteOffset, value.byteLength);
+        // 分段转换，避免大数组超出apply的参数个数限制
+        let binary = '';
+        for (let i = 0; i < bytes.length; i += 0x8000) {
+            binary += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+        }
+        return btoa(binary);
+    },
+
+    /**
+     * 原地转换事件数据
+     * @param {Object} data Socket事件数据
+     */
+    normalize: function(data) {
+        if (!data || typeof data !== 'object') {
+            return data;
+        }
+        this.DM_FIELDS.forEach(field => {
+            if (this.isBinary(data[field])) {
+                data[field] = this.toBase64(data[field]);
+            }
+        });
+        if (this.isBinary(data.ciphertext)) {
+            const envelope = {
+                encrypted: true,
+                content: this.toBase64(data.ciphertext),
+                version: '1.0'
+            };
+            if (this.isBinary(data.nonce)) {
+                envelope.nonce = this.toBase64(data.nonce);
+            }
+            if (data.sender_key_version !== undefined && data.sender_key_version !== null) {
+                envelope.sender_key_version = data.sender_key_version;
+            }
+            data.content = JSON.stringify(envelope);
+            delete data.ciphertext;
+            delete data.nonce;
+            delete data.sender_key_version;
+        }
+        return data;
+    },
+
+    /**
+     * 在所有事件处理函数之前转换密文
+     * @param {Object} socket Socket.IO客户端
+     */
+    attach: function(socket) {
+        socket.prependAny((event, data) => this.normalize(data));
+    }
+};
+window.ciphertextWire = ciphertextWire;
+
 /**
  * 获取CSRF令牌
  * @returns {string} CSRF令牌值
@@ -0,0 +1,257 @@
+"""
+静态资源打包
+页面原来逐个引用 static/js 和 static/css 下的几十个文件，而且没有版本号，每次冷启动都要发出几十个请求。
+`flask assets build` 按页面把脚本和样式表合并、压缩，文件名带内容哈希，并生成 .gz/.br 预压缩文件：
+
+- BUNDLES 定义每个包包含的源文件（按原来的加载顺序）；同一个包中的脚本合并为一个 <script>，
+  因此在模板中原来相邻、加载方式（同步/defer）相同的脚本才放在同一个包里
+- 结果写入 static/dist/，清单 static/dist/manifest.json 记录包名到文件名的映射
+- 模板中使用 asset_url('<包名>')：有清单时指向带哈希的文件（一年缓存、immutable），
+  没有构建时指向即时合并的未压缩版本（不缓存），开发时修改源文件不需要重新构建
+
+压缩使用可选依赖 rjsmin / rcssmin / brotli，未安装时分别跳过压缩和 .br 文件
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+
+import click
+from flask import current_app, url_for
+from flask.cli import AppGroup
+
+try:
+    import rjsmin
+except ImportError:  # 可选依赖：不压缩脚本
+    rjsmin = None
+
+try:
+    import rcssmin
+except ImportError:  # 可选依赖：不压缩样式表
+    rcssmin = None
+
+try:
+    import brotli
+except ImportError:  # 可选依赖：不生成 .br 文件
+    brotli = None
+
+# 包名 -> 源文件（相对static目录，按加载顺序）
+BUNDLES = {
+    # chat.html
+    'chat.css': ['css/style.css', 'css/direct-message.css', 'css/e2ee.css'],
+    'chat-crypto.js': ['js/lib/nacl-util.js', 'js/lib/tweetnacl.min.js'],
+    'chat-deferred.js': ['js/resource-fixes.js', 'js/chunked-upload.js', 'js/channel-manager.js'],
+    'chat-head.js': ['js/crypto.js', 'js/channel-encryption.js', 'js/e2ee_settings.js',
+                     'js/direct_messages.js', 'js/offline-crypto-api.js'],
+    'chat-main.js': ['js/common.js', 'js/ui-effects.js', 'js/panels.js', 'js/ui-fixes.js', 'js/pin-handler.js',
+                     'js/app.js', 'js/messages.js', 'js/search.js', 'js/test-api.js',
+                     'js/online-users-manager.js'],
+    'chat-tail.js': ['js/file-previewer.js', 'js/saved-items-manager.js'],
+    # mention-manager.js 与 saved-items-manager.js 都在顶层声明了 itemsPerPage，合并后会让两个文件都无法执行
+    'chat-mentions.js': ['js/mention-manager.js'],
+    # index.html
+    'index.css': ['css/style.css'],
+    # login / register / forgot-password / reset-password / error
+    'auth.css': ['css/style.css', 'css/components.css', 'css/animations.css', 'css/forms.css',
+                 'css/effects/water-ripple.css'],
+    'auth.js': ['js/effects/water-ripple.js', 'js/ui-effects.js'],
+    'register.js': ['js/effects/water-ripple.js', 'js/ui-effects.js', 'js/register.js']
+}
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+
+MIMETYPES = {
+    '.js': 'application/javascript',
+    '.css': 'text/css'
+}
+
+# 顶层的 let/const/class 声明：同一个脚本中重复声明是语法错误，会让整个包无法执行
+_TOP_LEVEL_DECLARATION = re.compile(r'^(?:let|const|class)\s+([A-Za-z_$][\w$]*)', re.MULTILINE)
+_CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+_FINGERPRINTED = re.compile(r'^(.+)\.[0-9a-f]{12}(\.[a-z]+)$')
+
+# 当前使用的清单，init_app() 时加载
+_manifest = {}
+
+
+def bundle_type(name):
+    """包的扩展名 .js / .css"""
+    return os.path.splitext(name)[1]
+
+
+def _read(static_folder, source):
+    with open(os.path.join(static_folder, *source.split('/')), encoding='utf-8') as f:
+        return f.read()
+
+
+def _rewrite_css_urls(text, source, static_url):
+    """把样式表中的相对路径改为绝对路径，合并到 dist/ 之后仍然指向原文件"""
+    base = os.path.dirname(source)
+
+    def replace(match):
+        quote, url = match.group(1), match.group(2).strip()
+        if url.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+            return match.group(0)
+        resolved = os.path.normpath(os.path.join(base, url)).replace(os.sep, '/')
+        return f'url({quote}{static_url}/{resolved}{quote})'
+
+    return _CSS_URL.sub(replace, text)
+
+
+def _check_declarations(name, sources, texts):
+    """检查同一个包中是否有重复的顶层声明"""
+    declared = {}
+    for source, text in zip(sources, texts):
+        for identifier in _TOP_LEVEL_DECLARATION.findall(text):
+            if identifier in declared and declared[identifier] != source:
+                raise ValueError(f'{name}: {source} 与 {declared[identifier]} 都在顶层声明了 {identifier}，不能合并')
+            declared[identifier] = source
+
+
+def bundle_source(static_folder, name, static_url='/static', minify=False):
+    """
+    合并一个包的源文件
+
+    参数:
+        static_folder: static目录
+        name: 包名
+        static_url: static目录的URL前缀（改写样式表中的相对路径）
+        minify: 是否压缩（需要 rjsmin / rcssmin）
+
+    返回:
+        str: 合并后的内容
+    """
+    sources = BUNDLES[name]
+    texts = [_read(static_folder, source) for source in sources]
+    kind = bundle_type(name)
+    parts = []
+    if kind == '.js':
+        _check_declarations(name, sources, texts)
+        for source, text in zip(sources, texts):
+            if minify and rjsmin is not None and not source.endswith('.min.js'):
+                text = rjsmin.jsmin(text)
+            # 分号避免上一个文件没有以分号结尾时与下一个文件连在一起
+            parts.append(text if minify else f'/* {source} */\n{text}')
+        return '\n;\n'.join(parts) + '\n'
+
+    for source, text in zip(sources, texts):
+        text = _rewrite_css_urls(text, source, static_url)
+        if minify and rcssmin is not None:
+            text = rcssmin.cssmin(text)
+        parts.append(text if minify else f'/* {source} */\n{text}')
+    return '\n'.join(parts) + '\n'
+
+
+def _write(path, data):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def build(static_folder, static_url='/static', minify=True, gzip_level=9, brotli_quality=11):
+    """
+    构建所有包，写入 static/dist/ 并更新清单
+    只保留本次和上一次构建的文件，部署期间仍在使用旧页面的客户端可以继续加载
+
+    返回:
+        dict: 新的清单
+    """
+    dist = os.path.join(static_folder, DIST_DIR)
+    os.makedirs(dist, exist_ok=True)
+    previous = load_manifest(static_folder)
+    manifest = {}
+    for name in BUNDLES:
+        data = bundle_source(static_folder, name, static_url, minify).encode('utf-8')
+        stem, kind = os.path.splitext(name)
+        filename = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{kind}'
+        path = os.path.join(dist, filename)
+        _write(path, data)
+        entry = {'file': filename, 'size': len(data), 'sources': BUNDLES[name]}
+
+        # 压缩后更大的文件不保存，服务时会退回到原文件
+        compressed = gzip.compress(data, compresslevel=gzip_level, mtime=0)
+        if len(compressed) < len(data):
+            _write(f'{path}.gz', compressed)
+            entry['gzip'] = len(compressed)
+        if brotli is not None:
+            compressed = brotli.compress(data, quality=brotli_quality)
+            if len(compressed) < len(data):
+                _write(f'{path}.br', compressed)
+                entry['brotli'] = len(compressed)
+        manifest[name] = entry
+
+    _write(os.path.join(dist, MANIFEST), json.dumps(manifest, indent=2, ensure_ascii=False).encode('utf-8'))
+
+    keep = {entry['file'] for entry in list(manifest.values()) + list(previous.values())}
+    with os.scandir(dist) as entries:
+        for entry in entries:
+            base = re.sub(r'\.(gz|br)$', '', entry.name)
+            if entry.is_file() and entry.name != MANIFEST and base not in keep:
+                os.remove(entry.path)
+    return manifest
+
+
+def load_manifest(static_folder):
+    """读取清单，没有构建过时返回空字典"""
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def built_file(filename):
+    """
+    filename 是否为某个包的带哈希文件名（<名称>.<12位哈希><扩展名>）
+    不只看当前清单：构建保留了上一次的文件，部署后旧页面引用的URL仍然可以加载，
+    文件是否存在由调用方检查
+    """
+    match = _FINGERPRINTED.match(filename)
+    return match is not None and f'{match.group(1)}{match.group(2)}' in BUNDLES
+
+
+def asset_url(name):
+    """模板中使用的包URL：构建过时为带哈希的文件，否则为即时合并的版本"""
+    entry = _manifest.get(name)
+    return url_for('assets.asset', filename=entry['file'] if entry else name)
+
+
+assets_cli = AppGroup('assets', help='静态资源打包')
+
+
+@assets_cli.command('build')
+@click.option('--no-minify', is_flag=True, help='只合并，不压缩')
+def build_command(no_minify):
+    """合并、压缩所有包并生成带哈希的文件名和 .gz/.br 文件"""
+    if not no_minify and (rjsmin is None or rcssmin is None):
+        click.echo('未安装 rjsmin/rcssmin，只合并不压缩')
+    if brotli is None:
+        click.echo('未安装 brotli，跳过 .br 文件')
+    try:
+        manifest = build(current_app.static_folder, current_app.static_url_path, minify=not no_minify,
+                         gzip_level=current_app.config.get('ASSETS_GZIP_LEVEL', 9),
+                         brotli_quality=current_app.config.get('ASSETS_BROTLI_QUALITY', 11))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    source_total = 0
+    for name, entry in manifest.items():
+        size = sum(os.path.getsize(os.path.join(current_app.static_folder, *source.split('/')))
+                   for source in entry['sources'])
+        source_total += size
+        click.echo(f"{entry['file']}: {len(entry['sources'])} 个文件 {size} -> {entry['size']} 字节"
+                   f"（gzip {entry.get('gzip', '-')}，brotli {entry.get('brotli', '-')}）")
+    click.echo(f"共 {len(manifest)} 个包，源文件 {source_total} 字节 -> {sum(e['size'] for e in manifest.values())} 字节")
+    _manifest.clear()
+    _manifest.update(manifest)
+
+
+def init_app(app):
+    """加载清单，注册模板函数 asset_url 和 `flask assets` 命令"""
+    _manifest.clear()
+    if app.config.get('ASSETS_USE_BUNDLES', True):
+        _manifest.update(load_manifest(app.static_folder))
+    app.add_template_global(asset_url)
+    app.cli.add_command(assets_cli)
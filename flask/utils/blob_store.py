@@ -0,0 +1,338 @@
+"""
+按内容寻址的上传文件存储
+上传的文件按SHA-256保存在分层目录 `<UPLOAD_FOLDER>/blobs/ab/cd/<sha256>` 中，相同内容只保存一份：
+
+1. upload_blobs 记录每份内容的大小、存储路径和引用计数
+2. upload_aliases 把用户可见的文件名（URL中的 `<name>_<uuid>.<ext>`）映射到内容，
+   重复上传相同的文件只新增一条别名记录，不再写入新文件
+3. 引用计数为0的内容不会立即删除，由 utils/upload_gc.py 在宽限期之后移入隔离目录，再过一段时间才删除；
+   隔离期间重新上传相同内容会清空 quarantined_at 并重新写入文件
+
+本模块不依赖Flask，迁移脚本也可以直接使用；上传目录由调用方传入
+"""
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# 读写文件的块大小
+READ_SIZE = 64 * 1024
+
+BLOB_DIR = 'blobs'
+
+_stats_lock = threading.Lock()
+_stats = {
+    'stored': 0,
+    'deduplicated': 0,
+    'bytes_stored': 0,
+    'bytes_saved': 0,
+    'released': 0
+}
+
+
+def _count(**deltas):
+    with _stats_lock:
+        for key, value in deltas.items():
+            _stats[key] += value
+
+
+def storage_path(sha256):
+    """内容相对上传目录的存储路径（数据库中统一使用 / 分隔）"""
+    return f'{BLOB_DIR}/{sha256[:2]}/{sha256[2:4]}/{sha256}'
+
+
+def absolute_path(root, relative_path):
+    """把数据库中的存储路径转换为文件系统路径"""
+    return os.path.join(root, *relative_path.split('/'))
+
+
+def quarantine_path(quarantine_root, sha256):
+    """内容在隔离目录中的路径"""
+    return os.path.join(quarantine_root, sha256[:2], sha256[2:4], sha256)
+
+
+def spool_stream(stream, tmp_dir):
+    """
+    把上传流写入临时文件，同时计算SHA-256
+
+    参数:
+        stream: 可读的文件对象
+        tmp_dir: 临时目录
+
+    返回:
+        (tmp_path, sha256, size)
+    """
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, f'{uuid.uuid4().hex}.spool')
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                data = stream.read(READ_SIZE)
+                if not data:
+                    break
+                f.write(data)
+                digest.update(data)
+                size += len(data)
+    except Exception:
+        discard(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), size
+
+
+def discard(path):
+    """删除临时文件，文件不存在时忽略"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def store(conn, root, src_path, sha256, size):
+    """
+    把临时文件存入内容存储（不提交事务）
+    内容已存在时直接删除临时文件，只在数据库中登记
+
+    参数:
+        conn: 数据库连接
+        root: 上传目录
+        src_path: 已写完的临时文件，调用后不再存在
+        sha256: 文件内容的SHA-256
+        size: 文件字节数
+
+    返回:
+        dict: {sha256, size, storage_path, path, deduplicated}
+    """
+    relative_path = storage_path(sha256)
+    path = absolute_path(root, relative_path)
+    # 先写入记录再检查文件：写锁一直持有到提交，回收任务移动文件前也要取得写锁，
+    # 因此这里看到的文件在提交前不会被移走；已隔离的内容重新登记为正常状态
+    conn.execute('''
+        INSERT INTO upload_blobs (sha256, size, storage_path) VALUES (?, ?, ?)
+        ON CONFLICT(sha256) DO UPDATE SET quarantined_at = NULL WHERE quarantined_at IS NOT NULL
+    ''', (sha256, size, relative_path))
+
+    deduplicated = os.path.isfile(path)
+    if deduplicated:
+        discard(src_path)
+        _count(deduplicated=1, bytes_saved=size)
+    else:
+        # 同一内容并发写入时替换的是相同的字节，结果一致
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src_path, path)
+        _count(stored=1, bytes_stored=size)
+    return {
+        'sha256': sha256,
+        'size': size,
+        'storage_path': relative_path,
+        'path': path,
+        'deduplicated': deduplicated
+    }
+
+
+def add_alias(conn, filename, sha256, original_filename, user_id=None):
+    """
+    登记一个指向内容的文件名，并增加内容的引用计数（不提交事务）
+
+    参数:
+        conn: 数据库连接
+        filename: URL中使用的文件名，全局唯一
+        sha256: 内容的SHA-256，必须已经通过 store() 登记
+        original_filename: 用户上传时的文件名
+        user_id: 上传者
+    """
+    conn.execute('''
+        INSERT INTO upload_aliases (filename, sha256, original_filename, user_id)
+        VALUES (?, ?, ?, ?)
+    ''', (filename, sha256, original_filename, user_id))
+    conn.execute('''
+        UPDATE upload_blobs
+        SET ref_count = ref_count + 1, last_referenced_at = CURRENT_TIMESTAMP
+        WHERE sha256 = ?
+    ''', (sha256,))
+
+
+def save(conn, root, src_path, sha256, size, filename, original_filename, user_id=None):
+    """
+    存入内容并登记文件名（会提交事务）
+
+    返回:
+        dict: 同 store()
+    """
+    try:
+        blob = store(conn, root, src_path, sha256, size)
+        add_alias(conn, filename, sha256, original_filename, user_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return blob
+
+
+def resolve(conn, filename):
+    """
+    查找文件名对应的内容
+
+    返回:
+        sqlite3.Row: sha256, size, storage_path, original_filename, created_at；不存在时返回None
+    """
+    return conn.execute('''
+        SELECT b.sha256, b.size, b.storage_path, a.original_filename, a.created_at
+        FROM upload_aliases a
+        JOIN upload_blobs b ON b.sha256 = a.sha256
+        WHERE a.filename = ?
+    ''', (filename,)).fetchone()
+
+
+def release(conn, filename):
+    """
+    删除文件名并减少内容的引用计数（不提交事务）
+    内容本身保留，引用计数为0后由清理任务在宽限期之后删除
+
+    返回:
+        bool: 文件名是否存在
+    """
+    alias = conn.execute('SELECT sha256 FROM upload_aliases WHERE filename = ?', (filename,)).fetchone()
+    if not alias:
+        return False
+    conn.execute('DELETE FROM upload_aliases WHERE filename = ?', (filename,))
+    alias_cache.invalidate(filename)
+    conn.execute('''
+        UPDATE upload_blobs
+        SET ref_count = MAX(ref_count - 1, 0), last_referenced_at = CURRENT_TIMESTAMP
+        WHERE sha256 = ?
+    ''', (alias['sha256'],))
+    _count(released=1)
+    return True
+
+
+def import_file(conn, root, path, filename, original_filename=None, user_id=None):
+    """
+    把上传目录中按旧方式保存的文件移入内容存储，原文件名作为别名保留（不提交事务）
+
+    返回:
+        dict: 同 store()；文件名已登记过时返回None
+    """
+    if conn.execute('SELECT 1 FROM upload_aliases WHERE filename = ?', (filename,)).fetchone():
+        return None
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+            size += len(data)
+    sha256 = digest.hexdigest()
+    blob = store(conn, root, path, sha256, size)
+    add_alias(conn, filename, sha256, original_filename or filename, user_id)
+    return blob
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+class AliasCache:
+    """
+    文件名 -> 内容 的TTL + LRU缓存，读取上传文件时不必每次查询数据库
+
+    别名创建后不会改变，只会被删除；本进程删除时立即失效，
+    其他进程最多在 TTL 时间内仍然指向原内容（内容在宽限期内不会被删除）。
+    只缓存查到的结果，旧文件名和不存在的文件名每次都会查询。
+
+    参数:
+        maxsize: 最大条目数
+        ttl: 条目有效期（秒）
+    """
+
+    def __init__(self, maxsize=4096, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def configure(self, maxsize=None, ttl=None):
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if ttl is not None:
+            self.ttl = ttl
+
+    def get(self, key):
+        """获取缓存的值，未命中或已过期时返回None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+def cached_resolve(get_conn, filename):
+    """
+    带缓存的 resolve()
+
+    参数:
+        get_conn: 未命中时获取数据库连接的函数，连接用完后关闭
+        filename: 文件名
+
+    返回:
+        dict，不存在时返回None
+    """
+    blob = alias_cache.get(filename)
+    if blob is not None:
+        return blob
+    conn = get_conn()
+    try:
+        row = resolve(conn, filename)
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    blob = dict(row)
+    alias_cache.set(filename, blob)
+    return blob
+
+
+# 进程级文件名缓存
+alias_cache = AliasCache()
@@ -0,0 +1,266 @@
+"""
+聊天页面初始状态
+/chat 原来对每个聊天室单独查询频道（N+1），并把系统中所有用户都作为私信联系人逐行转换后渲染，
+页面加载后前端还要再调用一串接口获取加密状态、固定消息等。
+这里用固定数量的集合查询构建页面需要的全部初始状态，以一个JSON嵌入页面：
+
+- 聊天室及用户在其中的角色
+- 这些聊天室中的所有频道：成员关系、静音、加密状态、固定消息数（一次查询）
+- 最近的私信会话：最后一条消息时间和未读数（私信会话索引 dm_conversations）
+- 补足的私信联系人（有上限，不再加载所有用户）
+
+频道没有按用户记录的已读位置，因此只有私信有未读数。
+完整状态用于服务端渲染侧边栏；嵌入页面的JSON只包含前端脚本实际读取的字段（client_state()）。
+结果按用户缓存（TTL + LRU），私信收发、已读时使相关用户的缓存失效，
+频道结构、成员、固定消息、加密状态变化时使全部缓存失效。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from utils import dm_index
+from utils.db import get_db_connection
+
+DEFAULT_CONVERSATION_LIMIT = 30
+DEFAULT_CONTACT_LIMIT = 50
+
+
+def _rooms(conn, user_id):
+    return conn.execute('''
+        SELECT r.room_id, r.room_name, r.description, r.is_private, ur.role
+        FROM user_rooms ur
+        JOIN rooms r ON r.room_id = ur.room_id
+        WHERE ur.user_id = ?
+        ORDER BY r.room_id
+    ''', (user_id,)).fetchall()
+
+
+def _channels(conn, user_id):
+    # idx_user_rooms_user -> idx_channels_room；成员关系和加密状态按主键连接，固定消息数走 idx_pinned_messages_channel
+    return conn.execute('''
+        SELECT c.channel_id, c.room_id, c.channel_name, c.description, c.is_private,
+               uc.user_id IS NOT NULL AS is_member,
+               COALESCE(uc.is_muted, 0) AS is_muted,
+               COALESCE(ce.enabled, c.is_encrypted, 0) AS encrypted,
+               (SELECT COUNT(*) FROM pinned_messages pm WHERE pm.channel_id = c.channel_id) AS pinned_count
+        FROM user_rooms ur
+        JOIN channels c ON c.room_id = ur.room_id
+        LEFT JOIN user_channels uc ON uc.channel_id = c.channel_id AND uc.user_id = ur.user_id
+        LEFT JOIN channel_encryption ce ON ce.channel_id = c.channel_id
+        WHERE ur.user_id = ?
+        ORDER BY c.room_id, c.channel_id
+    ''', (user_id,)).fetchall()
+
+
+def _conversations(conn, user_id, limit):
+    # 会话索引 idx_dm_conversations_recent（utils/dm_index.py）
+    rows, _ = dm_index.list_conversations(conn, user_id, limit=limit)
+    return rows
+
+
+def _unread_total(conn, user_id):
+    # 所有会话的未读数，不只是第一页
+    row = conn.execute('SELECT COALESCE(SUM(unread_count), 0) FROM dm_conversations WHERE user_id = ?',
+                       (user_id,)).fetchone()
+    return row[0]
+
+
+def _contacts(conn, user_id, limit):
+    return conn.execute('''
+        SELECT user_id, username, avatar_url, is_active AS is_online
+        FROM users
+        WHERE user_id != ?
+        ORDER BY is_active DESC, username
+        LIMIT ?
+    ''', (user_id, limit)).fetchall()
+
+
+def build(conn, user_id, conversation_limit=DEFAULT_CONVERSATION_LIMIT, contact_limit=DEFAULT_CONTACT_LIMIT):
+    """
+    构建聊天页面的初始状态（5条查询，与聊天室、频道和用户数量无关）
+
+    参数:
+        conn: 数据库连接
+        user_id: 当前用户ID
+        conversation_limit: 最多返回的私信会话数
+        contact_limit: 最多补充的其他联系人数
+
+    返回:
+        dict: rooms / channels / conversations / contacts / unread_direct_messages / active_channel_id
+    """
+    rooms = [{
+        'room_id': row['room_id'],
+        'room_name': row['room_name'],
+        'description': row['description'],
+        'is_private': bool(row['is_private']),
+        'role': row['role']
+    } for row in _rooms(conn, user_id)]
+
+    channels = [{
+        'channel_id': row['channel_id'],
+        'room_id': row['room_id'],
+        'channel_name': row['channel_name'],
+        'description': row['description'],
+        'is_private': bool(row['is_private']),
+        'is_member': bool(row['is_member']),
+        'is_muted': bool(row['is_muted']),
+        'encrypted': bool(row['encrypted']),
+        'pinned_count': row['pinned_count']
+    } for row in _channels(conn, user_id)]
+
+    conversations = [dm_index.conversation_info(row) for row in _conversations(conn, user_id, conversation_limit)]
+
+    # 多取会话数条，去掉已经在会话列表中的用户后仍能补足 contact_limit
+    partners = {conversation['user_id'] for conversation in conversations}
+    contacts = [{
+        'user_id': row['user_id'],
+        'username': row['username'],
+        'avatar_url': row['avatar_url'],
+        'is_online': bool(row['is_online'])
+    } for row in _contacts(conn, user_id, contact_limit + len(partners))
+        if row['user_id'] not in partners][:contact_limit]
+
+    return {
+        'rooms': rooms,
+        'channels': channels,
+        'conversations': conversations,
+        'contacts': contacts,
+        'unread_direct_messages': _unread_total(conn, user_id),
+        'active_channel_id': channels[0]['channel_id'] if channels else None,
+        'generated_at': int(time.time())
+    }
+
+
+def client_state(state):
+    """
+    嵌入页面（window.CHAT_BOOTSTRAP）的部分：目前前端只读取频道的加密状态，
+    私信会话、未读数和固定消息数已经渲染在侧边栏中，不重复嵌入
+    """
+    return {
+        'channels': [{'channel_id': channel['channel_id'], 'encrypted': channel['encrypted']}
+                     for channel in state['channels']]
+    }
+
+
+class BootstrapCache:
+    """
+    按用户的 TTL + LRU 初始状态缓存
+
+    构建前先取 token()，写入时 token 已变化（构建期间发生了失效）则丢弃结果，
+    避免把失效前读到的旧状态写回缓存
+
+    参数:
+        maxsize: 最大缓存用户数
+        ttl: 条目有效期（秒）
+    """
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # user_id -> (expires_at, token, state)
+        self._versions = {}  # user_id -> int
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_writes = 0
+
+    def configure(self, maxsize=None, ttl=None):
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if ttl is not None:
+            self.ttl = ttl
+
+    def token(self, user_id):
+        """用户状态的当前版本"""
+        with self._lock:
+            return self._generation, self._versions.get(user_id, 0)
+
+    def get(self, user_id):
+        """获取缓存的初始状态，未命中、已过期或已失效时返回None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= now or entry[1] != (self._generation, self._versions.get(user_id, 0)):
+                del self._data[user_id]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, user_id, token, state):
+        """写入缓存，token 与当前版本不一致时不写入"""
+        with self._lock:
+            if token != (self._generation, self._versions.get(user_id, 0)):
+                self.stale_writes += 1
+                return
+            self._data[user_id] = (time.monotonic() + self.ttl, token, state)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *user_ids):
+        """私信收发、已读等只影响部分用户的变化"""
+        with self._lock:
+            for user_id in user_ids:
+                try:
+                    user_id = int(user_id)
+                except (TypeError, ValueError):
+                    continue
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+                if self._data.pop(user_id, None) is not None:
+                    self.invalidations += 1
+
+    def invalidate_all(self):
+        """频道、成员、固定消息、加密状态等影响多个用户的变化"""
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def clear(self):
+        self.invalidate_all()
+
+    def stats(self):
+        """返回缓存命中统计"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'generation': self._generation,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expirations': self.expirations,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'stale_writes': self.stale_writes,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+# 进程级初始状态缓存
+bootstrap_cache = BootstrapCache()
+
+
+def get_state(user_id, conversation_limit=DEFAULT_CONVERSATION_LIMIT, contact_limit=DEFAULT_CONTACT_LIMIT):
+    """读取缓存的初始状态，未命中时构建并写入缓存（命中时不打开数据库连接）"""
+    state = bootstrap_cache.get(user_id)
+    if state is None:
+        token = bootstrap_cache.token(user_id)
+        conn = get_db_connection()
+        try:
+            state = build(conn, user_id, conversation_limit, contact_limit)
+        finally:
+            conn.close()
+        bootstrap_cache.set(user_id, token, state)
+    return state
@@ -0,0 +1,209 @@
+"""
+频道密钥工具模块
+提供频道密钥版本查询和批量写入密钥共享记录的辅助函数，
+以及发送消息路径上使用的"密钥已存在"缓存
+
+缓存在 store_key_shares / activate_key_version 中自动失效；
+直接修改 channels.is_encrypted 或 user_channel_keys 的代码需要调用 invalidate_channel()。
+"""
+import threading
+import time
+
+
+class KeyPresenceCache:
+    """
+    频道密钥状态缓存
+
+    - 频道状态: channel_id -> (is_encrypted, 活跃密钥版本)，带TTL，多worker部署时限制其他进程轮换后的过期时间
+    - 密钥存在: (channel_id, user_id, key_version) 集合，版本变化后旧条目自然不再命中
+
+    参数:
+        ttl: 频道状态有效期（秒）
+        maxsize: 密钥存在集合的最大条目数，超过后整体清空
+    """
+
+    def __init__(self, ttl=60, maxsize=100000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._channels = {}
+        self._present = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def configure(self, ttl=None, maxsize=None):
+        if ttl is not None:
+            self.ttl = ttl
+        if maxsize is not None:
+            self.maxsize = maxsize
+
+    def get_channel(self, channel_id):
+        """返回 (is_encrypted, key_version)，未缓存或已过期时返回None"""
+        entry = self._channels.get(channel_id)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def set_channel(self, channel_id, state):
+        self._channels[channel_id] = (time.monotonic() + self.ttl, state)
+
+    def has_key(self, channel_id, user_id, key_version):
+        if (channel_id, user_id, key_version) in self._present:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add_key(self, channel_id, user_id, key_version):
+        with self._lock:
+            if len(self._present) >= self.maxsize:
+                self._present.clear()
+            self._present.add((channel_id, user_id, key_version))
+
+    def invalidate_channel(self, channel_id, user_ids=None):
+        """
+        使频道状态失效
+
+        参数:
+            channel_id: 频道ID
+            user_ids: 可选，只清除这些用户的密钥存在记录；为None时清除该频道所有记录
+        """
+        try:
+            channel_id = int(channel_id)
+            if user_ids is not None:
+                user_ids = {int(user_id) for user_id in user_ids}
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            self._channels.pop(channel_id, None)
+            if user_ids is None:
+                self._present = {k for k in self._present if k[0] != channel_id}
+            else:
+                self._present = {k for k in self._present
+                                 if k[0] != channel_id or k[1] not in user_ids}
+            self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'channels': len(self._channels),
+            'keys': len(self._present),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+# 进程级密钥状态缓存
+key_presence_cache = KeyPresenceCache()
+
+
+def invalidate_channel(channel_id, user_ids=None):
+    """频道加密状态、密钥版本或用户密钥变更后使缓存失效"""
+    key_presence_cache.invalidate_channel(channel_id, user_ids)
+
+
+def load_channel_key_state(conn, channel_id):
+    """
+    一次查询获取频道的加密状态和活跃密钥版本
+
+    返回:
+        (is_encrypted, key_version)，频道不存在时返回 (False, None)
+    """
+    row = conn.execute('''
+        SELECT c.is_encrypted,
+               (SELECT MAX(key_version) FROM channel_master_keys
+                WHERE channel_id = c.channel_id AND is_active = 1) AS key_version
+        FROM channels c WHERE c.channel_id = ?
+    ''', (channel_id,)).fetchone()
+    if not row:
+        return (False, None)
+    return (bool(row[0]), row[1] or 1)
+
+
+def get_active_key_version(conn, channel_id, default=1):
+    """
+    获取频道当前活跃的主密钥版本
+
+    参数:
+        conn: 数据库连接
+        channel_id: 频道ID
+        default: 没有主密钥记录时的默认版本
+
+    返回:
+        int: 密钥版本
+    """
+    row = conn.execute('''
+        SELECT key_version FROM channel_master_keys
+        WHERE channel_id = ? AND is_active = 1
+        ORDER BY key_version DESC LIMIT 1
+    ''', (channel_id,)).fetchone()
+    return row[0] if row else default
+
+
+def store_key_shares(conn, channel_id, sender_id, shares, overwrite=False):
+    """
+    批量写入密钥共享记录和用户频道密钥（不提交事务，由调用方控制）
+
+    参数:
+        conn: 数据库连接
+        channel_id: 频道ID
+        sender_id: 分发密钥的用户ID
+        shares: [{'user_id', 'encrypted_key', 'nonce', 'key_version'}]
+        overwrite: 已存在相同版本的密钥时是否覆盖（密钥轮换或强制更新）
+    """
+    conn.executemany('''
+        INSERT INTO channel_key_shares
+        (channel_id, sender_id, recipient_id, encrypted_key, nonce, created_at)
+        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ''', [(channel_id, sender_id, s['user_id'], s['encrypted_key'], s['nonce'])
+          for s in shares])
+
+    conn.executemany('''
+        INSERT INTO user_channel_keys
+        (channel_id, user_id, key_version, encrypted_key, nonce, is_active, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+        ON CONFLICT(channel_id, user_id, key_version) DO UPDATE SET
+            encrypted_key = excluded.encrypted_key,
+            nonce = excluded.nonce,
+            is_active = 1,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE ?
+    ''', [(channel_id, s['user_id'], s['key_version'], s['encrypted_key'], s['nonce'],
+           1 if overwrite else 0) for s in shares])
+
+    # 完成这些用户待处理的密钥请求
+    conn.executemany('''
+        UPDATE key_distribution_requests
+        SET status = 'completed', updated_at = CURRENT_TIMESTAMP
+        WHERE channel_id = ? AND requester_id = ? AND status = 'pending'
+    ''', [(channel_id, s['user_id']) for s in shares])
+
+    invalidate_channel(channel_id, [s['user_id'] for s in shares])
+
+
+def activate_key_version(conn, channel_id, key_version, created_by):
+    """
+    密钥轮换时把新版本设为活跃主密钥（不提交事务）
+
+    返回:
+        bool: 是否创建了新版本记录
+    """
+    exists = conn.execute('''
+        SELECT 1 FROM channel_master_keys WHERE channel_id = ? AND key_version = ?
+    ''', (channel_id, key_version)).fetchone()
+    if exists:
+        return False
+    conn.execute('''
+        UPDATE channel_master_keys SET is_active = 0
+        WHERE channel_id = ? AND is_active = 1
+    ''', (channel_id,))
+    conn.execute('''
+        INSERT INTO channel_master_keys
+        (channel_id, key_version, key_data, nonce, created_by, is_active, created_at)
+        VALUES (?, ?, 'rotated_key', 'auto_generated', ?, 1, CURRENT_TIMESTAMP)
+    ''', (channel_id, key_version, created_by))
+    invalidate_channel(channel_id)
+    return True
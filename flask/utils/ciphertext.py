@@ -0,0 +1,285 @@
+"""
+密文编码模块
+密文默认以base64字符串存储和传输。开启二进制模式后：
+
+1. 存储：私聊的 encrypted_content / iv / encrypted_for_self / iv_for_self 以BLOB保存；
+   加密频道消息的JSON信封拆成 messages.ciphertext / cipher_nonce / cipher_key_version，
+   信封的其余字段（timestamp、debug 等）和键顺序保存在 cipher_envelope，content 留空；
+   只拆分能原样重建的信封，其他信封仍按文本保存
+2. 传输：连接时声明 binary_ciphertext=1 的客户端加入 `<房间>:bin`，密文以Socket.IO二进制附件发送；
+   其他客户端加入 `<房间>:b64`，收到的仍是base64字符串和原来的JSON信封
+3. 读取时不区分新旧数据：BLOB和base64字符串都可以按任一格式输出
+
+本模块不依赖Flask，迁移脚本也可以直接使用
+"""
+import base64
+import binascii
+import json
+
+# 私聊表中的密文字段
+DM_CIPHER_FIELDS = ('encrypted_content', 'iv', 'encrypted_for_self', 'iv_for_self')
+
+ENVELOPE_VERSION = '1.0'
+
+
+def to_bytes(value):
+    """
+    把密文转换为字节
+
+    返回:
+        bytes，value为None或不是合法base64时返回None
+    """
+    if value is None:
+        return None
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError, TypeError):
+        return None
+
+
+def to_text(value):
+    """把密文转换为base64字符串（已经是字符串的原样返回）"""
+    if value is None:
+        return None
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(value)).decode('ascii')
+    return value
+
+
+def storage_value(value, binary):
+    """
+    写入数据库的密文值
+
+    参数:
+        value: 客户端提交的密文（base64字符串或二进制附件）
+        binary: 是否以BLOB存储；无法解码的字符串原样保存为TEXT
+    """
+    if value is None:
+        return None
+    if binary:
+        raw = to_bytes(value)
+        # 只转换规范的base64，保证旧客户端读回的字符串与提交时完全一致
+        if raw is not None and (not isinstance(value, str) or to_text(raw) == value):
+            return raw
+        return value
+    return to_text(value)
+
+
+def wire_value(value, binary):
+    """发给客户端的密文值：二进制客户端收到bytes，其他客户端收到base64字符串"""
+    if value is None:
+        return None
+    if binary:
+        raw = to_bytes(value)
+        return raw if raw is not None else value
+    return to_text(value)
+
+
+def dm_fields(source, binary, include_self=True):
+    """
+    私聊密文字段
+
+    参数:
+        source: 数据库行或字典
+        binary: 输出格式
+        include_self: 是否包含发送者自己的副本（只返回给发送者）
+    """
+    fields = {}
+    for field in DM_CIPHER_FIELDS:
+        if not include_self and field in ('encrypted_for_self', 'iv_for_self'):
+            fields[field] = None
+        else:
+            fields[field] = wire_value(source[field], binary)
+    return fields
+
+
+def split_envelope(content):
+    """
+    把加密频道消息的JSON信封拆成 (ciphertext, nonce, key_version, envelope)
+    envelope 是把 content / nonce 置为null后的信封JSON，保留其他字段和键顺序
+
+    返回:
+        tuple，内容不是可识别的信封、或者重建后与原文不完全一致时返回None（按文本保存）
+    """
+    if not isinstance(content, str) or not content.startswith('{'):
+        return None
+    try:
+        envelope = json.loads(content)
+    except ValueError:
+        return None
+    if not isinstance(envelope, dict) or envelope.get('encrypted') is not True:
+        return None
+    ciphertext = to_bytes(envelope.get('content'))
+    if not ciphertext:
+        return None
+    nonce = None
+    if envelope.get('nonce') is not None:
+        nonce = to_bytes(envelope['nonce'])
+        if nonce is None:
+            return None
+    key_version = envelope.get('sender_key_version')
+    if key_version is not None and (not isinstance(key_version, int) or isinstance(key_version, bool)):
+        return None
+    template = dict(envelope, content=None)
+    if 'nonce' in template:
+        template['nonce'] = None
+    template = json.dumps(template, separators=(',', ':'), ensure_ascii=False)
+    if join_envelope(ciphertext, nonce, key_version, template) != content:
+        return None
+    return ciphertext, nonce, key_version, template
+
+
+def join_envelope(ciphertext, nonce, key_version, template=None):
+    """
+    重建JSON信封：有 template（cipher_envelope）时按原来的字段和顺序重建，
+    否则按旧客户端的格式重建（该列出现之前拆分的消息）
+    """
+    if template:
+        envelope = json.loads(template)
+        envelope['content'] = to_text(ciphertext)
+        if 'nonce' in envelope:
+            envelope['nonce'] = to_text(nonce)
+        return json.dumps(envelope, separators=(',', ':'), ensure_ascii=False)
+    envelope = {
+        'encrypted': True,
+        'content': to_text(ciphertext),
+        'version': ENVELOPE_VERSION
+    }
+    if nonce is not None:
+        envelope['nonce'] = to_text(nonce)
+    if key_version is not None:
+        envelope['sender_key_version'] = key_version
+    return json.dumps(envelope)
+
+
+def _row_get(row, key):
+    try:
+        return row[key]
+    except (KeyError, IndexError):
+        return None
+
+
+def message_content(row):
+    """频道消息的content：拆分存储的密文重建为JSON信封，其他消息原样返回"""
+    ciphertext = _row_get(row, 'ciphertext')
+    if ciphertext is None:
+        return row['content']
+    return join_envelope(ciphertext, _row_get(row, 'cipher_nonce'), _row_get(row, 'cipher_key_version'),
+                         _row_get(row, 'cipher_envelope'))
+
+
+def message_fields(row, binary):
+    """
+    频道消息的内容字段
+
+    二进制客户端收到 content=None 和 ciphertext / nonce / sender_key_version，
+    其他客户端只收到 content（JSON信封）
+    """
+    ciphertext = _row_get(row, 'ciphertext')
+    if binary and ciphertext is not None:
+        return {
+            'content': None,
+            'ciphertext': to_bytes(ciphertext),
+            'nonce': to_bytes(_row_get(row, 'cipher_nonce')),
+            'sender_key_version': _row_get(row, 'cipher_key_version')
+        }
+    if binary and _row_get(row, 'is_encrypted'):
+        parts = split_envelope(row['content'])
+        if parts:
+            return {
+                'content': None,
+                'ciphertext': parts[0],
+                'nonce': parts[1],
+                'sender_key_version': parts[2]
+            }
+    return {'content': message_content(row)}
+
+
+def message_storage(content, is_encrypted, binary):
+    """
+    频道消息写入数据库的内容列
+
+    返回:
+        (content, ciphertext, cipher_nonce, cipher_key_version, cipher_envelope)
+    """
+    if binary and is_encrypted:
+        parts = split_envelope(content)
+        if parts:
+            return ('',) + parts
+    return content, None, None, None, None
+
+
+def format_room(room, binary):
+    """按密文格式区分的房间名"""
+    return f'{room}:bin' if binary else f'{room}:b64'
+
+
+def emit_by_format(emit, event, room, build):
+    """
+    向房间中两种格式的客户端分别发送事件
+
+    参数:
+        emit: flask_socketio.emit 或 socketio.emit
+        event: 事件名
+        room: 基础房间名（user_{id} / channel_{id}）
+        build: build(binary) -> payload
+    """
+    emit(event, build(False), room=format_room(room, False))
+    emit(event, build(True), room=format_room(room, True))
+
+
+def convert_dm_batch(conn, after_id, batch_size):
+    """
+    把一批私聊的base64密文转换为BLOB（不提交事务）
+
+    返回:
+        (last_id, converted)，last_id为None表示已经处理完
+    """
+    rows = conn.execute('''
+        SELECT dm_id, encrypted_content, iv, encrypted_for_self, iv_for_self
+        FROM direct_messages WHERE dm_id > ? ORDER BY dm_id LIMIT ?
+    ''', (after_id, batch_size)).fetchall()
+    if not rows:
+        return None, 0
+    converted = 0
+    for row in rows:
+        values = [storage_value(row[field], True) for field in DM_CIPHER_FIELDS]
+        if any(isinstance(new, bytes) and not isinstance(row[field], bytes)
+               for new, field in zip(values, DM_CIPHER_FIELDS)):
+            conn.execute('''
+                UPDATE direct_messages
+                SET encrypted_content = ?, iv = ?, encrypted_for_self = ?, iv_for_self = ?
+                WHERE dm_id = ?
+            ''', (*values, row['dm_id']))
+            converted += 1
+    return rows[-1]['dm_id'], converted
+
+
+def convert_message_batch(conn, after_id, batch_size):
+    """
+    把一批加密频道消息的JSON信封拆分为二进制列（不提交事务）
+    不能原样重建的信封保持文本不变
+
+    返回:
+        (last_id, converted)，last_id为None表示已经处理完
+    """
+    rows = conn.execute('''
+        SELECT message_id, content FROM messages
+        WHERE message_id > ? AND is_encrypted = 1 AND ciphertext IS NULL
+        ORDER BY message_id LIMIT ?
+    ''', (after_id, batch_size)).fetchall()
+    if not rows:
+        return None, 0
+    converted = 0
+    for row in rows:
+        parts = split_envelope(row['content'])
+        if parts:
+            conn.execute('''
+                UPDATE messages SET content = '', ciphertext = ?, cipher_nonce = ?, cipher_key_version = ?,
+                                    cipher_envelope = ?
+                WHERE message_id = ?
+            ''', (*parts, row['message_id']))
+            converted += 1
+    return rows[-1]['message_id'], converted
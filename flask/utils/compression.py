@@ -0,0 +1,195 @@
+"""
+API响应压缩
+私信、在线用户、收藏、频道日志等接口返回的JSON较大，原来不压缩直接发送。
+after_request 中按 Accept-Encoding 选择 brotli 或 gzip：
+
+- 只压缩配置的类型（默认 application/json）且不小于阈值的响应
+- 已经编码的响应、send_file 的文件响应（direct_passthrough）和流式响应不处理
+- 分块压缩，块与块之间让出协程，大响应不会长时间占用 gevent hub
+- 压缩后的响应 ETag 加上 ;enc=gzip / ;enc=br 后缀；请求的 If-None-Match 在处理前去掉后缀，
+  接口仍按原始 ETag 比较，304 响应再加回客户端缓存的后缀。后缀只由这里生成，
+  其他接口自己的 ETag（例如静态资源的 "<文件名>-gzip"）不受影响
+- stats() 报告压缩前后的字节数和节省的比例
+
+brotli 为可选依赖，未安装时只使用 gzip
+"""
+import threading
+import time
+import zlib
+
+from flask import g, request
+from werkzeug.http import parse_etags, quote_etag
+
+try:
+    import brotli
+except ImportError:  # 可选依赖：只使用gzip
+    brotli = None
+
+# 压缩时加到 ETag 后面的后缀，使用其他接口不会生成的形式
+ETAG_SUFFIXES = (';enc=gzip', ';enc=br')
+
+
+class ResponseCompressor:
+    """
+    按 Accept-Encoding 压缩响应
+
+    参数:
+        min_size: 小于此字节数的响应不压缩
+        gzip_level: gzip压缩级别（1-9）
+        brotli_quality: brotli压缩质量（0-11），在线压缩使用较低的质量
+        chunk_size: 每次压缩的字节数，块之间让出协程
+        mimetypes: 压缩的响应类型
+    """
+
+    def __init__(self, min_size=1024, gzip_level=6, brotli_quality=4, chunk_size=64 * 1024,
+                 mimetypes=('application/json',)):
+        self.enabled = True
+        self.configure(min_size, gzip_level, brotli_quality, chunk_size, mimetypes)
+        self._socketio = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'responses': 0,
+            'compressed': 0,
+            'skipped_small': 0,
+            'skipped_encoding': 0,
+            'gzip': 0,
+            'br': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'compress_ms': 0.0
+        }
+
+    def configure(self, min_size=1024, gzip_level=6, brotli_quality=4, chunk_size=64 * 1024,
+                  mimetypes=('application/json',)):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.chunk_size = chunk_size
+        self.mimetypes = frozenset(mimetypes)
+
+    def init_app(self, app, socketio=None):
+        """读取配置并注册 after_request"""
+        self._socketio = socketio
+        self.enabled = app.config.get('COMPRESS_ENABLED', True)
+        self.configure(
+            min_size=app.config.get('COMPRESS_MIN_SIZE', 1024),
+            gzip_level=app.config.get('COMPRESS_GZIP_LEVEL', 6),
+            brotli_quality=app.config.get('COMPRESS_BROTLI_QUALITY', 4),
+            chunk_size=app.config.get('COMPRESS_CHUNK_SIZE', 64 * 1024),
+            mimetypes=app.config.get('COMPRESS_MIMETYPES', ('application/json',))
+        )
+        if self.enabled:
+            app.before_request(self.before_request)
+            app.after_request(self.after_request)
+
+    def _count(self, **deltas):
+        with self._lock:
+            for key, value in deltas.items():
+                self._stats[key] += value
+
+    def choose_encoding(self, accept_encodings):
+        """客户端接受的编码中优先使用brotli，都不接受时返回None"""
+        br = accept_encodings.quality('br') if brotli is not None else 0
+        gzip = accept_encodings.quality('gzip')
+        if br > 0 and br >= gzip:
+            return 'br'
+        if gzip > 0:
+            return 'gzip'
+        return None
+
+    def compress(self, data, encoding):
+        """分块压缩，块之间让出协程"""
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            feed, finish = compressor.process, compressor.finish
+        else:
+            # wbits=31：带gzip头和尾
+            compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+            feed, finish = compressor.compress, compressor.flush
+        parts = []
+        view = memoryview(data)
+        for offset in range(0, len(data), self.chunk_size):
+            parts.append(feed(view[offset:offset + self.chunk_size]))
+            if self._socketio is not None and offset + self.chunk_size < len(data):
+                self._socketio.sleep(0)
+        parts.append(finish())
+        return b''.join(parts)
+
+    def before_request(self):
+        """去掉 If-None-Match 中的编码后缀，接口按未压缩时的 ETag 比较"""
+        header = request.environ.get('HTTP_IF_NONE_MATCH')
+        if not header or not any(suffix in header for suffix in ETAG_SUFFIXES):
+            return
+        etags = parse_etags(header)
+        strong = etags.as_set()
+        tags = []
+        for weak, values in ((False, strong), (True, etags.as_set(include_weak=True) - strong)):
+            for value in values:
+                for suffix in ETAG_SUFFIXES:
+                    if value.endswith(suffix):
+                        value = value[:-len(suffix)]
+                        g.compression_etag_suffix = suffix
+                        break
+                tags.append(quote_etag(value, weak))
+        if etags.star_tag:
+            tags.append('*')
+        request.environ['HTTP_IF_NONE_MATCH'] = ', '.join(tags)
+        request.__dict__.pop('if_none_match', None)
+
+    def after_request(self, response):
+        if response.status_code == 304:
+            # 客户端缓存的是压缩后的表示，304 的 ETag 保持客户端发来的后缀
+            suffix = g.get('compression_etag_suffix')
+            etag, weak = response.get_etag()
+            if suffix and etag and not etag.endswith(ETAG_SUFFIXES):
+                response.set_etag(etag + suffix, weak)
+            return response
+        if response.mimetype not in self.mimetypes:
+            return response
+        self._count(responses=1)
+        if (response.direct_passthrough or response.is_streamed
+                or response.status_code < 200 or response.status_code in (204, 206, 304)
+                or 'Content-Encoding' in response.headers
+                or 'no-transform' in response.headers.get('Cache-Control', '')):
+            return response
+
+        # 是否压缩取决于请求头，缓存必须区分
+        response.vary.add('Accept-Encoding')
+        encoding = self.choose_encoding(request.accept_encodings)
+        if encoding is None:
+            self._count(skipped_encoding=1)
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size:
+            self._count(skipped_small=1)
+            return response
+
+        started = time.perf_counter()
+        compressed = self.compress(data, encoding)
+        elapsed = (time.perf_counter() - started) * 1000
+        if len(compressed) >= len(data):
+            self._count(skipped_small=1, compress_ms=elapsed)
+            return response
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f'{etag};enc={encoding}', weak)
+        self._count(compressed=1, bytes_in=len(data), bytes_out=len(compressed), compress_ms=elapsed,
+                    **{encoding: 1})
+        return response
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['bytes_saved'] = stats['bytes_in'] - stats['bytes_out']
+        stats['ratio'] = round(stats['bytes_out'] / stats['bytes_in'], 4) if stats['bytes_in'] else 0.0
+        stats['avg_compress_ms'] = round(stats['compress_ms'] / stats['compressed'], 3) if stats['compressed'] else 0.0
+        stats['compress_ms'] = round(stats['compress_ms'], 2)
+        stats['brotli_available'] = brotli is not None
+        return stats
+
+
+# 进程级响应压缩
+response_compressor = ResponseCompressor()
@@ -1,6 +1,87 @@
 import sqlite3
 import os
+import time
 from flask import g, current_app
+from utils.metrics import db_query_latency
+
+# 写事务耗时观察者，参数为秒数（例如准入控制器）
+_write_observers = []
+
+_WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE', 'REPLAC')
+
+def add_write_observer(observer):
+    """注册写事务耗时观察者"""
+    if observer not in _write_observers:
+        _write_observers.append(observer)
+
+class TimedCursor(sqlite3.Cursor):
+    """通过 conn.cursor() 执行的语句同样计时，写语句开始连接的写事务计时"""
+    def execute(self, sql, *args):
+        self.connection._mark_write(sql)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            db_query_latency.observe(time.perf_counter() - started)
+
+    def executemany(self, sql, *args):
+        self.connection._mark_write(sql)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            db_query_latency.observe(time.perf_counter() - started)
+
+class TimedConnection(sqlite3.Connection):
+    """
+    记录语句和写事务耗时的连接
+    写事务从事务中第一条写语句开始计时到commit结束，包含等待写锁和落盘的时间；
+    每条语句的 execute() 耗时记入 utils.metrics，cursor() 返回的游标同样计时
+    （executescript() 不计时）
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._write_started = None
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    def _mark_write(self, sql):
+        if self._write_started is None and sql.lstrip()[:6].upper() in _WRITE_PREFIXES:
+            self._write_started = time.perf_counter()
+
+    def execute(self, sql, *args):
+        self._mark_write(sql)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            db_query_latency.observe(time.perf_counter() - started)
+
+    def executemany(self, sql, *args):
+        self._mark_write(sql)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            db_query_latency.observe(time.perf_counter() - started)
+
+    def commit(self):
+        try:
+            return super().commit()
+        finally:
+            started, self._write_started = self._write_started, None
+            if started is not None:
+                elapsed = time.perf_counter() - started
+                for observer in _write_observers:
+                    try:
+                        observer(elapsed)
+                    except Exception:
+                        pass
+
+    def rollback(self):
+        self._write_started = None
+        return super().rollback()
 
 def get_db_connection():
     """获取数据库连接"""
@@ -17,7 +98,7 @@ def get_db_connection():
         db_path = os.path.join(app_root, 'chat_system.sqlite')
     
     # 创建数据库连接
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(db_path, factory=TimedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -0,0 +1,167 @@
+"""
+私信会话索引
+dm_conversations 为每个用户与每个私信对象保存一行（最后一条私信、最后活动时间、未读数），
+在插入私信的同一事务中维护，会话列表和未读数不需要扫描 direct_messages 或用户表：
+
+- 会话列表：idx_dm_conversations_recent (user_id, last_dm_id)，按最后一条私信倒序，
+  使用 last_dm_id 游标（before_id）分页，翻页代价与页码无关
+- 未读数：插入时对接收者加一，标记已读后按 idx_direct_messages_unread 重新计数
+- 发起新会话时按用户名前缀搜索用户：idx_users_username_lower
+"""
+
+DEFAULT_PAGE_SIZE = 30
+MAX_PAGE_SIZE = 100
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 50
+
+
+def record_message(conn, dm_id, sender_id, recipient_id):
+    """
+    插入私信后更新双方的会话（不提交事务）
+
+    参数:
+        conn: 数据库连接
+        dm_id: 新私信ID
+        sender_id: 发送者
+        recipient_id: 接收者
+    """
+    conn.execute('''
+        INSERT INTO dm_conversations (user_id, peer_id, last_dm_id, last_activity, unread_count)
+        VALUES (?, ?, ?, CURRENT_TIMESTAMP, 0)
+        ON CONFLICT(user_id, peer_id) DO UPDATE SET
+            last_dm_id = excluded.last_dm_id,
+            last_activity = excluded.last_activity
+        WHERE excluded.last_dm_id > dm_conversations.last_dm_id
+    ''', (sender_id, recipient_id, dm_id))
+    if sender_id == recipient_id:
+        return
+    conn.execute('''
+        INSERT INTO dm_conversations (user_id, peer_id, last_dm_id, last_activity, unread_count)
+        VALUES (?, ?, ?, CURRENT_TIMESTAMP, 1)
+        ON CONFLICT(user_id, peer_id) DO UPDATE SET
+            last_dm_id = MAX(dm_conversations.last_dm_id, excluded.last_dm_id),
+            last_activity = CASE WHEN excluded.last_dm_id > dm_conversations.last_dm_id
+                                 THEN excluded.last_activity ELSE dm_conversations.last_activity END,
+            unread_count = dm_conversations.unread_count + 1
+    ''', (recipient_id, sender_id, dm_id))
+
+
+def refresh_unread(conn, user_id, peer_ids):
+    """
+    标记已读后重新计算用户与这些对象的会话未读数（不提交事务）
+    按实际未读的私信计数，重复标记或并发标记不会让未读数出错
+
+    参数:
+        conn: 数据库连接
+        user_id: 读消息的用户（接收者）
+        peer_ids: 发送者ID列表
+    """
+    peer_ids = list(dict.fromkeys(peer_ids))
+    if not peer_ids:
+        return
+    conn.execute(f'''
+        UPDATE dm_conversations
+        SET unread_count = (
+            SELECT COUNT(*) FROM direct_messages dm
+            WHERE dm.recipient_id = dm_conversations.user_id
+              AND dm.sender_id = dm_conversations.peer_id
+              AND dm.read_at IS NULL AND dm.is_deleted = 0
+        )
+        WHERE user_id = ? AND peer_id IN ({','.join('?' * len(peer_ids))})
+    ''', (user_id, *peer_ids))
+
+
+def rebuild(conn):
+    """
+    由 direct_messages 重建全部会话（迁移和初始化数据库时使用，不提交事务）
+
+    返回:
+        int: 会话行数
+    """
+    conn.execute('DELETE FROM dm_conversations')
+    conn.execute('''
+        INSERT INTO dm_conversations (user_id, peer_id, last_dm_id, last_activity, unread_count)
+        SELECT user_id, peer_id, MAX(dm_id), MAX(created_at), SUM(unread)
+        FROM (
+            SELECT sender_id AS user_id, recipient_id AS peer_id, dm_id, created_at, 0 AS unread
+            FROM direct_messages WHERE is_deleted = 0
+            UNION ALL
+            SELECT recipient_id, sender_id, dm_id, created_at, read_at IS NULL
+            FROM direct_messages WHERE is_deleted = 0 AND recipient_id != sender_id
+        )
+        GROUP BY user_id, peer_id
+    ''')
+    return conn.execute('SELECT COUNT(*) FROM dm_conversations').fetchone()[0]
+
+
+def list_conversations(conn, user_id, before_id=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    分页列出用户的私信会话，按最后一条私信倒序
+
+    参数:
+        conn: 数据库连接
+        user_id: 用户ID
+        before_id: 可选，上一页最后一个会话的 last_dm_id
+        limit: 每页条数
+
+    返回:
+        (rows, next_before_id)，没有下一页时 next_before_id 为None
+    """
+    where = ['c.user_id = ?']
+    params = [user_id]
+    if before_id:
+        where.append('c.last_dm_id < ?')
+        params.append(before_id)
+    limit = max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+
+    # 多取一条判断是否还有下一页
+    rows = conn.execute(f'''
+        SELECT c.peer_id, c.last_dm_id, c.last_activity, c.unread_count,
+               u.username, u.avatar_url, u.is_active
+        FROM dm_conversations c
+        JOIN users u ON u.user_id = c.peer_id
+        WHERE {' AND '.join(where)}
+        ORDER BY c.last_dm_id DESC
+        LIMIT ?
+    ''', (*params, limit + 1)).fetchall()
+    next_before_id = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_before_id = rows[-1]['last_dm_id']
+    return rows, next_before_id
+
+
+def conversation_info(row):
+    """返回给客户端的会话信息"""
+    return {
+        'user_id': row['peer_id'],
+        'username': row['username'],
+        'avatar_url': row['avatar_url'],
+        'is_online': bool(row['is_active']),
+        'last_dm_id': row['last_dm_id'],
+        'last_message_at': row['last_activity'],
+        'unread': row['unread_count']
+    }
+
+
+def search_users(conn, user_id, query, limit=DEFAULT_SEARCH_LIMIT):
+    """
+    按用户名前缀（不区分大小写）搜索用户，用于发起新会话，不包括自己
+    使用区间条件而不是 LIKE，可以走 lower(username) 表达式索引
+
+    返回:
+        list[sqlite3.Row]: user_id, username, avatar_url, is_active, has_conversation
+    """
+    prefix = (query or '').strip().lower()
+    if not prefix:
+        return []
+    limit = max(1, min(int(limit or DEFAULT_SEARCH_LIMIT), MAX_SEARCH_LIMIT))
+    return conn.execute('''
+        SELECT u.user_id, u.username, u.avatar_url, u.is_active,
+               EXISTS (SELECT 1 FROM dm_conversations c
+                       WHERE c.user_id = ? AND c.peer_id = u.user_id) AS has_conversation
+        FROM users u
+        WHERE lower(u.username) >= ? AND lower(u.username) < ? AND u.user_id != ?
+        ORDER BY lower(u.username)
+        LIMIT ?
+    ''', (user_id, prefix, prefix + '\U0010ffff', user_id, limit)).fetchall()
@@ -0,0 +1,106 @@
+"""
+临时事件工具模块
+处理输入中(typing)、正在查看频道(viewing)、窗口焦点(focus)等交互信号
+
+这些信号只在内存中路由，不写入数据库。
+频率限制由 utils.rate_limit 的令牌桶负责（'ephemeral' 事件），
+本模块负责服务端合并：同一用户对同一目标的同一状态在合并窗口内最多转发一帧。
+发给单个用户的信号要求双方有私信会话或共同频道（shares_conversation），
+检查结果由 PeerCache 短时间缓存，输入中等高频信号不必每帧查询数据库
+"""
+import time
+
+# 支持的临时事件类型
+EPHEMERAL_TYPES = ('typing', 'viewing', 'focus')
+
+
+class EphemeralCoalescer:
+    """
+    临时事件合并器
+
+    以 (user_id, 事件类型, 目标) 为键记录最近一次转发的状态和时间。
+    状态未变化且距上次转发不足 interval 秒的帧会被丢弃；状态变化（如停止输入）立即转发。
+
+    参数:
+        interval: 合并窗口（秒）
+        max_entries: 内存中保留的最大键数量，超过后清理过期条目
+    """
+
+    def __init__(self, interval=2.0, max_entries=10000):
+        self.interval = interval
+        self.max_entries = max_entries
+        self._last = {}  # (user_id, kind, target) -> (state, timestamp)
+
+    def should_emit(self, user_id, kind, target, state, now=None):
+        """判断该帧是否需要转发，需要时同时记录转发时间"""
+        now = time.monotonic() if now is None else now
+        key = (user_id, kind, target)
+        last = self._last.get(key)
+        if last is not None and last[0] == state and now - last[1] < self.interval:
+            return False
+        if len(self._last) >= self.max_entries:
+            self._prune(now)
+        self._last[key] = (state, now)
+        return True
+
+    def forget_user(self, user_id):
+        """用户所有会话断开时清理其合并状态"""
+        for key in [k for k in self._last if k[0] == user_id]:
+            del self._last[key]
+
+    def _prune(self, now):
+        expired = [k for k, (_, ts) in self._last.items() if now - ts >= self.interval]
+        for key in expired:
+            del self._last[key]
+        # 仍然超限时丢弃最早的一半
+        if len(self._last) >= self.max_entries:
+            oldest = sorted(self._last.items(), key=lambda item: item[1][1])
+            for key, _ in oldest[:len(oldest) // 2]:
+                del self._last[key]
+
+
+def shares_conversation(conn, user_id, peer_id):
+    """双方是否有私信会话或至少一个共同频道"""
+    row = conn.execute('''
+        SELECT 1 FROM dm_conversations WHERE user_id = ? AND peer_id = ?
+        UNION ALL
+        SELECT 1 FROM user_channels a
+        JOIN user_channels b ON b.channel_id = a.channel_id
+        WHERE a.user_id = ? AND b.user_id = ?
+        LIMIT 1
+    ''', (user_id, peer_id, user_id, peer_id)).fetchone()
+    return row is not None
+
+
+class PeerCache:
+    """
+    (user_id, peer_id) -> 是否允许发送信号 的短时缓存
+
+    参数:
+        ttl: 缓存有效期（秒），会话或成员关系变化后最多在此时间内沿用旧结果
+        max_entries: 内存中保留的最大键数量，超过后清空
+    """
+
+    def __init__(self, ttl=60.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}  # (user_id, peer_id) -> (allowed, expires_at)
+
+    def get(self, user_id, peer_id, now=None):
+        """返回缓存的结果，未命中或已过期时返回None"""
+        now = time.monotonic() if now is None else now
+        entry = self._entries.get((user_id, peer_id))
+        if entry is None or entry[1] <= now:
+            return None
+        return entry[0]
+
+    def set(self, user_id, peer_id, allowed, now=None):
+        now = time.monotonic() if now is None else now
+        if len(self._entries) >= self.max_entries:
+            self._entries.clear()
+        self._entries[(user_id, peer_id)] = (allowed, now + self.ttl)
+
+    def forget_user(self, user_id):
+        """用户所有会话断开时清理其缓存"""
+        for key in [k for k in self._entries if k[0] == user_id]:
+            del self._entries[key]
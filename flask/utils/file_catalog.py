@@ -0,0 +1,168 @@
+"""
+上传文件目录模块
+每次上传到频道的文件都登记到 files 表，发送引用该文件的消息时关联 message_id，
+频道附件和用户文件列表直接按索引分页查询，不需要扫描消息或上传目录：
+
+- 频道附件：idx_files_channel / idx_files_channel_type（只包含已发送到消息中的文件）
+- 用户文件：idx_files_user / idx_files_user_type
+- 分页使用 file_id 游标（before_id），翻页代价与页码无关
+"""
+from flask import url_for
+
+from utils import previews
+
+# 文件类型（files.file_type），按扩展名归类
+FILE_TYPES = {
+    'image': {'png', 'jpg', 'jpeg', 'gif', 'webp'},
+    'video': {'mp4'},
+    'audio': {'mp3'},
+    'document': {'txt', 'pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx'},
+    'archive': {'zip'}
+}
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+
+def file_category(filename):
+    """文件类型：image / video / audio / document / archive / other"""
+    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    for category, extensions in FILE_TYPES.items():
+        if ext in extensions:
+            return category
+    return 'other'
+
+
+def can_access_channel(conn, user_id, channel_id):
+    """用户能否访问频道：聊天室成员，私有频道还需要是频道成员（管理员除外）"""
+    row = conn.execute('''
+        SELECT c.is_private, ur.role,
+               EXISTS (SELECT 1 FROM user_channels uc
+                       WHERE uc.user_id = ? AND uc.channel_id = c.channel_id) AS is_channel_member
+        FROM channels c
+        JOIN user_rooms ur ON ur.room_id = c.room_id AND ur.user_id = ?
+        WHERE c.channel_id = ?
+    ''', (user_id, user_id, channel_id)).fetchone()
+    if not row:
+        return False
+    return not row['is_private'] or row['role'] in ('admin', 'owner') or bool(row['is_channel_member'])
+
+
+def record_upload(conn, user_id, channel_id, filename, original_filename, storage_path, size):
+    """
+    登记上传到频道的文件（不提交事务）
+
+    参数:
+        conn: 数据库连接
+        user_id: 上传者
+        channel_id: 频道ID
+        filename: URL中的文件名
+        original_filename: 用户上传时的文件名
+        storage_path: 相对上传目录的存储路径
+        size: 文件字节数
+
+    返回:
+        int: file_id
+    """
+    cursor = conn.execute('''
+        INSERT INTO files (filename, original_filename, file_path, file_size, file_type, channel_id, user_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (filename, original_filename, storage_path, size, file_category(original_filename),
+          channel_id, user_id))
+    return cursor.lastrowid
+
+
+def link_message(conn, message_id, channel_id, user_id, content, file_ids=None):
+    """
+    把文件关联到消息（不提交事务）
+    只关联发送者上传到该频道且尚未关联的文件：客户端提交的 file_ids，
+    以及消息内容中引用的上传文件（加密消息的内容不可读，需要客户端提交 file_ids）
+
+    返回:
+        int: 关联的文件数
+    """
+    conditions = []
+    params = []
+    names = list(dict.fromkeys(previews.upload_filenames(content)))
+    if names:
+        conditions.append(f"filename IN ({','.join('?' * len(names))})")
+        params.extend(names)
+    if not isinstance(file_ids, list):
+        file_ids = []
+    ids = [int(file_id) for file_id in file_ids[:20]
+           if isinstance(file_id, int) or (isinstance(file_id, str) and file_id.isdigit())]
+    if ids:
+        conditions.append(f"file_id IN ({','.join('?' * len(ids))})")
+        params.extend(ids)
+    if not conditions:
+        return 0
+    cursor = conn.execute(f'''
+        UPDATE files SET message_id = ?
+        WHERE ({' OR '.join(conditions)})
+          AND channel_id = ? AND user_id = ? AND message_id IS NULL
+    ''', (message_id, *params, channel_id, user_id))
+    return cursor.rowcount
+
+
+def list_files(conn, channel_id=None, user_id=None, file_type=None, before_id=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    分页列出频道附件或用户上传的文件，按上传先后倒序
+
+    参数:
+        conn: 数据库连接
+        channel_id: 频道ID（列出频道中已发送的附件）
+        user_id: 用户ID（列出该用户上传的文件），与channel_id二选一
+        file_type: 可选，按类型过滤
+        before_id: 可选，上一页最后一个file_id
+        limit: 每页条数
+
+    返回:
+        (rows, next_before_id)，没有下一页时 next_before_id 为None
+    """
+    if channel_id is not None:
+        where = ['f.channel_id = ?', 'f.is_deleted = 0', 'f.message_id IS NOT NULL']
+        params = [channel_id]
+    else:
+        where = ['f.user_id = ?', 'f.is_deleted = 0']
+        params = [user_id]
+    if file_type:
+        where.append('f.file_type = ?')
+        params.append(file_type)
+    if before_id:
+        where.append('f.file_id < ?')
+        params.append(before_id)
+    limit = max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+
+    # 多取一条判断是否还有下一页
+    rows = conn.execute(f'''
+        SELECT f.file_id, f.filename, f.original_filename, f.file_size, f.file_type,
+               f.channel_id, f.user_id, f.message_id, f.upload_time, u.username
+        FROM files f
+        LEFT JOIN users u ON u.user_id = f.user_id
+        WHERE {' AND '.join(where)}
+        ORDER BY f.file_id DESC
+        LIMIT ?
+    ''', (*params, limit + 1)).fetchall()
+    next_before_id = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_before_id = rows[-1]['file_id']
+    return rows, next_before_id
+
+
+def file_info(row):
+    """返回给客户端的文件信息"""
+    info = {
+        'file_id': row['file_id'],
+        'name': row['original_filename'],
+        'url': url_for('uploads.uploaded_file', filename=row['filename']),
+        'type': row['file_type'],
+        'size': row['file_size'],
+        'channel_id': row['channel_id'],
+        'message_id': row['message_id'],
+        'uploaded_by': {'id': row['user_id'], 'username': row['username']},
+        'uploaded_at': row['upload_time']
+    }
+    if row['file_type'] == 'image':
+        info.update(previews.preview_urls(row['filename']))
+    return info
@@ -0,0 +1,152 @@
+"""
+KDM密钥投递模块
+每个接收者一个按游标递增的密钥发件箱(kdm_outbox)
+
+写入密钥共享时同一事务中调用 enqueue()，提交后调用 push() 通过 user_{id} 房间推送；
+客户端处理后确认游标(ack_cursor)，重连时从游标开始用一次有界查询补发(replay)。
+游标就是 kdm_outbox.outbox_id，对每个接收者单调递增。
+"""
+
+# 单次补发的最大条目数
+DEFAULT_REPLAY_LIMIT = 200
+
+
+def enqueue(conn, channel_id, sender_id, shares, is_key_rotation=False):
+    """
+    把密钥写入接收者的发件箱（不提交事务，由调用方控制）
+
+    参数:
+        conn: 数据库连接
+        channel_id: 频道ID
+        sender_id: 分发密钥的用户ID
+        shares: [{'user_id', 'encrypted_key', 'nonce', 'key_version'}]
+        is_key_rotation: 是否为密钥轮换
+
+    返回:
+        list: 发件箱条目，可直接传给 push()
+    """
+    entries = []
+    for share in shares:
+        cursor = conn.execute('''
+            INSERT INTO kdm_outbox
+            (recipient_id, channel_id, sender_id, key_version, encrypted_key, nonce, is_key_rotation)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (share['user_id'], channel_id, sender_id, share['key_version'],
+              share['encrypted_key'], share.get('nonce'), 1 if is_key_rotation else 0))
+        entries.append({
+            'cursor': cursor.lastrowid,
+            'recipient_id': share['user_id'],
+            'channel_id': channel_id,
+            'sender_id': sender_id,
+            'key_version': share['key_version'],
+            'encrypted_key': share['encrypted_key'],
+            'nonce': share.get('nonce'),
+            'is_key_rotation': bool(is_key_rotation)
+        })
+    return entries
+
+
+def to_payload(entry, sender_username=None, channel_name=None, timestamp=None):
+    """
+    转换为客户端格式（与 /api/kdm/pending 的 pending_keys 条目一致）
+    """
+    return {
+        'id': entry['cursor'],
+        'cursor': entry['cursor'],
+        'channel_id': entry['channel_id'],
+        'channel_name': channel_name,
+        'sender_id': entry['sender_id'],
+        'sender_username': sender_username,
+        'encrypted_keys_for_me': entry['encrypted_key'],
+        'nonce': entry['nonce'],
+        'version': entry['key_version'],
+        'is_key_rotation': bool(entry['is_key_rotation']),
+        'timestamp': timestamp
+    }
+
+
+def push(socketio, entries, sender_username=None, timestamp=None, online=None):
+    """
+    通过接收者的 user_{id} 房间推送 kdm_update
+
+    参数:
+        socketio: SocketIO实例
+        entries: enqueue() 返回的条目
+        online: 可选的在线用户ID集合，只推送给其中的用户；为None时推送给所有接收者
+                （离线用户重连时会从游标补发）
+    """
+    for entry in entries:
+        if online is not None and entry['recipient_id'] not in online:
+            continue
+        socketio.emit('kdm_update',
+                      to_payload(entry, sender_username=sender_username, timestamp=timestamp),
+                      room=f"user_{entry['recipient_id']}")
+
+
+def replay(conn, user_id, after=None, channel_id=None, limit=DEFAULT_REPLAY_LIMIT):
+    """
+    从游标之后补发密钥，一次查询完成
+
+    参数:
+        conn: 数据库连接
+        user_id: 接收者ID
+        after: 起始游标，为None时使用服务端保存的游标
+        channel_id: 可选，只返回该频道的密钥
+        limit: 最大条目数
+
+    返回:
+        (条目列表, 最后一个游标, 是否还有更多)
+    """
+    conditions = ['k.recipient_id = ?',
+                  'k.outbox_id > COALESCE(?, (SELECT kdm_cursor FROM user_settings WHERE user_id = ?), 0)']
+    params = [user_id, after, user_id]
+    if channel_id is not None:
+        conditions.append('k.channel_id = ?')
+        params.append(channel_id)
+    # 多取一条用于判断是否还有更多
+    params.append(limit + 1)
+
+    rows = conn.execute(f'''
+        SELECT k.outbox_id AS cursor, k.channel_id, k.sender_id, k.key_version,
+               k.encrypted_key, k.nonce, k.is_key_rotation, k.created_at,
+               u.username AS sender_username, c.channel_name
+        FROM kdm_outbox k
+        LEFT JOIN users u ON u.user_id = k.sender_id
+        LEFT JOIN channels c ON c.channel_id = k.channel_id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY k.outbox_id
+        LIMIT ?
+    ''', params).fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    entries = [to_payload(row, sender_username=row['sender_username'],
+                          channel_name=row['channel_name'], timestamp=row['created_at'])
+               for row in rows]
+    last_cursor = rows[-1]['cursor'] if rows else after
+    return entries, last_cursor, has_more
+
+
+def get_cursor(conn, user_id):
+    """获取服务端保存的游标"""
+    row = conn.execute('SELECT kdm_cursor FROM user_settings WHERE user_id = ?',
+                       (user_id,)).fetchone()
+    return (row[0] or 0) if row else 0
+
+
+def ack_cursor(conn, user_id, cursor):
+    """
+    保存客户端确认的游标，游标只会前进（不提交事务）
+
+    参数:
+        conn: 数据库连接
+        user_id: 用户ID
+        cursor: 已处理的最后一个游标
+    """
+    conn.execute('''
+        INSERT INTO user_settings (user_id, kdm_cursor, updated_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(user_id) DO UPDATE SET
+            kdm_cursor = MAX(COALESCE(kdm_cursor, 0), excluded.kdm_cursor),
+            updated_at = CURRENT_TIMESTAMP
+    ''', (user_id, cursor))
@@ -0,0 +1,150 @@
+"""
+公钥目录模块
+批量查询用户公钥，并在进程内缓存结果
+
+公钥来源与 /api/users/<id>/public_key 一致：优先 user_keys 表，其次 users 表。
+公钥变更（store_public_key / upload_pubkey / 修复公钥）后必须调用 invalidate(user_id)。
+"""
+import hashlib
+import json
+import threading
+import time
+
+# 单次请求允许查询的最大用户数
+MAX_DIRECTORY_USERS = 500
+
+
+class KeyDirectoryCache:
+    """
+    用户公钥缓存 user_id -> 公钥条目
+
+    参数:
+        ttl: 条目有效期（秒），多worker部署时其他进程最多在此时间内返回旧公钥
+        maxsize: 最大条目数，超过后整体清空
+    """
+
+    def __init__(self, ttl=300, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def configure(self, ttl=None, maxsize=None):
+        if ttl is not None:
+            self.ttl = ttl
+        if maxsize is not None:
+            self.maxsize = maxsize
+
+    def get_many(self, user_ids):
+        """返回 (命中的条目字典, 未命中的ID列表)"""
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._data.get(user_id)
+                if entry is not None and entry[0] > now:
+                    found[user_id] = entry[1]
+                else:
+                    missing.append(user_id)
+        self.hits += len(found)
+        self.misses += len(missing)
+        return found, missing
+
+    def set_many(self, entries):
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            if len(self._data) + len(entries) > self.maxsize:
+                self._data.clear()
+            for user_id, entry in entries.items():
+                self._data[user_id] = (expires, entry)
+
+    def invalidate(self, user_id):
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            if self._data.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+# 进程级公钥缓存
+key_directory_cache = KeyDirectoryCache()
+
+
+def invalidate(user_id):
+    """用户公钥变更后使缓存失效"""
+    key_directory_cache.invalidate(user_id)
+
+
+def fetch_public_keys(conn, user_ids):
+    """
+    批量获取用户公钥
+
+    参数:
+        conn: 数据库连接
+        user_ids: 用户ID列表（整数）
+
+    返回:
+        dict: user_id -> {'user_id', 'username', 'public_key', 'key_updated_at'}
+              不存在的用户不包含在结果中；存在但没有公钥的用户 public_key 为None
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    found, missing = key_directory_cache.get_many(user_ids)
+    if missing:
+        placeholders = ','.join('?' * len(missing))
+        rows = conn.execute(f'''
+            SELECT u.user_id, u.username,
+                   uk.public_key AS uk_public_key, uk.updated_at AS uk_updated_at,
+                   u.public_key AS u_public_key, u.key_updated_at AS u_key_updated_at
+            FROM users u
+            LEFT JOIN user_keys uk ON uk.user_id = u.user_id
+            WHERE u.user_id IN ({placeholders})
+        ''', missing).fetchall()
+        loaded = {}
+        for row in rows:
+            if row['uk_public_key']:
+                public_key, updated_at = row['uk_public_key'], row['uk_updated_at']
+            else:
+                public_key, updated_at = row['u_public_key'], row['u_key_updated_at']
+            loaded[row['user_id']] = {
+                'user_id': row['user_id'],
+                'username': row['username'],
+                'public_key': public_key or None,
+                'key_updated_at': updated_at
+            }
+        key_directory_cache.set_many(loaded)
+        found.update(loaded)
+    return found
+
+
+def directory_etag(entries, missing=()):
+    """
+    根据公钥条目和没有公钥的用户计算强ETag
+    没有公钥的成员加入或离开时响应中的 missing 会变化，ETag 也必须变化
+
+    参数:
+        entries: fetch_public_keys 返回的条目列表
+        missing: 没有公钥的用户ID
+    """
+    digest = hashlib.sha256()
+    for entry in sorted(entries, key=lambda e: e['user_id']):
+        digest.update(json.dumps(
+            [entry['user_id'], entry['public_key'], entry['key_updated_at']],
+            default=str
+        ).encode('utf-8'))
+    digest.update(json.dumps(['missing', sorted(missing)]).encode('utf-8'))
+    return digest.hexdigest()[:32]
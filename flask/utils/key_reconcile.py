@@ -0,0 +1,198 @@
+"""
+频道密钥对账模块
+发送消息时发现用户缺少频道密钥记录，不再在请求中直接修复，而是交给后台任务批量处理：
+
+1. 用户已有活跃密钥：只更新缓存
+2. 有密钥共享记录：用最新的共享记录补齐 user_channel_keys
+3. 都没有：向频道管理员发起密钥请求（已有待处理请求时不重复创建）
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import current_app
+
+from utils.db import get_db_connection
+from utils.channel_keys import key_presence_cache, get_active_key_version
+
+
+def reconcile_user_key(conn, channel_id, user_id, username, socketio=None):
+    """
+    对账单个用户的频道密钥（会提交事务）
+
+    参数:
+        conn: 数据库连接
+        channel_id: 频道ID
+        user_id: 用户ID
+        username: 用户名，用于密钥请求通知
+        socketio: 可选，用于通知管理员
+
+    返回:
+        str: 'present' / 'repaired' / 'requested' / 'pending'（已有待处理请求或没有管理员）
+    """
+    key_version = get_active_key_version(conn, channel_id)
+
+    has_key = conn.execute('''
+        SELECT 1 FROM user_channel_keys
+        WHERE channel_id = ? AND user_id = ? AND is_active = 1
+        LIMIT 1
+    ''', (channel_id, user_id)).fetchone()
+    if has_key:
+        key_presence_cache.add_key(channel_id, user_id, key_version)
+        return 'present'
+
+    share = conn.execute('''
+        SELECT encrypted_key, nonce FROM channel_key_shares
+        WHERE channel_id = ? AND recipient_id = ?
+        ORDER BY created_at DESC, share_id DESC
+        LIMIT 1
+    ''', (channel_id, user_id)).fetchone()
+    if share:
+        conn.execute('''
+            INSERT INTO user_channel_keys
+            (channel_id, user_id, key_version, encrypted_key, nonce, is_active, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            ON CONFLICT(channel_id, user_id, key_version) DO UPDATE SET
+                encrypted_key = excluded.encrypted_key,
+                nonce = excluded.nonce,
+                is_active = 1,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (channel_id, user_id, key_version, share['encrypted_key'],
+              share['nonce'] or 'auto_generated'))
+        conn.commit()
+        key_presence_cache.add_key(channel_id, user_id, key_version)
+        return 'repaired'
+
+    pending = conn.execute('''
+        SELECT 1 FROM key_distribution_requests
+        WHERE channel_id = ? AND requester_id = ? AND status = 'pending'
+        LIMIT 1
+    ''', (channel_id, user_id)).fetchone()
+    if pending:
+        return 'pending'
+
+    admin = conn.execute('''
+        SELECT ur.user_id
+        FROM user_rooms ur
+        JOIN channels c ON c.room_id = ur.room_id
+        WHERE c.channel_id = ? AND ur.role IN ('admin', 'owner')
+        ORDER BY CASE WHEN ur.role = 'owner' THEN 0 ELSE 1 END
+        LIMIT 1
+    ''', (channel_id,)).fetchone()
+    if not admin:
+        return 'pending'
+
+    admin_id = admin['user_id']
+    conn.execute('''
+        INSERT INTO key_distribution_requests
+        (channel_id, requester_id, admin_id, status, created_at)
+        VALUES (?, ?, ?, 'pending', CURRENT_TIMESTAMP)
+    ''', (channel_id, user_id, admin_id))
+    conn.commit()
+
+    if socketio is not None:
+        socketio.emit('channel_key_request', {
+            'channel_id': channel_id,
+            'requester_id': user_id,
+            'requester_username': username,
+            'timestamp': datetime.now().isoformat()
+        }, room=f'user_{admin_id}')
+    return 'requested'
+
+
+class KeyReconciler:
+    """
+    后台密钥对账任务
+
+    参数:
+        interval: 两轮对账之间的间隔（秒）
+        batch_size: 每轮最多处理的用户数
+        max_pending: 等待队列上限，超出时丢弃（下一次发消息会重新加入）
+    """
+
+    def __init__(self, interval=5.0, batch_size=50, max_pending=1000):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending = OrderedDict()  # (channel_id, user_id) -> username
+        self._lock = threading.Lock()
+        self._app = None
+        self._socketio = None
+        self._running = False
+        self.scheduled = 0
+        self.dropped = 0
+        self.failed = 0
+        self.results = {}
+
+    def init_app(self, app, socketio):
+        self._app = app
+        self._socketio = socketio
+        self.interval = app.config.get('KEY_RECONCILE_INTERVAL', self.interval)
+        self.batch_size = app.config.get('KEY_RECONCILE_BATCH_SIZE', self.batch_size)
+
+    def schedule(self, channel_id, user_id, username=None):
+        """加入对账队列，同一用户同一频道只保留一条"""
+        key = (channel_id, user_id)
+        with self._lock:
+            if key in self._pending:
+                return
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending[key] = username
+            self.scheduled += 1
+            start = not self._running and self._socketio is not None
+            if start:
+                self._running = True
+        if start:
+            self._socketio.start_background_task(self._run)
+
+    def _take_batch(self):
+        with self._lock:
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False))
+            return batch
+
+    def _run(self):
+        while True:
+            self._socketio.sleep(self.interval)
+            batch = self._take_batch()
+            if not batch:
+                with self._lock:
+                    if not self._pending:
+                        self._running = False
+                        return
+                continue
+            with self._app.app_context():
+                self.run_batch(batch)
+
+    def run_batch(self, batch):
+        """处理一批 ((channel_id, user_id), username)，需要应用上下文"""
+        conn = get_db_connection()
+        try:
+            for (channel_id, user_id), username in batch:
+                try:
+                    result = reconcile_user_key(conn, channel_id, user_id, username, self._socketio)
+                    self.results[result] = self.results.get(result, 0) + 1
+                except Exception as e:
+                    self.failed += 1
+                    conn.rollback()
+                    current_app.logger.error(
+                        f"频道 {channel_id} 用户 {user_id} 密钥对账失败: {str(e)}", exc_info=True)
+        finally:
+            conn.close()
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'running': self._running,
+            'scheduled': self.scheduled,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'results': dict(self.results)
+        }
+
+
+# 进程级对账任务
+key_reconciler = KeyReconciler()
@@ -0,0 +1,236 @@
+"""
+结构化日志
+原来 Socket 事件、私信、密钥共享和登录路径每条消息、每个请求 print 多行（包括完整的私信内容），
+Socket.IO 和 Engine.IO 的日志逐个数据包写 stderr，高负载时日志I/O占用了大量CPU。这里：
+
+- get_logger(子系统) 返回结构化日志器：log.info('message_sent', channel_id=1, message_id=2)，
+  事件名和字段分开记录，不记录消息内容；级别不够时在格式化之前就返回
+- 每个子系统单独设置级别（LOG_LEVELS），生产环境关闭 Engine.IO 数据包日志和访问日志
+- 根日志器只有一个非阻塞的 QueueHandler：调用方只把记录放入有界队列，队列满时丢弃并计数，
+  格式化（text 或 json）和写入在 QueueListener 中进行（gevent 下为单独的greenlet）
+- 高频事件按 LOG_SAMPLE_RATES 每N条保留1条，保留的记录带 sample=N 字段
+"""
+import atexit
+import copy
+import json
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+# logging.Logger._log 自身的关键字参数，其余关键字参数作为结构化字段
+_LOG_KWARGS = frozenset(('exc_info', 'stack_info', 'stacklevel', 'extra'))
+
+TEXT_FORMAT = '[%(asctime)s] %(levelname)s %(name)s: %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    """
+    把多余的关键字参数放到 record.fields 中的日志器
+
+    log.info('direct_message_sent', dm_id=5, recipient_id=3)
+    """
+
+    def __init__(self, logger):
+        super().__init__(logger, {})
+
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs) if key not in _LOG_KWARGS}
+        if fields:
+            extra = dict(kwargs.get('extra') or {})
+            extra['fields'] = fields
+            kwargs['extra'] = extra
+        return msg, kwargs
+
+
+def get_logger(subsystem):
+    """返回 chat.<subsystem> 的结构化日志器"""
+    return StructuredLogger(logging.getLogger(f'chat.{subsystem}'))
+
+
+def _fields(record):
+    return getattr(record, 'fields', None) or {}
+
+
+class TextFormatter(logging.Formatter):
+    """开发环境：消息后面附加 key=value 字段"""
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT, DATE_FORMAT)
+
+    def formatMessage(self, record):
+        line = super().formatMessage(record)
+        fields = _fields(record)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """生产环境：每条记录一行JSON，便于日志系统按字段检索"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage()
+        }
+        entry.update(_fields(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    高频事件每N条保留1条
+
+    参数:
+        rates: 事件名（日志消息）-> N
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self._seen = {}
+        self.sampled_out = 0
+
+    def filter(self, record):
+        rate = self.rates.get(record.msg) if isinstance(record.msg, str) else None
+        if not rate or rate <= 1 or record.levelno >= logging.WARNING:
+            return True
+        seen = self._seen.get(record.msg, 0)
+        self._seen[record.msg] = seen + 1
+        if seen % rate:
+            self.sampled_out += 1
+            return False
+        record.fields = dict(_fields(record), sample=rate)
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """队列满时丢弃记录并计数，不阻塞调用方，也不向stderr打印错误"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.enqueued = 0
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 只合并消息参数，异常栈先转成文本（traceback对象不能跨线程保存），完整格式化留给监听器
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(QueueListener):
+    # 队列满时 put_nowait 会失败，停止标记等待监听器腾出位置
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class LogPipeline:
+    """
+    进程的日志输出：根日志器 -> 采样 -> 有界队列 -> 监听器 -> stderr
+
+    参数:
+        level: 默认级别
+        levels: 日志器名 -> 级别，例如 {'engineio.server': 'WARNING'}
+        fmt: 'text' 或 'json'
+        queue_size: 队列长度上限，超出的记录被丢弃
+        sample_rates: 事件名 -> N（每N条保留1条）
+    """
+
+    def __init__(self):
+        self.level = 'INFO'
+        self.levels = {}
+        self.fmt = 'text'
+        self.queue_size = 10000
+        self.sample_rates = {}
+        self._handler = None
+        self._sampler = None
+        self._listener = None
+        self._atexit = False
+
+    def configure(self, level=None, levels=None, fmt=None, queue_size=None, sample_rates=None):
+        if level is not None:
+            self.level = level
+        if levels is not None:
+            self.levels = dict(levels)
+        if fmt is not None:
+            self.fmt = fmt
+        if queue_size is not None:
+            self.queue_size = queue_size
+        if sample_rates is not None:
+            self.sample_rates = dict(sample_rates)
+
+    def init_app(self, app):
+        """读取 LOG_* 配置并安装到根日志器（需要在第一次访问 app.logger 之前调用）"""
+        self.configure(
+            level=app.config.get('LOG_LEVEL', 'INFO'),
+            levels=app.config.get('LOG_LEVELS', {}),
+            fmt=app.config.get('LOG_FORMAT', 'text'),
+            queue_size=app.config.get('LOG_QUEUE_SIZE', 10000),
+            sample_rates=app.config.get('LOG_SAMPLE_RATES', {})
+        )
+        self.start()
+
+    def start(self):
+        """替换根日志器的处理器并启动监听器，重复调用时先停止旧的监听器"""
+        self.stop()
+        sink = logging.StreamHandler(sys.stderr)
+        sink.setFormatter(JsonFormatter() if self.fmt == 'json' else TextFormatter())
+
+        self._sampler = SamplingFilter(self.sample_rates)
+        self._handler = NonBlockingQueueHandler(queue.Queue(maxsize=self.queue_size))
+        self._handler.addFilter(self._sampler)
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self._handler)
+        root.setLevel(self.level)
+        for name, level in self.levels.items():
+            logging.getLogger(name).setLevel(level)
+
+        self._listener = _Listener(self._handler.queue, sink, respect_handler_level=True)
+        self._listener.start()
+        if not self._atexit:
+            atexit.register(self.stop)
+            self._atexit = True
+
+    def stop(self):
+        """写完队列中剩余的记录"""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def stats(self):
+        """返回队列和采样统计"""
+        handler = self._handler
+        return {
+            'enqueued': handler.enqueued if handler else 0,
+            'dropped': handler.dropped if handler else 0,
+            'queued': handler.queue.qsize() if handler else 0,
+            'queue_size': self.queue_size,
+            'sampled_out': self._sampler.sampled_out if self._sampler else 0
+        }
+
+
+# 进程级日志输出
+log_pipeline = LogPipeline()
@@ -0,0 +1,242 @@
+"""
+运行指标
+以 Prometheus 文本格式在内部接口 /metrics 导出（blueprints/metrics.py）：
+
+- HTTP 请求数和耗时直方图（按 Flask endpoint）
+- Socket 事件数和耗时直方图（按事件名），emit 的本进程接收者数
+- 数据库语句耗时、写事务耗时（包含等待写锁）、密码哈希池排队时间
+- 在线Socket连接数、在线用户数
+- 各缓存和后台任务 stats() 中的数值（命中率、队列长度等）
+
+为了可以在生产环境常开，记录路径上不加锁：计数器和直方图只做整数/浮点加法，
+直方图的桶边界预先确定，记录一次只是一次二分查找和一次加法。
+gevent 下所有greenlet在同一个原生线程中运行，加法之间不会切换，不会丢失计数；
+stats() 只在抓取时调用。
+"""
+import re
+import time
+from bisect import bisect_left
+
+from flask import g, request
+
+# 直方图默认桶边界（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_INVALID_NAME = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    """单调递增计数器"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}  # label值元组 -> 计数
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in list(self._values.items()):
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    """
+    预分桶直方图
+
+    参数:
+        buckets: 升序的桶上界，最后自动加上 +Inf
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label值元组 -> [每个桶的计数（不累计）, 总和]
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series.setdefault(label_values, [[0] * (len(self.buckets) + 1), 0.0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for label_values, (counts, total) in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), list(counts)):
+                cumulative += count
+                yield (f'{self.name}_bucket',
+                       _format_labels(self.labels, label_values, ('le', _format_value(float(bound)))),
+                       cumulative)
+            yield f'{self.name}_sum', _format_labels(self.labels, label_values), total
+            yield f'{self.name}_count', _format_labels(self.labels, label_values), cumulative
+
+
+class Metrics:
+    """指标注册表"""
+
+    def __init__(self):
+        self.enabled = True
+        self._metrics = []
+        self._gauges = []  # (name, help, 取值函数)
+        self._stats = []  # (子系统名, stats函数)
+
+    def counter(self, name, help_text, labels=()):
+        metric = Counter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, func):
+        """抓取时调用 func() 取值的gauge"""
+        self._gauges.append((name, help_text, func))
+
+    def add_stats(self, subsystem, stats):
+        """
+        抓取时调用 stats()，其中的数值（包括嵌套字典中的数值）按 gauge 导出，
+        名称为 chat_<subsystem>_<键>
+        """
+        self._stats.append((subsystem, stats))
+
+    def _flatten(self, prefix, stats):
+        for key, value in stats.items():
+            name = f'{prefix}_{_INVALID_NAME.sub("_", str(key))}'
+            if isinstance(value, dict):
+                yield from self._flatten(name, value)
+            elif isinstance(value, bool):
+                yield name, int(value)
+            elif isinstance(value, (int, float)):
+                yield name, value
+
+    def render(self):
+        """Prometheus 文本格式"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        for name, help_text, func in self._gauges:
+            try:
+                value = func()
+            except Exception:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {_format_value(value)}')
+        for subsystem, stats in self._stats:
+            try:
+                values = list(self._flatten(f'chat_{subsystem}', stats()))
+            except Exception:
+                continue
+            for name, value in values:
+                lines.append(f'# TYPE {name} gauge')
+                lines.append(f'{name} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def init_app(self, app, socketio=None):
+        """注册HTTP请求计时和 emit 接收者计数"""
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        if not self.enabled:
+            return
+        app.before_request(_start_request_timer)
+        app.after_request(_record_request)
+        from utils.db import add_write_observer
+        add_write_observer(db_write_latency.observe)
+        if socketio is not None and getattr(socketio, 'server', None) is not None:
+            _instrument_emit(socketio.server.manager)
+
+
+# 进程级指标注册表
+metrics = Metrics()
+
+http_requests = metrics.counter(
+    'chat_http_requests_total', 'HTTP requests by endpoint, method and status', ('endpoint', 'method', 'status'))
+http_latency = metrics.histogram(
+    'chat_http_request_duration_seconds', 'HTTP request latency by endpoint', ('endpoint',))
+socket_events = metrics.counter(
+    'chat_socket_events_total', 'Socket.IO events by name and outcome', ('event', 'outcome'))
+socket_latency = metrics.histogram(
+    'chat_socket_event_duration_seconds', 'Socket.IO event handler latency by name', ('event',))
+emit_fanout = metrics.histogram(
+    'chat_socket_emit_recipients', 'Local recipients per emit', buckets=FANOUT_BUCKETS)
+db_query_latency = metrics.histogram(
+    'chat_db_query_duration_seconds', 'SQLite execute() latency (time to the first row for SELECTs)', buckets=DB_BUCKETS)
+db_write_latency = metrics.histogram(
+    'chat_db_write_transaction_seconds', 'SQLite write transaction time including write-lock waits')
+password_pool_wait = metrics.histogram(
+    'chat_password_pool_wait_seconds', 'Time bcrypt jobs wait for a pool thread')
+
+
+def _start_request_timer():
+    g.metrics_started = time.perf_counter()
+
+
+def _record_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        endpoint = request.url_rule.endpoint if request.url_rule is not None else 'unmatched'
+        http_latency.observe(time.perf_counter() - started, endpoint)
+        http_requests.inc(endpoint, request.method, str(response.status_code))
+    return response
+
+
+def _instrument_emit(manager):
+    """
+    记录每次 emit 在本进程的接收者数
+    python-socketio 的管理器没有钩子，这里包装管理器实例的 emit；
+    使用消息队列时在发布进程记录，接收者数是发布进程内的房间人数
+    """
+    emit = manager.emit
+
+    def counted_emit(event, data, namespace, room=None, *args, **kwargs):
+        try:
+            rooms = manager.rooms.get(namespace or '/', {})
+            targets = room if isinstance(room, (list, tuple)) else (room,)
+            emit_fanout.observe(sum(len(rooms.get(target, ())) for target in targets))
+        except Exception:
+            pass
+        return emit(event, data, namespace, room, *args, **kwargs)
+
+    manager.emit = counted_emit
+
+
+def observe_socket_event(event, outcome, seconds=None):
+    """记录一次Socket事件（socket_events.socket_guard 调用）"""
+    socket_events.inc(event, outcome)
+    if seconds is not None:
+        socket_latency.observe(seconds, event)
@@ -0,0 +1,126 @@
+"""
+密码哈希线程池模块
+把 bcrypt 哈希和校验放到有界的原生线程池中执行，避免阻塞 gevent 事件循环
+
+bcrypt 在计算时会释放GIL，因此在原生线程中运行时其他greenlet（包括所有websocket）可以继续运行。
+在gevent环境下使用 gevent.threadpool.ThreadPool（调用方greenlet让出而不是阻塞整个hub），
+没有gevent时退回 concurrent.futures.ThreadPoolExecutor。
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from utils.metrics import password_pool_wait
+
+try:
+    from gevent.threadpool import ThreadPool as GeventThreadPool
+except ImportError:
+    GeventThreadPool = None
+
+
+class PasswordPoolBusy(Exception):
+    """等待中的哈希任务超过队列上限"""
+
+
+class PasswordHasherPool:
+    """
+    有界的密码哈希池
+
+    参数:
+        size: 同时执行bcrypt的线程数
+        max_queue: 允许排队等待的任务数，超出时抛出 PasswordPoolBusy
+        rounds: 新密码哈希使用的bcrypt轮数
+    """
+
+    def __init__(self, size=4, max_queue=64, rounds=12):
+        self.size = size
+        self.max_queue = max_queue
+        self.rounds = rounds
+        self._pool = None
+        self.pending = 0
+        self.max_pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+
+    def configure(self, size=None, max_queue=None, rounds=None):
+        if size is not None and size != self.size:
+            self.size = size
+            self._pool = None  # 下次使用时按新大小创建
+        if max_queue is not None:
+            self.max_queue = max_queue
+        if rounds is not None:
+            self.rounds = rounds
+
+    def _get_pool(self):
+        if self._pool is None:
+            if GeventThreadPool is not None:
+                self._pool = GeventThreadPool(maxsize=self.size)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.size,
+                                                thread_name_prefix='bcrypt')
+        return self._pool
+
+    def _run(self, func, *args):
+        if self.pending >= self.size + self.max_queue:
+            self.rejected += 1
+            raise PasswordPoolBusy('password hashing queue is full')
+
+        queued_at = time.perf_counter()
+
+        def task():
+            started = time.perf_counter()
+            return func(*args), started, time.perf_counter()
+
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        try:
+            pool = self._get_pool()
+            if GeventThreadPool is not None and isinstance(pool, GeventThreadPool):
+                result, started, finished = pool.apply(task)
+            else:
+                result, started, finished = pool.submit(task).result()
+        finally:
+            self.pending -= 1
+
+        # 统计在调用方greenlet中更新，避免跨线程写共享状态
+        wait = started - queued_at
+        self.completed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        password_pool_wait.observe(wait)
+        self.total_run += finished - started
+        return result
+
+    def check_password(self, password, password_hash):
+        """校验密码，返回bool"""
+        if not password or not password_hash:
+            return False
+        return self._run(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
+
+    def hash_password(self, password):
+        """生成bcrypt哈希，返回字符串"""
+        salt = bcrypt.gensalt(rounds=self.rounds)
+        return self._run(bcrypt.hashpw, password.encode('utf-8'), salt).decode('utf-8')
+
+    def stats(self):
+        """返回线程池和队列统计"""
+        return {
+            'size': self.size,
+            'max_queue': self.max_queue,
+            'in_flight': min(self.pending, self.size),
+            'queued': max(0, self.pending - self.size),
+            'max_pending': self.max_pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avg_wait_ms': round(self.total_wait * 1000 / self.completed, 2) if self.completed else 0.0,
+            'max_wait_ms': round(self.max_wait * 1000, 2),
+            'avg_run_ms': round(self.total_run * 1000 / self.completed, 2) if self.completed else 0.0
+        }
+
+
+# 进程级密码哈希池
+password_pool = PasswordHasherPool()
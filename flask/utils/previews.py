@@ -0,0 +1,446 @@
+"""
+上传文件的缩略图和预览生成模块
+图片上传后生成缩小的缩略图（消息列表）和预览图（点击查看），PDF记录页数，客户端不再需要下载原图：
+
+1. 上传完成时 enqueue() 按内容SHA-256登记一条 pending 记录，相同内容只生成一次
+2. 后台任务把待处理的记录交给进程池（Pillow解码和缩放是CPU密集的，不能在gevent worker中执行），
+   协作式等待结果后写回 upload_previews
+3. 缩略图URL是确定的（/thumbnails/<variant>/<filename>），生成完成前重定向到原文件，
+   因此上传响应和消息中可以立即带上
+4. 没有安装Pillow时图片标记为 unsupported，客户端继续使用原图
+
+结果文件保存在 `<UPLOAD_FOLDER>/previews/ab/cd/<sha256>_<variant>.<ext>`
+"""
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app, url_for
+
+from utils.blob_store import AliasCache, absolute_path
+from utils.db import get_db_connection
+
+try:
+    from PIL import Image, ImageOps, features as pil_features
+except ImportError:
+    Image = None
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+PDF_EXTENSIONS = {'pdf'}
+
+# 缩略图用于消息列表，预览图用于点击放大
+VARIANTS = ('thumbnail', 'preview')
+
+# 消息内容中引用的上传文件名（包括旧的 /static/uploads/ 路径）
+_UPLOAD_URL = re.compile(r'/uploads/([^\s"\'<>?#/]+)')
+_PDF_PAGE = re.compile(rb'/Type\s*/Page(?![a-zA-Z])')
+
+
+def preview_kind(filename):
+    """按扩展名判断能否生成预览，返回 'image' / 'pdf' / None"""
+    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    if ext in IMAGE_EXTENSIONS:
+        return 'image'
+    if ext in PDF_EXTENSIONS:
+        return 'pdf'
+    return None
+
+
+def variant_path(sha256, variant, ext):
+    """预览文件相对上传目录的路径"""
+    return f'previews/{sha256[:2]}/{sha256[2:4]}/{sha256}_{variant}.{ext}'
+
+
+def render_preview(source, root, sha256, kind, sizes, max_pixels, max_source_size):
+    """
+    在子进程中生成预览（不依赖Flask和数据库）
+
+    参数:
+        source: 原文件路径
+        root: 上传目录
+        sha256: 内容哈希，用于命名输出文件
+        kind: 'image' 或 'pdf'
+        sizes: {variant: 最长边像素}
+        max_pixels: 允许解码的最大像素数，超出时放弃（防止解压炸弹）
+        max_source_size: 超过此大小的文件不处理
+
+    返回:
+        dict: status, width, height, page_count, paths {variant: 相对路径}, error
+    """
+    result = {'status': 'ready', 'width': None, 'height': None, 'page_count': None, 'paths': {}, 'error': None}
+    if os.path.getsize(source) > max_source_size:
+        result['status'] = 'unsupported'
+        result['error'] = 'file too large'
+        return result
+
+    if kind == 'pdf':
+        # 只统计页对象数量，不渲染；压缩对象流中的页可能统计不到
+        with open(source, 'rb') as f:
+            result['page_count'] = len(_PDF_PAGE.findall(f.read())) or None
+        return result
+
+    if Image is None:
+        result['status'] = 'unsupported'
+        result['error'] = 'Pillow is not installed'
+        return result
+
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    use_webp = pil_features.check('webp')
+    ext = 'webp' if use_webp else 'jpg'
+    with Image.open(source) as img:
+        result['width'], result['height'] = img.size
+        if img.getexif().get(0x0112) in (5, 6, 7, 8):
+            # EXIF方向为旋转90度时，显示尺寸与存储尺寸相反
+            result['width'], result['height'] = result['height'], result['width']
+        # JPEG可以在解码时直接按比例缩小
+        img.draft('RGB', (max(sizes.values()), max(sizes.values())))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'PA') else 'RGB')
+        if not use_webp and img.mode == 'RGBA':
+            img = img.convert('RGB')
+        # 从大到小缩放，小图以上一个结果为源
+        for variant, size in sorted(sizes.items(), key=lambda item: -item[1]):
+            img.thumbnail((size, size))
+            relative_path = variant_path(sha256, variant, ext)
+            path = absolute_path(root, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.tmp'
+            if use_webp:
+                img.save(tmp_path, 'WEBP', quality=80, method=4)
+            else:
+                img.save(tmp_path, 'JPEG', quality=80, optimize=True, progressive=True)
+            os.replace(tmp_path, path)
+            result['paths'][variant] = relative_path
+    return result
+
+
+def enqueue(conn, sha256, filename):
+    """
+    登记需要生成预览的内容（不提交事务）
+
+    返回:
+        bool: 文件类型是否支持预览
+    """
+    kind = preview_kind(filename)
+    if kind is None:
+        return False
+    conn.execute('''
+        INSERT INTO upload_previews (sha256, kind) VALUES (?, ?)
+        ON CONFLICT(sha256) DO NOTHING
+    ''', (sha256, kind))
+    return True
+
+
+def preview_urls(filename):
+    """上传文件的缩略图和预览图URL，生成完成前重定向到原文件"""
+    return {
+        'thumbnail_url': url_for('uploads.uploaded_preview', variant='thumbnail', filename=filename),
+        'preview_url': url_for('uploads.uploaded_preview', variant='preview', filename=filename)
+    }
+
+
+def get_preview(conn, filename):
+    """文件名对应的预览记录，没有时返回None"""
+    return conn.execute('''
+        SELECT p.* FROM upload_aliases a
+        JOIN upload_previews p ON p.sha256 = a.sha256
+        WHERE a.filename = ?
+    ''', (filename,)).fetchone()
+
+
+def cached_ready_preview(filename):
+    """
+    已生成完成的预览记录（带缓存）；未完成的不缓存，完成后下一次请求即可读到
+
+    返回:
+        dict，没有可用的预览时返回None
+    """
+    preview = ready_preview_cache.get(filename)
+    if preview is not None:
+        return preview
+    conn = get_db_connection()
+    try:
+        row = get_preview(conn, filename)
+    finally:
+        conn.close()
+    if row is None or row['status'] != 'ready':
+        return None
+    preview = dict(row)
+    ready_preview_cache.set(filename, preview)
+    return preview
+
+
+def upload_filenames(content):
+    """消息内容中引用的上传文件名（按出现顺序，可能重复）"""
+    if not content or not isinstance(content, str) or '/uploads/' not in content:
+        return []
+    return _UPLOAD_URL.findall(content)
+
+
+def attachment_map(conn, contents, limit=200):
+    """
+    一次查询取出一批消息中引用的上传文件的预览信息
+
+    参数:
+        conn: 数据库连接
+        contents: 消息内容列表
+        limit: 最多查询的文件名数
+
+    返回:
+        dict: {filename: 附件信息}
+    """
+    names = []
+    seen = set()
+    for content in contents:
+        for name in upload_filenames(content):
+            if name not in seen and len(names) < limit:
+                seen.add(name)
+                names.append(name)
+    if not names:
+        return {}
+    rows = conn.execute(f'''
+        SELECT a.filename, p.kind, p.status, p.width, p.height, p.page_count
+        FROM upload_aliases a
+        JOIN upload_previews p ON p.sha256 = a.sha256
+        WHERE a.filename IN ({','.join('?' * len(names))})
+    ''', names).fetchall()
+    attachments = {}
+    for row in rows:
+        info = {
+            'filename': row['filename'],
+            'url': url_for('uploads.uploaded_file', filename=row['filename']),
+            'kind': row['kind'],
+            'preview_status': row['status'],
+            'width': row['width'],
+            'height': row['height'],
+            'page_count': row['page_count']
+        }
+        if row['kind'] == 'image':
+            info.update(preview_urls(row['filename']))
+        attachments[row['filename']] = info
+    return attachments
+
+
+def message_attachments(content, attachments):
+    """消息引用的附件列表（attachment_map() 的结果中查找）"""
+    if not attachments:
+        return []
+    result = []
+    for name in upload_filenames(content):
+        info = attachments.get(name)
+        if info and info not in result:
+            result.append(info)
+    return result
+
+
+class PreviewPipeline:
+    """
+    后台预览生成任务
+
+    参数:
+        workers: 进程池大小
+        batch_size: 每轮最多处理的文件数
+        interval: 两轮之间的间隔（秒），有新上传时通过 kick() 立即处理
+        max_attempts: 单个文件最多尝试次数
+    """
+
+    def __init__(self, workers=2, batch_size=8, interval=30.0, max_attempts=3):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.sizes = {'thumbnail': 320, 'preview': 1280}
+        self.max_pixels = 50_000_000
+        self.max_source_size = 100 * 1024 * 1024
+        self._app = None
+        self._socketio = None
+        self._pool = None
+        self._started = False
+        self._lock = threading.Lock()
+        self._rerun = False
+        self.in_flight = 0
+        self.generated = 0
+        self.unsupported = 0
+        self.failed = 0
+        self.pool_restarts = 0
+        self.batches = 0
+        self.total_render = 0.0
+        self.max_render = 0.0
+        self.last_pass_at = None
+
+    def init_app(self, app, socketio):
+        self._app = app
+        self._socketio = socketio
+        self.workers = app.config.get('THUMBNAIL_WORKERS', self.workers)
+        self.batch_size = app.config.get('THUMBNAIL_BATCH_SIZE', self.batch_size)
+        self.interval = app.config.get('THUMBNAIL_INTERVAL', self.interval)
+        self.sizes = {
+            'thumbnail': app.config.get('THUMBNAIL_SIZE', self.sizes['thumbnail']),
+            'preview': app.config.get('THUMBNAIL_PREVIEW_SIZE', self.sizes['preview'])
+        }
+        self.max_pixels = app.config.get('THUMBNAIL_MAX_PIXELS', self.max_pixels)
+        self.max_source_size = app.config.get('THUMBNAIL_MAX_SOURCE_SIZE', self.max_source_size)
+
+    def start(self):
+        """启动后台任务（重启后继续处理数据库中未完成的记录）"""
+        if self._started or self._socketio is None:
+            return
+        self._started = True
+        self._socketio.start_background_task(self._run)
+
+    def kick(self):
+        """有新上传时立即处理一轮"""
+        if self._socketio is not None:
+            self._socketio.start_background_task(self._pass_with_context)
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def _run(self):
+        while True:
+            self._pass_with_context()
+            self._socketio.sleep(self.interval)
+
+    def _pass_with_context(self):
+        # 同一时间只运行一轮，期间的触发合并为一次重跑
+        if not self._lock.acquire(blocking=False):
+            self._rerun = True
+            return
+        try:
+            with self._app.app_context():
+                while True:
+                    self._rerun = False
+                    try:
+                        processed = self.process_once()
+                    except Exception as e:
+                        current_app.logger.error(f"生成上传文件预览失败: {str(e)}", exc_info=True)
+                        processed = 0
+                    # 一批处理满时继续下一批
+                    if not self._rerun and processed < self.batch_size:
+                        break
+        finally:
+            self._lock.release()
+
+    def process_once(self):
+        """处理一批待生成的预览，需要应用上下文
+
+        返回:
+            int: 处理的文件数
+        """
+        root = current_app.config['UPLOAD_FOLDER']
+        conn = get_db_connection()
+        try:
+            # 主进程在保存结果前退出时，用完尝试次数的记录会一直停在 pending
+            conn.execute('''
+                UPDATE upload_previews SET status = 'failed', updated_at = CURRENT_TIMESTAMP
+                WHERE status = 'pending' AND attempts >= ?
+            ''', (self.max_attempts,))
+            conn.commit()
+            rows = conn.execute('''
+                SELECT p.sha256, p.kind, p.attempts, b.storage_path
+                FROM upload_previews p
+                JOIN upload_blobs b ON b.sha256 = p.sha256
+                WHERE p.status = 'pending' AND p.attempts < ?
+                ORDER BY p.created_at
+                LIMIT ?
+            ''', (self.max_attempts, self.batch_size)).fetchall()
+            if not rows:
+                return 0
+            conn.execute(f'''
+                UPDATE upload_previews SET attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE sha256 IN ({','.join('?' * len(rows))})
+            ''', [row['sha256'] for row in rows])
+            conn.commit()
+
+            started = time.perf_counter()
+            pool = self._get_pool()
+            futures = [
+                (row, pool.submit(render_preview, absolute_path(root, row['storage_path']), root,
+                                  row['sha256'], row['kind'], self.sizes, self.max_pixels,
+                                  self.max_source_size))
+                for row in rows
+            ]
+            self.in_flight = len(futures)
+            # 协作式等待，不阻塞事件循环
+            while not all(future.done() for _, future in futures):
+                self._socketio.sleep(0.05)
+            self.in_flight = 0
+            elapsed = time.perf_counter() - started
+
+            for row, future in futures:
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    # 同一批的其他任务也会失败，只关闭并替换一次进程池
+                    if self._pool is pool:
+                        pool.shutdown(wait=False)
+                        self._pool = None
+                        self.pool_restarts += 1
+                    result = {'status': 'pending', 'error': 'worker process died'}
+                except Exception as e:
+                    result = {'status': 'failed', 'error': str(e)[:500]}
+                self._save_result(conn, row, result)
+            conn.commit()
+        finally:
+            conn.close()
+
+        self.batches += 1
+        self.total_render += elapsed
+        self.max_render = max(self.max_render, elapsed)
+        self.last_pass_at = time.time()
+        return len(rows)
+
+    def _save_result(self, conn, row, result):
+        status = result['status']
+        paths = result.get('paths') or {}
+        if status == 'pending' and row['attempts'] + 1 < self.max_attempts:
+            # 进程池异常退出，保留待处理状态重试（尝试次数已增加）
+            conn.execute('''
+                UPDATE upload_previews SET error = ?, updated_at = CURRENT_TIMESTAMP WHERE sha256 = ?
+            ''', (result['error'], row['sha256']))
+            return
+        if status == 'pending':
+            # 尝试次数已用完：标记为失败，否则查询不再选中它，缩略图一直重定向到原文件
+            status = 'failed'
+        conn.execute('''
+            UPDATE upload_previews
+            SET status = ?, width = ?, height = ?, page_count = ?,
+                thumbnail_path = ?, preview_path = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE sha256 = ?
+        ''', (status, result.get('width'), result.get('height'), result.get('page_count'),
+              paths.get('thumbnail'), paths.get('preview'), result.get('error'), row['sha256']))
+        if status == 'ready':
+            self.generated += 1
+        elif status == 'unsupported':
+            self.unsupported += 1
+        else:
+            self.failed += 1
+            current_app.logger.error(f"生成预览失败 {row['sha256']}: {result.get('error')}")
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'in_flight': self.in_flight,
+            'generated': self.generated,
+            'unsupported': self.unsupported,
+            'failed': self.failed,
+            'pool_restarts': self.pool_restarts,
+            'pillow_available': Image is not None,
+            'batches': self.batches,
+            'avg_batch_ms': round(self.total_render * 1000 / self.batches, 2) if self.batches else 0.0,
+            'max_batch_ms': round(self.max_render * 1000, 2),
+            'last_pass_at': self.last_pass_at
+        }
+
+
+# 进程级预览生成任务
+preview_pipeline = PreviewPipeline()
+
+# 已完成预览的文件名缓存
+ready_preview_cache = AliasCache()
@@ -0,0 +1,190 @@
+"""
+Socket事件限流与背压模块
+- 按sid和按用户的令牌桶限流，每种事件类型独立配置
+- 全局准入控制：数据库写入延迟超过阈值时丢弃或延迟低优先级事件
+"""
+import time
+
+PRIORITY_HIGH = 'high'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_LOW = 'low'
+
+ADMIT = 'admit'
+DELAY = 'delay'
+SHED = 'shed'
+
+
+class TokenBucket:
+    """
+    令牌桶
+
+    参数:
+        rate: 每秒补充的令牌数
+        capacity: 桶容量（允许的突发量）
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic() if now is None else now
+
+    def consume(self, now=None, cost=1.0):
+        """
+        尝试消耗令牌
+
+        返回:
+            0 表示允许；否则为需要等待的秒数
+        """
+        now = time.monotonic() if now is None else now
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        if self.rate <= 0:
+            return float('inf')
+        return (cost - self.tokens) / self.rate
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class SocketRateLimiter:
+    """
+    按事件类型的双层令牌桶限流（每个sid一个桶，每个用户一个桶）
+
+    参数:
+        limits: {事件名: {'sid': (rate, burst), 'user': (rate, burst)}}
+                未配置的事件不限流
+    """
+
+    def __init__(self, limits):
+        self.limits = limits or {}
+        self._sid_buckets = {}   # (sid, event) -> TokenBucket
+        self._user_buckets = {}  # (user_id, event) -> TokenBucket
+        self._last_prune = time.monotonic()
+
+    def check(self, event, sid, user_id=None, now=None):
+        """
+        检查并记录一次事件
+
+        返回:
+            0 表示允许；否则为建议的重试等待秒数
+        """
+        limit = self.limits.get(event)
+        if not limit:
+            return 0
+        now = time.monotonic() if now is None else now
+        if now - self._last_prune > 60:
+            self._prune(now)
+
+        # 先检查sid桶再检查用户桶，sid被拒绝时不消耗用户配额
+        sid_limit = limit.get('sid')
+        if sid_limit:
+            bucket = self._sid_buckets.get((sid, event))
+            if bucket is None:
+                bucket = self._sid_buckets[(sid, event)] = TokenBucket(*sid_limit, now=now)
+            wait = bucket.consume(now)
+            if wait:
+                return wait
+
+        user_limit = limit.get('user')
+        if user_limit and user_id is not None:
+            bucket = self._user_buckets.get((user_id, event))
+            if bucket is None:
+                bucket = self._user_buckets[(user_id, event)] = TokenBucket(*user_limit, now=now)
+            wait = bucket.consume(now)
+            if wait:
+                return wait
+        return 0
+
+    def forget_sid(self, sid):
+        """sid断开时清理其令牌桶"""
+        for key in [k for k in self._sid_buckets if k[0] == sid]:
+            del self._sid_buckets[key]
+
+    def _prune(self, now):
+        # 已经回满的用户桶与新建桶等价，可以安全丢弃
+        for key in [k for k, b in self._user_buckets.items() if b.is_full(now)]:
+            del self._user_buckets[key]
+        self._last_prune = now
+
+
+class AdmissionController:
+    """
+    全局准入控制
+
+    根据数据库写事务耗时的指数移动平均判断写入压力：
+    - 超过 threshold：丢弃低优先级事件，延迟普通优先级事件
+    - 超过 critical：丢弃低/普通优先级事件，延迟高优先级事件
+    长时间没有写入样本时视为压力已解除
+    """
+
+    def __init__(self, threshold_ms=200, critical_ms=1000, delay_ms=250,
+                 alpha=0.2, stale_after=5.0):
+        self.configure(threshold_ms, critical_ms, delay_ms, alpha, stale_after)
+        self.latency_ms = 0.0
+        self.last_sample = 0.0
+        self.shed_count = 0
+        self.delay_count = 0
+
+    def configure(self, threshold_ms=200, critical_ms=1000, delay_ms=250,
+                  alpha=0.2, stale_after=5.0):
+        self.threshold_ms = threshold_ms
+        self.critical_ms = critical_ms
+        self.delay_ms = delay_ms
+        self.alpha = alpha
+        self.stale_after = stale_after
+
+    def init_app(self, app):
+        """从应用配置读取阈值"""
+        self.configure(
+            threshold_ms=app.config.get('DB_WRITE_LATENCY_THRESHOLD_MS', 200),
+            critical_ms=app.config.get('DB_WRITE_LATENCY_CRITICAL_MS', 1000),
+            delay_ms=app.config.get('ADMISSION_DELAY_MS', 250),
+        )
+
+    def record_write(self, seconds):
+        """记录一次写事务耗时（供 utils.db 的提交观察者调用）"""
+        sample = seconds * 1000.0
+        now = time.monotonic()
+        if now - self.last_sample > self.stale_after:
+            self.latency_ms = sample
+        else:
+            self.latency_ms += self.alpha * (sample - self.latency_ms)
+        self.last_sample = now
+
+    def current_latency_ms(self, now=None):
+        now = time.monotonic() if now is None else now
+        if now - self.last_sample > self.stale_after:
+            return 0.0
+        return self.latency_ms
+
+    def decide(self, priority):
+        """返回 ADMIT / DELAY / SHED"""
+        latency = self.current_latency_ms()
+        if latency < self.threshold_ms:
+            return ADMIT
+        critical = latency >= self.critical_ms
+        if priority == PRIORITY_LOW or (critical and priority == PRIORITY_NORMAL):
+            self.shed_count += 1
+            return SHED
+        if priority == PRIORITY_NORMAL or critical:
+            self.delay_count += 1
+            return DELAY
+        return ADMIT
+
+    def stats(self):
+        return {
+            'write_latency_ms': round(self.current_latency_ms(), 2),
+            'shed': self.shed_count,
+            'delayed': self.delay_count
+        }
+
+
+# 进程级准入控制器
+admission_controller = AdmissionController()
@@ -0,0 +1,453 @@
+"""
+密钥轮换任务模块
+服务端记录每次轮换的目标版本和每个成员的投递状态，由后台调度器分批交给在线管理员完成
+
+流程:
+1. create_job() 在移除成员、定期轮换（rotation_scheduler）等场景中创建任务，为当前所有成员生成待投递记录
+2. 调度器选择一个在线管理员作为密钥持有者（generate_key=True），向其推送 key_rotation_needed，
+   附带一批成员；客户端生成新密钥后通过 /api/channels/share_keys 分发
+3. share_keys 调用 record_deliveries() 标记投递完成，调度器继续推送下一批；
+   已收到新密钥的管理员也可以并行处理后续批次
+4. 分配出去的批次有租约，超时未完成的重新分配，多次失败后标记为failed
+5. 任务状态都在数据库中，进程重启后调度器从数据库继续
+"""
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from flask import current_app
+
+from utils.db import get_db_connection
+from utils.channel_keys import get_active_key_version
+
+ACTIVE_STATUSES = ('pending', 'running')
+
+
+def create_job(conn, channel_id, created_by, reason=None):
+    """
+    创建密钥轮换任务（不提交事务）
+    同一频道未完成的旧任务会被标记为superseded
+
+    参数:
+        conn: 数据库连接
+        channel_id: 频道ID
+        created_by: 触发轮换的用户ID
+        reason: 轮换原因
+
+    返回:
+        (job_id, target_version)
+    """
+    old_version = get_active_key_version(conn, channel_id)
+    row = conn.execute('''
+        SELECT MAX(target_version) FROM key_rotation_jobs
+        WHERE channel_id = ? AND status IN ('pending', 'running')
+    ''', (channel_id,)).fetchone()
+    target_version = max(old_version, row[0] or 0) + 1
+
+    conn.execute('''
+        UPDATE key_rotation_jobs
+        SET status = 'superseded', updated_at = CURRENT_TIMESTAMP, completed_at = CURRENT_TIMESTAMP
+        WHERE channel_id = ? AND status IN ('pending', 'running')
+    ''', (channel_id,))
+
+    job_id = conn.execute('''
+        INSERT INTO key_rotation_jobs
+        (channel_id, old_key_version, target_version, status, reason, created_by)
+        VALUES (?, ?, ?, 'pending', ?, ?)
+    ''', (channel_id, old_version, target_version, reason, created_by)).lastrowid
+
+    total = conn.execute('''
+        INSERT INTO key_rotation_deliveries (job_id, user_id)
+        SELECT ?, user_id FROM user_channels WHERE channel_id = ?
+    ''', (job_id, channel_id)).rowcount
+    conn.execute('UPDATE key_rotation_jobs SET total_members = ? WHERE job_id = ?', (total, job_id))
+
+    conn.execute('''
+        INSERT INTO key_rotation_logs
+        (channel_id, old_key_version, new_key_version, rotated_by, reason)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (channel_id, old_version, target_version, created_by, reason))
+
+    # 任何原因的轮换都重新开始定期轮换的周期
+    from utils.rotation_scheduler import rotation_scheduler, reschedule
+    reschedule(conn, channel_id, rotation_scheduler.jitter_seconds, rotated=True)
+    return job_id, target_version
+
+
+def add_member(conn, channel_id, user_id):
+    """轮换进行中加入的新成员也需要收到新密钥（不提交事务）"""
+    jobs = conn.execute('''
+        SELECT job_id FROM key_rotation_jobs
+        WHERE channel_id = ? AND status IN ('pending', 'running')
+    ''', (channel_id,)).fetchall()
+    for job in jobs:
+        inserted = conn.execute('''
+            INSERT OR IGNORE INTO key_rotation_deliveries (job_id, user_id) VALUES (?, ?)
+        ''', (job['job_id'], user_id)).rowcount
+        if inserted:
+            conn.execute('''
+                UPDATE key_rotation_jobs SET total_members = total_members + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = ?
+            ''', (job['job_id'],))
+
+
+def get_job(conn, job_id):
+    return conn.execute('SELECT * FROM key_rotation_jobs WHERE job_id = ?', (job_id,)).fetchone()
+
+
+def can_deliver(conn, job_id, sender_id):
+    """
+    发送者是否可以为该任务分发密钥：必须是当前密钥持有者，或者已经收到了新密钥
+    （持有者被重新分配后，旧持有者生成的密钥不能再写入）
+    """
+    row = conn.execute('''
+        SELECT j.key_holder_id, d.status
+        FROM key_rotation_jobs j
+        LEFT JOIN key_rotation_deliveries d ON d.job_id = j.job_id AND d.user_id = ?
+        WHERE j.job_id = ? AND j.status IN ('pending', 'running')
+    ''', (sender_id, job_id)).fetchone()
+    if not row:
+        return False
+    return row['key_holder_id'] == sender_id or row['status'] == 'delivered'
+
+
+def record_deliveries(conn, channel_id, key_version, user_ids):
+    """
+    标记成员已收到目标版本的新密钥（不提交事务）
+
+    参数:
+        conn: 数据库连接
+        channel_id: 频道ID
+        key_version: 分发的密钥版本
+        user_ids: 收到密钥的用户ID（包括分发者自己）
+
+    返回:
+        list: 受影响的任务ID
+    """
+    jobs = conn.execute('''
+        SELECT job_id FROM key_rotation_jobs
+        WHERE channel_id = ? AND target_version = ? AND status IN ('pending', 'running')
+    ''', (channel_id, key_version)).fetchall()
+    job_ids = [job['job_id'] for job in jobs]
+    for job_id in job_ids:
+        conn.executemany('''
+            UPDATE key_rotation_deliveries
+            SET status = 'delivered', delivered_at = CURRENT_TIMESTAMP, lease_token = NULL
+            WHERE job_id = ? AND user_id = ? AND status != 'delivered'
+        ''', [(job_id, user_id) for user_id in set(user_ids)])
+        refresh_job(conn, job_id)
+    return job_ids
+
+
+def refresh_job(conn, job_id):
+    """
+    根据投递记录更新任务计数和状态（不提交事务）
+
+    返回:
+        str: 任务状态
+    """
+    counts = dict(conn.execute('''
+        SELECT status, COUNT(*) FROM key_rotation_deliveries WHERE job_id = ? GROUP BY status
+    ''', (job_id,)).fetchall())
+    delivered = counts.get('delivered', 0)
+    failed = counts.get('failed', 0)
+    remaining = counts.get('pending', 0) + counts.get('assigned', 0)
+    if remaining:
+        status = 'running' if delivered or counts.get('assigned') else 'pending'
+    else:
+        status = 'completed' if not failed else 'failed'
+
+    updated = conn.execute('''
+        UPDATE key_rotation_jobs
+        SET delivered_count = ?, failed_count = ?, status = ?, updated_at = CURRENT_TIMESTAMP,
+            completed_at = CASE WHEN ? IN ('completed', 'failed') THEN CURRENT_TIMESTAMP END
+        WHERE job_id = ? AND status IN ('pending', 'running')
+    ''', (delivered, failed, status, status, job_id)).rowcount
+
+    if updated and status in ('completed', 'failed'):
+        row = conn.execute('''
+            SELECT (julianday(completed_at) - julianday(created_at)) * 86400
+            FROM key_rotation_jobs WHERE job_id = ?
+        ''', (job_id,)).fetchone()
+        rotation_dispatcher.note_finished(status, row[0] or 0.0)
+    return status
+
+
+def expire_leases(conn, lease_seconds, max_attempts):
+    """
+    收回超时未完成的批次（不提交事务）
+    超过最大尝试次数的成员标记为failed；没有任何投递的任务清除密钥持有者，由其他管理员重新生成
+
+    返回:
+        int: 收回的成员数
+    """
+    cutoff = f'-{int(lease_seconds)} seconds'
+    jobs = conn.execute('''
+        SELECT DISTINCT job_id FROM key_rotation_deliveries
+        WHERE status = 'assigned' AND assigned_at < datetime('now', ?)
+    ''', (cutoff,)).fetchall()
+    if not jobs:
+        return 0
+
+    expired = conn.execute('''
+        UPDATE key_rotation_deliveries
+        SET status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END,
+            attempts = attempts + 1, assigned_to = NULL, lease_token = NULL, assigned_at = NULL
+        WHERE status = 'assigned' AND assigned_at < datetime('now', ?)
+    ''', (max_attempts, cutoff)).rowcount
+
+    for job in jobs:
+        refresh_job(conn, job['job_id'])
+        conn.execute('''
+            UPDATE key_rotation_jobs SET key_holder_id = NULL
+            WHERE job_id = ? AND delivered_count = 0 AND status IN ('pending', 'running')
+        ''', (job['job_id'],))
+    return expired
+
+
+def claim_batch(conn, job_id, worker_id, batch_size):
+    """
+    把一批待投递成员分配给管理员（不提交事务）
+
+    返回:
+        list: [{'id', 'username'}]
+    """
+    token = uuid.uuid4().hex
+    conn.execute('''
+        UPDATE key_rotation_deliveries
+        SET status = 'assigned', assigned_to = ?, lease_token = ?, assigned_at = CURRENT_TIMESTAMP
+        WHERE job_id = ? AND status = 'pending' AND user_id IN (
+            SELECT user_id FROM key_rotation_deliveries
+            WHERE job_id = ? AND status = 'pending'
+            ORDER BY user_id LIMIT ?
+        )
+    ''', (worker_id, token, job_id, job_id, batch_size))
+    rows = conn.execute('''
+        SELECT d.user_id, u.username
+        FROM key_rotation_deliveries d
+        JOIN users u ON u.user_id = d.user_id
+        WHERE d.job_id = ? AND d.lease_token = ?
+    ''', (job_id, token)).fetchall()
+    return [{'id': row['user_id'], 'username': row['username']} for row in rows]
+
+
+def job_progress(job):
+    """任务进度（返回给客户端和管理接口）"""
+    return {
+        'job_id': job['job_id'],
+        'channel_id': job['channel_id'],
+        'status': job['status'],
+        'target_version': job['target_version'],
+        'total_members': job['total_members'],
+        'delivered': job['delivered_count'],
+        'failed': job['failed_count'],
+        'remaining': max(0, job['total_members'] - job['delivered_count'] - job['failed_count']),
+        'created_at': job['created_at'],
+        'completed_at': job['completed_at']
+    }
+
+
+class RotationDispatcher:
+    """
+    后台轮换调度器
+    定期（或在有新投递时立即）收回超时批次，并把待投递成员分批推送给在线的管理员
+
+    参数:
+        interval: 两轮调度之间的间隔（秒）
+        batch_size: 每批成员数
+        lease_seconds: 批次租约时长（秒）
+        max_attempts: 单个成员最多分配次数
+    """
+
+    def __init__(self, interval=5.0, batch_size=50, lease_seconds=60, max_attempts=5):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._app = None
+        self._socketio = None
+        self._started = False
+        self._lock = threading.Lock()
+        self._rerun = False
+        self.batches_dispatched = 0
+        self.members_dispatched = 0
+        self.leases_expired = 0
+        self.jobs_completed = 0
+        self.jobs_failed = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.active_jobs = 0
+        self.oldest_active_seconds = 0.0
+        self.last_pass_at = None
+
+    def init_app(self, app, socketio):
+        self._app = app
+        self._socketio = socketio
+        self.interval = app.config.get('KEY_ROTATION_DISPATCH_INTERVAL', self.interval)
+        self.batch_size = app.config.get('KEY_ROTATION_BATCH_SIZE', self.batch_size)
+        self.lease_seconds = app.config.get('KEY_ROTATION_LEASE_SECONDS', self.lease_seconds)
+        self.max_attempts = app.config.get('KEY_ROTATION_MAX_ATTEMPTS', self.max_attempts)
+
+    def start(self):
+        """启动后台调度（重启后会继续数据库中未完成的任务）"""
+        if self._started or self._socketio is None:
+            return
+        self._started = True
+        self._socketio.start_background_task(self._run)
+
+    def kick(self):
+        """有新任务或新投递时立即调度一轮"""
+        if self._socketio is not None:
+            self._socketio.start_background_task(self._pass_with_context)
+
+    def note_finished(self, status, duration):
+        if status == 'completed':
+            self.jobs_completed += 1
+        else:
+            self.jobs_failed += 1
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+
+    def _run(self):
+        while True:
+            self._pass_with_context()
+            self._socketio.sleep(self.interval)
+
+    def _pass_with_context(self):
+        # 同一时间只运行一轮，期间的触发合并为一次重跑
+        if not self._lock.acquire(blocking=False):
+            self._rerun = True
+            return
+        try:
+            with self._app.app_context():
+                while True:
+                    self._rerun = False
+                    try:
+                        self.dispatch_once()
+                    except Exception as e:
+                        current_app.logger.error(f"密钥轮换调度失败: {str(e)}", exc_info=True)
+                    if not self._rerun:
+                        break
+        finally:
+            self._lock.release()
+
+    def dispatch_once(self):
+        """执行一轮调度，需要应用上下文"""
+        from socket_events import user_sessions
+        online = set(user_sessions)
+        emits = []
+
+        conn = get_db_connection()
+        try:
+            self.leases_expired += expire_leases(conn, self.lease_seconds, self.max_attempts)
+
+            jobs = conn.execute('''
+                SELECT j.*, c.room_id FROM key_rotation_jobs j
+                JOIN channels c ON c.channel_id = j.channel_id
+                WHERE j.status IN ('pending', 'running')
+                ORDER BY j.job_id
+            ''').fetchall()
+
+            for job in jobs:
+                if not online:
+                    break
+                emits.extend(self._dispatch_job(conn, job, online))
+
+            summary = conn.execute('''
+                SELECT COUNT(*), (julianday('now') - julianday(MIN(created_at))) * 86400
+                FROM key_rotation_jobs WHERE status IN ('pending', 'running')
+            ''').fetchone()
+            conn.commit()
+        finally:
+            conn.close()
+
+        self.active_jobs = summary[0]
+        self.oldest_active_seconds = round(summary[1] or 0.0, 1)
+        self.last_pass_at = time.time()
+
+        for worker_id, payload in emits:
+            self._socketio.emit('key_rotation_needed', payload, room=f'user_{worker_id}')
+
+    def _dispatch_job(self, conn, job, online):
+        job_id = job['job_id']
+        in_flight = {row[0] for row in conn.execute('''
+            SELECT DISTINCT assigned_to FROM key_rotation_deliveries
+            WHERE job_id = ? AND status = 'assigned'
+        ''', (job_id,)).fetchall()}
+
+        admins = conn.execute('''
+            SELECT uc.user_id, d.status
+            FROM user_channels uc
+            JOIN user_rooms ur ON ur.user_id = uc.user_id AND ur.room_id = ?
+            LEFT JOIN key_rotation_deliveries d ON d.job_id = ? AND d.user_id = uc.user_id
+            WHERE uc.channel_id = ? AND ur.role IN ('admin', 'owner')
+            ORDER BY CASE WHEN uc.user_id = ? THEN 0 ELSE 1 END, uc.user_id
+        ''', (job['room_id'], job_id, job['channel_id'], job['created_by'])).fetchall()
+
+        holder_id = job['key_holder_id']
+        if holder_id is None:
+            # 还没有人生成新密钥：交给一个在线管理员，由他生成并分发第一批
+            if in_flight:
+                return []
+            workers = [a['user_id'] for a in admins if a['user_id'] in online][:1]
+            if not workers:
+                return []
+            # 条件更新认领：多个进程可能同时读到没有持有者，只有一个能指定生成新密钥的管理员
+            claimed = conn.execute('''
+                UPDATE key_rotation_jobs SET key_holder_id = ?, status = 'running', updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = ? AND key_holder_id IS NULL
+            ''', (workers[0], job_id)).rowcount
+            if not claimed:
+                return []
+            generate_key = True
+        else:
+            # 持有者和已收到新密钥的管理员都可以处理后续批次
+            workers = [a['user_id'] for a in admins
+                       if a['user_id'] in online and a['user_id'] not in in_flight
+                       and (a['user_id'] == holder_id or a['status'] == 'delivered')]
+            generate_key = False
+
+        emits = []
+        for worker_id in workers:
+            members = claim_batch(conn, job_id, worker_id, self.batch_size)
+            if not members:
+                break
+            self.batches_dispatched += 1
+            self.members_dispatched += len(members)
+            emits.append((worker_id, {
+                'job_id': job_id,
+                'channel_id': job['channel_id'],
+                'new_version': job['target_version'],
+                'reason': job['reason'],
+                'is_key_rotation': True,
+                'generate_key': generate_key and worker_id == workers[0],
+                'members': members,
+                'progress': {
+                    'total': job['total_members'],
+                    'delivered': job['delivered_count']
+                },
+                'timestamp': datetime.now().isoformat()
+            }))
+        return emits
+
+    def stats(self):
+        finished = self.jobs_completed + self.jobs_failed
+        return {
+            'active_jobs': self.active_jobs,
+            'oldest_active_seconds': self.oldest_active_seconds,
+            'batches_dispatched': self.batches_dispatched,
+            'members_dispatched': self.members_dispatched,
+            'leases_expired': self.leases_expired,
+            'jobs_completed': self.jobs_completed,
+            'jobs_failed': self.jobs_failed,
+            'last_duration_seconds': round(self.last_duration, 1),
+            'max_duration_seconds': round(self.max_duration, 1),
+            'avg_duration_seconds': round(self.total_duration / finished, 1) if finished else 0.0
+        }
+
+
+# 进程级轮换调度器
+rotation_dispatcher = RotationDispatcher()
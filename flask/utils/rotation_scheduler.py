@@ -0,0 +1,288 @@
+"""
+定期密钥轮换调度模块
+channel_encryption.key_rotation_frequency（天，0表示不自动轮换）大于0的频道按周期自动轮换密钥：
+
+1. next_rotation_at 记录下一次到期时间，由 reschedule() 根据 last_key_rotation 和频率计算，
+   附加随机抖动，避免同时开启加密的频道在同一时刻集中到期
+2. 后台任务每轮用一次走索引的查询取出已到期的频道，按到期时间先后创建轮换任务，
+   交给 rotation_jobs 的调度器分批分发
+3. 每轮创建的任务数和同时进行的任务数都有上限，积压的频道顺延到下一轮；
+   每个进程都运行调度，创建任务前按读到的 next_rotation_at 条件更新认领频道，避免重复创建
+4. 任何原因的轮换（包括移除成员）都会通过 create_job() 重置周期
+5. 跳过的到期（已有进行中的轮换、频道没有创建者）只用 postpone() 顺延 next_rotation_at，
+   不更新 last_key_rotation
+"""
+import random
+import threading
+import time
+from collections import deque
+
+from flask import current_app
+
+from utils.db import get_db_connection
+
+
+def reschedule(conn, channel_id, jitter_seconds=0, rotated=False):
+    """
+    重新计算频道的下一次轮换时间（不提交事务）
+    未启用加密或频率为0时清空 next_rotation_at
+
+    参数:
+        conn: 数据库连接
+        channel_id: 频道ID
+        jitter_seconds: 最大随机抖动（秒）
+        rotated: 是否刚刚完成一次轮换（同时更新 last_key_rotation）
+    """
+    jitter = random.randint(0, int(jitter_seconds)) if jitter_seconds else 0
+    if rotated:
+        conn.execute('''
+            UPDATE channel_encryption SET last_key_rotation = CURRENT_TIMESTAMP
+            WHERE channel_id = ?
+        ''', (channel_id,))
+    conn.execute('''
+        UPDATE channel_encryption
+        SET next_rotation_at = CASE
+            WHEN enabled = 1 AND key_rotation_frequency > 0 THEN datetime(
+                COALESCE(last_key_rotation, CURRENT_TIMESTAMP),
+                '+' || key_rotation_frequency || ' days',
+                '+' || ? || ' seconds')
+        END
+        WHERE channel_id = ?
+    ''', (jitter, channel_id))
+
+
+def postpone(conn, channel_id, jitter_seconds=0):
+    """
+    没有实际轮换时把下一次轮换时间从现在起顺延一个周期（不提交事务）
+    不更新 last_key_rotation，避免已到期的频道一直占用每轮的批次
+
+    参数:
+        conn: 数据库连接
+        channel_id: 频道ID
+        jitter_seconds: 最大随机抖动（秒）
+    """
+    jitter = random.randint(0, int(jitter_seconds)) if jitter_seconds else 0
+    conn.execute('''
+        UPDATE channel_encryption
+        SET next_rotation_at = CASE
+            WHEN enabled = 1 AND key_rotation_frequency > 0 THEN datetime(
+                'now',
+                '+' || key_rotation_frequency || ' days',
+                '+' || ? || ' seconds')
+        END
+        WHERE channel_id = ?
+    ''', (jitter, channel_id))
+
+
+def set_channel_schedule(conn, channel_id, enabled, frequency=None, jitter_seconds=0):
+    """
+    更新频道的加密开关和轮换频率，并重新计算下一次轮换时间（不提交事务）
+
+    参数:
+        conn: 数据库连接
+        channel_id: 频道ID
+        enabled: 是否启用加密
+        frequency: 轮换频率（天），None表示保持原值
+        jitter_seconds: 最大随机抖动（秒）
+    """
+    conn.execute('''
+        INSERT INTO channel_encryption (channel_id, enabled, key_rotation_frequency)
+        VALUES (?, ?, COALESCE(?, 0))
+        ON CONFLICT(channel_id) DO UPDATE SET
+            enabled = excluded.enabled,
+            key_rotation_frequency = COALESCE(?, key_rotation_frequency)
+    ''', (channel_id, 1 if enabled else 0, frequency, frequency))
+    reschedule(conn, channel_id, jitter_seconds)
+
+
+def get_schedule(conn, channel_id):
+    """频道的轮换周期信息（返回给客户端）"""
+    row = conn.execute('''
+        SELECT key_rotation_frequency, last_key_rotation, next_rotation_at
+        FROM channel_encryption WHERE channel_id = ?
+    ''', (channel_id,)).fetchone()
+    if not row:
+        return None
+    return {
+        'frequency_days': row['key_rotation_frequency'] or 0,
+        'last_rotation': row['last_key_rotation'],
+        'next_rotation_at': row['next_rotation_at']
+    }
+
+
+class RotationScheduler:
+    """
+    定期轮换的后台任务
+
+    参数:
+        interval: 两轮检查之间的间隔（秒）
+        batch_size: 每轮最多创建的轮换任务数
+        max_active_jobs: 进行中的轮换任务达到此数量时本轮不再创建
+        jitter_seconds: 计算下一次轮换时间时的最大随机抖动（秒）
+    """
+
+    def __init__(self, interval=60.0, batch_size=10, max_active_jobs=20, jitter_seconds=3600):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_active_jobs = max_active_jobs
+        self.jitter_seconds = jitter_seconds
+        self._app = None
+        self._socketio = None
+        self._started = False
+        self._lock = threading.Lock()
+        self._recent = deque()  # 最近一小时创建任务的时间戳
+        self.passes = 0
+        self.rotations_queued = 0
+        self.skipped = 0
+        self.skipped_no_owner = 0
+        self.deferred = 0
+        self.failed = 0
+        self.due_backlog = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.last_pass_at = None
+
+    def init_app(self, app, socketio):
+        self._app = app
+        self._socketio = socketio
+        self.interval = app.config.get('KEY_ROTATION_SCHEDULE_INTERVAL', self.interval)
+        self.batch_size = app.config.get('KEY_ROTATION_SCHEDULE_BATCH', self.batch_size)
+        self.max_active_jobs = app.config.get('KEY_ROTATION_MAX_ACTIVE_JOBS', self.max_active_jobs)
+        self.jitter_seconds = app.config.get('KEY_ROTATION_SCHEDULE_JITTER', self.jitter_seconds)
+
+    def start(self):
+        if self._started or self._socketio is None:
+            return
+        self._started = True
+        self._socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            # 多个进程同时启动时错开第一轮
+            self._socketio.sleep(self.interval * (0.5 + random.random()) if not self.passes else self.interval)
+            if not self._lock.acquire(blocking=False):
+                continue
+            try:
+                with self._app.app_context():
+                    try:
+                        self.run_once()
+                    except Exception as e:
+                        current_app.logger.error(f"定期密钥轮换调度失败: {str(e)}", exc_info=True)
+            finally:
+                self._lock.release()
+
+    def run_once(self):
+        """执行一轮检查，需要应用上下文
+
+        返回:
+            int: 本轮创建的轮换任务数
+        """
+        from utils import rotation_jobs
+
+        conn = get_db_connection()
+        queued = 0
+        try:
+            active = conn.execute('''
+                SELECT COUNT(*) FROM key_rotation_jobs WHERE status IN ('pending', 'running')
+            ''').fetchone()[0]
+            capacity = min(self.batch_size, max(0, self.max_active_jobs - active))
+
+            # 走 idx_channel_encryption_next_rotation，按到期先后取一批
+            due = conn.execute('''
+                SELECT ce.channel_id, ce.next_rotation_at, c.created_by,
+                       (julianday('now') - julianday(ce.next_rotation_at)) * 86400 AS lag_seconds,
+                       EXISTS (
+                           SELECT 1 FROM key_rotation_jobs j
+                           WHERE j.channel_id = ce.channel_id AND j.status IN ('pending', 'running')
+                       ) AS has_active_job
+                FROM channel_encryption ce
+                JOIN channels c ON c.channel_id = ce.channel_id
+                WHERE ce.next_rotation_at <= datetime('now')
+                ORDER BY ce.next_rotation_at
+                LIMIT ?
+            ''', (self.batch_size,)).fetchall()
+
+            for index, row in enumerate(due):
+                channel_id = row['channel_id']
+                try:
+                    if row['has_active_job']:
+                        # 正在进行的轮换（例如移除成员触发）已经覆盖这次到期，顺延一个周期
+                        postpone(conn, channel_id, self.jitter_seconds)
+                        conn.commit()
+                        self.skipped += 1
+                        continue
+                    if row['created_by'] is None:
+                        # 没有创建者的频道无法记录轮换人，没有轮换，只顺延一个周期
+                        postpone(conn, channel_id, self.jitter_seconds)
+                        conn.commit()
+                        self.skipped_no_owner += 1
+                        current_app.logger.warning(f"频道 {channel_id} 没有创建者，跳过定期密钥轮换")
+                        continue
+                    if queued >= capacity:
+                        # 同时进行的任务太多，剩下的留到下一轮
+                        self.deferred += len(due) - index
+                        break
+                    # 每个进程都运行调度，先用读到的到期时间认领频道，另一个进程已经认领时跳过；
+                    # create_job() 在同一事务中重新计算下一次轮换时间
+                    claimed = conn.execute('''
+                        UPDATE channel_encryption SET next_rotation_at = datetime('now', '+1 day')
+                        WHERE channel_id = ? AND next_rotation_at = ?
+                    ''', (channel_id, row['next_rotation_at'])).rowcount
+                    if not claimed:
+                        conn.rollback()
+                        continue
+                    rotation_jobs.create_job(conn, channel_id, row['created_by'], 'scheduled')
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    self.failed += 1
+                    current_app.logger.error(f"频道 {channel_id} 定期密钥轮换失败: {str(e)}", exc_info=True)
+                    continue
+                queued += 1
+                self._note_queued(row['lag_seconds'] or 0.0)
+
+            self.due_backlog = conn.execute('''
+                SELECT COUNT(*) FROM channel_encryption WHERE next_rotation_at <= datetime('now')
+            ''').fetchone()[0]
+        finally:
+            conn.close()
+
+        self.passes += 1
+        self.last_pass_at = time.time()
+        if queued:
+            rotation_jobs.rotation_dispatcher.kick()
+        return queued
+
+    def _note_queued(self, lag):
+        now = time.time()
+        self._recent.append(now)
+        while self._recent and self._recent[0] < now - 3600:
+            self._recent.popleft()
+        self.rotations_queued += 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.total_lag += lag
+
+    def stats(self):
+        now = time.time()
+        while self._recent and self._recent[0] < now - 3600:
+            self._recent.popleft()
+        return {
+            'passes': self.passes,
+            'rotations_queued': self.rotations_queued,
+            'rotations_last_hour': len(self._recent),
+            'skipped': self.skipped,
+            'skipped_no_owner': self.skipped_no_owner,
+            'deferred': self.deferred,
+            'failed': self.failed,
+            'due_backlog': self.due_backlog,
+            'last_lag_seconds': round(self.last_lag, 1),
+            'max_lag_seconds': round(self.max_lag, 1),
+            'avg_lag_seconds': round(self.total_lag / self.rotations_queued, 1) if self.rotations_queued else 0.0,
+            'last_pass_at': self.last_pass_at
+        }
+
+
+# 进程级定期轮换调度
+rotation_scheduler = RotationScheduler()
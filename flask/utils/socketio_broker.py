@@ -0,0 +1,335 @@
+"""
+Socket.IO 跨进程消息代理
+提供一个不依赖Redis的轻量级发布/订阅代理，用于多进程部署时的跨进程emit
+
+使用方式:
+    # 启动代理进程
+    python -m utils.socketio_broker --host 127.0.0.1 --port 5679
+
+    # 每个worker设置
+    export SOCKETIO_MESSAGE_QUEUE=broker://127.0.0.1:5679
+
+代理只负责把每个worker发布的帧原样转发给所有已连接的worker（包括发布者自己），
+python-socketio 的 PubSubManager 会在各进程内完成本地投递。
+生产环境建议使用 Redis (redis://)，本代理适用于单机多进程和测试。
+
+帧只包含数据（JSON，bytes 和 tuple 带类型标记），接收方不会执行帧中的任何内容。
+设置 SOCKETIO_BROKER_SECRET 后每帧带 HMAC-SHA256，代理和worker都丢弃签名不对的帧；
+未设置密钥时代理只允许监听回环地址。
+"""
+import base64
+import hashlib
+import hmac
+import ipaddress
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from urllib.parse import urlparse
+
+try:
+    from socketio.pubsub_manager import PubSubManager
+except ImportError:  # pragma: no cover - 仅在运行代理进程时不需要socketio
+    PubSubManager = object
+
+DEFAULT_BROKER_PORT = 5679
+_HEADER = struct.Struct('!I')
+_MAX_FRAME = 64 * 1024 * 1024
+_MAC_SIZE = hashlib.sha256().digest_size
+
+# JSON 不能直接表示的类型的标记；用户数据中的字典恰好含有这些键时用 __d 包一层
+_TAG_BYTES = '__b'
+_TAG_TUPLE = '__t'
+_TAG_DICT = '__d'
+_TAGS = frozenset((_TAG_BYTES, _TAG_TUPLE, _TAG_DICT))
+
+
+class BrokerAuthError(ValueError):
+    """帧的签名不正确"""
+
+
+def _encode(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {_TAG_BYTES: base64.b64encode(bytes(value)).decode('ascii')}
+    if isinstance(value, tuple):
+        return {_TAG_TUPLE: [_encode(item) for item in value]}
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if isinstance(value, dict):
+        encoded = {key: _encode(item) for key, item in value.items()}
+        return {_TAG_DICT: encoded} if _TAGS.intersection(encoded) else encoded
+    return value
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    if isinstance(value, dict):
+        if len(value) == 1:
+            (key, item), = value.items()
+            if key == _TAG_BYTES:
+                return base64.b64decode(item)
+            if key == _TAG_TUPLE:
+                return tuple(_decode(element) for element in item)
+            if key == _TAG_DICT:
+                return {k: _decode(v) for k, v in item.items()}
+        return {key: _decode(item) for key, item in value.items()}
+    return value
+
+
+def dumps(envelope):
+    """把发布的消息编码为JSON字节（只包含数据）"""
+    return json.dumps(_encode(envelope), separators=(',', ':'), default=str).encode('utf-8')
+
+
+def loads(payload):
+    """dumps 的逆操作"""
+    return _decode(json.loads(payload.decode('utf-8')))
+
+
+def sign(secret, payload):
+    """有密钥时在帧前加上 HMAC-SHA256"""
+    if not secret:
+        return payload
+    return hmac.new(secret, payload, hashlib.sha256).digest() + payload
+
+
+def verify(secret, frame):
+    """校验并去掉帧前的 HMAC，签名不正确时抛出 BrokerAuthError"""
+    if not secret:
+        return frame
+    mac, payload = frame[:_MAC_SIZE], frame[_MAC_SIZE:]
+    if len(mac) != _MAC_SIZE or not hmac.compare_digest(mac, hmac.new(secret, payload, hashlib.sha256).digest()):
+        raise BrokerAuthError('bad broker frame signature')
+    return payload
+
+
+def _secret_bytes(secret):
+    if isinstance(secret, str):
+        secret = secret.encode('utf-8')
+    return secret or None
+
+
+def is_loopback(host):
+    """host 是否只在本机可达"""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _send_frame(sock, payload):
+    """发送一个带长度前缀的帧"""
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exact(sock, size):
+    """从套接字读取指定字节数，连接关闭时返回None"""
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = sock.recv(remaining)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def _recv_frame(sock):
+    """读取一个带长度前缀的帧，连接关闭时返回None"""
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None
+    (size,) = _HEADER.unpack(header)
+    if size > _MAX_FRAME:
+        raise ValueError(f'frame too large: {size}')
+    return _recv_exact(sock, size)
+
+
+def parse_broker_url(url):
+    """
+    解析 broker://host:port/channel 形式的地址
+
+    返回:
+        (host, port, channel)，channel 为空时返回None
+    """
+    parsed = urlparse(url)
+    host = parsed.hostname or '127.0.0.1'
+    port = parsed.port or DEFAULT_BROKER_PORT
+    channel = parsed.path.lstrip('/') or None
+    return host, port, channel
+
+
+class BrokerClientManager(PubSubManager):
+    """
+    基于进程内代理的 Socket.IO 客户端管理器
+
+    消息用JSON编码（不使用pickle，收到的帧不会被执行），有密钥时加 HMAC 签名后发布到代理，
+    代理再广播给所有订阅者。发布与订阅使用两条独立连接。
+
+    参数:
+        secret: 共享密钥，代理不在回环地址时必须设置
+    """
+    name = 'broker'
+
+    def __init__(self, url='broker://127.0.0.1:5679', channel='socketio',
+                 write_only=False, logger=None, reconnect_delay=1.0, secret=None):
+        self.host, self.port, url_channel = parse_broker_url(url)
+        self.secret = _secret_bytes(secret)
+        if self.secret is None and not is_loopback(self.host):
+            raise ValueError('SOCKETIO_BROKER_SECRET is required for a broker that is not on loopback')
+        self.reconnect_delay = reconnect_delay
+        self._pub_sock = None
+        self._pub_lock = threading.Lock()
+        super().__init__(channel=url_channel or channel,
+                         write_only=write_only, logger=logger)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=10)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _publish(self, data):
+        payload = sign(self.secret, dumps({'channel': self.channel, 'data': data}))
+        with self._pub_lock:
+            for attempt in range(2):
+                try:
+                    if self._pub_sock is None:
+                        self._pub_sock = self._connect()
+                    _send_frame(self._pub_sock, payload)
+                    return
+                except OSError:
+                    if self._pub_sock is not None:
+                        try:
+                            self._pub_sock.close()
+                        except OSError:
+                            pass
+                        self._pub_sock = None
+                    if attempt:
+                        raise
+
+    def _listen(self):
+        while True:
+            try:
+                sock = self._connect()
+            except OSError as e:
+                self._get_logger().error(
+                    'Cannot connect to Socket.IO broker %s:%s (%s), retrying',
+                    self.host, self.port, e)
+                time.sleep(self.reconnect_delay)
+                continue
+            try:
+                while True:
+                    frame = _recv_frame(sock)
+                    if frame is None:
+                        break
+                    try:
+                        envelope = loads(verify(self.secret, frame))
+                    except BrokerAuthError:
+                        self._get_logger().warning('Dropped Socket.IO broker frame with a bad signature')
+                        continue
+                    except ValueError:
+                        continue
+                    if envelope.get('channel') == self.channel:
+                        yield envelope['data']
+            except (OSError, ValueError) as e:
+                self._get_logger().error('Socket.IO broker connection lost: %s', e)
+            finally:
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+            time.sleep(self.reconnect_delay)
+
+
+class _BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, secret=None):
+        super().__init__(address, _BrokerHandler)
+        self.secret = secret
+        self.clients = set()
+        self.clients_lock = threading.Lock()
+
+    def broadcast(self, frame):
+        with self.clients_lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                with client.send_lock:
+                    _send_frame(client.request, frame)
+            except OSError:
+                self.remove_client(client)
+
+    def remove_client(self, client):
+        with self.clients_lock:
+            self.clients.discard(client)
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.send_lock = threading.Lock()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.clients_lock:
+            self.server.clients.add(self)
+
+    def handle(self):
+        while True:
+            try:
+                frame = _recv_frame(self.request)
+            except (OSError, ValueError):
+                return
+            if frame is None:
+                return
+            if self.server.secret is not None:
+                try:
+                    verify(self.server.secret, frame)
+                except BrokerAuthError:
+                    # 不知道密钥的连接直接断开
+                    return
+            self.server.broadcast(frame)
+
+    def finish(self):
+        self.server.remove_client(self)
+
+
+def serve(host='127.0.0.1', port=DEFAULT_BROKER_PORT, ready_event=None, secret=None):
+    """
+    启动代理并阻塞运行
+
+    参数:
+        secret: 共享密钥；未设置时只允许监听回环地址
+    """
+    secret = _secret_bytes(secret)
+    if secret is None and not is_loopback(host):
+        raise ValueError(f'refusing to listen on {host} without SOCKETIO_BROKER_SECRET')
+    server = _BrokerServer((host, port), secret)
+    print(f"Socket.IO broker listening on {host}:{port}")
+    if ready_event is not None:
+        ready_event.set()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Socket.IO message broker for multi-worker deployments')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_BROKER_PORT)
+    args = parser.parse_args()
+    # 密钥从环境变量读取，不出现在进程参数中
+    try:
+        serve(args.host, args.port, secret=os.environ.get('SOCKETIO_BROKER_SECRET'))
+    except ValueError as e:
+        parser.error(str(e))
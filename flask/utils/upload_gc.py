@@ -0,0 +1,570 @@
+"""
+上传文件的增量回收
+上传目录中的文件原来从不删除：上传后没有发送的文件、所在消息或频道已删除的文件会一直保留。
+回收任务在后台按小批量分阶段处理，每个阶段之间暂停，不会长时间占用数据库写锁和磁盘：
+
+1. 别名：上传超过宽限期、既没有关联到仍然存在、被固定或被收藏的消息，也没有被任何明文内容
+   （频道消息、私信、头像、资源链接、固定消息和收藏的副本）引用的文件名，删除别名并减少内容的引用计数；
+   没有登记到 files 表的旧文件名，如果上传者之后发送过加密消息（内容不可读）则保留
+2. 隔离：引用计数为0超过宽限期的内容（idx_upload_blobs_unreferenced）移入隔离目录，
+   记录 quarantined_at；隔离期间重新上传相同内容会恢复为正常状态
+3. 删除：隔离超过 UPLOAD_GC_QUARANTINE_PERIOD 的内容（idx_upload_blobs_quarantined）
+   连同缩略图一起删除
+4. 扫描：按目录逐批遍历 blobs/、previews/ 和隔离目录，处理没有数据库记录的文件
+   （例如写入文件后事务回滚），以及重新上传后隔离目录中多余的副本
+
+所有修改都在写事务中重新检查条件后进行；blob_store.store() 先写记录再检查文件，
+因此同一内容的并发上传不会与回收冲突。dry-run 模式只统计和记录日志，不修改文件和数据库。
+"""
+import os
+import re
+import threading
+import time
+from collections import deque
+
+import click
+from flask import current_app
+
+from utils import blob_store, previews
+from utils.db import get_db_connection
+
+_SHA256 = re.compile(r'^[0-9a-f]{64}$')
+_PREVIEW_FILE = re.compile(r'^([0-9a-f]{64})_')
+
+# 按主键范围分段扫描内容引用，每段之后释放读锁
+SCAN_CHUNK = 5000
+
+# 可能以 /uploads/<filename> 引用上传文件的明文字段：(表, 主键, 字段, 条件)
+# 固定消息和收藏保存了消息内容的副本，原消息删除后仍然显示
+REFERENCE_SOURCES = (
+    ('messages', 'message_id', 'content', 'is_deleted = 0'),
+    ('direct_messages', 'dm_id', 'content', 'COALESCE(is_deleted, 0) = 0'),
+    ('users', 'user_id', 'avatar_url', '1 = 1'),
+    ('resources', 'resource_id', 'url', '1 = 1'),
+    ('pinned_messages', 'pin_id', 'message_content', '1 = 1'),
+    ('saved_items', 'save_id', 'item_data', '1 = 1')
+)
+
+COUNTERS = (
+    'aliases_checked',
+    'aliases_released',
+    'blobs_quarantined',
+    'blobs_purged',
+    'blobs_rescued',
+    'untracked_quarantined',
+    'untracked_removed',
+    'previews_removed',
+    'files_scanned',
+    'bytes_reclaimed'
+)
+
+
+def _ago(seconds):
+    """datetime('now', ?) 的参数"""
+    return f'-{int(seconds)} seconds'
+
+
+def _leaf_dirs(top):
+    """两级分层目录（ab/cd）下的所有子目录，按名称排序"""
+    if not os.path.isdir(top):
+        return []
+    result = []
+    for first in sorted(os.listdir(top)):
+        first_path = os.path.join(top, first)
+        if not os.path.isdir(first_path):
+            continue
+        for second in sorted(os.listdir(first_path)):
+            path = os.path.join(first_path, second)
+            if os.path.isdir(path):
+                result.append(path)
+    return result
+
+
+def _remove(path):
+    """删除文件，返回释放的字节数；文件不存在时返回0"""
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+def _move(src, dst):
+    """移动文件并把修改时间设为当前时间（隔离目录中按修改时间计算隔离期）"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    os.replace(src, dst)
+    os.utime(dst)
+
+
+class UploadCollector:
+    """
+    后台增量回收未被引用的上传文件
+
+    参数:
+        interval: 两轮回收之间的间隔（秒）
+        batch_size: 每轮每个阶段最多处理的条目数
+        grace_period: 上传后未被引用多久之后回收（秒）
+        quarantine_period: 在隔离目录中保留多久之后删除（秒）
+        pause: 各阶段之间的暂停（秒）
+        dry_run: 只统计和记录日志，不修改文件和数据库
+    """
+
+    def __init__(self, interval=3600.0, batch_size=200, grace_period=7 * 24 * 3600,
+                 quarantine_period=7 * 24 * 3600, pause=0.5, dry_run=False):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.grace_period = grace_period
+        self.quarantine_period = quarantine_period
+        self.pause = pause
+        self.dry_run = dry_run
+        self._app = None
+        self._socketio = None
+        self._started = False
+        self._lock = threading.Lock()
+        self._alias_cursor = 0
+        self._pending_dirs = deque()
+        self._dirs_total = 0
+        self.phase = 'idle'
+        self.passes = 0
+        self.cycles = 0
+        self.totals = dict.fromkeys(COUNTERS, 0)
+        self.last_pass = None
+        self.last_pass_at = None
+        self.last_pass_ms = 0.0
+
+    def init_app(self, app, socketio):
+        self._app = app
+        self._socketio = socketio
+        self.interval = app.config.get('UPLOAD_GC_INTERVAL', self.interval)
+        self.batch_size = app.config.get('UPLOAD_GC_BATCH_SIZE', self.batch_size)
+        self.grace_period = app.config.get('UPLOAD_GC_GRACE_PERIOD', self.grace_period)
+        self.quarantine_period = app.config.get('UPLOAD_GC_QUARANTINE_PERIOD', self.quarantine_period)
+        self.pause = app.config.get('UPLOAD_GC_PAUSE', self.pause)
+        self.dry_run = app.config.get('UPLOAD_GC_DRY_RUN', self.dry_run)
+
+        @app.cli.command('gc-uploads')
+        @click.option('--dry-run', is_flag=True, help='只列出将要回收的文件，不做修改')
+        def gc_uploads_command(dry_run):
+            """回收未被引用的上传文件，直到完整扫描一遍上传目录"""
+            self.run_cycle(dry_run=dry_run or self.dry_run, report=click.echo)
+
+    def start(self):
+        if self._started or self._socketio is None:
+            return
+        self._started = True
+        self._socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            self._socketio.sleep(self.interval)
+            with self._app.app_context():
+                try:
+                    self.collect_once()
+                except Exception as e:
+                    current_app.logger.error(f"回收上传文件失败: {str(e)}", exc_info=True)
+
+    def _sleep(self, seconds):
+        if self._socketio is not None:
+            self._socketio.sleep(seconds)
+        elif seconds:
+            time.sleep(seconds)
+
+    def run_cycle(self, dry_run=False, report=None):
+        """连续运行直到别名和上传目录都处理完一遍，需要应用上下文"""
+        cycles = self.cycles
+        while True:
+            result = self.collect_once(dry_run=dry_run)
+            if result is None:
+                self._sleep(1)
+                continue
+            if report:
+                progress = self.stats()['scan']
+                report(f"[{'dry-run' if dry_run else 'gc'}] 目录 {progress['dirs_done']}/{progress['dirs_total']} "
+                       + ' '.join(f'{key}={value}' for key, value in result.items() if value))
+            if self.cycles > cycles and self._alias_cursor == 0:
+                return
+
+    def collect_once(self, dry_run=None):
+        """
+        运行一轮回收，需要应用上下文
+
+        返回:
+            dict: 本轮各项计数；另一轮正在运行时返回None
+        """
+        if not self._lock.acquire(blocking=False):
+            return None
+        dry_run = self.dry_run if dry_run is None else dry_run
+        result = dict.fromkeys(COUNTERS, 0)
+        root = current_app.config['UPLOAD_FOLDER']
+        quarantine_root = current_app.config['UPLOAD_QUARANTINE_FOLDER']
+        started = time.perf_counter()
+        conn = get_db_connection()
+        try:
+            self.phase = 'aliases'
+            self._release_aliases(conn, result, dry_run)
+            self._sleep(self.pause)
+            self.phase = 'quarantine'
+            self._quarantine_blobs(conn, root, quarantine_root, result, dry_run)
+            self._sleep(self.pause)
+            self.phase = 'purge'
+            self._purge_quarantine(conn, root, quarantine_root, result, dry_run)
+            self._sleep(self.pause)
+            self.phase = 'scan'
+            self._scan_store(conn, root, quarantine_root, result, dry_run)
+        finally:
+            conn.close()
+            self.phase = 'idle'
+            self._lock.release()
+
+        self.passes += 1
+        self.last_pass = result
+        self.last_pass_at = time.time()
+        self.last_pass_ms = round((time.perf_counter() - started) * 1000, 2)
+        if not dry_run:
+            for key, value in result.items():
+                self.totals[key] += value
+        changed = {key: value for key, value in result.items()
+                   if value and key not in ('aliases_checked', 'files_scanned')}
+        if changed:
+            current_app.logger.info(f"上传文件回收{'（dry-run）' if dry_run else ''}: {changed}")
+        return result
+
+    # ---- 1. 别名 ----
+
+    def _release_aliases(self, conn, result, dry_run):
+        """检查一批超过宽限期的文件名，删除不再被引用的"""
+        rows = conn.execute('''
+            SELECT rowid, filename, user_id, created_at FROM upload_aliases
+            WHERE rowid > ? AND created_at < datetime('now', ?)
+            ORDER BY rowid LIMIT ?
+        ''', (self._alias_cursor, _ago(self.grace_period), self.batch_size)).fetchall()
+        self._alias_cursor = rows[-1]['rowid'] if len(rows) == self.batch_size else 0
+        result['aliases_checked'] += len(rows)
+
+        candidates = [row for row in rows if not self._linked(conn, row['filename'])]
+        if not candidates:
+            return
+        referenced, watermarks = self._content_references(conn, {row['filename'] for row in candidates})
+        for row in candidates:
+            filename = row['filename']
+            if filename in referenced or self._maybe_encrypted_reference(conn, row):
+                continue
+            if dry_run:
+                current_app.logger.info(f"[dry-run] 将删除未被引用的文件名 {filename}")
+                result['aliases_released'] += 1
+                continue
+            # 在写事务中重新检查，期间新发送的消息只需检查扫描之后的新行
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self._linked(conn, filename) or self._referenced_since(conn, filename, watermarks):
+                    conn.rollback()
+                    continue
+                blob_store.release(conn, filename)
+                conn.execute('UPDATE files SET is_deleted = 1 WHERE filename = ?', (filename,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            previews.ready_preview_cache.invalidate(filename)
+            result['aliases_released'] += 1
+            self._sleep(0)
+
+    def _linked(self, conn, filename):
+        """文件名是否关联到仍然存在的消息，或文件、所在消息被收藏或固定（原消息删除后仍然显示）"""
+        return conn.execute('''
+            SELECT 1 FROM files f
+            LEFT JOIN messages m ON m.message_id = f.message_id
+            JOIN channels c ON c.channel_id = f.channel_id
+            WHERE f.filename = ?
+              AND ((f.is_deleted = 0 AND m.message_id IS NOT NULL AND m.is_deleted = 0)
+                   OR EXISTS (SELECT 1 FROM saved_items s
+                              WHERE s.item_type = 'file' AND s.item_id = f.file_id)
+                   OR (f.message_id IS NOT NULL
+                       AND (EXISTS (SELECT 1 FROM saved_items s
+                                    WHERE s.item_type = 'message' AND s.item_id = f.message_id)
+                            OR EXISTS (SELECT 1 FROM pinned_messages pm
+                                       WHERE pm.message_id = CAST(f.message_id AS TEXT)))))
+            LIMIT 1
+        ''', (filename,)).fetchone() is not None
+
+    def _sources(self, conn):
+        # saved_items.item_data 等字段只在部分数据库中存在
+        tables = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        sources = []
+        for source in REFERENCE_SOURCES:
+            table, _, column, _ = source
+            if table in tables and any(row['name'] == column
+                                       for row in conn.execute(f'PRAGMA table_info({table})')):
+                sources.append(source)
+        return sources
+
+    def _content_references(self, conn, names):
+        """
+        names 中被明文内容引用的文件名
+        按主键范围分段扫描，段与段之间不持有读锁
+
+        返回:
+            (referenced, watermarks)：watermarks 为扫描开始时各表的最大主键
+        """
+        referenced = set()
+        watermarks = {}
+        for table, key, column, condition in self._sources(conn):
+            high = conn.execute(f'SELECT MAX({key}) FROM {table}').fetchone()[0] or 0
+            watermarks[table] = high
+            low = 0
+            while low < high:
+                rows = conn.execute(f'''
+                    SELECT {column} FROM {table}
+                    WHERE {key} > ? AND {key} <= ? AND {condition} AND {column} LIKE '%/uploads/%'
+                ''', (low, low + SCAN_CHUNK)).fetchall()
+                for row in rows:
+                    referenced.update(name for name in previews.upload_filenames(row[0]) if name in names)
+                low += SCAN_CHUNK
+                self._sleep(0)
+        return referenced, watermarks
+
+    def _referenced_since(self, conn, filename, watermarks):
+        """扫描之后新写入的明文内容是否引用了文件名"""
+        needle = f'/uploads/{filename}'
+        for table, key, column, condition in self._sources(conn):
+            row = conn.execute(f'''
+                SELECT 1 FROM {table}
+                WHERE {key} > ? AND {condition} AND instr({column}, ?) > 0
+                LIMIT 1
+            ''', (watermarks.get(table, 0), needle)).fetchone()
+            if row:
+                return True
+        return False
+
+    def _maybe_encrypted_reference(self, conn, alias):
+        """
+        没有登记到 files 表的文件名可能只被加密内容引用（服务器不可读）：
+        上传者在上传之后发送过加密消息或私信时保留；上传者未知（迁移导入）时只要有加密内容就保留
+        """
+        if conn.execute('SELECT 1 FROM files WHERE filename = ? LIMIT 1', (alias['filename'],)).fetchone():
+            return False
+        if alias['user_id'] is None:
+            return conn.execute('''
+                SELECT EXISTS (SELECT 1 FROM messages WHERE is_encrypted = 1)
+                    OR EXISTS (SELECT 1 FROM direct_messages WHERE encrypted_content IS NOT NULL)
+            ''').fetchone()[0] == 1
+        return conn.execute('''
+            SELECT EXISTS (SELECT 1 FROM messages
+                           WHERE user_id = ? AND is_encrypted = 1 AND created_at >= ?)
+                OR EXISTS (SELECT 1 FROM direct_messages
+                           WHERE sender_id = ? AND encrypted_content IS NOT NULL AND created_at >= ?)
+        ''', (alias['user_id'], alias['created_at'], alias['user_id'], alias['created_at'])).fetchone()[0] == 1
+
+    # ---- 2. 隔离 ----
+
+    def _quarantine_blobs(self, conn, root, quarantine_root, result, dry_run):
+        """把引用计数为0超过宽限期的内容移入隔离目录"""
+        rows = conn.execute('''
+            SELECT sha256, storage_path, size FROM upload_blobs
+            WHERE ref_count = 0 AND last_referenced_at < datetime('now', ?) AND quarantined_at IS NULL
+            ORDER BY last_referenced_at LIMIT ?
+        ''', (_ago(self.grace_period), self.batch_size)).fetchall()
+        for row in rows:
+            if dry_run:
+                current_app.logger.info(f"[dry-run] 将隔离未被引用的内容 {row['sha256']} ({row['size']} 字节)")
+                result['blobs_quarantined'] += 1
+                continue
+            # 条件更新取得写锁，持有到文件移动完成后提交：并发上传要么在此之前已增加引用计数，
+            # 要么在提交之后看到文件已不在原位置并重新写入
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                cursor = conn.execute('''
+                    UPDATE upload_blobs SET quarantined_at = CURRENT_TIMESTAMP
+                    WHERE sha256 = ? AND ref_count = 0 AND quarantined_at IS NULL
+                      AND last_referenced_at < datetime('now', ?)
+                ''', (row['sha256'], _ago(self.grace_period)))
+                if cursor.rowcount:
+                    path = blob_store.absolute_path(root, row['storage_path'])
+                    if os.path.isfile(path):
+                        _move(path, blob_store.quarantine_path(quarantine_root, row['sha256']))
+                    result['blobs_quarantined'] += 1
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            self._sleep(0)
+
+    # ---- 3. 删除 ----
+
+    def _purge_quarantine(self, conn, root, quarantine_root, result, dry_run):
+        """删除隔离期已满的内容及其缩略图"""
+        rows = conn.execute('''
+            SELECT sha256, size FROM upload_blobs
+            WHERE quarantined_at IS NOT NULL AND quarantined_at < datetime('now', ?) AND ref_count = 0
+            ORDER BY quarantined_at LIMIT ?
+        ''', (_ago(self.quarantine_period), self.batch_size)).fetchall()
+        for row in rows:
+            sha256 = row['sha256']
+            if dry_run:
+                current_app.logger.info(f"[dry-run] 将删除隔离的内容 {sha256} ({row['size']} 字节)")
+                result['blobs_purged'] += 1
+                result['bytes_reclaimed'] += row['size']
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                preview = conn.execute('SELECT thumbnail_path, preview_path FROM upload_previews WHERE sha256 = ?',
+                                       (sha256,)).fetchone()
+                cursor = conn.execute('''
+                    DELETE FROM upload_blobs
+                    WHERE sha256 = ? AND ref_count = 0 AND quarantined_at IS NOT NULL
+                      AND quarantined_at < datetime('now', ?)
+                ''', (sha256, _ago(self.quarantine_period)))
+                purged = cursor.rowcount > 0
+                if purged:
+                    conn.execute('DELETE FROM upload_previews WHERE sha256 = ?', (sha256,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            if not purged:
+                continue
+            # 提交之后再删除文件：删除中断时留下的文件由扫描阶段处理
+            result['blobs_purged'] += 1
+            result['bytes_reclaimed'] += _remove(blob_store.quarantine_path(quarantine_root, sha256))
+            if preview:
+                for relative_path in (preview['thumbnail_path'], preview['preview_path']):
+                    if relative_path and _remove(blob_store.absolute_path(root, relative_path)):
+                        result['previews_removed'] += 1
+            self._sleep(0)
+
+    # ---- 4. 扫描 ----
+
+    def _scan_store(self, conn, root, quarantine_root, result, dry_run):
+        """继续上一轮的位置扫描一批目录，整个上传目录扫描完后从头开始"""
+        if not self._pending_dirs:
+            self._pending_dirs.extend(('blobs', path) for path in _leaf_dirs(os.path.join(root, blob_store.BLOB_DIR)))
+            self._pending_dirs.extend(('previews', path) for path in _leaf_dirs(os.path.join(root, 'previews')))
+            self._pending_dirs.extend(('quarantine', path) for path in _leaf_dirs(quarantine_root))
+            self._dirs_total = len(self._pending_dirs)
+            if not self._pending_dirs:
+                self.cycles += 1
+                return
+
+        grace_cutoff = time.time() - self.grace_period
+        quarantine_cutoff = time.time() - self.quarantine_period
+        scanned = 0
+        while self._pending_dirs and scanned < self.batch_size:
+            kind, directory = self._pending_dirs.popleft()
+            try:
+                with os.scandir(directory) as iterator:
+                    entries = [entry for entry in iterator if entry.is_file()]
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                scanned += 1
+                if kind == 'blobs':
+                    self._check_blob_file(conn, entry, quarantine_root, grace_cutoff, result, dry_run)
+                elif kind == 'previews':
+                    self._check_preview_file(conn, entry, grace_cutoff, result, dry_run)
+                else:
+                    self._check_quarantined_file(conn, entry, root, quarantine_cutoff, result, dry_run)
+            self._sleep(0)
+        result['files_scanned'] += scanned
+        if not self._pending_dirs:
+            self.cycles += 1
+
+    def _check_blob_file(self, conn, entry, quarantine_root, cutoff, result, dry_run):
+        """没有数据库记录且超过宽限期的内容文件移入隔离目录"""
+        sha256 = entry.name
+        if not _SHA256.match(sha256) or entry.stat().st_mtime > cutoff:
+            return
+        if conn.execute('SELECT 1 FROM upload_blobs WHERE sha256 = ?', (sha256,)).fetchone():
+            return
+        if dry_run:
+            current_app.logger.info(f"[dry-run] 将隔离没有记录的文件 {entry.path}")
+            result['untracked_quarantined'] += 1
+            return
+        # store() 先写记录再放置文件，持有写锁时仍没有记录说明没有进行中的上传
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if not conn.execute('SELECT 1 FROM upload_blobs WHERE sha256 = ?', (sha256,)).fetchone():
+                _move(entry.path, blob_store.quarantine_path(quarantine_root, sha256))
+                result['untracked_quarantined'] += 1
+            conn.commit()
+        except FileNotFoundError:
+            conn.rollback()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _check_preview_file(self, conn, entry, cutoff, result, dry_run):
+        """删除内容已不存在的缩略图（缩略图可以重新生成，不经过隔离）"""
+        match = _PREVIEW_FILE.match(entry.name)
+        if not match or entry.stat().st_mtime > cutoff:
+            return
+        if conn.execute('SELECT 1 FROM upload_previews WHERE sha256 = ?', (match.group(1),)).fetchone():
+            return
+        if dry_run:
+            current_app.logger.info(f"[dry-run] 将删除没有记录的缩略图 {entry.path}")
+            result['previews_removed'] += 1
+            return
+        if _remove(entry.path):
+            result['previews_removed'] += 1
+
+    def _check_quarantined_file(self, conn, entry, root, cutoff, result, dry_run):
+        """
+        隔离目录中的文件：
+        - 内容已重新上传（quarantined_at 已清空）：原位置有文件时删除副本，否则移回
+        - 没有数据库记录：隔离期满后删除
+        - 仍在隔离中：由删除阶段处理
+        """
+        sha256 = entry.name
+        if not _SHA256.match(sha256):
+            return
+        row = conn.execute('SELECT storage_path, quarantined_at FROM upload_blobs WHERE sha256 = ?',
+                           (sha256,)).fetchone()
+        if row is not None and row['quarantined_at'] is not None:
+            return
+        if row is None and entry.stat().st_mtime > cutoff:
+            return
+        if dry_run:
+            current_app.logger.info(f"[dry-run] 将处理隔离目录中的文件 {entry.path}")
+            result['blobs_rescued' if row is not None else 'untracked_removed'] += 1
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT storage_path, quarantined_at FROM upload_blobs WHERE sha256 = ?',
+                               (sha256,)).fetchone()
+            if row is None:
+                result['untracked_removed'] += 1
+                result['bytes_reclaimed'] += _remove(entry.path)
+            elif row['quarantined_at'] is None:
+                path = blob_store.absolute_path(root, row['storage_path'])
+                if os.path.isfile(path):
+                    _remove(entry.path)
+                else:
+                    _move(entry.path, path)
+                result['blobs_rescued'] += 1
+            conn.commit()
+        except FileNotFoundError:
+            conn.rollback()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def stats(self):
+        return {
+            'phase': self.phase,
+            'dry_run': self.dry_run,
+            'passes': self.passes,
+            'cycles': self.cycles,
+            'scan': {
+                'dirs_total': self._dirs_total,
+                'dirs_done': self._dirs_total - len(self._pending_dirs),
+                'alias_cursor': self._alias_cursor
+            },
+            **self.totals,
+            'last_pass': self.last_pass,
+            'last_pass_at': self.last_pass_at,
+            'last_pass_ms': self.last_pass_ms
+        }
+
+
+# 进程级上传文件回收任务
+upload_collector = UploadCollector()
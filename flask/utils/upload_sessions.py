@@ -0,0 +1,377 @@
+"""
+分片续传上传模块
+大文件按分片上传，每个分片直接从请求流写入临时文件，不经过Werkzeug的表单解析和内存/临时文件缓冲：
+
+1. create_session() 创建上传会话，记录文件名、总大小和可选的整体SHA-256
+2. write_chunk() 只接受从当前已接收位置开始的分片，边读边写并计算分片校验；
+   校验失败或连接中断时截断回分片开始的位置，客户端从 received_size 重新发送即可
+3. finalize() 校验大小（和整体校验值）后把临时文件存入内容存储（blob_store），相同内容不重复保存
+4. UploadJanitor 后台清理过期未完成的会话和临时文件
+
+会话状态保存在 upload_sessions 表中，进程重启或请求落到其他worker都可以继续上传。
+同一会话的分片在进程内用锁串行，跨进程时写入期间对临时文件加非阻塞的 flock，
+已接收位置用条件更新前进，同时写同一位置的请求只有一个成功，其余返回409和当前位置
+"""
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+from flask import current_app
+
+try:
+    import fcntl
+except ImportError:  # 非POSIX平台：只依赖已接收位置的条件更新
+    fcntl = None
+
+from utils import blob_store
+from utils.db import get_db_connection
+
+# 从请求流读取的块大小
+READ_SIZE = 64 * 1024
+
+# 每个上传会话一把锁，同一会话的分片串行写入
+_session_locks = {}
+_session_locks_guard = threading.Lock()
+
+
+class UploadError(Exception):
+    """上传协议错误，status为返回给客户端的HTTP状态码"""
+
+    def __init__(self, message, status=400, **extra):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.extra = extra
+
+
+def _session_lock(upload_id):
+    with _session_locks_guard:
+        lock = _session_locks.get(upload_id)
+        if lock is None:
+            lock = _session_locks[upload_id] = threading.Lock()
+        return lock
+
+
+def _forget_lock(upload_id):
+    with _session_locks_guard:
+        _session_locks.pop(upload_id, None)
+
+
+def tmp_folder():
+    folder = current_app.config['UPLOAD_TMP_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def part_path(upload_id):
+    return os.path.join(tmp_folder(), f'{upload_id}.part')
+
+
+def create_session(conn, user_id, filename, total_size, checksum=None, chunk_size=None):
+    """
+    创建上传会话（会提交事务）
+
+    参数:
+        conn: 数据库连接
+        user_id: 上传者
+        filename: 原始文件名
+        total_size: 文件总字节数
+        checksum: 可选，整个文件的SHA-256（十六进制）
+        chunk_size: 客户端期望的分片大小，超出上限时按上限处理
+
+    返回:
+        sqlite3.Row: 会话记录
+    """
+    max_size = current_app.config['UPLOAD_MAX_FILE_SIZE']
+    if not isinstance(total_size, int) or total_size <= 0:
+        raise UploadError('Invalid file size')
+    if total_size > max_size:
+        raise UploadError(f'File exceeds the maximum size of {max_size} bytes', 413)
+
+    max_chunk = current_app.config['UPLOAD_CHUNK_SIZE']
+    chunk_size = min(int(chunk_size or max_chunk), max_chunk)
+    if chunk_size <= 0:
+        raise UploadError('Invalid chunk size')
+
+    active = conn.execute('''
+        SELECT COUNT(*) FROM upload_sessions WHERE user_id = ? AND status = 'uploading'
+    ''', (user_id,)).fetchone()[0]
+    if active >= current_app.config['UPLOAD_MAX_ACTIVE_SESSIONS']:
+        raise UploadError('Too many unfinished uploads', 429)
+
+    upload_id = uuid.uuid4().hex
+    # 先创建空的临时文件，之后的分片都以追加方式写入
+    open(part_path(upload_id), 'wb').close()
+    conn.execute('''
+        INSERT INTO upload_sessions
+        (upload_id, user_id, filename, total_size, chunk_size, checksum, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?, datetime('now', ?))
+    ''', (upload_id, user_id, filename, total_size, chunk_size,
+          checksum.lower() if checksum else None,
+          f"+{int(current_app.config['UPLOAD_SESSION_TTL'])} seconds"))
+    conn.commit()
+    return get_session(conn, upload_id, user_id)
+
+
+def get_session(conn, upload_id, user_id):
+    """获取当前用户的上传会话，不存在时抛出UploadError"""
+    session = conn.execute('''
+        SELECT * FROM upload_sessions WHERE upload_id = ? AND user_id = ?
+    ''', (upload_id, user_id)).fetchone()
+    if not session:
+        raise UploadError('Upload not found', 404)
+    return session
+
+
+def session_info(session):
+    """返回给客户端的会话状态"""
+    return {
+        'upload_id': session['upload_id'],
+        'filename': session['filename'],
+        'size': session['total_size'],
+        'offset': session['received_size'],
+        'chunk_size': session['chunk_size'],
+        'status': session['status'],
+        'expires_at': session['expires_at']
+    }
+
+
+def write_chunk(conn, upload_id, user_id, offset, length, stream, chunk_checksum=None):
+    """
+    从请求流写入一个分片（会提交事务）
+
+    参数:
+        conn: 数据库连接
+        upload_id: 会话ID
+        user_id: 上传者
+        offset: 分片在文件中的起始位置，必须等于已接收的字节数
+        length: 分片字节数（Content-Length）
+        stream: 请求体流
+        chunk_checksum: 可选，分片的SHA-256（十六进制）
+
+    返回:
+        sqlite3.Row: 更新后的会话记录
+    """
+    with _session_lock(upload_id):
+        session = get_session(conn, upload_id, user_id)
+        if session['status'] != 'uploading':
+            raise UploadError('Upload is already finished', 409)
+        received = session['received_size']
+        if offset != received:
+            raise UploadError('Offset does not match the received size', 409, offset=received)
+        if length is None or length <= 0 or length > session['chunk_size']:
+            raise UploadError(f"Chunk size must be between 1 and {session['chunk_size']} bytes")
+        if received + length > session['total_size']:
+            raise UploadError('Chunk exceeds the declared file size')
+
+        digest = hashlib.sha256()
+        written = 0
+        path = part_path(upload_id)
+        with open(path, 'r+b') as f:
+            if fcntl is not None:
+                # 其他worker正在写这个会话时不等待（gevent下阻塞的flock会卡住整个进程）
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise UploadError('Another chunk is being written', 409, offset=received)
+                # 拿到锁之前其他worker可能已经写完了这个位置
+                received = get_session(conn, upload_id, user_id)['received_size']
+                if offset != received:
+                    raise UploadError('Offset does not match the received size', 409, offset=received)
+            # 丢弃上次中断留下的不完整分片
+            f.truncate(received)
+            f.seek(received)
+            try:
+                while written < length:
+                    data = stream.read(min(READ_SIZE, length - written))
+                    if not data:
+                        break
+                    f.write(data)
+                    digest.update(data)
+                    written += len(data)
+            except Exception:
+                f.truncate(received)
+                raise
+            if written != length:
+                f.truncate(received)
+                raise UploadError('Chunk was truncated', 400, offset=received)
+            if chunk_checksum and digest.hexdigest() != chunk_checksum.lower():
+                f.truncate(received)
+                raise UploadError('Chunk checksum mismatch', 422, offset=received)
+
+            # 已接收位置没有被其他请求改变时才前进
+            updated = conn.execute('''
+                UPDATE upload_sessions
+                SET received_size = ?, updated_at = CURRENT_TIMESTAMP, expires_at = datetime('now', ?)
+                WHERE upload_id = ? AND received_size = ?
+            ''', (received + written, f"+{int(current_app.config['UPLOAD_SESSION_TTL'])} seconds",
+                  upload_id, received)).rowcount
+            conn.commit()
+            if not updated:
+                # 另一个请求已经前进了位置，只去掉超出它的部分
+                current = get_session(conn, upload_id, user_id)['received_size']
+                if current < received + written:
+                    f.truncate(current)
+                raise UploadError('Offset does not match the received size', 409, offset=current)
+        upload_janitor.chunks_written += 1
+        upload_janitor.bytes_written += written
+        return get_session(conn, upload_id, user_id)
+
+
+def file_sha256(path):
+    """分块计算文件的SHA-256，每块之间让出CPU"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            digest.update(data)
+            time.sleep(0)
+    return digest.hexdigest()
+
+
+def finalize(conn, upload_id, user_id, filename):
+    """
+    完成上传，把临时文件存入内容存储并登记为 filename（会提交事务）
+
+    返回:
+        dict: blob_store.store() 的结果
+    """
+    with _session_lock(upload_id):
+        session = get_session(conn, upload_id, user_id)
+        if session['status'] != 'uploading':
+            raise UploadError('Upload is already finished', 409)
+        if session['received_size'] != session['total_size']:
+            raise UploadError('Upload is incomplete', 409, offset=session['received_size'])
+
+        path = part_path(upload_id)
+        sha256 = file_sha256(path)
+        if session['checksum'] and sha256 != session['checksum']:
+            raise UploadError('File checksum mismatch', 422)
+
+        conn.execute('''
+            UPDATE upload_sessions SET status = 'completed', updated_at = CURRENT_TIMESTAMP
+            WHERE upload_id = ?
+        ''', (upload_id,))
+        blob = blob_store.save(conn, current_app.config['UPLOAD_FOLDER'], path, sha256,
+                               session['total_size'], filename, session['filename'], user_id)
+    _forget_lock(upload_id)
+    upload_janitor.completed += 1
+    return blob
+
+
+def abort(conn, upload_id, user_id):
+    """取消上传并删除临时文件（会提交事务）"""
+    with _session_lock(upload_id):
+        get_session(conn, upload_id, user_id)
+        conn.execute('DELETE FROM upload_sessions WHERE upload_id = ?', (upload_id,))
+        conn.commit()
+        _remove_part(upload_id)
+    _forget_lock(upload_id)
+
+
+def _remove_part(upload_id):
+    try:
+        os.remove(part_path(upload_id))
+    except FileNotFoundError:
+        pass
+
+
+class UploadJanitor:
+    """
+    后台清理过期的上传会话
+
+    参数:
+        interval: 两轮清理之间的间隔（秒）
+        batch_size: 每轮最多清理的会话数
+    """
+
+    def __init__(self, interval=600.0, batch_size=100):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._app = None
+        self._socketio = None
+        self._started = False
+        self.expired = 0
+        self.completed = 0
+        self.chunks_written = 0
+        self.bytes_written = 0
+        self.last_pass_at = None
+
+    def init_app(self, app, socketio):
+        self._app = app
+        self._socketio = socketio
+        self.interval = app.config.get('UPLOAD_CLEANUP_INTERVAL', self.interval)
+
+    def start(self):
+        if self._started or self._socketio is None:
+            return
+        self._started = True
+        self._socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            self._socketio.sleep(self.interval)
+            with self._app.app_context():
+                try:
+                    self.cleanup_once()
+                except Exception as e:
+                    current_app.logger.error(f"清理过期上传会话失败: {str(e)}", exc_info=True)
+
+    def cleanup_once(self):
+        """删除过期未完成的会话和已完成会话的记录，需要应用上下文
+
+        返回:
+            int: 删除的会话数
+        """
+        conn = get_db_connection()
+        try:
+            rows = conn.execute('''
+                SELECT upload_id, status FROM upload_sessions
+                WHERE expires_at < datetime('now')
+                ORDER BY expires_at LIMIT ?
+            ''', (self.batch_size,)).fetchall()
+            for row in rows:
+                with _session_lock(row['upload_id']):
+                    conn.execute('DELETE FROM upload_sessions WHERE upload_id = ?', (row['upload_id'],))
+                    conn.commit()
+                    if row['status'] == 'uploading':
+                        _remove_part(row['upload_id'])
+                        self.expired += 1
+                _forget_lock(row['upload_id'])
+            self._remove_stale_parts(conn)
+        finally:
+            conn.close()
+        self.last_pass_at = time.time()
+        return len(rows)
+
+    def _remove_stale_parts(self, conn):
+        """删除没有会话记录的临时文件（例如创建会话时进程退出）"""
+        cutoff = time.time() - current_app.config['UPLOAD_SESSION_TTL']
+        with os.scandir(tmp_folder()) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.part') or entry.stat().st_mtime > cutoff:
+                    continue
+                upload_id = entry.name[:-len('.part')]
+                exists = conn.execute('SELECT 1 FROM upload_sessions WHERE upload_id = ?',
+                                      (upload_id,)).fetchone()
+                if not exists:
+                    _remove_part(upload_id)
+                    self.expired += 1
+
+    def stats(self):
+        return {
+            'active_locks': len(_session_locks),
+            'chunks_written': self.chunks_written,
+            'bytes_written': self.bytes_written,
+            'completed': self.completed,
+            'expired': self.expired,
+            'last_pass_at': self.last_pass_at
+        }
+
+
+# 进程级上传会话清理任务
+upload_janitor = UploadJanitor()
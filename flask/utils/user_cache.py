@@ -0,0 +1,133 @@
+"""
+用户缓存模块
+为 Flask-Login 的 user_loader 提供按 user_id 的 TTL + LRU 缓存
+
+缓存中保存的是只读(frozen)的 User 对象，可以在请求和Socket事件之间安全共享。
+公钥、头像或密码变更后必须调用 invalidate_user(user_id)。
+
+每个用户还有一个版本号，资料或角色变化时递增，
+Socket会话记录据此判断是否需要重新加载用户（见 socket_events.get_socket_session）。
+缓存是进程级的，多worker部署时其他进程最多在 TTL 时间内读到旧数据。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """
+    TTL + LRU 用户缓存
+
+    参数:
+        maxsize: 最大缓存用户数，超出后淘汰最久未使用的条目
+        ttl: 条目有效期（秒）
+    """
+
+    def __init__(self, maxsize=2048, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # user_id -> (expires_at, user)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def configure(self, maxsize=None, ttl=None):
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if ttl is not None:
+            self.ttl = ttl
+
+    def get(self, user_id):
+        """获取缓存的用户，未命中或已过期时返回None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= now:
+                del self._data[user_id]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, user_id, user):
+        """写入缓存"""
+        with self._lock:
+            self._data[user_id] = (time.monotonic() + self.ttl, user)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        """删除指定用户的缓存"""
+        with self._lock:
+            if self._data.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """返回缓存命中统计"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expirations': self.expirations,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+# 进程级用户缓存
+user_cache = UserCache()
+
+# 用户版本号 user_id -> int
+_user_versions = {}
+
+
+def get_user_version(user_id):
+    """获取用户当前版本号"""
+    return _user_versions.get(user_id, 0)
+
+
+def bump_user_version(user_id):
+    """
+    递增用户版本号（角色或成员关系变化时调用），已绑定的Socket会话会在下一个事件时重新验证
+
+    参数:
+        user_id: 用户ID（整数或字符串）
+    """
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return
+    _user_versions[user_id] = _user_versions.get(user_id, 0) + 1
+
+
+def invalidate_user(user_id):
+    """
+    用户资料（公钥、头像、密码等）变更后使缓存失效
+
+    参数:
+        user_id: 用户ID（整数或字符串）
+    """
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return
+    user_cache.invalidate(user_id)
+    bump_user_version(user_id)